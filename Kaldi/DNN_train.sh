@@ -50,11 +50,13 @@ echo ===========================================================================
 
 mfccdir=mfcc
 
+# utils/data/validate_data_dir.py reads each file of the data directory once;
+# the shell scripts are used if it fails.
 for x in train test; do 
-        utils/fix_data_dir.sh data/$x;
+        utils/data/validate_data_dir.py --fix=true data/$x || utils/fix_data_dir.sh data/$x;
 	steps/make_mfcc.sh --cmd "$train_cmd" --nj "$feat_nj" data/$x $exp/make_mfcc/$x $mfccdir || exit 1;
  	steps/compute_cmvn_stats.sh data/$x $exp/make_mfcc/$x $mfccdir || exit 1;
-	utils/validate_data_dir.sh data/$x;
+	utils/data/validate_data_dir.py data/$x || utils/validate_data_dir.sh data/$x;
 done
 fi
 
@@ -12,6 +12,10 @@ import errno
 import copy
 import shutil
 import warnings
+import heapq
+
+sys.path.insert(0, 'steps')
+import libs.data_dir as data_dir_lib
 
 def GetArgs():
     # we add compulsary arguments as named arguments for readability
@@ -61,47 +65,20 @@ def CheckFiles(input_data_dir):
         if not os.path.exists(file_name):
             raise Exception("There is no such file {0}".format(file_name))
 
-def ParseFileToDict(file, assert2fields = False, value_processor = None):
-    if value_processor is None:
-        value_processor = lambda x: x[0]
-
-    dict = {}
-    for line in open(file, 'r'):
-        parts = line.split()
-        if assert2fields:
-            assert(len(parts) == 2)
-
-        dict[parts[0]] = value_processor(parts[1:])
-    return dict
-
-def WriteDictToFile(dict, file_name):
-    file = open(file_name, 'w')
-    keys = dict.keys()
-    keys.sort()
-    for key in keys:
-        value = dict[key]
-        if type(value) in [list, tuple] :
-            if type(value) is tuple:
-                value = list(value)
-            value.sort()
-            value = ' '.join(value)
-        file.write('{0}\t{1}\n'.format(key, value))
-    file.close()
-
-
 def ParseDataDirInfo(data_dir):
-    data_dir_file = lambda file_name: '{0}/{1}'.format(data_dir, file_name)
-
-    utt2spk = ParseFileToDict(data_dir_file('utt2spk'))
-    spk2utt = ParseFileToDict(data_dir_file('spk2utt'), value_processor = lambda x: x)
-    text = ParseFileToDict(data_dir_file('text'), value_processor = lambda x: " ".join(x))
-    # we want to assert feats.scp has just 2 fields, as we don't know how
-    # to process it otherwise
-    feat = ParseFileToDict(data_dir_file('feats.scp'), assert2fields = True)
-    utt2dur = ParseFileToDict(data_dir_file('utt2dur'), value_processor = lambda x: float(x[0]))
+    data = data_dir_lib.DataDir(data_dir)
+
+    utt2spk = data['utt2spk'].to_dict()
+    spk2utt = data['spk2utt'].to_dict(value_processor = lambda x: x)
+    utt2dur = data['utt2dur'].to_dict(value_processor = lambda x: float(x[0]))
+    # text, feats.scp and utt2uniq are not read here: only the entries of the
+    # utterances that are combined are looked up (in the index of the file),
+    # and the others are copied when the output files are written.
+    text = data['text']
+    feat = data['feats.scp']
     utt2uniq = None
-    if os.path.exists(data_dir_file('utt2uniq')):
-        utt2uniq = ParseFileToDict(data_dir_file('utt2uniq'))
+    if data.has('utt2uniq'):
+        utt2uniq = data['utt2uniq']
     return utt2spk, spk2utt, text, feat, utt2dur, utt2uniq
 
 
@@ -172,8 +149,31 @@ def GetCombinedUttIndexRange(utt_index, utts, utt_durs, minimum_duration):
     return left_index, right_index, cur_utt_dur
 
 
+# This function returns the entries of the table (a TableFile) with the
+# entries of the utterances in 'combined_utts' (a dict from the new utterance
+# to the sorted list of the utterances combined in it) replaced by those of the
+# new utterances; their values are combine_values(list-of-values).  The entries
+# are sorted, as the table is read in sorted order and merged with the sorted
+# new entries.
+def CombineTableEntries(table, combined_utts, removed_utts, combine_values,
+                        value_processor = lambda x: x):
+    new_entries = sorted([ (new_utt, combine_values([ table[utt] for utt in utts ]))
+                           for new_utt, utts in combined_utts.items() ])
+    old_entries = ((utt, value_processor(value)) for utt, value in table.items()
+                   if utt not in removed_utts)
+    return heapq.merge(old_entries, new_entries)
+
+
+def CheckFeatValue(value):
+    # we want to assert feats.scp has just 2 fields, as we don't know how
+    # to process it otherwise
+    if len(value.split()) != 1:
+        raise Exception("Bad line in feats.scp (expected 2 fields): {0}".format(value))
+    return value
+
+
 def WriteCombinedDirFiles(output_dir, utt2spk, spk2utt, text, feat, utt2dur, utt2uniq):
-    out_dir_file = lambda file_name: '{0}/{1}'.format(output_dir, file_name)
+    out_data = data_dir_lib.DataDir(output_dir)
     total_combined_utt_list = []
     for speaker in spk2utt.keys():
         utts = spk2utt[speaker]
@@ -182,10 +182,16 @@ def WriteCombinedDirFiles(output_dir, utt2spk, spk2utt, text, feat, utt2dur, utt
                 #this is a combined utt
                 total_combined_utt_list.append((speaker, utt))
 
+    # a dict from the name of each combined utterance to the sorted list of
+    # the utterances that it combines.
+    combined_utts = {}
+    removed_utts = set()
     for speaker, combined_utt_tuple in total_combined_utt_list:
         combined_utt_list = list(combined_utt_tuple)
         combined_utt_list.sort()
         new_utt_name = "-".join(combined_utt_list)+'-appended'
+        combined_utts[new_utt_name] = combined_utt_list
+        removed_utts.update(combined_utt_list)
 
         # updating the utt2spk dict
         for utt in combined_utt_list:
@@ -196,47 +202,39 @@ def WriteCombinedDirFiles(output_dir, utt2spk, spk2utt, text, feat, utt2dur, utt
         spk2utt[speaker].remove(combined_utt_tuple)
         spk2utt[speaker].append(new_utt_name)
 
-        # updating the text dict
-        combined_text = []
-        for utt in combined_utt_list:
-            combined_text.append(text.pop(utt))
-        text[new_utt_name] = ' '.join(combined_text)
-
-        # updating the feat dict
-        combined_feat = []
-        for utt in combined_utt_list:
-            combined_feat.append(feat.pop(utt))
-        feat_command = "concat-feats --print-args=false {feats} - |".format(feats = " ".join(combined_feat))
-        feat[new_utt_name] = feat_command
-
         # updating utt2dur
         combined_dur = 0
         for utt in combined_utt_list:
             combined_dur += utt2dur.pop(utt)
         utt2dur[new_utt_name] = combined_dur
 
-        # updating utt2uniq
-        if utt2uniq is not None:
-            combined_uniqs = []
-            for utt in combined_utt_list:
-                combined_uniqs.append(utt2uniq.pop(utt))
-            # utt2uniq file is used to map perturbed data to original unperturbed
-            # versions so that the training cross validation sets can avoid overlap
-            # of data however if perturbation changes the length of the utterance
-            # (e.g. speed perturbation) the utterance combinations in each
-            # perturbation of the original recording can be very different. So there
-            # is no good way to find the utt2uniq mapping so that we can avoid
-            # overlap.
-            utt2uniq[new_utt_name] = combined_uniqs[0]
-
-
-    WriteDictToFile(utt2spk, out_dir_file('utt2spk'))
-    WriteDictToFile(spk2utt, out_dir_file('spk2utt'))
-    WriteDictToFile(feat, out_dir_file('feats.scp'))
-    WriteDictToFile(text, out_dir_file('text'))
+    out_data.write('utt2spk', utt2spk.items(), separator = '\t')
+    out_data.write('spk2utt', [ (speaker, sorted(utts)) for speaker, utts in spk2utt.items() ],
+                   separator = '\t')
+    out_data.write('feats.scp',
+                   CombineTableEntries(feat, combined_utts, removed_utts,
+                                       lambda feats: "concat-feats --print-args=false {feats} - |".format(
+                                           feats = " ".join(feats)),
+                                       value_processor = CheckFeatValue),
+                   is_sorted = True, separator = '\t')
+    out_data.write('text',
+                   CombineTableEntries(text, combined_utts, removed_utts,
+                                       lambda texts: ' '.join([ ' '.join(x.split()) for x in texts ]),
+                                       value_processor = lambda x: ' '.join(x.split())),
+                   is_sorted = True, separator = '\t')
     if utt2uniq is not None:
-        WriteDictToFile(utt2uniq, out_dir_file('utt2uniq'))
-    WriteDictToFile(utt2dur, out_dir_file('utt2dur'))
+        # utt2uniq file is used to map perturbed data to original unperturbed
+        # versions so that the training cross validation sets can avoid overlap
+        # of data however if perturbation changes the length of the utterance
+        # (e.g. speed perturbation) the utterance combinations in each
+        # perturbation of the original recording can be very different. So there
+        # is no good way to find the utt2uniq mapping so that we can avoid
+        # overlap.
+        out_data.write('utt2uniq',
+                       CombineTableEntries(utt2uniq, combined_utts, removed_utts,
+                                           lambda uniqs: uniqs[0]),
+                       is_sorted = True, separator = '\t')
+    out_data.write('utt2dur', utt2dur.items(), separator = '\t')
 
 
 def CombineSegments(input_dir, output_dir, minimum_duration):
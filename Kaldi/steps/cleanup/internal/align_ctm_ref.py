@@ -18,6 +18,13 @@ import sys
 
 sys.path.insert(0, 'steps')
 import libs.common as common_lib
+import libs.scoring as scoring_lib
+
+try:
+    import numpy as np
+    g_numpy = True
+except ImportError:
+    g_numpy = False
 
 logger = logging.getLogger(__name__)
 handler = logging.StreamHandler()
@@ -75,6 +82,20 @@ def get_args():
                         the end to get the alignment. This is different
                         from the normal Smith-Waterman alignment, where the
                         traceback will be from the maximum score.""")
+    parser.add_argument("--band-width", type=int, default=0,
+                        help="""If > 0, restrict the alignment to reference
+                        words within this many positions of the reference
+                        position expected from the CTM timing of each
+                        hypothesis word. This is only applicable for
+                        hyp-format=CTM, and is useful for aligning very
+                        long recordings. A value of 0 disables the band.""")
+    parser.add_argument("--use-numpy", type=str,
+                        action=common_lib.StrToBoolAction,
+                        choices=["true", "false"], default=True,
+                        help="""Use the vectorized NumPy implementation
+                        of the alignment, if NumPy is available.
+                        Otherwise, the pure-python implementation is
+                        used.""")
 
     parser.add_argument("--debug-only", type=str, default="false",
                         choices=["true", "false"],
@@ -103,6 +124,12 @@ def get_args():
             "--reco2file-and-channel must be provided for "
             "hyp-format=CTM")
 
+    if args.band_width < 0:
+        raise ValueError("--band-width must be >= 0")
+
+    if args.band_width > 0 and args.hyp_format != "CTM":
+        raise RuntimeError("--band-width > 0 requires hyp-format=CTM")
+
     args.debug_only = bool(args.debug_only == "true")
 
     global verbose_level
@@ -344,148 +371,231 @@ def smith_waterman_alignment(ref, hyp, similarity_score_function,
     return (output, max_score)
 
 
-def print_alignment(recording, alignment, out_file_handle):
-    out_text = [recording]
-    for line in alignment:
-        try:
-            out_text.append(line[1])
-        except Exception:
-            logger.error("Something wrong with alignment. "
-                         "Invalid line {0}".format(line))
-            raise
-    print (" ".join(out_text), file=out_file_handle)
+# Backpointer codes used by fast_smith_waterman_alignment()
+_BP_NONE = 0    # start of alignment; corresponds to (0, 0) in the above
+_BP_DIAG = 1    # substitution or correct
+_BP_UP = 2      # deletion
+_BP_LEFT = 3    # insertion
 
 
-def get_edit_type(hyp_word, ref_word, duration=-1, eps_symbol='<eps>',
-                  oov_word=None, symbol_table=None):
-    if hyp_word == ref_word and hyp_word != eps_symbol:
-        return 'cor'
-    if hyp_word != eps_symbol and ref_word == eps_symbol:
-        return 'ins'
-    if hyp_word == eps_symbol and ref_word != eps_symbol and duration == 0.0:
-        return 'del'
-    if (hyp_word == oov_word and symbol_table is not None
-            and len(symbol_table) > 0 and ref_word not in symbol_table):
-        return 'cor'    # this special case is treated as correct
-    if hyp_word == eps_symbol and ref_word == eps_symbol and duration > 0.0:
-        # silence in hypothesis; we don't match this up with any reference
-        # word.
-        return 'sil'
-    # The following assertion is because, based on how get_ctm_edits()
-    # works, we shouldn't hit this case.
-    assert hyp_word != eps_symbol and ref_word != eps_symbol
-    return 'sub'
-
-
-def get_ctm_edits(alignment_output, ctm_array, eps_symbol="<eps>",
-                  oov_word=None, symbol_table=None):
+def get_band_centers_from_ctm(ctm_lines, ref_len):
+    """Returns a list with the reference position (in the range
+    [0, ref_len]) that is expected to align with each hypothesis word in
+    ctm_lines, assuming that the reference words are spread uniformly in time
+    over the span of the CTM.
+    ctm_lines is a list of [ start, duration, hyp_word, confidence ], sorted
+    by start time, as returned by read_ctm().
     """
-    This function takes two lists
-        alignment_output = The output of smith_waterman_alignment() which is a
-            list of tuples (ref_word, hyp_word, ref_word_from_index,
-            hyp_word_from_index, ref_word_to_index, hyp_word_to_index)
-        ctm_array = [ [ start1, duration1, hyp_word1, confidence1 ], ... ]
-    and pads them with new list elements so that the entries 'match up'.
-
-    Returns CTM edits lines, which are CTM lines appended with reference word
-    and edit type.
-
-    What we are aiming for is that for each i, ctm_array[i][2] ==
-    alignment_output[i][1].  The reasons why this is not automatically true
-    are:
-
-     (1) There may be insertions in the hypothesis sequence that are not
-         aligned with any reference words in the beginning of the
-         alignment_output.
-     (2) There may be deletions in the end of the alignment_output that
-         do not correspond to any additional hypothesis CTM lines.
-
-    We introduce suitable entries in to alignment_output and ctm_array as
-    necessary to make them 'match up'.
+    if len(ctm_lines) == 0:
+        return []
+    begin_time = ctm_lines[0][0]
+    end_time = max(x[0] + x[1] for x in ctm_lines)
+    total_duration = max(end_time - begin_time, 1e-10)
+
+    centers = []
+    prev_center = 0
+    for start, duration in ((x[0], x[1]) for x in ctm_lines):
+        mid_time = start + 0.5 * duration
+        center = int(round(ref_len * (mid_time - begin_time)
+                           / total_duration))
+        # keep the centers monotonic so that the band is contiguous.
+        center = min(max(center, prev_center), ref_len)
+        centers.append(center)
+        prev_center = center
+    return centers
+
+
+def fast_smith_waterman_alignment(ref, hyp, correct_score, substitution_score,
+                                  del_score, ins_score,
+                                  eps_symbol="<eps>", align_full_hyp=True,
+                                  band_centers=None, band_width=0):
+    """A vectorized version of smith_waterman_alignment() for the common case
+    where the similarity score is correct_score for identical words and
+    substitution_score otherwise. It requires NumPy.
+
+    The words are mapped to integers and the score matrix is filled one
+    reference word (row) at a time: the substitution and deletion scores of
+    a row are computed with array operations on the previous row, and the
+    insertion scores, which form a dependency within the row, are resolved
+    with a running maximum. Only two rows of scores are kept in memory; the
+    backpointers are stored as int8 codes.
+
+    If band_centers (a list with the expected reference position of each
+    hypothesis word, e.g. from get_band_centers_from_ctm()) is given and
+    band_width > 0, then only the reference positions within band_width of
+    the expected position are considered for each hypothesis word.
+    This makes the alignment linear in the length of the hypothesis, at
+    the cost of possibly missing the best alignment if it falls outside the
+    band.
+
+    Without the band, the output is identical to that of
+    smith_waterman_alignment() with the equivalent similarity_score_function,
+    including the tie-breaking between alignments with equal scores.
     """
-    ctm_edits = []
-    ali_len = len(alignment_output)
-    ctm_len = len(ctm_array)
-    ali_pos = 0
-    ctm_pos = 0
+    output = []
 
-    # current_time is the end of the last ctm segment we processesed.
-    current_time = ctm_array[0][0] if ctm_len > 0 else 0.0
+    ref_len = len(ref)
+    hyp_len = len(hyp)
 
-    for (ref_word, hyp_word, ref_prev_i, hyp_prev_i,
-         ref_i, hyp_i) in alignment_output:
-        try:
-            ctm_pos = hyp_prev_i
-            # This is true because we cannot have errors at the end because
-            # that will decrease the smith-waterman alignment score.
-            assert ctm_pos < ctm_len
-            assert len(ctm_array[ctm_pos]) == 4
-
-            if hyp_prev_i == hyp_i:
-                assert hyp_word == eps_symbol
-                # These are deletions as there are no CTM entries
-                # corresponding to these alignments.
-                edit_type = get_edit_type(
-                    hyp_word=eps_symbol, ref_word=ref_word,
-                    duration=0.0, eps_symbol=eps_symbol,
-                    oov_word=oov_word, symbol_table=symbol_table)
-                ctm_line = [current_time, 0.0, eps_symbol, 1.0,
-                            ref_word, edit_type]
-                ctm_edits.append(ctm_line)
+    vocab = {}
+    ref_ids = np.array([vocab.setdefault(x, len(vocab)) for x in ref],
+                       dtype=np.int64)
+    hyp_ids = np.array([vocab.setdefault(x, len(vocab)) for x in hyp],
+                       dtype=np.int64)
+
+    # A score that is lower than any that can be reached in the alignment.
+    # It is used for cells outside the band.
+    min_score = -(abs(correct_score) + abs(substitution_score)
+                  + abs(del_score) + abs(ins_score) + 1) * (ref_len + hyp_len
+                                                            + 2)
+    # The initial score of a cell, which corresponds to a backpointer
+    # to the beginning of the alignment.
+    init_score = -(hyp_len + 2) if align_full_hyp else 0
+
+    use_band = band_centers is not None and band_width > 0
+    if use_band:
+        assert len(band_centers) == hyp_len
+        band_centers = np.array(band_centers, dtype=np.int64)
+
+    # This is the row 0 of the score matrix
+    prev_row = np.zeros(hyp_len + 1, dtype=np.int64)
+    if align_full_hyp:
+        prev_row += ins_score * np.arange(hyp_len + 1, dtype=np.int64)
+
+    # bp_rows[ref_index] is a tuple (begin, bp) where bp is an int8 array
+    # of backpointers for the hypothesis indexes [begin, begin + len(bp)).
+    bp_rows = [(1, np.zeros(0, dtype=np.int8))]
+
+    max_score = -float("inf")
+    max_score_element = (0, 0)
+
+    for ref_index in range(1, ref_len + 1):
+        if use_band:
+            begin = int(np.searchsorted(band_centers, ref_index - band_width,
+                                        side='left')) + 1
+            end = int(np.searchsorted(band_centers, ref_index + band_width,
+                                      side='right')) + 1
+        else:
+            begin, end = 1, hyp_len + 1
+        end = max(begin, end)
+        num_cells = end - begin
+
+        row = np.full(hyp_len + 1, min_score, dtype=np.int64)
+        row[0] = 0
+        bp = np.zeros(num_cells, dtype=np.int8)
+
+        if num_cells > 0:
+            sub_or_ok = (prev_row[begin-1:end-1]
+                         + np.where(hyp_ids[begin-1:end-1]
+                                    == ref_ids[ref_index-1],
+                                    correct_score, substitution_score))
+            if align_full_hyp:
+                take_diag = sub_or_ok >= init_score
             else:
-                assert hyp_i == hyp_prev_i + 1
-                assert hyp_word == ctm_array[ctm_pos][2]
-                # This is the normal case, where there are 2 entries where
-                # they hyp-words match up.
-                ctm_line = list(ctm_array[ctm_pos])
-                if hyp_word == eps_symbol and ref_word != eps_symbol:
-                    # This is a silence in hypothesis aligned with a reference
-                    # word. We split this into two ctm edit lines where the
-                    # first one is a deletion of duration 0 and the second
-                    # one is a silence of duration given by the ctm line.
-                    edit_type = get_edit_type(
-                        hyp_word=eps_symbol, ref_word=ref_word,
-                        duration=0.0, eps_symbol=eps_symbol,
-                        oov_word=oov_word, symbol_table=symbol_table)
-                    assert edit_type == 'del'
-                    ctm_edits.append([current_time, 0.0, eps_symbol, 1.0,
-                                      ref_word, edit_type])
-
-                    edit_type = get_edit_type(
-                        hyp_word=eps_symbol, ref_word=eps_symbol,
-                        duration=ctm_line[1], eps_symbol=eps_symbol,
-                        oov_word=oov_word, symbol_table=symbol_table)
-                    assert edit_type == 'sil'
-                    ctm_line.extend([eps_symbol, edit_type])
-                    ctm_edits.append(ctm_line)
-                else:
-                    edit_type = get_edit_type(
-                        hyp_word=hyp_word, ref_word=ref_word,
-                        duration=ctm_line[1], eps_symbol=eps_symbol,
-                        oov_word=oov_word, symbol_table=symbol_table)
-                    ctm_line.extend([ref_word, edit_type])
-                    ctm_edits.append(ctm_line)
-                current_time = (ctm_array[ctm_pos][0]
-                                + ctm_array[ctm_pos][1])
-        except Exception:
-            logger.error("Could not get ctm edits for "
-                         "edits@{edits_pos} = {0}, ctm@{ctm_pos} = {1}".format(
-                            ("NONE" if ali_pos >= ali_len
-                             else alignment_output[ali_pos]),
-                            ("NONE" if ctm_pos >= ctm_len
-                             else ctm_array[ctm_pos]),
-                            edits_pos=ali_pos, ctm_pos=ctm_pos))
-            logger.error("alignment = {0}".format(alignment_output))
-            raise
-    return ctm_edits
+                take_diag = sub_or_ok > init_score
+            scores = np.where(take_diag, sub_or_ok, init_score)
+            bp[take_diag] = _BP_DIAG
+
+            deletion = prev_row[begin:end] + del_score
+            take_up = deletion > scores
+            scores = np.where(take_up, deletion, scores)
+            bp[take_up] = _BP_UP
+
+            # Resolve the insertions using
+            # H[n] - n * ins = max(H'[n] - n * ins, H[n-1] - (n-1) * ins),
+            # where H' is the score before considering insertions.
+            offsets = ins_score * np.arange(1, num_cells + 1, dtype=np.int64)
+            running_max = np.maximum.accumulate(
+                np.concatenate(([row[begin-1]], scores - offsets)))
+            row[begin:end] = running_max[1:] + offsets
+            insertion = row[begin-1:end-1] + ins_score
+            bp[insertion > scores] = _BP_LEFT
+
+            if align_full_hyp:
+                if end == hyp_len + 1 and row[hyp_len] >= max_score:
+                    max_score = int(row[hyp_len])
+                    max_score_element = (ref_index, hyp_len)
+            else:
+                cells = row[begin:end]
+                # the last index of the maximum value
+                hyp_index = end - 1 - int(np.argmax(cells[::-1]))
+                if row[hyp_index] >= max_score:
+                    max_score = int(row[hyp_index])
+                    max_score_element = (ref_index, hyp_index)
+
+        bp_rows.append((begin, bp))
+        prev_row = row
+
+    def get_backpointer(ref_index, hyp_index):
+        if ref_index == 0:
+            return (_BP_LEFT if align_full_hyp and hyp_index > 0
+                    else _BP_NONE)
+        begin, bp = bp_rows[ref_index]
+        if hyp_index < begin or hyp_index >= begin + len(bp):
+            return _BP_NONE
+        return bp[hyp_index - begin]
+
+    ref_index, hyp_index = max_score_element
+    score = max_score
+    logger.debug("Alignment score: %s for (%d, %d)",
+                 score, ref_index, hyp_index)
 
+    # In the case of align_full_hyp == False, all the scores on the path
+    # are >= 0, so the traceback stops only on reaching (0, 0) or a
+    # beginning of the alignment, like in smith_waterman_alignment().
+    while ((not align_full_hyp and score >= 0)
+           or (align_full_hyp and hyp_index > 0)):
+        backpointer = get_backpointer(ref_index, hyp_index)
+        if backpointer == _BP_DIAG:
+            prev_ref_index, prev_hyp_index = ref_index - 1, hyp_index - 1
+        elif backpointer == _BP_UP:
+            prev_ref_index, prev_hyp_index = ref_index - 1, hyp_index
+        elif backpointer == _BP_LEFT:
+            prev_ref_index, prev_hyp_index = ref_index, hyp_index - 1
+        else:
+            prev_ref_index, prev_hyp_index = 0, 0
+
+        if (prev_ref_index, prev_hyp_index) == (0, 0):
+            ref_index, hyp_index = (prev_ref_index, prev_hyp_index)
+            score = 0
+            break
+
+        if backpointer == _BP_DIAG:
+            output.append((ref[ref_index-1], hyp[hyp_index-1],
+                           prev_ref_index, prev_hyp_index,
+                           ref_index, hyp_index))
+        elif backpointer == _BP_UP:
+            output.append((ref[ref_index-1], eps_symbol,
+                           prev_ref_index, prev_hyp_index,
+                           ref_index, hyp_index))
+        else:
+            output.append((eps_symbol, hyp[hyp_index-1],
+                           prev_ref_index, prev_hyp_index,
+                           ref_index, hyp_index))
+
+        ref_index, hyp_index = (prev_ref_index, prev_hyp_index)
+
+    assert (align_full_hyp or score == 0)
+
+    output.reverse()
+
+    logger.debug("Aligned output:")
+    logger.debug("  -  ".join(["({0},{1})".format(x[4], x[5])
+                               for x in output]))
+
+    return (output, max_score)
 
-def ctm_line_to_string(ctm_line):
-    if len(ctm_line) != 8:
-        raise RuntimeError("len(ctm_line) expected to be {0}. "
-                           "Invalid line {1}".format(8, ctm_line))
 
-    return " ".join([str(x) for x in ctm_line])
+def print_alignment(recording, alignment, out_file_handle):
+    out_text = [recording]
+    for line in alignment:
+        try:
+            out_text.append(line[1])
+        except Exception:
+            logger.error("Something wrong with alignment. "
+                         "Invalid line {0}".format(line))
+            raise
+    print (" ".join(out_text), file=out_file_handle)
 
 
 def test_alignment():
@@ -498,6 +608,27 @@ def test_alignment():
 
     print_alignment("Alignment", output, out_file_handle=sys.stderr)
 
+    if not g_numpy:
+        return
+
+    for align_full_hyp in [True, False]:
+        for ref, hyp in [("AGCACACA", "ACACACTA"), ("ABC", "XYZ"),
+                         ("AAAA", "AA"), ("A", "BAB"), ("AB", "A")]:
+            output, score = smith_waterman_alignment(
+                ref, hyp,
+                similarity_score_function=lambda x, y: 2 if (x == y) else -1,
+                del_score=-1, ins_score=-1, eps_symbol="-",
+                align_full_hyp=align_full_hyp)
+            fast_output, fast_score = fast_smith_waterman_alignment(
+                ref, hyp, correct_score=2, substitution_score=-1,
+                del_score=-1, ins_score=-1, eps_symbol="-",
+                align_full_hyp=align_full_hyp)
+            if output != fast_output or score != fast_score:
+                raise RuntimeError(
+                    "Mismatch in fast alignment of {0} and {1}: "
+                    "{2} ({3}) vs {4} ({5})".format(
+                        ref, hyp, output, score, fast_output, fast_score))
+
 
 def run(args):
     if args.debug_only:
@@ -561,21 +692,33 @@ def run(args):
 
             logger.debug("Running Smith-Waterman alignment for %s", reco)
 
-            output, score = smith_waterman_alignment(
-                ref_text, hyp_array, eps_symbol=args.eps_symbol,
-                similarity_score_function=similarity_score_function,
-                del_score=del_score, ins_score=ins_score,
-                align_full_hyp=args.align_full_hyp)
+            if g_numpy and args.use_numpy:
+                band_centers = None
+                if args.band_width > 0:
+                    band_centers = get_band_centers_from_ctm(
+                        hyp_lines[reco], len(ref_text))
+                output, score = fast_smith_waterman_alignment(
+                    ref_text, hyp_array, eps_symbol=args.eps_symbol,
+                    correct_score=args.correct_score,
+                    substitution_score=-args.substitution_penalty,
+                    del_score=del_score, ins_score=ins_score,
+                    align_full_hyp=args.align_full_hyp,
+                    band_centers=band_centers, band_width=args.band_width)
+            else:
+                output, score = smith_waterman_alignment(
+                    ref_text, hyp_array, eps_symbol=args.eps_symbol,
+                    similarity_score_function=similarity_score_function,
+                    del_score=del_score, ins_score=ins_score,
+                    align_full_hyp=args.align_full_hyp)
 
             if args.hyp_format == "CTM":
-                ctm_edits = get_ctm_edits(output, hyp_lines[reco],
-                                          eps_symbol=args.eps_symbol,
-                                          oov_word=args.oov_word,
-                                          symbol_table=symbol_table)
+                ctm_edits = scoring_lib.get_ctm_edits(
+                    output, hyp_lines[reco], eps_symbol=args.eps_symbol,
+                    oov_word=args.oov_word, symbol_table=symbol_table)
                 for line in ctm_edits:
                     ctm_line = list(reco2file_and_channel[reco])
                     ctm_line.extend(line)
-                    print(ctm_line_to_string(ctm_line),
+                    print(scoring_lib.ctm_line_to_string(ctm_line),
                           file=args.alignment_out_file)
             else:
                 print_alignment(
@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+
+# Apache 2.0.
+
+"""This script builds a binary TF-IDF index of the source documents, which
+can be memory-mapped by retrieve_similar_docs.py using the option
+--source-tfidf-index. This avoids parsing the source TF-IDF text files in
+every retrieval job. See retrieve_similar_docs.py for the terminology.
+
+e.g.: steps/cleanup/internal/build_tfidf_index.py \\
+        --source-text-id2doc-ids=exp/foo/docs/text2doc \\
+        --source-text-id2tfidf=exp/foo/docs/source2tf_idf.scp \\
+        exp/foo/docs/tf_idf_index
+"""
+
+from __future__ import print_function
+import argparse
+import logging
+import sys
+
+import tf_idf
+sys.path.insert(0, 'steps')
+
+logger = logging.getLogger('tf_idf')
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+handler.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s [%(filename)s:%(lineno)s - "
+                              "%(funcName)s - %(levelname)s ] %(message)s")
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+
+def _get_args():
+    parser = argparse.ArgumentParser(
+        description="""This script builds a binary TF-IDF index of the source
+        documents for use with retrieve_similar_docs.py
+        --source-tfidf-index.""")
+
+    parser.add_argument("--source-text-id2doc-ids",
+                        type=argparse.FileType('r'), required=True,
+                        help="""A mapping from the source text to a list of
+                        documents that it is broken into
+                        <text-utterance-id> <document-id-1> ...
+                        <document-id-N>""")
+    parser.add_argument("--source-text-id2tfidf", type=argparse.FileType('r'),
+                        required=True,
+                        help="""An SCP file for the TF-IDF for source
+                        documents indexed by the source-text-id.""")
+    parser.add_argument("index_dir", type=str,
+                        help="Output directory for the TF-IDF index")
+
+    args = parser.parse_args()
+
+    if not tf_idf.g_numpy:
+        raise RuntimeError("This script requires NumPy.")
+
+    return args
+
+
+def _run(args):
+    source_text_id2doc_ids = []
+    for line in args.source_text_id2doc_ids:
+        parts = line.strip().split()
+        if len(parts) < 2:
+            raise TypeError("Invalid line {0} in {1}".format(
+                line, args.source_text_id2doc_ids.name))
+        source_text_id2doc_ids.append((parts[0], parts[1:]))
+
+    source_text_id2tfidf = {}
+    for line in args.source_text_id2tfidf:
+        parts = line.strip().split()
+        if len(parts) != 2:
+            raise TypeError("Invalid line {0} in {1}".format(
+                line, args.source_text_id2tfidf.name))
+        source_text_id2tfidf[parts[0]] = parts[1]
+
+    # The source TF-IDF file for a group of source texts is usually the
+    # same. So we group the source texts by the file and read it only once.
+    file2source_texts = {}
+    files = []
+    for source_text_id, doc_ids in source_text_id2doc_ids:
+        file_name = source_text_id2tfidf[source_text_id]
+        if file_name not in file2source_texts:
+            files.append(file_name)
+        file2source_texts.setdefault(file_name, []).append(
+            (source_text_id, doc_ids))
+
+    index = tf_idf.TFIDFIndex()
+    for file_name in files:
+        source_tfidf = tf_idf.TFIDF()
+        with open(file_name) as f:
+            source_tfidf.read(f)
+        doc2values = source_tfidf.get_values_by_document()
+        for source_text_id, doc_ids in file2source_texts[file_name]:
+            index.add_documents(doc2values, doc_ids, source_id=source_text_id)
+    index.finalize()
+    index.write(args.index_dir)
+
+    logger.info("Built TF-IDF index with %d documents and %d terms from "
+                "%d source texts", index.num_docs(), len(index.term2id),
+                len(source_text_id2doc_ids))
+
+
+def main():
+    args = _get_args()
+
+    try:
+        _run(args)
+    finally:
+        args.source_text_id2doc_ids.close()
+        args.source_text_id2tfidf.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,9 @@ import argparse
 import math
 from collections import defaultdict
 
+sys.path.insert(0, 'steps')
+import libs.ngram_counts as ngram_counts_lib
+
 parser = argparse.ArgumentParser(description="""
 This script creates a biased language model suitable for alignment and
 data-cleanup purposes.   It reads (possibly multiple) lines of integerized text
@@ -39,11 +42,6 @@ parser.add_argument("--discounting-constant", type = float, default = 0.3,
 parser.add_argument("--verbose", type = int, default = 0,
                     choices=[0,1,2,3,4,5], help = "Verbose level")
 
-args = parser.parse_args()
-
-if args.verbose >= 1:
-    print(' '.join(sys.argv), file = sys.stderr)
-
 
 
 
@@ -52,14 +50,16 @@ class NgramCounts:
     ## Firstly, all words are represented as integers.
     ## We store n-gram counts as an array, indexed by (history-length == n-gram order minus one)
     ## (note: python calls arrays "lists")  of dicts from histories to counts, where
-    ## histories are arrays of integers and "counts" are dicts from integer to float.
+    ## histories are arrays of integers and "counts" are dicts from integer to float
+    ## (HistoryState objects, see steps/libs/ngram_counts.py).
     ## For instance, when accumulating the 4-gram count for the '8' in the sequence '5 6 7 8',
     ## we'd do as follows:
     ##  self.counts[3][[5,6,7]][8] += 1.0
     ## where the [3] indexes an array, the [[5,6,7]] indexes a dict, and
     ## the [8] indexes a dict.
-    def __init__(self, ngram_order):
+    def __init__(self, ngram_order, verbose = 0):
         self.ngram_order = ngram_order
+        self.verbose = verbose
         # Integerized counts will never contain negative numbers, so
         # inside this program, we use -3 and -2 for the BOS and EOS symbols
         # respectively.
@@ -72,64 +72,55 @@ class NgramCounts:
         # backoff_symbol is kind of a pseudo-word, it's used in keeping track of
         # the backoff counts in each state.
         self.backoff_symbol = -1
-        self.counts = []
-        for n in range(ngram_order):
-            # The 'lambda: defaultdict(float)' is an anonymous function taking
-            # no arguments that returns a new defaultdict(float).
-            # If we index self.counts[n][history] for a history-length n < ngram_order
-            # and a previously unseen history, it will create a new defaultdict
-            # that defaults to 0.0 [since the function float() will return 0.0].
-            # This means that we can index self.counts without worrying about
-            # undefined values.
-            self.counts.append(defaultdict(lambda: defaultdict(float)))
-
-    # adds a raw count (called while processing input data).
-    # Suppose we see the sequence '6 7 8 9' and ngram_order=4, 'history'
-    # would be (6,7,8) and 'predicted_word' would be 9; 'count' would be
-    # 1.0.
-    def AddCount(self, history, predicted_word, count):
-        self.counts[len(history)][history][predicted_word] += count
+        # self.counts is the 'states' of an NgramCountStore, which also does the
+        # counting of the raw n-grams.
+        # If we index self.counts[n][history] for a history-length n < ngram_order
+        # and a previously unseen history, it will create a new HistoryState
+        # (a defaultdict) that defaults to 0.0 [since the function float() will
+        # return 0.0].
+        # This means that we can index self.counts without worrying about
+        # undefined values.
+        self.count_store = ngram_counts_lib.NgramCountStore(
+            ngram_order, count_type = float)
+        self.counts = self.count_store.states
 
     # 'line' is a string containing a sequence of integer word-ids.
-    # This function adds the un-smoothed counts from this line of text.
-    def AddRawCountsFromLine(self, line):
+    # This function returns them as a list of integers.
+    def ParseLine(self, line):
         try:
-            words = [self.bos_symbol] + [ int(x) for x in line.split() ] + [self.eos_symbol]
+            return [ int(x) for x in line.split() ]
         except:
             sys.exit("make_one_biased_lm.py: bad input line {0} (expected a sequence "
                      "of integers)".format(line))
 
-        for n in range(1, len(words)):
-            predicted_word = words[n]
-            history_start = max(0, n + 1 - self.ngram_order)
-            history = tuple(words[history_start:n])
-            self.AddCount(history, predicted_word, 1.0)
-
-    def AddRawCountsFromStandardInput(self):
-        lines_processed = 0
-        while True:
-            line = sys.stdin.readline()
-            if line == '':
-                break
-            self.AddRawCountsFromLine(line)
-            lines_processed += 1
-        if lines_processed == 0 or args.verbose > 0:
+    # This function adds the un-smoothed counts from 'lines', an iterable of
+    # strings each containing a sequence of integer word-ids, using the
+    # NgramCountStore.
+    def AddRawCountsFromLines(self, lines):
+        lines_processed = [ 0 ]
+        def GetSentences():
+            for line in lines:
+                lines_processed[0] += 1
+                yield self.ParseLine(line)
+        self.count_store.add_counts_from_sentences(
+            GetSentences(), self.bos_symbol, self.eos_symbol)
+        if lines_processed[0] == 0 or self.verbose > 0:
             print("make_one_biased_lm.py: processed {0} lines of input".format(
-                    lines_processed), file = sys.stderr)
+                    lines_processed[0]), file = sys.stderr)
 
 
     # This function returns a dict from history (as a tuple of integers of
-    # length > 1, ignoring lower-order histories), to the total count of this
-    # history state plus all history-states which back off to this history state.
+    # length 'hist_len', which is > 1), to the total count of this history state
+    # plus all history-states which back off to this history state.
     # It's used inside CompletelyDiscountLowCountStates().
-    def GetHistToTotalCount(self):
+    def GetHistToTotalCount(self, hist_len):
         ans = defaultdict(float)
-        for n in range(2, self.ngram_order):
-            for hist, word_to_count in self.counts[n].items():
-                total_count = sum(word_to_count.values())
-                while len(hist) >= 2:
-                    ans[hist] += total_count
-                    hist = hist[1:]
+        for n in range(hist_len, self.ngram_order):
+            this_order_counts = self.counts[n]
+            for hist in this_order_counts:
+                # the total_count is up to date, as the counts have only been
+                # added to so far.
+                ans[hist[n - hist_len:]] += this_order_counts[hist].total_count
         return ans
 
 
@@ -138,17 +129,20 @@ class NgramCounts:
     # 'min_count'; when computing the total counts, we include higher-order
     # LM-states that would back off to 'this' lm-state, in the total.
     def CompletelyDiscountLowCountStates(self, min_count):
-        hist_to_total_count = self.GetHistToTotalCount()
         for n in reversed(range(2, self.ngram_order)):
+            # The total counts are worked out one history-length at a time, to
+            # save memory.  Backing off the higher-order states does not change
+            # them, as their counts go to states with the same history-suffix.
+            hist_to_total_count = self.GetHistToTotalCount(n)
             this_order_counts = self.counts[n]
-            for hist in this_order_counts.keys():
+            # list() as the dict is changed in the loop.
+            for hist in list(this_order_counts.keys()):
                 if hist_to_total_count[hist] < min_count:
                     # we need to completely back off this count.
                     word_to_count = this_order_counts[hist]
                     del this_order_counts[hist] # delete the key from the dict.
                     backoff_hist = hist[1:]  # this will be a tuple not a list.
-                    for word, count in word_to_count.items():
-                        self.AddCount(backoff_hist, word, count)
+                    self.counts[n-1][backoff_hist].add_counts(word_to_count)
 
 
 
@@ -194,39 +188,23 @@ class NgramCounts:
         print('total count = {0}, excluding discount = {1}'.format(
                 total, total_excluding_backoff), file = sys.stderr)
 
-    def AddTopWords(self, top_words_file):
+    # This function adds the words and probabilities in 'top_words' (a list of
+    # pairs (word, prob), see ReadTopWords()) to the unigram state.
+    def AddTopWords(self, top_words):
         empty_history = ()
         word_to_count = self.counts[0][empty_history]
         total = sum(word_to_count.values())
-        try:
-            f = open(top_words_file)
-        except:
-            sys.exit("make_one_biased_lm.py: error opening top-words file: "
-                     "--top-words=" + top_words_file)
-        while True:
-            line = f.readline()
-            if line == '':
-                break
-            try:
-                [ word_index, prob ] = line.split()
-                word_index = int(word_index)
-                prob = float(prob)
-                assert word_index > 0 and prob > 0.0
-                word_to_count[word_index] += prob * total
-            except Exception as e:
-                sys.exit("make_one_biased_lm.py: could not make sense of the "
-                         "line '{0}' in op-words file: {1} ".format(line, str(e)))
-        f.close()
-
-
-    def GetTotalCountMap(self):
-        # This function, called from PrintAsFst, returns a map from
-        # history to the total-count for that state.
-        total_count_map = dict()
+        for word_index, prob in top_words:
+            word_to_count[word_index] += prob * total
+
+
+    def SetTotalCounts(self):
+        # This function, called from PrintAsFst, sets the total_count of each
+        # history-state to the sum of its counts.  (The counts are modified
+        # directly, so total_count is not kept up to date before this).
         for n in range(0, self.ngram_order):
-            for hist, word_to_count in self.counts[n].items():
-                total_count_map[hist] = sum(word_to_count.values())
-        return total_count_map
+            for word_to_count in self.counts[n].values():
+                word_to_count.total_count = sum(word_to_count.values())
 
     def GetHistToStateMap(self):
         # This function, called from PrintAsFst, returns a map from
@@ -239,18 +217,24 @@ class NgramCounts:
                 fst_state_counter += 1
         return hist_to_state
 
-    def GetProb(self, hist, word, total_count_map):
-        total_count = total_count_map[hist]
+    def GetProb(self, hist, word):
         word_to_count = self.counts[len(hist)][hist]
+        total_count = word_to_count.total_count
         prob = word_to_count[word] / total_count
         if len(hist) > 0 and word != self.backoff_symbol:
-            prob_in_backoff = self.GetProb(hist[1:], word, total_count_map)
+            prob_in_backoff = self.GetProb(hist[1:], word)
             backoff_prob = word_to_count[self.backoff_symbol] / total_count
             prob += backoff_prob * prob_in_backoff
         return prob
 
     # This function prints the estimated language model as an FST.
     def PrintAsFst(self, word_disambig_symbol):
+        for text in self.GetFstText(word_disambig_symbol):
+            sys.stdout.write(text)
+
+    # This function returns the estimated language model as a text-form FST;
+    # it is a generator that yields the text of one FST-state at a time.
+    def GetFstText(self, word_disambig_symbol):
         # n is the history-length (== order + 1).  We iterate over the
         # history-length in the order 1, 0, 2, 3, and then iterate over the
         # histories of each order in sorted order.  Putting order 1 first
@@ -260,53 +244,106 @@ class NgramCounts:
 
         # History will map from history (as a tuple) to integer FST-state.
         hist_to_state = self.GetHistToStateMap()
-        total_count_map = self.GetTotalCountMap()
+        self.SetTotalCounts()
 
-        for n in [ 1, 0 ] + range(2, self.ngram_order):
+        for n in [ 1, 0 ] + list(range(2, self.ngram_order)):
             this_order_counts = self.counts[n]
             # For order 1, make sure the keys are sorted.
             keys = this_order_counts.keys() if n != 1 else sorted(this_order_counts.keys())
             for hist in keys:
                 word_to_count = this_order_counts[hist]
                 this_fst_state = hist_to_state[hist]
+                # The lines for this state are output all at once, which is
+                # much faster than calling print() for each line; format()
+                # prints the cost with the same digits as print().
+                lines = []
 
                 for word in word_to_count.keys():
                     # work out this_cost.  Costs in OpenFst are negative logs.
-                    this_cost = -math.log(self.GetProb(hist, word, total_count_map))
+                    this_cost = -math.log(self.GetProb(hist, word))
 
                     if word > 0: # a real word.
                         next_hist = hist + (word,)  # appending tuples
                         while not next_hist in hist_to_state:
                             next_hist = next_hist[1:]
                         next_fst_state = hist_to_state[next_hist]
-                        print(this_fst_state, next_fst_state, word, word,
-                              this_cost)
+                        lines.append('{0} {1} {2} {2} {3}\n'.format(
+                            this_fst_state, next_fst_state, word, this_cost))
                     elif word == self.eos_symbol:
                         # print final-prob for this state.
-                        print(this_fst_state, this_cost)
+                        lines.append('{0} {1}\n'.format(this_fst_state,
+                                                        this_cost))
                     else:
                         assert word == self.backoff_symbol
                         backoff_fst_state = hist_to_state[hist[1:len(hist)]]
-                        print(this_fst_state, backoff_fst_state,
-                              word_disambig_symbol, 0, this_cost)
-
-
-ngram_counts = NgramCounts(args.ngram_order)
-ngram_counts.AddRawCountsFromStandardInput()
-
-if args.verbose >= 3:
-    ngram_counts.Print("Raw counts:")
-ngram_counts.CompletelyDiscountLowCountStates(args.min_lm_state_count)
-if args.verbose >= 3:
-    ngram_counts.Print("Counts after discounting low-count states:")
-ngram_counts.ApplyBackoff(args.discounting_constant)
-if args.verbose >= 3:
-    ngram_counts.Print("Counts after applying Kneser-Ney discounting:")
-if args.top_words != None:
-    ngram_counts.AddTopWords(args.top_words)
+                        lines.append('{0} {1} {2} 0 {3}\n'.format(
+                            this_fst_state, backoff_fst_state,
+                            word_disambig_symbol, this_cost))
+                yield ''.join(lines)
+
+
+# This function reads the file given to the --top-words option, and returns
+# a list of pairs (word, prob).
+def ReadTopWords(top_words_file):
+    try:
+        f = open(top_words_file)
+    except:
+        sys.exit("make_one_biased_lm.py: error opening top-words file: "
+                 "--top-words=" + top_words_file)
+    top_words = []
+    while True:
+        line = f.readline()
+        if line == '':
+            break
+        try:
+            [ word_index, prob ] = line.split()
+            word_index = int(word_index)
+            prob = float(prob)
+            assert word_index > 0 and prob > 0.0
+            top_words.append((word_index, prob))
+        except Exception as e:
+            sys.exit("make_one_biased_lm.py: could not make sense of the "
+                     "line '{0}' in op-words file: {1} ".format(line, str(e)))
+    f.close()
+    return top_words
+
+
+# This function estimates the biased LM from 'lines' (an iterable of strings
+# containing sequences of integer word-ids), and returns it as an NgramCounts
+# object (call its PrintAsFst() or GetFstText() to get the FST).  'args' are
+# the options, as parsed by 'parser'; 'top_words' is the result of
+# ReadTopWords(args.top_words), or None; it can be passed in so that callers
+# that make many LMs, like steps/cleanup/make_biased_lms.py, read the
+# top-words file just once.
+def MakeBiasedLm(lines, args, top_words = None):
+    ngram_counts = NgramCounts(args.ngram_order, args.verbose)
+    ngram_counts.AddRawCountsFromLines(lines)
+
+    if args.verbose >= 3:
+        ngram_counts.Print("Raw counts:")
+    ngram_counts.CompletelyDiscountLowCountStates(args.min_lm_state_count)
+    if args.verbose >= 3:
+        ngram_counts.Print("Counts after discounting low-count states:")
+    ngram_counts.ApplyBackoff(args.discounting_constant)
     if args.verbose >= 3:
-        ngram_counts.Print("Counts after applying top-n-words")
-ngram_counts.PrintAsFst(args.word_disambig_symbol)
+        ngram_counts.Print("Counts after applying Kneser-Ney discounting:")
+    if args.top_words != None:
+        if top_words is None:
+            top_words = ReadTopWords(args.top_words)
+        ngram_counts.AddTopWords(top_words)
+        if args.verbose >= 3:
+            ngram_counts.Print("Counts after applying top-n-words")
+    return ngram_counts
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.verbose >= 1:
+        print(' '.join(sys.argv), file = sys.stderr)
+
+    ngram_counts = MakeBiasedLm(iter(sys.stdin.readline, ''), args)
+    ngram_counts.PrintAsFst(args.word_disambig_symbol)
 
 
 # test comand:
@@ -136,9 +136,20 @@ def get_args():
                         source text from which a document needs to be
                         retrieved.""")
     parser.add_argument("--source-text-id2tfidf", type=argparse.FileType('r'),
-                        required=True,
                         help="""An SCP file for the TF-IDF for source
-                        documents indexed by the source-text-id.""")
+                        documents indexed by the source-text-id.
+                        Either this or --source-tfidf-index is required.""")
+    parser.add_argument("--source-tfidf-index", type=str,
+                        help="""Directory containing a binary TF-IDF index
+                        of the source documents created by
+                        steps/cleanup/internal/build_tfidf_index.py.
+                        If provided, the index is memory-mapped instead of
+                        reading the TF-IDF text files from
+                        --source-text-id2tfidf. Requires NumPy.""")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="""Number of queries scored together against
+                        the source TF-IDF index. This is only used if
+                        NumPy is available.""")
     parser.add_argument("--query-tfidf", type=argparse.FileType('r'),
                         required=True,
                         help="""Archive of TF-IDF objects for query documents
@@ -158,6 +169,19 @@ def get_args():
         logger.error("--partial-doc-fraction must be in [0,1]")
         raise ValueError
 
+    if args.source_text_id2tfidf is None and args.source_tfidf_index is None:
+        logger.error("One of --source-text-id2tfidf or --source-tfidf-index "
+                     "must be provided")
+        raise ValueError
+
+    if args.source_tfidf_index is not None and not tf_idf.g_numpy:
+        logger.error("--source-tfidf-index requires NumPy")
+        raise ValueError
+
+    if args.batch_size <= 0:
+        logger.error("--batch-size must be > 0")
+        raise ValueError
+
     return args
 
 
@@ -235,6 +259,81 @@ def get_document_ids(source_docs, indexes):
     return doc_ids
 
 
+def get_best_docs(args, query_id, source_doc_ids, scores, best_index=None):
+    """Returns the list of tuples (<doc-id>, <start-fraction>,
+    <end-fraction>) of the documents retrieved for the query 'query_id'.
+    'scores' is a list of the similarity scores of the query with the
+    documents in 'source_doc_ids' (in the same order).
+    'best_index' is the index of the document with the maximum score; it is
+    computed from 'scores' if not provided.
+    """
+    if best_index is None:
+        best_index = max(range(len(source_doc_ids)),
+                         key=lambda x: scores[x])
+    best_doc_id = source_doc_ids[best_index]
+    best_score = scores[best_index]
+
+    best_indexes = {}
+
+    if args.num_neighbors_to_search == 0:
+        best_indexes[best_index] = (1, 1)
+        if best_index > 0:
+            best_indexes[best_index - 1] = (0, args.partial_doc_fraction)
+        if best_index < len(source_doc_ids) - 1:
+            best_indexes[best_index + 1] = (args.partial_doc_fraction, 0)
+    else:
+        excluded_indexes = set()
+        for index in range(
+                max(best_index - args.num_neighbors_to_search, 0),
+                min(best_index + args.num_neighbors_to_search + 1,
+                    len(source_doc_ids))):
+            if (scores[index]
+                    >= args.neighbor_tfidf_threshold * best_score):
+                best_indexes[index] = (1, 1)    # Type 2
+                if index > 0 and index - 1 in excluded_indexes:
+                    try:
+                        # Type 1 and 3
+                        start_frac, end_frac = best_indexes[index - 1]
+                        assert end_frac == 0
+                        best_indexes[index - 1] = (
+                            start_frac, args.partial_doc_fraction)
+                    except KeyError:
+                        # Type 1
+                        best_indexes[index - 1] = (
+                            0, args.partial_doc_fraction)
+            else:
+                excluded_indexes.add(index)
+                if index > 0 and index - 1 not in excluded_indexes:
+                    # Type 3
+                    best_indexes[index] = (args.partial_doc_fraction, 0)
+
+    best_docs = get_document_ids(source_doc_ids, best_indexes)
+
+    assert len(best_docs) > 0, (
+        "Did not get best docs for query {0}\n"
+        "Scores: {1}\n"
+        "Source docs: {2}\n"
+        "Best index: {best_index}, score: {best_score}\n".format(
+            query_id, scores, source_doc_ids,
+            best_index=best_index, best_score=best_score))
+    assert (best_doc_id, 1.0, 1.0) in best_docs
+
+    return best_docs
+
+
+def print_best_docs(query_id, best_docs, file_handle):
+    print ("{0} {1}".format(query_id, " ".join(
+        ["%s,%.2f,%.2f" % x for x in best_docs])),
+           file=file_handle)
+
+
+def read_tfidf_file(file_name):
+    source_tfidf = tf_idf.TFIDF()
+    with open(file_name) as f:
+        source_tfidf.read(f)
+    return source_tfidf
+
+
 def run(args):
     """The main function that does all the processing.
     Takes as argument the Namespace object obtained from _get_args().
@@ -244,8 +343,15 @@ def run(args):
     source_text_id2doc_ids = read_map(args.source_text_id2doc_ids,
                                       min_num_values_per_key=1)
 
-    source_text_id2tfidf = read_map(args.source_text_id2tfidf,
-                                    num_values_per_key=1)
+    source_text_id2tfidf = None
+    if args.source_text_id2tfidf is not None:
+        source_text_id2tfidf = read_map(args.source_text_id2tfidf,
+                                        num_values_per_key=1)
+
+    if tf_idf.g_numpy:
+        run_batched(args, query_id2source_text_id, source_text_id2doc_ids,
+                    source_text_id2tfidf)
+        return
 
     num_queries = 0
     prev_source_text_id = ""
@@ -257,8 +363,8 @@ def run(args):
         source_text_id = query_id2source_text_id[query_id]
 
         if prev_source_text_id != source_text_id:
-            source_tfidf = tf_idf.TFIDF()
-            source_tfidf.read(source_text_id2tfidf[source_text_id])
+            source_tfidf = read_tfidf_file(
+                source_text_id2tfidf[source_text_id])
             prev_source_text_id = source_text_id
 
         # The source documents corresponding to the source text.
@@ -276,62 +382,91 @@ def run(args):
                 logger.debug("Score, {num}: {0} {1} {2}".format(
                     tup[0], tup[1], score, num=num_queries))
 
-        best_index, best_doc_id = max(
-            enumerate(source_doc_ids), key=lambda x: scores[(query_id, x[1])])
-        best_score = scores[(query_id, best_doc_id)]
-
-        assert source_doc_ids[best_index] == best_doc_id
-        assert best_score == max([scores[(query_id, x)]
-                                  for x in source_doc_ids])
-
-        best_indexes = {}
-
-        if args.num_neighbors_to_search == 0:
-            best_indexes[best_index] = (1, 1)
-            if best_index > 0:
-                best_indexes[best_index - 1] = (0, args.partial_doc_fraction)
-            if best_index < len(source_doc_ids) - 1:
-                best_indexes[best_index + 1] = (args.partial_doc_fraction, 0)
-        else:
-            excluded_indexes = set()
-            for index in range(
-                    max(best_index - args.num_neighbors_to_search, 0),
-                    min(best_index + args.num_neighbors_to_search + 1,
-                        len(source_doc_ids))):
-                if (scores[(query_id, source_doc_ids[index])]
-                        >= args.neighbor_tfidf_threshold * best_score):
-                    best_indexes[index] = (1, 1)    # Type 2
-                    if index > 0 and index - 1 in excluded_indexes:
-                        try:
-                            # Type 1 and 3
-                            start_frac, end_frac = best_indexes[index - 1]
-                            assert end_frac == 0
-                            best_indexes[index - 1] = (
-                                start_frac, args.partial_doc_fraction)
-                        except KeyError:
-                            # Type 1
-                            best_indexes[index - 1] = (
-                                0, args.partial_doc_fraction)
-                else:
-                    excluded_indexes.add(index)
-                    if index > 0 and index - 1 not in excluded_indexes:
-                        # Type 3
-                        best_indexes[index] = (args.partial_doc_fraction, 0)
-
-        best_docs = get_document_ids(source_doc_ids, best_indexes)
-
-        assert len(best_docs) > 0, (
-            "Did not get best docs for query {0}\n"
-            "Scores: {1}\n"
-            "Source docs: {2}\n"
-            "Best index: {best_index}, score: {best_score}\n".format(
-                query_id, scores, source_doc_ids,
-                best_index=best_index, best_score=best_score))
-        assert (best_doc_id, 1.0, 1.0) in best_docs
-
-        print ("{0} {1}".format(query_id, " ".join(
-            ["%s,%.2f,%.2f" % x for x in best_docs])),
-               file=args.relevant_docs)
+        best_docs = get_best_docs(
+            args, query_id, source_doc_ids,
+            [scores[(query_id, x)] for x in source_doc_ids])
+        print_best_docs(query_id, best_docs, args.relevant_docs)
+    logger.info("Retrieved similar documents for "
+                "%d queries", num_queries)
+
+
+def run_batched(args, query_id2source_text_id, source_text_id2doc_ids,
+                source_text_id2tfidf):
+    """Like run(), but scores batches of --batch-size queries at a time
+    using a tf_idf.TFIDFIndex of the source documents.
+    The index is either memory-mapped from --source-tfidf-index or
+    built for the source texts needed by each batch, in which case
+    each source TF-IDF file is read only once per batch.
+    """
+    index = None
+    if args.source_tfidf_index is not None:
+        index = tf_idf.TFIDFIndex()
+        index.read(args.source_tfidf_index)
+
+    num_queries = 0
+    batch = []
+
+    def score_batch(batch, index):
+        if args.source_tfidf_index is None:
+            index = tf_idf.TFIDFIndex()
+            file2doc_values = {}
+            for source_text_id in sorted(set(x[1] for x in batch)):
+                file_name = source_text_id2tfidf[source_text_id]
+                if file_name not in file2doc_values:
+                    file2doc_values[file_name] = read_tfidf_file(
+                        file_name).get_values_by_document()
+                index.add_documents(file2doc_values[file_name],
+                                    source_text_id2doc_ids[source_text_id],
+                                    source_id=source_text_id)
+            index.finalize()
+
+        for query_id, source_text_id, _ in batch:
+            source_doc_ids = source_text_id2doc_ids[source_text_id]
+            begin, end = index.source2rows[source_text_id]
+            if end - begin != len(source_doc_ids):
+                raise RuntimeError(
+                    "Mismatch in the number of documents for {0} in "
+                    "TF-IDF index ({1}) and in --source-text-id2doc-ids "
+                    "({2})".format(source_text_id, end - begin,
+                                   len(source_doc_ids)))
+
+        all_scores = index.compute_similarity_scores(
+            [x[2] for x in batch],
+            row_ranges=[index.source2rows[x[1]] for x in batch])
+
+        for (query_id, source_text_id, _), scores in zip(batch, all_scores):
+            source_doc_ids = source_text_id2doc_ids[source_text_id]
+
+            if args.verbose > 2:
+                for doc_id, score in zip(source_doc_ids, scores):
+                    logger.debug("Score: {0} {1} {2}".format(
+                        query_id, doc_id, score))
+
+            # Ties are broken in favor of the earlier document like in
+            # get_best_docs().
+            best_index = tf_idf.TFIDFIndex.get_top_k(scores, k=1)[0]
+
+            best_docs = get_best_docs(args, query_id, source_doc_ids,
+                                      scores.tolist(), best_index=best_index)
+            print_best_docs(query_id, best_docs, args.relevant_docs)
+
+    for query_id, query_tfidf in tf_idf.read_tfidf_ark(args.query_tfidf):
+        num_queries += 1
+        source_text_id = query_id2source_text_id[query_id]
+        for tup in query_tfidf.tf_idf:
+            if tup[1] != query_id:
+                raise RuntimeError("TF-IDF contains document {0}, which is "
+                                   "not the required query {1}.".format(
+                                       tup[1], query_id))
+        batch.append((query_id, source_text_id, query_tfidf))
+
+        if len(batch) == args.batch_size:
+            score_batch(batch, index)
+            batch = []
+
+    if len(batch) > 0:
+        score_batch(batch, index)
+
     logger.info("Retrieved similar documents for "
                 "%d queries", num_queries)
 
@@ -345,8 +480,10 @@ def main():
         run(args)
     finally:
         for f in [args.query_id2source_text_id, args.source_text_id2doc_ids,
-                  args.relevant_docs, args.query_tfidf, args.source_tfidf]:
-            f.close()
+                  args.relevant_docs, args.query_tfidf,
+                  args.source_text_id2tfidf]:
+            if f is not None:
+                f.close()
 
 
 if __name__ == '__main__':
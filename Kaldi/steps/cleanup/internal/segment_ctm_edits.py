@@ -7,6 +7,13 @@
 from __future__ import print_function
 import sys, operator, argparse, os
 from collections import defaultdict
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+sys.path.insert(0, 'steps')
+import libs.common as common_lib
 
 # This script reads 'ctm-edits' file format that is produced by get_ctm_edits.py
 # and modified by modify_ctm_edits.py and taint_ctm_edits.py Its function is to
@@ -93,6 +100,10 @@ parser.add_argument("--word-stats-out", type = str,
                     "reference word does not make it into a segment.  It can help reveal words "
                     "that have problematic pronunciations or are associated with "
                     "transcription errors.")
+parser.add_argument("--num-workers", type = int, default = 1,
+                    help = "Number of processes used to segment the utterances "
+                    "in parallel.  The outputs are the same as with a single "
+                    "process, and are written in the order of the input.")
 
 
 parser.add_argument("non_scored_words_in", metavar = "<non-scored-words-file>",
@@ -918,6 +929,103 @@ def PrintWordStats(word_stats_out):
           file = sys.stderr)
 
 
+# This function reads the ctm-edits input and yields 2-tuples
+# (utterance-id, split-lines-of-utterance), one for each utterance.
+def ReadUtterances(f_in):
+    first_line = f_in.readline()
+    if first_line == '':
+        sys.exit("segment_ctm_edits.py: empty input")
+    split_pending_line = first_line.split()
+    if len(split_pending_line) == 0:
+        sys.exit("segment_ctm_edits.py: bad input line " + first_line)
+    cur_utterance = split_pending_line[0]
+    split_lines_of_cur_utterance = []
+
+    while True:
+        if len(split_pending_line) == 0 or split_pending_line[0] != cur_utterance:
+            yield cur_utterance, split_lines_of_cur_utterance
+            split_lines_of_cur_utterance = []
+            if len(split_pending_line) == 0:
+                break
+            else:
+                cur_utterance = split_pending_line[0]
+
+        split_lines_of_cur_utterance.append(split_pending_line)
+        next_line = f_in.readline()
+        split_pending_line = next_line.split()
+        if len(split_pending_line) == 0:
+            if next_line != '':
+                sys.exit("segment_ctm_edits.py: got an empty or whitespace input line")
+
+# This function processes one utterance, given a 2-tuple
+# (utterance-id, split-lines-of-utterance).  It returns a 4-tuple
+# (text, segments, ctm-edits, stats) where the first three are the strings to
+# be written to the respective outputs, and 'stats' contains the stats
+# accumulated for just this utterance; see AccumulateUtteranceStats().  The
+# global stats are left unchanged, so that this can be called either in this
+# process or in a worker process.
+def ProcessUtterance(utterance_and_lines):
+    global segment_total_length, num_segments, word_count_pair, \
+       num_utterances, num_utterances_without_segments, \
+       total_length_of_utterances
+    (cur_utterance, split_lines_of_cur_utterance) = utterance_and_lines
+
+    saved_stats = (segment_total_length, num_segments, word_count_pair,
+                   num_utterances, num_utterances_without_segments,
+                   total_length_of_utterances)
+    segment_total_length = defaultdict(int)
+    num_segments = defaultdict(int)
+    word_count_pair = defaultdict(lambda: [0, 0])
+    num_utterances = 0
+    num_utterances_without_segments = 0
+    total_length_of_utterances = 0
+    try:
+        text_output_handle = StringIO()
+        segments_output_handle = StringIO()
+        ctm_edits_output_handle = StringIO()
+        (segments_for_utterance,
+         deleted_segments_for_utterance) = GetSegmentsForUtterance(split_lines_of_cur_utterance)
+        AccWordStatsForUtterance(split_lines_of_cur_utterance, segments_for_utterance)
+        WriteSegmentsForUtterance(text_output_handle, segments_output_handle,
+                                  cur_utterance, segments_for_utterance)
+        if args.ctm_edits_out != None:
+            PrintDebugInfoForUtterance(ctm_edits_output_handle,
+                                       split_lines_of_cur_utterance,
+                                       segments_for_utterance,
+                                       deleted_segments_for_utterance)
+        # the defaultdicts are converted to dicts as lambda expressions
+        # cannot be pickled.
+        stats = (dict(segment_total_length), dict(num_segments),
+                 dict(word_count_pair), num_utterances,
+                 num_utterances_without_segments, total_length_of_utterances)
+    finally:
+        (segment_total_length, num_segments, word_count_pair,
+         num_utterances, num_utterances_without_segments,
+         total_length_of_utterances) = saved_stats
+    return (text_output_handle.getvalue(), segments_output_handle.getvalue(),
+            ctm_edits_output_handle.getvalue(), stats)
+
+# This function adds the stats returned by ProcessUtterance() to the global
+# stats.
+def AccumulateUtteranceStats(stats):
+    global segment_total_length, num_segments, word_count_pair, \
+       num_utterances, num_utterances_without_segments, \
+       total_length_of_utterances
+    (this_segment_total_length, this_num_segments, this_word_count_pair,
+     this_num_utterances, this_num_utterances_without_segments,
+     this_total_length_of_utterances) = stats
+    for key, value in this_segment_total_length.items():
+        segment_total_length[key] += value
+    for key, value in this_num_segments.items():
+        num_segments[key] += value
+    for key, pair in this_word_count_pair.items():
+        word_count_pair[key][0] += pair[0]
+        word_count_pair[key][1] += pair[1]
+    num_utterances += this_num_utterances
+    num_utterances_without_segments += this_num_utterances_without_segments
+    total_length_of_utterances += this_total_length_of_utterances
+
+
 def ProcessData():
     try:
         f_in = open(args.ctm_edits_in)
@@ -942,41 +1050,17 @@ def ProcessData():
                      "file {0}".format(args.ctm_edits_out))
 
     # Most of what we're doing in the lines below is splitting the input lines
-    # and grouping them per utterance, before giving them to ProcessUtterance()
-    # and then printing the modified lines.
-    first_line = f_in.readline()
-    if first_line == '':
-        sys.exit("segment_ctm_edits.py: empty input")
-    split_pending_line = first_line.split()
-    if len(split_pending_line) == 0:
-        sys.exit("segment_ctm_edits.py: bad input line " + first_line)
-    cur_utterance = split_pending_line[0]
-    split_lines_of_cur_utterance = []
-
-    while True:
-        if len(split_pending_line) == 0 or split_pending_line[0] != cur_utterance:
-            (segments_for_utterance,
-             deleted_segments_for_utterance) = GetSegmentsForUtterance(split_lines_of_cur_utterance)
-            AccWordStatsForUtterance(split_lines_of_cur_utterance, segments_for_utterance)
-            WriteSegmentsForUtterance(text_output_handle, segments_output_handle,
-                                      cur_utterance, segments_for_utterance)
-            if args.ctm_edits_out != None:
-                PrintDebugInfoForUtterance(ctm_edits_output_handle,
-                                           split_lines_of_cur_utterance,
-                                           segments_for_utterance,
-                                           deleted_segments_for_utterance)
-            split_lines_of_cur_utterance = []
-            if len(split_pending_line) == 0:
-                break
-            else:
-                cur_utterance = split_pending_line[0]
-
-        split_lines_of_cur_utterance.append(split_pending_line)
-        next_line = f_in.readline()
-        split_pending_line = next_line.split()
-        if len(split_pending_line) == 0:
-            if next_line != '':
-                sys.exit("segment_ctm_edits.py: got an empty or whitespace input line")
+    # and grouping them per utterance (in ReadUtterances()), before giving them
+    # to ProcessUtterance() and then printing the modified lines.  If
+    # --num-workers > 1, ProcessUtterance() is run in a pool of processes.
+    for (text, segments, ctm_edits, stats) in common_lib.imap_in_order(
+            ProcessUtterance, ReadUtterances(f_in),
+            num_workers = args.num_workers):
+        text_output_handle.write(text)
+        segments_output_handle.write(segments)
+        if args.ctm_edits_out != None:
+            ctm_edits_output_handle.write(ctm_edits)
+        AccumulateUtteranceStats(stats)
     try:
         text_output_handle.close()
         segments_output_handle.close()
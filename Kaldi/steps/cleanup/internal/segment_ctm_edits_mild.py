@@ -12,6 +12,14 @@ import heapq
 import sys
 from collections import defaultdict
 
+sys.path.insert(0, 'steps')
+import libs.common as common_lib
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 """
 This script reads 'ctm-edits' file format that is produced by align_ctm_ref.py
 and modified by modify_ctm_edits.py and taint_ctm_edits.py. Its function is to
@@ -206,22 +214,22 @@ def get_args():
                         words that have problematic pronunciations or are
                         associated with transcription errors.""")
 
-    parser.add_argument("non_scored_words_in",
+    parser.add_argument("non_scored_words_in", nargs="?",
                         metavar="<non-scored-words-file>",
                         type=argparse.FileType('r'),
                         help="""Filename of file containing a list of
                         non-scored words, one per line. See
                         steps/cleanup/internal/get_nonscored_words.py.""")
-    parser.add_argument("ctm_edits_in", metavar="<ctm-edits-in>",
+    parser.add_argument("ctm_edits_in", nargs="?", metavar="<ctm-edits-in>",
                         type=argparse.FileType('r'),
                         help="""Filename of input ctm-edits file.  Use
                         /dev/stdin for standard input.""")
-    parser.add_argument("text_out", metavar="<text-out>",
+    parser.add_argument("text_out", nargs="?", metavar="<text-out>",
                         type=argparse.FileType('w'),
                         help="""Filename of output text file (same format as
                         data/train/text, i.e.  <new-utterance-id> <word1>
                         <word2> ... <wordN>""")
-    parser.add_argument("segments_out", metavar="<segments-out>",
+    parser.add_argument("segments_out", nargs="?", metavar="<segments-out>",
                         type=argparse.FileType('w'),
                         help="""Filename of output segments.  This has the same
                         format as data/train/segments, but instead of
@@ -229,11 +237,28 @@ def get_args():
                         utterance-id, i.e <new-utterance-id> <old-utterance-id>
                         <start-time> <end-time>""")
 
+    parser.add_argument("--num-workers", type=int, default=1,
+                        help="""Number of processes used to segment the
+                        utterances in parallel. The outputs are written in
+                        the order of the input regardless of this value.""")
+    parser.add_argument("--debug-only", type=str, default="false",
+                        choices=["true", "false"],
+                        help="Run test functions only")
     parser.add_argument("--verbose", type=int, default=0,
                         help="Use higher verbosity for more debugging output")
 
     args = parser.parse_args()
 
+    args.debug_only = bool(args.debug_only == "true")
+
+    # The positional arguments are optional only so that the tests can be
+    # run on their own with --debug-only=true.
+    if not args.debug_only and None in [
+            args.non_scored_words_in, args.ctm_edits_in, args.text_out,
+            args.segments_out]:
+        parser.error("the arguments <non-scored-words-file> <ctm-edits-in> "
+                     "<text-out> <segments-out> are required")
+
     if args.verbose > 2:
         _global_handler.setLevel(logging.DEBUG)
         _global_logger.setLevel(logging.DEBUG)
@@ -1200,7 +1225,9 @@ class SegmentsMerger(object):
     Paramters:
         segments - a reference to the list of inital segments
         merged_segments - stores all the initial segments as well
-                          as the newly created segments
+                          as the segments created for the accepted
+                          merges, indexed by the tuple of
+                          the indexes of the initial segments in the cluster
         between_segments - stores the inter-segment "segments"
                            for the initial segments
         split_lines_of_utt - a reference to the CTM lines
@@ -1218,6 +1245,10 @@ class SegmentsMerger(object):
         self.merged_segments = {}
         self.between_segments = [None for i in range(len(segments) + 1)]
 
+        # Stats of the single-line segments that are shared between
+        # adjacent segments, indexed by the line index.
+        self._line_stats = {}
+
         if segments[0].start_index > 0:
             self.between_segments[0] = Segment(
                 self.split_lines_of_utt, 0, segments[0].start_index,
@@ -1237,63 +1268,103 @@ class SegmentsMerger(object):
                 self.split_lines_of_utt, segments[-1].end_index,
                 len(self.split_lines_of_utt), compute_segment_stats=True)
 
-    def _get_merged_cluster(self, cluster1, cluster2, rejected_clusters=None,
-                            max_intersegment_incorrect_words_length=1):
+    def _get_line_stats(self, index):
+        if index not in self._line_stats:
+            self._line_stats[index] = Segment(
+                self.split_lines_of_utt, index, index + 1,
+                compute_segment_stats=True).stats
+        return self._line_stats[index]
+
+    def _combine_adjacent_stats(self, stats, end_index, other):
+        """Returns a tuple (stats, end_index) of the segment obtained by
+        merging a segment with stats 'stats' and end-index 'end_index' with
+        the segment 'other' that follows it. The stats are computed
+        the same way as in Segment.merge_adjacent_segment(), but without
+        creating the merged segment.
+        """
+        assert end_index <= other.start_index + 1
+        assert not stats.compare(other.stats), "%s %s" % (stats, other)
+
+        stats = copy.copy(stats)
+        stats.combine(other.stats)
+        if end_index == other.start_index + 1:
+            stats.combine(self._get_line_stats(other.start_index), scale=-1)
+        return (stats, other.end_index)
+
+    def _get_merged_stats(self, cluster1, cluster2,
+                          max_intersegment_incorrect_words_length=1):
+        """Returns the SegmentStats of the segment that would be obtained by
+        merging the clusters cluster1 and cluster2 (tuples of indexes of the
+        initial segments), or None if this merge must be rejected because
+        of the region between them.
+        The index -1 (len(self.segments)) is used for the region before
+        (after) the initial segments.
+        """
+        assert cluster2[0] > cluster1[-1]
+
+        if cluster1[-1] == -1:
+            assert len(cluster1) == 1
+            # Consider merging cluster2 with the region before the 0^th
+            # segment
+            first = self.between_segments[0]
+            if (first is None or first.stats.total_length == 0
+                    or (first.stats.incorrect_words_length
+                        > max_intersegment_incorrect_words_length)):
+                # Reject zero length or bad start region
+                return None
+            stats, end_index = first.stats, first.end_index
+        else:
+            left = self.merged_segments[cluster1]
+            stats, end_index = left.stats, left.end_index
+
+            if cluster2[0] == len(self.segments):
+                assert len(cluster2) == 1
+                last = self.between_segments[-1]
+                if (last is None or last.stats.total_length == 0
+                        or (last.stats.incorrect_words_length
+                            > max_intersegment_incorrect_words_length)):
+                    # Reject zero length or bad end region
+                    return None
+
+            between = self.between_segments[cluster2[0]]
+            if between is not None:
+                if (between.stats.incorrect_words_length
+                        > max_intersegment_incorrect_words_length):
+                    return None
+                stats, end_index = self._combine_adjacent_stats(
+                    stats, end_index, between)
+
+        if cluster2[0] < len(self.segments):
+            stats, end_index = self._combine_adjacent_stats(
+                stats, end_index, self.merged_segments[cluster2])
+        return stats
+
+    def _get_merged_cluster(self, cluster1, cluster2):
+        """Creates the segment obtained by merging the clusters cluster1 and
+        cluster2 and stores it in self.merged_segments.
+        This is only called for the accepted merges; the candidates are
+        scored using the stats from _get_merged_stats().
+        """
         try:
-            assert cluster2[0] > cluster1[-1]
             new_cluster = cluster1 + cluster2
-            new_cluster_tup = tuple(new_cluster)
-
-            if (rejected_clusters is not None
-                    and new_cluster_tup in rejected_clusters):
-                return (None, new_cluster, True)
-
-            if new_cluster_tup in self.merged_segments:
-                return (self.merged_segments[new_cluster_tup],
-                        new_cluster, False)
 
             if cluster1[-1] == -1:
-                assert len(cluster1) == 1
-                # Consider merging cluster2 with the region before the 0^th
-                # segment
-                if (self.between_segments[0] is None
-                        or self.between_segments[0].stats.total_length == 0
-                        or (self.between_segments[0]
-                            .stats.incorrect_words_length
-                            > max_intersegment_incorrect_words_length)):
-                    # Reject zero length or bad start region
-                    return (None, new_cluster, True)
                 merged_segment = self.between_segments[0].copy()
             else:
-                merged_segment = self.merged_segments[tuple(cluster1)].copy()
-
-                if cluster2[0] == len(self.segments):
-                    assert len(cluster2) == 1
-                    if (self.between_segments[-1] is None
-                            or (self.between_segments[-1]
-                                .stats.total_length == 0)
-                            or (self.between_segments[-1]
-                                .stats.incorrect_words_length
-                                > max_intersegment_incorrect_words_length)):
-                        # Reject zero length or bad end region
-                        return (None, new_cluster, True)
+                merged_segment = self.merged_segments[cluster1].copy()
                 if self.between_segments[cluster2[0]] is not None:
-                    if (self.between_segments[cluster2[0]]
-                            .stats.incorrect_words_length
-                            > max_intersegment_incorrect_words_length):
-                        return (None, new_cluster, True)
                     merged_segment.merge_adjacent_segment(
                         self.between_segments[cluster2[0]])
 
             if cluster2[0] < len(self.segments):
                 merged_segment.merge_adjacent_segment(
-                    self.merged_segments[tuple(cluster2)])
+                    self.merged_segments[cluster2])
             # else:
             # Already done
             # merged_segment.merge_adjacent_segment(self.between_segments[-1])
 
-            self.merged_segments[new_cluster_tup] = merged_segment
-            return (merged_segment, new_cluster, False)
+            self.merged_segments[new_cluster] = merged_segment
+            return new_cluster
         except:
             _global_logger.error("Failed merging cluster1 %s and cluster2 %s",
                                  cluster1, cluster2)
@@ -1307,96 +1378,128 @@ class SegmentsMerger(object):
                        max_wer=10, max_bad_proportion=0.3,
                        max_segment_length=10,
                        max_intersegment_incorrect_words_length=1):
+        """Does agglomerative clustering of the segments. At each step, the
+        pair of adjacent clusters whose merged segment has the best score
+        (given by scoring_function applied on its SegmentStats) and is
+        within the limits max_wer, max_bad_proportion and max_segment_length
+        is merged. Pairs that are not within the limits are never
+        considered again.
+
+        The candidate merges are kept in a priority queue. After a merge, only
+        the pairs involving the new cluster and its two neighbours are
+        scored and added to the queue; the entries for pairs that no
+        longer exist are discarded when they are popped.
+        Ties in the score are broken in favor of the leftmost pair.
+
+        Returns a list of clusters, where each cluster is a list of indexes
+        of the initial segments.
+        """
         for i, x in enumerate(self.segments):
             _global_logger.debug("before agglomerative clustering, segment %d"
                                  " = %s", i, x)
 
         # Initial clusters are the individual segments themselves.
-        clusters = [[x] for x in range(-1, len(self.segments) + 1)]
-
-        rejected_clusters = set()
-
-        while len(clusters) > 1:
+        # The clusters are stored as a doubly-linked list of tuples.
+        clusters = [(x, ) for x in range(-1, len(self.segments) + 1)]
+        next_cluster = {}
+        prev_cluster = {}
+        for i in range(len(clusters) - 1):
+            next_cluster[clusters[i]] = clusters[i + 1]
+            prev_cluster[clusters[i + 1]] = clusters[i]
+        next_cluster[clusters[-1]] = None
+        prev_cluster[clusters[0]] = None
+        first_cluster = clusters[0]
+
+        heap = []
+        num_pushed = [0]
+
+        def push_candidate(cluster1, cluster2):
+            if cluster1 is None or cluster2 is None:
+                return
             try:
-                _global_logger.debug("Current clusters: %s", clusters)
-
-                heap = []
+                stats = self._get_merged_stats(
+                    cluster1, cluster2,
+                    max_intersegment_incorrect_words_length=(
+                        max_intersegment_incorrect_words_length))
+            except:
+                _global_logger.error(
+                    "Failed merging cluster1 %s and cluster2 %s",
+                    cluster1, cluster2)
+                raise
+            if stats is None:
+                return
+            # The cluster1[0] and num_pushed make the order of the entries
+            # with the same score deterministic, without comparing the
+            # stats objects.
+            heapq.heappush(heap, (-scoring_function(stats), cluster1[0],
+                                  num_pushed[0], cluster1, cluster2, stats))
+            num_pushed[0] += 1
+
+        for i in range(len(clusters) - 1):
+            push_candidate(clusters[i], clusters[i + 1])
+
+        while len(heap) > 0:
+            score, _, _, cluster1, cluster2, stats = heapq.heappop(heap)
+
+            if next_cluster.get(cluster1, None) != cluster2:
+                # One of the clusters has since been merged with another
+                # cluster.
+                continue
 
-                for i in range(len(clusters) - 1):
-                    merged_segment, new_cluster, reject = (
-                        self._get_merged_cluster(
-                            clusters[i], clusters[i + 1], rejected_clusters,
-                            max_intersegment_incorrect_words_length=(
-                                max_intersegment_incorrect_words_length)))
-                    if reject:
-                        rejected_clusters.add(tuple(new_cluster))
-                        continue
+            cluster = cluster1 + cluster2
+            _global_logger.debug("Considering new cluster: %s", cluster)
 
-                    heapq.heappush(heap, (-scoring_function(merged_segment),
-                                          (merged_segment, i, new_cluster)))
+            if stats.wer() > max_wer:
+                _global_logger.debug(
+                    "Rejecting cluster with "
+                    "WER%% %.2f > %.2f", stats.wer(), max_wer)
+                continue
 
-                candidate_index = -1
-                candidate_cluster = None
+            if stats.bad_proportion() > max_bad_proportion:
+                _global_logger.debug(
+                    "Rejecting cluster with bad-proportion "
+                    "%.2f > %.2f", stats.bad_proportion(),
+                    max_bad_proportion)
+                continue
 
-                while True:
-                    try:
-                        score, tup = heapq.heappop(heap)
-                    except IndexError:
-                        break
+            if stats.total_length > max_segment_length:
+                _global_logger.debug(
+                    "Rejecting cluster with length "
+                    "%.2f > %.2f", stats.total_length,
+                    max_segment_length)
+                continue
 
-                    segment, index, cluster = tup
+            _global_logger.debug("Accepted cluster %s", cluster)
 
-                    _global_logger.debug(
-                        "Considering new cluster: (%d, %s)", index, cluster)
-
-                    if segment.stats.wer() > max_wer:
-                        _global_logger.debug(
-                            "Rejecting cluster with "
-                            "WER%% %.2f > %.2f", segment.stats.wer(), max_wer)
-                        rejected_clusters.add(tuple(cluster))
-                        continue
-
-                    if segment.stats.bad_proportion() > max_bad_proportion:
-                        _global_logger.debug(
-                            "Rejecting cluster with bad-proportion "
-                            "%.2f > %.2f", segment.stats.bad_proportion(),
-                            max_bad_proportion)
-                        rejected_clusters.add(tuple(cluster))
-                        continue
-
-                    if segment.stats.total_length > max_segment_length:
-                        _global_logger.debug(
-                            "Rejecting cluster with length "
-                            "%.2f > %.2f", segment.stats.total_length,
-                            max_segment_length)
-                        rejected_clusters.add(tuple(cluster))
-                        continue
-
-                    candidate_index, candidate_cluster = tup[1:]
-                    _global_logger.debug("Accepted cluster (%d, %s)",
-                                         candidate_index, candidate_cluster)
-                    break
-
-                if candidate_index == -1:
-                    return clusters
-
-                new_clusters = []
-
-                for i in range(candidate_index):
-                    new_clusters.append(clusters[i])
-                new_clusters.append(candidate_cluster)
-                for i in range(candidate_index + 2, len(clusters)):
-                    new_clusters.append(clusters[i])
-
-                if len(new_clusters) >= len(clusters):
-                    raise RuntimeError("Old: {0}; New: {1}".format(
-                        clusters, new_clusters))
-                clusters = new_clusters
+            try:
+                new_cluster = self._get_merged_cluster(cluster1, cluster2)
             except Exception:
                 _global_logger.error(
-                    "Failed merging clusters %s", clusters)
+                    "Failed merging clusters %s and %s", cluster1, cluster2)
                 raise
 
+            before = prev_cluster.pop(cluster1)
+            after = next_cluster.pop(cluster2)
+            del next_cluster[cluster1]
+            del prev_cluster[cluster2]
+            prev_cluster[new_cluster] = before
+            next_cluster[new_cluster] = after
+            if before is not None:
+                next_cluster[before] = new_cluster
+            else:
+                first_cluster = new_cluster
+            if after is not None:
+                prev_cluster[after] = new_cluster
+
+            push_candidate(before, new_cluster)
+            push_candidate(new_cluster, after)
+
+        clusters = []
+        cluster = first_cluster
+        while cluster is not None:
+            clusters.append(list(cluster))
+            cluster = next_cluster[cluster]
+        _global_logger.debug("Final clusters: %s", clusters)
         return clusters
 
 
@@ -1405,8 +1508,7 @@ def merge_segments(segments, args):
         _global_logger.debug("Got no segments at merging segments stage")
         return []
 
-    def scoring_function(segment):
-        stats = segment.stats
+    def scoring_function(stats):
         try:
             return (-stats.wer() - args.silence_factor * stats.silence_length
                     - args.incorrect_words_factor
@@ -1500,6 +1602,97 @@ def merge_segments(segments, args):
     return segments
 
 
+def test_merge_clusters():
+    """Checks the clusters found by SegmentsMerger.merge_clusters() on fixed
+    ctm-edits inputs against the ones pinned below, which were
+    found by the implementation that rescored all the pairs at every step.
+    """
+    def get_split_lines(durations_and_edits):
+        split_lines = []
+        start_time = 0.0
+        for duration, word, edit in durations_and_edits:
+            if edit == 'sil':
+                hyp_word, ref_word = '<eps>', '<eps>'
+            elif edit == 'sub':
+                hyp_word, ref_word = 'x', word
+            else:
+                hyp_word, ref_word = word, word
+            split_lines.append(['utt1', '1', '%.2f' % start_time,
+                                '%.2f' % duration, '1.0', hyp_word,
+                                ref_word, edit])
+            start_time += duration
+        return split_lines
+
+    def scoring_function(stats):
+        try:
+            return (-stats.wer() - 2.0 * stats.silence_length
+                    - 3.0 * stats.incorrect_words_length)
+        except ZeroDivisionError:
+            return float("-inf")
+
+    def check(durations_and_edits, cores, max_segment_length,
+              expected_clusters):
+        split_lines = get_split_lines(durations_and_edits)
+        segments = [Segment(split_lines, start_index, end_index)
+                    for start_index, end_index in cores]
+        merger = SegmentsMerger(segments)
+        clusters = merger.merge_clusters(
+            scoring_function, max_wer=50, max_bad_proportion=0.5,
+            max_segment_length=max_segment_length)
+        if clusters != [x[0] for x in expected_clusters]:
+            raise RuntimeError("Expected clusters {0}, got {1}".format(
+                [x[0] for x in expected_clusters], clusters))
+        for cluster, start_index, end_index, stats in expected_clusters:
+            if start_index is None:
+                # This is the region before or after the segments, which
+                # was not merged with any segment.
+                continue
+            segment = merger.merged_segments[tuple(cluster)]
+            if (segment.start_index != start_index
+                    or segment.end_index != end_index
+                    or str(segment.stats) != stats):
+                raise RuntimeError(
+                    "Expected cluster {0} to have boundaries ({1}, {2}) "
+                    "and stats {3}, got {4}".format(
+                        cluster, start_index, end_index, stats,
+                        segment.debug_info()))
+
+    check([(0.3, None, 'sil'), (0.5, 'a', 'cor'), (0.4, 'b', 'cor'),
+           (0.25, None, 'sil'), (0.5, 'c', 'cor'), (0.35, 'd', 'sub'),
+           (0.5, 'e', 'cor'), (0.6, 'f', 'cor'), (1.5, None, 'sil'),
+           (0.45, 'g', 'cor'), (0.15, None, 'sil')],
+          [(1, 3), (4, 5), (6, 8), (9, 10)], 3.0,
+          [([-1, 0, 1], 0, 5,
+            'num-incorrect-words=0,num-tainted-words=0,num-words=3,'
+            'incorrect-length=0.00,silence-length=0.55,'
+            'tainted-nonsilence-length=0.00,total-length=1.95'),
+           ([2], 6, 8,
+            'num-incorrect-words=0,num-tainted-words=0,num-words=2,'
+            'incorrect-length=0.00,silence-length=0.00,'
+            'tainted-nonsilence-length=0.00,total-length=1.10'),
+           ([3, 4], 9, 11,
+            'num-incorrect-words=0,num-tainted-words=0,num-words=1,'
+            'incorrect-length=0.00,silence-length=0.15,'
+            'tainted-nonsilence-length=0.00,total-length=0.60')])
+
+    # Merging segment 1 with either of its neighbours gives the same score,
+    # and only one of them can be merged because of max_segment_length.
+    # The leftmost pair is merged.
+    check([(0.5, 'a', 'cor'), (0.2, None, 'sil'), (0.5, 'b', 'cor'),
+           (0.2, None, 'sil'), (0.5, 'c', 'cor')],
+          [(0, 1), (2, 3), (4, 5)], 1.5,
+          [([-1], None, None, None),
+           ([0, 1], 0, 3,
+            'num-incorrect-words=0,num-tainted-words=0,num-words=2,'
+            'incorrect-length=0.00,silence-length=0.20,'
+            'tainted-nonsilence-length=0.00,total-length=1.20'),
+           ([2], 4, 5,
+            'num-incorrect-words=0,num-tainted-words=0,num-words=1,'
+            'incorrect-length=0.00,silence-length=0.00,'
+            'tainted-nonsilence-length=0.00,total-length=0.50'),
+           ([3], None, None, None)])
+
+
 def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
     """
     This function creates the segments for an utterance as a list
@@ -1844,7 +2037,14 @@ class WordStats(object):
     wrong lexicon entry).
     """
     def __init__(self):
-        self.word_count_pair = defaultdict(lambda: [0, 0])
+        self.word_count_pair = {}
+
+    def combine(self, other):
+        """Adds the stats in another WordStats object to this object."""
+        for word, pair in other.word_count_pair.items():
+            this_pair = self.word_count_pair.setdefault(word, [0, 0])
+            this_pair[0] += pair[0]
+            this_pair[1] += pair[1]
 
     def accumulate_for_utterance(self, split_lines_of_utt,
                                  segments_for_utterance,
@@ -1858,9 +2058,10 @@ class WordStats(object):
         for i, split_line in enumerate(split_lines_of_utt):
             this_ref_word = split_line[6]
             if this_ref_word != eps_symbol:
-                self.word_count_pair[this_ref_word][0] += 1
+                pair = self.word_count_pair.setdefault(this_ref_word, [0, 0])
+                pair[0] += 1
                 if not line_is_in_segment[i]:
-                    self.word_count_pair[this_ref_word][1] += 1
+                    pair[1] += 1
 
     def print(self, word_stats_out):
         # Sort from most to least problematic.  We want to give more prominence
@@ -1891,13 +2092,12 @@ class WordStats(object):
             of the file.""", word_stats_out.name)
 
 
-def process_data(args, oov_symbol, utterance_stats, word_stats):
-    """
-    Most of what we're doing in the lines below is splitting the input lines
-    and grouping them per utterance, before giving them to
-    get_segments_for_utterance() and then printing the modified lines.
+def read_utterances(ctm_edits_in):
+    """Reads the ctm-edits input and yields tuples
+    (utterance-id, split-lines-of-utterance) for each utterance.
+    The lines of an utterance are expected to be contiguous in the input.
     """
-    first_line = args.ctm_edits_in.readline()
+    first_line = ctm_edits_in.readline()
     if first_line == '':
         sys.exit("segment_ctm_edits.py: empty input")
     split_pending_line = first_line.split()
@@ -1907,42 +2107,95 @@ def process_data(args, oov_symbol, utterance_stats, word_stats):
     split_lines_of_cur_utterance = []
 
     while True:
-        try:
-            if (len(split_pending_line) == 0
-                    or split_pending_line[0] != cur_utterance):
-                # Read one whole utterance. Now process it.
-                (segments_for_utterance,
-                 deleted_segments_for_utterance) = get_segments_for_utterance(
-                     split_lines_of_cur_utterance, args=args,
-                     utterance_stats=utterance_stats)
-                word_stats.accumulate_for_utterance(
-                    split_lines_of_cur_utterance, segments_for_utterance)
-                write_segments_for_utterance(
-                    args.text_out, args.segments_out, cur_utterance,
-                    segments_for_utterance, oov_symbol=oov_symbol,
-                    frame_length=args.frame_length)
-                if args.ctm_edits_out is not None:
-                    print_debug_info_for_utterance(
-                        args.ctm_edits_out, split_lines_of_cur_utterance,
-                        segments_for_utterance, deleted_segments_for_utterance,
-                        frame_length=args.frame_length)
-                split_lines_of_cur_utterance = []
-                if len(split_pending_line) == 0:
-                    break
-                else:
-                    cur_utterance = split_pending_line[0]
-
-            split_lines_of_cur_utterance.append(split_pending_line)
-            next_line = args.ctm_edits_in.readline()
-            split_pending_line = next_line.split()
+        if (len(split_pending_line) == 0
+                or split_pending_line[0] != cur_utterance):
+            # Read one whole utterance.
+            yield cur_utterance, split_lines_of_cur_utterance
+            split_lines_of_cur_utterance = []
             if len(split_pending_line) == 0:
-                if next_line != '':
-                    sys.exit("segment_ctm_edits.py: got an "
-                             "empty or whitespace input line")
-        except Exception:
-            _global_logger.error(
-                "Error with utterance %s", cur_utterance)
-            raise
+                break
+            else:
+                cur_utterance = split_pending_line[0]
+
+        split_lines_of_cur_utterance.append(split_pending_line)
+        next_line = ctm_edits_in.readline()
+        split_pending_line = next_line.split()
+        if len(split_pending_line) == 0:
+            if next_line != '':
+                sys.exit("segment_ctm_edits.py: got an "
+                         "empty or whitespace input line")
+
+
+# The options used by process_utterance(). These are set by process_data()
+# before creating the worker processes, which inherit them.
+_global_process_options = None
+
+
+def process_utterance(utterance_and_lines):
+    """Segments an utterance and returns a tuple
+    (text-output, segments-output, ctm-edits-output, utterance-stats,
+     word-stats), where the outputs are the strings to be written to the
+    respective files and the stats are an UtteranceStats and a WordStats
+    object containing the stats for only this utterance.
+    This is run in the worker processes if --num-workers > 1.
+    """
+    args, oov_symbol = _global_process_options
+    cur_utterance, split_lines_of_cur_utterance = utterance_and_lines
+
+    utterance_stats = UtteranceStats()
+    word_stats = WordStats()
+    text_out = StringIO()
+    segments_out = StringIO()
+    ctm_edits_out = StringIO()
+
+    try:
+        (segments_for_utterance,
+         deleted_segments_for_utterance) = get_segments_for_utterance(
+             split_lines_of_cur_utterance, args=args,
+             utterance_stats=utterance_stats)
+        word_stats.accumulate_for_utterance(
+            split_lines_of_cur_utterance, segments_for_utterance)
+        write_segments_for_utterance(
+            text_out, segments_out, cur_utterance,
+            segments_for_utterance, oov_symbol=oov_symbol,
+            frame_length=args.frame_length)
+        if args.ctm_edits_out is not None:
+            print_debug_info_for_utterance(
+                ctm_edits_out, split_lines_of_cur_utterance,
+                segments_for_utterance, deleted_segments_for_utterance,
+                frame_length=args.frame_length)
+    except Exception:
+        _global_logger.error(
+            "Error with utterance %s", cur_utterance)
+        raise
+
+    return (text_out.getvalue(), segments_out.getvalue(),
+            ctm_edits_out.getvalue(), utterance_stats, word_stats)
+
+
+def process_data(args, oov_symbol, utterance_stats, word_stats):
+    """
+    Most of what we're doing in the lines below is splitting the input lines
+    and grouping them per utterance, before giving them to
+    get_segments_for_utterance() and then printing the modified lines.
+
+    If args.num_workers > 1, the utterances are segmented in parallel
+    in a pool of processes, but the outputs are still written in the order
+    of the input.
+    """
+    global _global_process_options
+    _global_process_options = (args, oov_symbol)
+
+    for (text, segments, ctm_edits,
+         this_utterance_stats, this_word_stats) in common_lib.imap_in_order(
+             process_utterance, read_utterances(args.ctm_edits_in),
+             num_workers=args.num_workers):
+        args.text_out.write(text)
+        args.segments_out.write(segments)
+        if args.ctm_edits_out is not None:
+            args.ctm_edits_out.write(ctm_edits)
+        utterance_stats.combine(this_utterance_stats)
+        word_stats.combine(this_word_stats)
 
 
 def read_non_scored_words(non_scored_words_file):
@@ -1969,6 +2222,17 @@ class UtteranceStats(object):
         self.num_utterances_without_segments = 0
         self.total_length_of_utterances = 0
 
+    def combine(self, other):
+        """Adds the stats in another UtteranceStats object to this object."""
+        for key, value in other.segment_total_length.items():
+            self.segment_total_length[key] += value
+        for key, value in other.num_segments.items():
+            self.num_segments[key] += value
+        self.num_utterances += other.num_utterances
+        self.num_utterances_without_segments += (
+            other.num_utterances_without_segments)
+        self.total_length_of_utterances += other.total_length_of_utterances
+
     def accumulate_segment_stats(self, segment_list, text):
         """
         Here, 'text' will be something that indicates the stage of processing,
@@ -2007,6 +2271,10 @@ class UtteranceStats(object):
 def main():
     args = get_args()
 
+    if args.debug_only:
+        test_merge_clusters()
+        raise SystemExit("Exiting since --debug-only was true")
+
     try:
         global _global_non_scored_words
         _global_non_scored_words = set()
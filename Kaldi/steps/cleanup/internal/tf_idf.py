@@ -8,11 +8,18 @@ for Term-frequency and Inverse-document-frequency values.
 from __future__ import print_function
 import logging
 import math
+import os
 import re
 import sys
 
 sys.path.insert(0, 'steps')
 
+try:
+    import numpy as np
+    g_numpy = True
+except ImportError:
+    g_numpy = False
+
 logger = logging.getLogger('__name__')
 logger.addHandler(logging.NullHandler())
 
@@ -201,6 +208,16 @@ class TFIDF(object):
         """
         return self.tf_idf[(term, doc)]
 
+    def get_values_by_document(self):
+        """Returns the TF-IDF values grouped by document as a dictionary
+            { document : [ (term, tf-idf-value), ... ] }
+        """
+        doc2values = {}
+        for tup, value in self.tf_idf.items():
+            term, doc = tup
+            doc2values.setdefault(doc, []).append((term, value))
+        return doc2values
+
     def compute_similarity_scores(self, source_tfidf, source_docs=None,
                                   do_length_normalization=False,
                                   query_id=None):
@@ -338,6 +355,250 @@ class TFIDF(object):
         print ("</TFIDF>", file=tf_idf_file)
 
 
+class TFIDFIndex(object):
+    """Stores the TF-IDF values of a set of documents as a sparse matrix of
+    shape (num-docs x num-terms) in the compressed-sparse-row (CSR) format,
+    with the terms (n-grams) interned as integers.
+    This is used to score a batch of query documents against the source
+    documents in one go, rather than looking up each (term, document) pair
+    in a dictionary as in TFIDF.compute_similarity_scores().
+    It requires NumPy.
+
+    The documents are grouped by the source they belong to (e.g. the
+    source-text-id) and the rows of a source are contiguous.
+
+    Attributes:
+        term2id - A dictionary { term : term-id }, where term is a tuple
+        doc_ids - The list of document-ids, one for each row
+        source2rows - A dictionary
+                      { source-id : (begin-row, end-row) }
+        indptr, indices, data - The CSR arrays. The TF-IDF values of
+                                document doc_ids[i] are in
+                                data[indptr[i]:indptr[i+1]] for the terms
+                                with ids indices[indptr[i]:indptr[i+1]].
+        term_keys, term_values - The same values sorted by
+                                 (term-id, row) and stored with the key
+                                 term-id * num-docs + row. These are used
+                                 to find the documents containing a term.
+    """
+
+    def __init__(self):
+        self.term2id = {}
+        self.doc_ids = []
+        self.source2rows = {}
+        self.indptr = None
+        self.indices = None
+        self.data = None
+        self.term_keys = None
+        self.term_values = None
+
+        # Rows accumulated by add_documents() until finalize() is called.
+        self._rows = []
+
+    def num_docs(self):
+        return len(self.doc_ids)
+
+    def add_documents(self, doc2values, doc_ids, source_id=None):
+        """Adds the documents in the list 'doc_ids' (in that order) as new
+        rows of the matrix, taking their TF-IDF values from 'doc2values',
+        which is of the format returned by TFIDF.get_values_by_document().
+        Documents not in 'doc2values' are added as empty rows.
+
+        If source_id is provided, the rows are recorded as belonging to
+        that source.
+        """
+        if self.indptr is not None:
+            raise RuntimeError("Cannot add documents to a finalized "
+                               "TFIDFIndex.")
+
+        begin = len(self.doc_ids)
+        for doc in doc_ids:
+            self.doc_ids.append(doc)
+            self._rows.append(sorted(
+                (self.term2id.setdefault(term, len(self.term2id)), value)
+                for term, value in doc2values.get(doc, [])))
+
+        if source_id is not None:
+            if source_id in self.source2rows:
+                raise RuntimeError("Duplicate source {0} in "
+                                   "TFIDFIndex".format(source_id))
+            self.source2rows[source_id] = (begin, len(self.doc_ids))
+
+    def finalize(self):
+        """Converts the rows added by add_documents() to the CSR arrays."""
+        lengths = [len(x) for x in self._rows]
+        self.indptr = np.zeros(len(self._rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.indptr[1:])
+        self.indices = np.array([x[0] for row in self._rows for x in row],
+                                dtype=np.int64)
+        self.data = np.array([x[1] for row in self._rows for x in row],
+                             dtype=np.float64)
+        self._rows = []
+        self._compute_term_keys()
+
+    def _compute_term_keys(self):
+        rows = np.repeat(np.arange(self.num_docs(), dtype=np.int64),
+                         np.diff(self.indptr))
+        keys = self.indices * max(self.num_docs(), 1) + rows
+        order = np.argsort(keys, kind='mergesort')
+        self.term_keys = keys[order]
+        self.term_values = self.data[order]
+
+    def write(self, index_dir):
+        """Writes the index to the directory index_dir. The arrays are
+        stored as .npy files so that they can be memory-mapped by read().
+        """
+        if self.indptr is None:
+            self.finalize()
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+
+        for name in ['indptr', 'indices', 'data',
+                     'term_keys', 'term_values']:
+            np.save(os.path.join(index_dir, name + '.npy'),
+                    getattr(self, name))
+
+        id2term = [None] * len(self.term2id)
+        for term, term_id in self.term2id.items():
+            id2term[term_id] = term
+        with open(os.path.join(index_dir, 'terms.txt'), 'w') as f:
+            for term in id2term:
+                print (" ".join(term), file=f)
+        with open(os.path.join(index_dir, 'docs.txt'), 'w') as f:
+            for doc in self.doc_ids:
+                print (doc, file=f)
+        with open(os.path.join(index_dir, 'sources.txt'), 'w') as f:
+            for source_id, rows in sorted(self.source2rows.items(),
+                                          key=lambda x: x[1]):
+                print ("{0} {1} {2}".format(source_id, rows[0], rows[1]),
+                       file=f)
+
+    def read(self, index_dir, memory_map=True):
+        """Loads the index written by write() from the directory index_dir.
+        If memory_map is True, the arrays are memory-mapped rather than
+        read into memory."""
+        if self.indptr is not None or len(self._rows) > 0:
+            raise RuntimeError("TFIDFIndex object is not empty.")
+
+        for name in ['indptr', 'indices', 'data',
+                     'term_keys', 'term_values']:
+            setattr(self, name,
+                    np.load(os.path.join(index_dir, name + '.npy'),
+                            mmap_mode=('r' if memory_map else None)))
+
+        with open(os.path.join(index_dir, 'terms.txt')) as f:
+            for term_id, line in enumerate(f):
+                self.term2id[tuple(line.split())] = term_id
+        with open(os.path.join(index_dir, 'docs.txt')) as f:
+            self.doc_ids = [line.strip() for line in f]
+        with open(os.path.join(index_dir, 'sources.txt')) as f:
+            for line in f:
+                parts = line.split()
+                self.source2rows[parts[0]] = (int(parts[1]), int(parts[2]))
+
+        if len(self.indptr) != len(self.doc_ids) + 1:
+            raise RuntimeError("Mismatch in number of documents in "
+                               "TFIDFIndex in {0}".format(index_dir))
+
+    def compute_similarity_scores(self, query_tfidfs, row_ranges=None,
+                                  do_length_normalization=False):
+        """Computes the TF-IDF similarity scores between a batch of query
+        documents and the documents in this index as a single sparse
+        matrix product.
+
+        Arguments:
+            query_tfidfs - A list of TFIDF objects, each containing the
+                           values for a single query document.
+            row_ranges - If provided, a list of (begin-row, end-row) tuples,
+                         one per query, so that the query is scored only
+                         against the documents in those rows, e.g. the
+                         rows of a source in source2rows.
+                         Otherwise, each query is scored against all
+                         the documents.
+            do_length_normalization - If True, the scores are normalized
+                                      by the number of terms in the query.
+
+        Returns a list of NumPy arrays, one per query, with the similarity
+        scores of the documents in its range of rows.
+        """
+        num_docs = self.num_docs()
+        if row_ranges is None:
+            row_ranges = [(0, num_docs)] * len(query_tfidfs)
+        assert len(row_ranges) == len(query_tfidfs)
+
+        query_rows = []
+        query_terms = []
+        query_values = []
+        num_terms = np.ones(len(query_tfidfs))
+        for i, query_tfidf in enumerate(query_tfidfs):
+            num_terms[i] = max(len(query_tfidf.tf_idf), 1)
+            for tup, value in query_tfidf.tf_idf.items():
+                term_id = self.term2id.get(tup[0])
+                if term_id is None:
+                    continue
+                query_rows.append(i)
+                query_terms.append(term_id)
+                query_values.append(value)
+
+        query_rows = np.array(query_rows, dtype=np.int64)
+        query_terms = np.array(query_terms, dtype=np.int64)
+        query_values = np.array(query_values, dtype=np.float64)
+
+        begins = np.array([x[0] for x in row_ranges], dtype=np.int64)
+        ends = np.array([x[1] for x in row_ranges], dtype=np.int64)
+        out_offsets = np.zeros(len(row_ranges) + 1, dtype=np.int64)
+        np.cumsum(ends - begins, out=out_offsets[1:])
+
+        # Find the range of entries of each query term in term_keys that
+        # belong to the documents in the query's range of rows.
+        stride = max(num_docs, 1)
+        first = np.searchsorted(
+            self.term_keys, query_terms * stride + begins[query_rows])
+        last = np.searchsorted(
+            self.term_keys, query_terms * stride + ends[query_rows])
+        lengths = last - first
+
+        # Expand the (query, term) pairs into one entry per document
+        # containing the term.
+        total = int(lengths.sum())
+        entry_offsets = np.cumsum(lengths) - lengths
+        positions = (np.repeat(first - entry_offsets, lengths)
+                     + np.arange(total, dtype=np.int64))
+        entry_rows = np.repeat(query_rows, lengths)
+        docs = self.term_keys[positions] % stride
+        values = (np.repeat(query_values, lengths)
+                  * self.term_values[positions])
+
+        scores = np.bincount(
+            out_offsets[entry_rows] + docs - begins[entry_rows],
+            weights=values, minlength=int(out_offsets[-1]))
+
+        output = []
+        for i in range(len(query_tfidfs)):
+            query_scores = scores[out_offsets[i]:out_offsets[i+1]]
+            if do_length_normalization:
+                query_scores = query_scores / num_terms[i]
+            output.append(query_scores)
+        return output
+
+    @staticmethod
+    def get_top_k(scores, k=1):
+        """Returns the indexes of the k highest scores in the NumPy array
+        'scores' in decreasing order of the scores. Ties are broken in
+        favour of the lower index."""
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        if k < len(scores):
+            candidates = np.argpartition(-scores, k - 1)[:k]
+            threshold = scores[candidates].min()
+            candidates = np.nonzero(scores >= threshold)[0]
+        else:
+            candidates = np.arange(len(scores))
+        order = np.lexsort((candidates, -scores[candidates]))
+        return [int(x) for x in candidates[order][:k]]
+
+
 def write_tfidf_from_stats(
         tf_stats, idf_stats, tf_idf_file, tf_weighting_scheme="raw",
         idf_weighting_scheme="log", tf_normalization_factor=0.5,
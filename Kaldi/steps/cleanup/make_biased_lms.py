@@ -4,8 +4,12 @@ from __future__ import print_function
 import sys
 import argparse
 import math
-import subprocess
-from collections import defaultdict
+import shlex
+import multiprocessing
+from collections import defaultdict, deque
+
+sys.path.insert(0, 'steps/cleanup/internal')
+import make_one_biased_lm
 
 parser = argparse.ArgumentParser(description="""
 This script is a wrapper for make_one_biased_lm.py that reads a Kaldi archive
@@ -13,7 +17,9 @@ of (integerized) text data from the standard input and writes a Kaldi archive of
 backoff-language-model FSTs to the standard-output.  It takes care of
 grouping utterances to respect the --min-words-per-graph option.  It writes
 the graphs to the standard output and also outputs a map from input utterance-ids
-to the per-group utterance-ids that index the output graphs.""")
+to the per-group utterance-ids that index the output graphs.  The LMs are built
+in-process (see MakeBiasedLm() in make_one_biased_lm.py), optionally in a pool
+of --num-workers processes.""")
 
 parser.add_argument("--lm-opts", type = str, default = "",
                     help = "Options to pass in to make_one_biased_lm.py (which "
@@ -22,6 +28,10 @@ parser.add_argument("--min-words-per-graph", type = int, default = 100,
                     help = "Minimum number of words per utterance group; this program "
                     "will try to arrange the input utterances into groups such that each "
                     "one has at least this many words in total.")
+parser.add_argument("--num-workers", type = int, default = 1,
+                    help = "Number of processes in which the LMs of the utterance "
+                    "groups are built; if 1, they are built in this process.  The "
+                    "graphs are output in the order of the input in any case.")
 parser.add_argument("utterance_map", type = str,
                     help = "Filename to which a map from input utterances to grouped "
                     "utterances, is written")
@@ -30,16 +40,46 @@ args = parser.parse_args()
 
 
 
+if args.num_workers < 1:
+    sys.exit("make_biased_lms.py: --num-workers must be at least 1")
+
+# The options of make_one_biased_lm.py are parsed, and the top-words file read,
+# just once.
+try:
+    lm_args = make_one_biased_lm.parser.parse_args(shlex.split(args.lm_opts))
+except SystemExit:
+    sys.exit("make_biased_lms.py: error parsing --lm-opts='{0}'".format(
+            args.lm_opts))
+top_words = None
+if lm_args.top_words != None:
+    top_words = make_one_biased_lm.ReadTopWords(lm_args.top_words)
+
 try:
     utterance_map_file = open(args.utterance_map, "w")
 except:
     sys.exit("make_biased_lms.py: error opening {0} to write utterance map".format(
             args.utterance_map))
 
-# This processes one group of input lines; 'group_of_lines' is
-# an array of lines of input integerized text, e.g.
-# [ 'utt1 67 89 432', 'utt2 89 48 62' ]
-def ProcessGroupOfLines(group_of_lines):
+
+# This function builds the LM for one group of lines of integerized text (with
+# the utterance-ids removed), and returns it as a text-form FST.  It's called
+# in the worker processes if --num-workers > 1; they get 'lm_args' and
+# 'top_words' from this process when they are forked.
+def MakeLmForGroup(lines_of_group):
+    try:
+        ngram_counts = make_one_biased_lm.MakeBiasedLm(lines_of_group, lm_args,
+                                                       top_words)
+        return ''.join(ngram_counts.GetFstText(lm_args.word_disambig_symbol))
+    except SystemExit as e:
+        # make_one_biased_lm.py exits on errors; a worker process must not
+        # exit, or the pool would wait for its result forever.
+        raise Exception(str(e))
+
+# This function prints to the utterance-map file the map from the utterances in
+# 'group_of_lines' (an array of lines of input integerized text, e.g.
+# [ 'utt1 67 89 432', 'utt2 89 48 62' ]) to the group utterance-id, and returns
+# (group-utterance-id, the lines without the utterance-ids).
+def GetGroupOfLines(group_of_lines):
     num_lines = len(group_of_lines)
     try:
         first_utterance_id = group_of_lines[0].split()[0]
@@ -47,51 +87,88 @@ def ProcessGroupOfLines(group_of_lines):
         sys.exit("make_biased_lms.py: empty input line")
 
     group_utterance_id = '{0}-group-of-{1}'.format(first_utterance_id, num_lines)
-    # print the group utterance-id to the stdout; it forms the name in
-    # the text-form archive.
+    lines_of_group = []
+    for line in group_of_lines:
+        a = line.split()
+        if len(a) == 0:
+            sys.exit("make_biased_lms.py: empty input line")
+        utterance_id = a[0]
+        # print <utt> <utt-group> to utterance-map file
+        print(utterance_id, group_utterance_id, file = utterance_map_file)
+        lines_of_group.append(' '.join(a[1:]))  # get rid of utterance id.
+    return (group_utterance_id, lines_of_group)
+
+# This function prints the FST for a group of utterances to the standard
+# output, in the Kaldi fst-archive format.
+def PrintFst(group_utterance_id, fst_text):
+    # the group utterance-id forms the name in the text-form archive.
     print(group_utterance_id)
-    sys.stdout.flush()
-
-    try:
-        command = "steps/cleanup/internal/make_one_biased_lm.py " + args.lm_opts
-        p = subprocess.Popen(command, shell = True, stdin = subprocess.PIPE,
-                            stdout = sys.stdout, stderr = sys.stderr)
-        for line in group_of_lines:
-            a = line.split()
-            if len(a) == 0:
-                sys.exit("make_biased_lms.py: empty input line")
-            utterance_id = a[0]
-            # print <utt> <utt-group> to utterance-map file
-            print(utterance_id, group_utterance_id, file = utterance_map_file)
-            rest_of_line = ' '.join(a[1:])  # get rid of utterance id.
-            print(rest_of_line, file=p.stdin)
-        p.stdin.close()
-        assert p.wait() == 0
-    except Exception as e:
-        sys.exit("make_biased_lms.py: error calling subprocess, command was: " +
-                 command + ", error was : " + str(e))
+    sys.stdout.write(fst_text)
     # Print a blank line; this terminates the FST in the Kaldi fst-archive
     # format.
     print("")
     sys.stdout.flush()
 
-
-
-num_words_this_group = 0
-this_group_of_lines = []  # An array of strings, one per line
-
-while True:
-    line = sys.stdin.readline();
-    num_words_this_group += len(line.split())
-    if line != '':
-        this_group_of_lines.append(line)
-    if num_words_this_group >= args.min_words_per_graph or \
-        (line == '' and len(this_group_of_lines) != 0):
-        ProcessGroupOfLines(this_group_of_lines)
-        num_words_this_group = 0
-        this_group_of_lines = []
-    if line == '':
-        break
+# This function returns the FST text from 'result', which is an AsyncResult
+# of MakeLmForGroup() if --num-workers > 1, or the lines of the group
+# (for which MakeLmForGroup() is called here) otherwise.
+def GetFstText(group_utterance_id, result):
+    try:
+        if args.num_workers == 1:
+            return MakeLmForGroup(result)
+        return result.get()
+    except Exception as e:
+        sys.exit("make_biased_lms.py: error making the LM for {0}, error "
+                 "was: {1}".format(group_utterance_id, str(e)))
+
+# This function prints the FSTs of the groups in 'pending' (see below), in
+# order, until at most 'max_pending' groups remain.
+def PrintPendingFsts(max_pending):
+    while len(pending) > max_pending:
+        (group_utterance_id, result) = pending.popleft()
+        PrintFst(group_utterance_id, GetFstText(group_utterance_id, result))
+
+# This generator yields the groups of input lines, grouped to respect the
+# --min-words-per-graph option.
+def ReadGroupsOfLines():
+    num_words_this_group = 0
+    this_group_of_lines = []  # An array of strings, one per line
+
+    while True:
+        line = sys.stdin.readline();
+        num_words_this_group += len(line.split())
+        if line != '':
+            this_group_of_lines.append(line)
+        if num_words_this_group >= args.min_words_per_graph or \
+            (line == '' and len(this_group_of_lines) != 0):
+            yield this_group_of_lines
+            num_words_this_group = 0
+            this_group_of_lines = []
+        if line == '':
+            break
+
+
+if args.num_workers > 1:
+    pool = multiprocessing.Pool(args.num_workers)
+# 'pending' contains (group-utterance-id, result) for the groups whose FSTs
+# have not been printed yet, in the input order.  We keep at most
+# 2 * num_workers groups in the pool, so that the workers are kept busy while
+# this process prints the FSTs, but the input isn't read ahead without limit.
+pending = deque()
+for group_of_lines in ReadGroupsOfLines():
+    (group_utterance_id, lines_of_group) = GetGroupOfLines(group_of_lines)
+    if args.num_workers == 1:
+        pending.append((group_utterance_id, lines_of_group))
+    else:
+        pending.append((group_utterance_id,
+                        pool.apply_async(MakeLmForGroup, (lines_of_group,))))
+    PrintPendingFsts(2 * args.num_workers - 1)
+PrintPendingFsts(0)
+
+if args.num_workers > 1:
+    pool.close()
+    pool.join()
+utterance_map_file.close()
 
 
 # test comand [to be run from ../..]
@@ -101,3 +178,5 @@ while True:
 # (echo utt1 6 7 8 4; echo utt2 7 8 9; echo utt3 7 8) | steps/cleanup/make_biased_lms.py --lm-opts='--word-disambig-symbol=1000 --top-words=top_words.txt' foo; cat foo
 
 # (echo utt1 6 7 8 4; echo utt2 7 8 9; echo utt3 7 8) | steps/cleanup/make_biased_lms.py --min-words-per-graph=4 --lm-opts='--word-disambig-symbol=1000 --top-words=top_words.txt' foo; cat foo
+
+# (echo utt1 6 7 8 4; echo utt2 7 8 9; echo utt3 7 8) | steps/cleanup/make_biased_lms.py --min-words-per-graph=4 --num-workers=2 --lm-opts='--word-disambig-symbol=1000 --top-words=top_words.txt' foo; cat foo
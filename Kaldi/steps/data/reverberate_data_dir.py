@@ -8,6 +8,10 @@ from __future__ import print_function
 import argparse, shlex, glob, math, os, random, sys, warnings, copy, imp, ast
 
 data_lib = imp.load_source('dml', 'steps/data/data_dir_manipulation_lib.py')
+reverberation_lib = imp.load_source('rvbl', 'steps/data/reverberation_lib.py')
+wav_duration_lib = imp.load_source('wdl', 'steps/libs/wav_duration.py')
+data_dir_lib = imp.load_source('ddl', 'steps/libs/data_dir.py')
+validate_lib = imp.load_source('vdl', 'steps/libs/validate_data_dir.py')
 
 def GetArgs():
     # we add required arguments as named arguments for readability
@@ -71,6 +75,13 @@ def GetArgs():
                         "the RIRs/noises will be resampled to the rate of the source data.")
     parser.add_argument("--include-original-data", type=str, help="If true, the output data includes one copy of the original data",
                          choices=['true', 'false'], default = "false")
+    parser.add_argument("--output-audio-dir", type=str, default = None,
+                        help="If specified, the reverberated recordings are computed by this script (which requires numpy) "
+                        "and written to this directory as wav files, which the output wav.scp refers to, "
+                        "instead of the output wav.scp containing wav-reverberate commands that are rerun each time it is read. "
+                        "The RIRs and noises must be 16-bit wav files, or commands that output them.")
+    parser.add_argument("--num-jobs", type=int, default = 1,
+                        help="Number of processes that compute the reverberated recordings, if --output-audio-dir is specified")
     parser.add_argument("input_dir",
                         help="Input data directory")
     parser.add_argument("output_dir",
@@ -117,6 +128,15 @@ def CheckArgs(args):
     if args.source_sampling_rate is not None and args.source_sampling_rate <= 0:
         raise Exception("--source-sampling-rate cannot be non-positive")
 
+    if args.num_jobs < 1:
+        raise Exception("--num-jobs must be positive")
+
+    if args.output_audio_dir is not None:
+        if not reverberation_lib.g_numpy:
+            raise Exception("--output-audio-dir requires numpy")
+        if not os.path.exists(args.output_audio_dir):
+            os.makedirs(args.output_audio_dir)
+
     return args
 
 
@@ -132,62 +152,57 @@ class list_cyclic_iterator:
     return item
 
 
-# This functions picks an item from the collection according to the associated probability distribution.
-# The probability estimate of each item in the collection is stored in the "probability" field of 
+# This class picks items from a collection according to the associated probability distribution,
+# in constant time per draw, using Walker's alias method. The tables are built once, so a sampler
+# should be created once for each collection and used for all the draws from it.
+# The probability estimate of each item in the collection is stored in the "probability" field of
 # the particular item. x : a collection (list or dictionary) where the values contain a field called probability
-def PickItemWithProbability(x):
-   if isinstance(x, dict):
-     plist = list(set(x.values()))
-   else:
-     plist = x
-   total_p = sum(item.probability for item in plist)
-   p = random.uniform(0, total_p)
-   accumulate_p = 0
-   for item in plist:
-      if accumulate_p + item.probability >= p:
-         return item
-      accumulate_p += item.probability
-   assert False, "Shouldn't get here as the accumulated probability should always equal to 1"
-
-
-# This function parses a file and pack the data into a dictionary
-# It is useful for parsing file like wav.scp, utt2spk, text...etc
-def ParseFileToDict(file, assert2fields = False, value_processor = None):
-    if value_processor is None:
-        value_processor = lambda x: x[0]
-
-    dict = {}
-    for line in open(file, 'r'):
-        parts = line.split()
-        if assert2fields:
-            assert(len(parts) == 2)
-
-        dict[parts[0]] = value_processor(parts[1:])
-    return dict
-
-# This function creates a file and write the content of a dictionary into it
-def WriteDictToFile(dict, file_name):
-    file = open(file_name, 'w')
-    keys = dict.keys()
-    keys.sort()
-    for key in keys:
-        value = dict[key]
-        if type(value) in [list, tuple] :
-            if type(value) is tuple:
-                value = list(value)
-            value.sort()
-            value = ' '.join(str(value))
-        file.write('{0} {1}\n'.format(key, value))
-    file.close()
+# The draws use the random module, so they are reproducible for a given --random-seed.
+class alias_sampler:
+  def __init__(self, x):
+    if isinstance(x, dict):
+      # the items are ordered by key, so that the draws don't depend on where the items are in memory
+      self.items = [x[key] for key in sorted(x.keys())]
+    else:
+      self.items = list(x)
+    num_items = len(self.items)
+    total_p = float(sum(item.probability for item in self.items))
+    # item i is picked if the draw falls in the first threshold[i] of the i'th bin,
+    # and item alias[i] otherwise
+    if total_p > 0:
+      scaled_p = [item.probability * num_items / total_p for item in self.items]
+    else:
+      scaled_p = [1.0] * num_items
+    self.threshold = [1.0] * num_items
+    self.alias = list(range(num_items))
+    small = [i for i in range(num_items) if scaled_p[i] < 1.0]
+    large = [i for i in range(num_items) if scaled_p[i] >= 1.0]
+    while len(small) > 0 and len(large) > 0:
+      i = small.pop()
+      j = large[-1]
+      self.threshold[i] = scaled_p[i]
+      self.alias[i] = j
+      scaled_p[j] -= 1.0 - scaled_p[i]
+      if scaled_p[j] < 1.0:
+        small.append(large.pop())
+    # the bins left in either list are full, up to rounding errors
+
+  def __len__(self):
+    return len(self.items)
+
+  def pick(self):
+    u = random.random() * len(self.items)
+    i = min(int(u), len(self.items) - 1)
+    if u - i < self.threshold[i]:
+      return self.items[i]
+    return self.items[self.alias[i]]
 
 
 # This function creates the utt2uniq file from the utterance id in utt2spk file
 def CreateCorruptedUtt2uniq(input_dir, output_dir, num_replicas, include_original, prefix):
     corrupted_utt2uniq = {}
     # Parse the utt2spk to get the utterance id
-    utt2spk = ParseFileToDict(input_dir + "/utt2spk", value_processor = lambda x: " ".join(x))
-    keys = utt2spk.keys()
-    keys.sort()
+    keys = list(data_dir_lib.TableFile(input_dir + "/utt2spk").keys())
     if include_original:
         start_index = 0
     else:
@@ -198,31 +213,33 @@ def CreateCorruptedUtt2uniq(input_dir, output_dir, num_replicas, include_origina
             new_utt_id = GetNewId(utt_id, prefix, i)
             corrupted_utt2uniq[new_utt_id] = utt_id
 
-    WriteDictToFile(corrupted_utt2uniq, output_dir + "/utt2uniq")
+    data_dir_lib.write_table(output_dir + "/utt2uniq", corrupted_utt2uniq.items())
 
 
 def AddPointSourceNoise(noise_addition_descriptor,  # descriptor to store the information of the noise added
                         room,  # the room selected
-                        pointsource_noise_list, # the point source noise list
+                        pointsource_noise_sampler, # the sampler of the point source noise list
                         pointsource_noise_addition_probability, # Probability of adding point-source noises
                         foreground_snrs, # the SNR for adding the foreground noises
                         background_snrs, # the SNR for adding the background noises
                         speech_dur,  # duration of the recording
                         max_noises_recording  # Maximum number of point-source noises that can be added
                         ):
-    if len(pointsource_noise_list) > 0 and random.random() < pointsource_noise_addition_probability and max_noises_recording >= 1:
+    if len(pointsource_noise_sampler) > 0 and random.random() < pointsource_noise_addition_probability and max_noises_recording >= 1:
         for k in range(random.randint(1, max_noises_recording)):
             # pick the RIR to reverberate the point-source noise
-            noise = PickItemWithProbability(pointsource_noise_list)
-            noise_rir = PickItemWithProbability(room.rir_list)
+            noise = pointsource_noise_sampler.pick()
+            noise_rir = room.rir_sampler.pick()
             # If it is a background noise, the noise will be extended and be added to the whole speech
             # if it is a foreground noise, the noise will not extended and be added at a random time of the speech
             if noise.bg_fg_type == "background":
                 noise_rvb_command = """wav-reverberate --impulse-response="{0}" --duration={1}""".format(noise_rir.rir_rspecifier, speech_dur)
+                noise_addition_descriptor['noise_specs'].append((noise.noise_rspecifier, noise_rir.rir_rspecifier, speech_dur))
                 noise_addition_descriptor['start_times'].append(0)
                 noise_addition_descriptor['snrs'].append(background_snrs.next())
             else:
                 noise_rvb_command = """wav-reverberate --impulse-response="{0}" """.format(noise_rir.rir_rspecifier)
+                noise_addition_descriptor['noise_specs'].append((noise.noise_rspecifier, noise_rir.rir_rspecifier, None))
                 noise_addition_descriptor['start_times'].append(round(random.random() * speech_dur, 2))
                 noise_addition_descriptor['snrs'].append(foreground_snrs.next())
 
@@ -237,10 +254,11 @@ def AddPointSourceNoise(noise_addition_descriptor,  # descriptor to store the in
 
 # This function randomly decides whether to reverberate, and sample a RIR if it does
 # It also decides whether to add the appropriate noises 
-# This function return the string of options to the binary wav-reverberate
-def GenerateReverberationOpts(room_dict,  # the room dictionary, please refer to MakeRoomDict() for the format
-                              pointsource_noise_list, # the point source noise list
-                              iso_noise_dict, # the isotropic noise dictionary
+# This function returns the string of options to the binary wav-reverberate, and the descriptor
+# of the reverberation, from which steps/data/reverberation_lib.py computes the same output
+def GenerateReverberationOpts(room_sampler,  # the sampler of the room dictionary, please refer to MakeRoomSamplers()
+                              pointsource_noise_sampler, # the sampler of the point source noise list
+                              iso_noise_samplers, # the samplers of the isotropic noise lists, indexed by the room
                               foreground_snrs, # the SNR for adding the foreground noises
                               background_snrs, # the SNR for adding the background noises
                               speech_rvb_probability, # Probability of reverberating a speech signal
@@ -251,35 +269,36 @@ def GenerateReverberationOpts(room_dict,  # the room dictionary, please refer to
                               ):
     reverberate_opts = ""
     noise_addition_descriptor = {'noise_io': [],
+                                 'noise_specs': [],
                                  'start_times': [],
-                                 'snrs': []}
+                                 'snrs': [],
+                                 'impulse_response': None}
     # Randomly select the room
     # Here the room probability is a sum of the probabilities of the RIRs recorded in the room.
-    room = PickItemWithProbability(room_dict)
+    room = room_sampler.pick()
     # Randomly select the RIR in the room
-    speech_rir = PickItemWithProbability(room.rir_list)
+    speech_rir = room.rir_sampler.pick()
     if random.random() < speech_rvb_probability:
         # pick the RIR to reverberate the speech
         reverberate_opts += """--impulse-response="{0}" """.format(speech_rir.rir_rspecifier)
+        noise_addition_descriptor['impulse_response'] = speech_rir.rir_rspecifier
 
-    rir_iso_noise_list = []
-    if speech_rir.room_id in iso_noise_dict:
-        rir_iso_noise_list = iso_noise_dict[speech_rir.room_id]
     # Add the corresponding isotropic noise associated with the selected RIR
-    if len(rir_iso_noise_list) > 0 and random.random() < isotropic_noise_addition_probability:
-        isotropic_noise = PickItemWithProbability(rir_iso_noise_list)
+    if speech_rir.room_id in iso_noise_samplers and random.random() < isotropic_noise_addition_probability:
+        isotropic_noise = iso_noise_samplers[speech_rir.room_id].pick()
         # extend the isotropic noise to the length of the speech waveform
         # check if the rspecifier is a pipe or not
         if len(isotropic_noise.noise_rspecifier.split()) == 1:
             noise_addition_descriptor['noise_io'].append("wav-reverberate --duration={1} {0} - |".format(isotropic_noise.noise_rspecifier, speech_dur))
         else:
             noise_addition_descriptor['noise_io'].append("{0} wav-reverberate --duration={1} - - |".format(isotropic_noise.noise_rspecifier, speech_dur))
+        noise_addition_descriptor['noise_specs'].append((isotropic_noise.noise_rspecifier, None, speech_dur))
         noise_addition_descriptor['start_times'].append(0)
         noise_addition_descriptor['snrs'].append(background_snrs.next())
 
     noise_addition_descriptor = AddPointSourceNoise(noise_addition_descriptor,  # descriptor to store the information of the noise added
                                                     room,  # the room selected
-                                                    pointsource_noise_list, # the point source noise list
+                                                    pointsource_noise_sampler, # the sampler of the point source noise list
                                                     pointsource_noise_addition_probability, # Probability of adding point-source noises
                                                     foreground_snrs, # the SNR for adding the foreground noises
                                                     background_snrs, # the SNR for adding the background noises
@@ -294,7 +313,7 @@ def GenerateReverberationOpts(room_dict,  # the room dictionary, please refer to
         reverberate_opts += "--start-times='{0}' ".format(','.join(map(lambda x:str(x), noise_addition_descriptor['start_times'])))
         reverberate_opts += "--snrs='{0}' ".format(','.join(map(lambda x:str(x), noise_addition_descriptor['snrs'])))
 
-    return reverberate_opts
+    return reverberate_opts, noise_addition_descriptor
 
 # This function generates a new id from the input id
 # This is needed when we have to create multiple copies of the original data
@@ -327,11 +346,22 @@ def GenerateReverberatedWavScp(wav_scp,  # a dictionary whose values are the Kal
                                shift_output, # option whether to shift the output waveform
                                isotropic_noise_addition_probability, # Probability of adding isotropic noises
                                pointsource_noise_addition_probability, # Probability of adding point-source noises
-                               max_noises_per_minute # maximum number of point-source noises that can be added to a recording according to its duration
+                               max_noises_per_minute, # maximum number of point-source noises that can be added to a recording according to its duration
+                               output_audio_dir = None, # if not None, the directory where the reverberated recordings are written
+                               num_jobs = 1 # number of processes that compute the reverberated recordings
                                ):
     foreground_snrs = list_cyclic_iterator(foreground_snr_array)
     background_snrs = list_cyclic_iterator(background_snr_array)
+    # the samplers are built once, and used for all the recordings and replicas
+    room_sampler = MakeRoomSamplers(room_dict)
+    pointsource_noise_sampler = alias_sampler(pointsource_noise_list)
+    iso_noise_samplers = {}
+    for room_id in iso_noise_dict.keys():
+        iso_noise_samplers[room_id] = alias_sampler(iso_noise_dict[room_id])
     corrupted_wav_scp = {}
+    # the recordings to compute in-process if output_audio_dir is specified,
+    # a list of (input-rspecifier, descriptor, output-filename)
+    reverberation_jobs = []
     keys = wav_scp.keys()
     keys.sort()
     if include_original:
@@ -348,9 +378,9 @@ def GenerateReverberatedWavScp(wav_scp,  # a dictionary whose values are the Kal
             speech_dur = durations[recording_id]
             max_noises_recording = math.floor(max_noises_per_minute * speech_dur / 60)
 
-            reverberate_opts = GenerateReverberationOpts(room_dict,  # the room dictionary, please refer to MakeRoomDict() for the format
-                                                         pointsource_noise_list, # the point source noise list
-                                                         iso_noise_dict, # the isotropic noise dictionary
+            reverberate_opts, descriptor = GenerateReverberationOpts(room_sampler,  # the sampler of the room dictionary, please refer to MakeRoomSamplers()
+                                                         pointsource_noise_sampler, # the sampler of the point source noise list
+                                                         iso_noise_samplers, # the samplers of the isotropic noise lists, indexed by the room
                                                          foreground_snrs, # the SNR for adding the foreground noises
                                                          background_snrs, # the SNR for adding the background noises
                                                          speech_rvb_probability, # Probability of reverberating a speech signal
@@ -361,15 +391,22 @@ def GenerateReverberatedWavScp(wav_scp,  # a dictionary whose values are the Kal
                                                          )       
 
             # prefix using index 0 is reserved for original data e.g. rvb0_swb0035 corresponds to the swb0035 recording in original data
+            new_recording_id = GetNewId(recording_id, prefix, i)
             if reverberate_opts == "" or i == 0:
                 wav_corrupted_pipe = "{0}".format(wav_original_pipe) 
+            elif output_audio_dir is not None:
+                wav_corrupted_pipe = os.path.abspath("{0}/{1}.wav".format(output_audio_dir, new_recording_id))
+                reverberation_jobs.append((wav_scp[recording_id], descriptor, wav_corrupted_pipe))
             else:
                 wav_corrupted_pipe = "{0} wav-reverberate --shift-output={1} {2} - - |".format(wav_original_pipe, shift_output, reverberate_opts)
 
-            new_recording_id = GetNewId(recording_id, prefix, i)
             corrupted_wav_scp[new_recording_id] = wav_corrupted_pipe
 
-    WriteDictToFile(corrupted_wav_scp, output_dir + "/wav.scp")
+    if len(reverberation_jobs) > 0:
+        print("Computing {0} reverberated recordings...".format(len(reverberation_jobs)))
+        reverberation_lib.ReverberateRecordings(reverberation_jobs, shift_output == "true", num_jobs)
+
+    data_dir_lib.write_table(output_dir + "/wav.scp", corrupted_wav_scp.items())
 
 
 # This function replicate the entries in files like segments, utt2spk, text
@@ -408,11 +445,14 @@ def CreateReverberatedCopy(input_dir,
                            shift_output, # option whether to shift the output waveform
                            isotropic_noise_addition_probability, # Probability of adding isotropic noises
                            pointsource_noise_addition_probability, # Probability of adding point-source noises
-                           max_noises_per_minute  # maximum number of point-source noises that can be added to a recording according to its duration
+                           max_noises_per_minute,  # maximum number of point-source noises that can be added to a recording according to its duration
+                           output_audio_dir = None, # if not None, the directory where the reverberated recordings are written
+                           num_jobs = 1 # number of processes that compute the reverberated recordings
                            ):
     
-    wav_scp = ParseFileToDict(input_dir + "/wav.scp", value_processor = lambda x: " ".join(x))
-    if not os.path.isfile(input_dir + "/reco2dur"):
+    data = data_dir_lib.DataDir(input_dir)
+    wav_scp = data["wav.scp"].to_dict(value_processor = lambda x: " ".join(x))
+    if not data.has("reco2dur"):
         print("Getting the duration of the recordings...");
         read_entire_file="false"
         for value in wav_scp.values():
@@ -420,15 +460,24 @@ def CreateReverberatedCopy(input_dir,
             if "sox" in value and "speed" in value:
                 read_entire_file="true"
                 break
-        data_lib.RunKaldiCommand("wav-to-duration --read-entire-file={1} scp:{0}/wav.scp ark,t:{0}/reco2dur".format(input_dir, read_entire_file))
-    durations = ParseFileToDict(input_dir + "/reco2dur", value_processor = lambda x: float(x[0]))
+        # the durations are read from the wav headers in-process, rather than
+        # by running wav-to-duration, which runs every command of the wav.scp
+        durations = wav_duration_lib.get_durations(sorted(wav_scp.items()),
+                                                   read_entire_file = (read_entire_file == "true"))
+        if len(durations) != len(wav_scp):
+            missing = set(wav_scp.keys()) - set([x[0] for x in durations])
+            raise Exception("Could not get the duration of {0} of the recordings in {1}/wav.scp, e.g. {2}".format(
+                            len(missing), input_dir, sorted(missing)[0]))
+        data.write("reco2dur", [(recording_id, wav_duration_lib.format_duration(duration))
+                                for (recording_id, duration) in durations], is_sorted = True)
+    durations = data["reco2dur"].to_dict(value_processor = lambda x: float(x[0]))
     foreground_snr_array = map(lambda x: float(x), foreground_snr_string.split(':'))
     background_snr_array = map(lambda x: float(x), background_snr_string.split(':'))
 
     GenerateReverberatedWavScp(wav_scp, durations, output_dir, room_dict, pointsource_noise_list, iso_noise_dict,
                foreground_snr_array, background_snr_array, num_replicas, include_original, prefix, 
                speech_rvb_probability, shift_output, isotropic_noise_addition_probability, 
-               pointsource_noise_addition_probability, max_noises_per_minute)
+               pointsource_noise_addition_probability, max_noises_per_minute, output_audio_dir, num_jobs)
 
     AddPrefixToFields(input_dir + "/utt2spk", output_dir + "/utt2spk", num_replicas, include_original, prefix, field = [0,1])
     data_lib.RunKaldiCommand("utils/utt2spk_to_spk2utt.pl <{output_dir}/utt2spk >{output_dir}/spk2utt"
@@ -447,8 +496,13 @@ def CreateReverberatedCopy(input_dir,
     if os.path.isfile(input_dir + "/reco2file_and_channel"):
         AddPrefixToFields(input_dir + "/reco2file_and_channel", output_dir + "/reco2file_and_channel", num_replicas, include_original, prefix, field = [0,1])
 
-    data_lib.RunKaldiCommand("utils/validate_data_dir.sh --no-feats {output_dir}"
-                    .format(output_dir = output_dir))
+    report = validate_lib.validate_data_dir(output_dir, no_feats = True,
+                                            num_jobs = max(num_jobs, 4))
+    messages = validate_lib.format_report(report, sys.argv[0])
+    if not report['valid']:
+        raise Exception("There was an error validating {0}:\n{1}".format(output_dir, messages))
+    if messages != '':
+        print(messages, file=sys.stderr)
 
 
 # This function smooths the probability distribution in the list
@@ -569,6 +623,14 @@ def MakeRoomDict(rir_list):
     return room_dict
 
 
+# This function creates the sampler of the rooms in the room dictionary, and the sampler of the RIRs
+# of each room, which is stored in its attribute "rir_sampler"
+def MakeRoomSamplers(room_dict):
+    for key in room_dict.keys():
+        room_dict[key].rir_sampler = alias_sampler(room_dict[key].rir_list)
+    return alias_sampler(room_dict)
+
+
 # This function creates the point-source noise list 
 # and the isotropic noise dictionary from the noise information file
 # The isotropic noise dictionary is indexed by the room
@@ -660,7 +722,9 @@ def Main():
                            shift_output = args.shift_output,
                            isotropic_noise_addition_probability = args.isotropic_noise_addition_probability,
                            pointsource_noise_addition_probability = args.pointsource_noise_addition_probability,
-                           max_noises_per_minute = args.max_noises_per_minute)
+                           max_noises_per_minute = args.max_noises_per_minute,
+                           output_audio_dir = args.output_audio_dir,
+                           num_jobs = args.num_jobs)
 
 if __name__ == "__main__":
     Main()
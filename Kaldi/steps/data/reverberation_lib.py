@@ -0,0 +1,292 @@
+# Apache 2.0
+
+""" This module reverberates recordings and adds noises to them in-process
+with numpy, doing what the 'wav-reverberate' pipes in the wav.scp written by
+steps/data/reverberate_data_dir.py do, so that the augmented audio can be
+written to disk once instead of being recomputed by every pass over the
+wav.scp.
+
+A recording is corrupted according to a reverberation descriptor, as returned
+by GenerateReverberationOpts() in reverberate_data_dir.py: a dict with the
+keys
+    'impulse_response': the rspecifier of the RIR of the speech, or None
+    'noise_specs': for each additive noise, a tuple (noise-rspecifier,
+        rir-rspecifier or None, duration or None), i.e. what the
+        'wav-reverberate' command of the noise in --additive-signals is
+        given; if the duration is given the noise is repeated or trimmed to
+        that duration
+    'start_times', 'snrs': the start time and SNR of each noise
+The computation follows wav-reverberate: the RIR is scaled by 1/2^15, the
+noises are scaled to their SNR relative to the power of the early
+reverberation of the speech (from 1ms before to 50ms after the peak of the
+RIR), the output is normalized to the power of the input, and with
+shift_output it is shifted by the position of the peak of the RIR and has
+the length of the input.  The convolutions are done by FFT-based overlap-add
+with the same block sizes as wav-reverberate.
+
+The RIRs and noises are read once, by ReverberateRecordings() before it
+starts the worker processes, which share them, and the FFTs of the RIRs are
+cached in each worker.
+"""
+
+import io
+import multiprocessing
+import subprocess
+import wave
+
+try:
+    import numpy as np
+    g_numpy = True
+except ImportError:
+    g_numpy = False
+
+
+# A dict from rspecifier to (sampling-rate, signal) for the RIRs and noises,
+# filled by LoadSignals(); the signals are float32 numpy arrays of the first
+# channel, with the sample values of the 16-bit wav files.
+g_signal_cache = {}
+# A dict from (rir-rspecifier, fft-length) to the FFT of the RIR.
+g_rir_fft_cache = {}
+
+
+def ReadWave(rspecifier):
+    """ Reads the wav file or the output of the piped command 'rspecifier'
+    (e.g. 'sox in.wav -t wav - |'), and returns (sampling-rate, signal),
+    where signal is a float32 numpy array of the first channel.  Only 16-bit
+    PCM wav files are supported. """
+    rspecifier = rspecifier.strip()
+    if rspecifier.endswith('|'):
+        p = subprocess.Popen(rspecifier[:-1], shell = True,
+                             stdout = subprocess.PIPE)
+        data = p.communicate()[0]
+        if p.returncode != 0:
+            raise Exception("Command exited with status {0}: {1}".format(
+                p.returncode, rspecifier))
+    else:
+        with open(rspecifier, 'rb') as f:
+            data = f.read()
+    w = wave.open(io.BytesIO(data), 'rb')
+    try:
+        if w.getsampwidth() != 2:
+            raise Exception("Only 16-bit wav files are supported: "
+                            "{0}".format(rspecifier))
+        num_channels = w.getnchannels()
+        samples = np.frombuffer(w.readframes(w.getnframes()), dtype='<i2')
+        return (w.getframerate(),
+                samples[0::num_channels].astype(np.float32))
+    finally:
+        w.close()
+
+
+def WriteWave(filename, sampling_rate, signal):
+    """ Writes the signal (with the sample values of a 16-bit wav file) to a
+    16-bit wav file, truncating and clipping the values like Kaldi does. """
+    samples = np.clip(np.trunc(signal), -32768, 32767).astype('<i2')
+    w = wave.open(filename, 'wb')
+    try:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sampling_rate)
+        w.writeframes(samples.tobytes())
+    finally:
+        w.close()
+
+
+def LoadSignals(rspecifiers):
+    """ Reads the signals that are not in g_signal_cache yet. """
+    for rspecifier in rspecifiers:
+        if rspecifier not in g_signal_cache:
+            g_signal_cache[rspecifier] = ReadWave(rspecifier)
+
+
+def _GetSignal(rspecifier):
+    if rspecifier not in g_signal_cache:
+        # the worker was not forked from the process that loaded the signals
+        g_signal_cache[rspecifier] = ReadWave(rspecifier)
+    return g_signal_cache[rspecifier]
+
+
+def _NextPowerOfTwo(n):
+    power = 1
+    while power < n:
+        power *= 2
+    return power
+
+
+def FftConvolve(signal, rir, rir_key = None):
+    """ Returns the convolution of the signal with the RIR (both 1-d numpy
+    arrays), of length len(signal) + len(rir) - 1, computed by overlap-add
+    with blocks of FFTs of length the power of two not less than 4 times the
+    length of the RIR, like FFTbasedBlockConvolveSignals() in Kaldi.  If
+    rir_key is not None, the FFT of the RIR is cached under it. """
+    filter_length = len(rir)
+    output_length = len(signal) + filter_length - 1
+    fft_length = _NextPowerOfTwo(4 * filter_length)
+    block_length = fft_length - filter_length + 1
+    if rir_key is not None and (rir_key, fft_length) in g_rir_fft_cache:
+        rir_fft = g_rir_fft_cache[(rir_key, fft_length)]
+    else:
+        rir_fft = np.fft.rfft(rir.astype(np.float64), fft_length)
+        if rir_key is not None:
+            g_rir_fft_cache[(rir_key, fft_length)] = rir_fft
+
+    num_blocks = max(1, (len(signal) + block_length - 1) // block_length)
+    blocks = np.zeros((num_blocks, block_length), dtype = np.float64)
+    blocks.reshape(-1)[:len(signal)] = signal
+    # all the blocks are transformed together
+    blocks = np.fft.irfft(np.fft.rfft(blocks, fft_length, axis = 1) * rir_fft,
+                          fft_length, axis = 1)
+    # the tail of each block (filter_length - 1 samples, which is less than
+    # block_length) overlaps the start of the next block.
+    tail = filter_length - 1
+    output = np.empty(num_blocks * block_length + tail, dtype = np.float64)
+    output_blocks = output[:num_blocks * block_length].reshape(
+        num_blocks, block_length)
+    output_blocks[:] = blocks[:, :block_length]
+    output_blocks[1:, :tail] += blocks[:-1, block_length:]
+    output[num_blocks * block_length:] = blocks[-1, block_length:]
+    return output[:output_length]
+
+
+def _GetPeakIndex(rir):
+    # the first maximum, like Vector::Max() in Kaldi
+    return int(np.argmax(rir))
+
+
+def _Reverberate(signal, rir_rspecifier, sampling_rate):
+    """ Returns (the reverberated signal, the power of its early
+    reverberation, the index of the peak of the RIR). """
+    (rir_sampling_rate, rir) = _GetSignal(rir_rspecifier)
+    if rir_sampling_rate != sampling_rate:
+        raise Exception("The sampling rate of the RIR {0} ({1}) differs from "
+                        "that of the signal ({2})".format(
+                            rir_rspecifier, rir_sampling_rate, sampling_rate))
+    rir = rir.astype(np.float64) / (1 << 15)
+    peak_index = _GetPeakIndex(rir)
+    early_start = max(0, peak_index - int(0.001 * rir_sampling_rate))
+    early_end = min(len(rir), peak_index + int(0.05 * rir_sampling_rate))
+    early_reverb = FftConvolve(signal, rir[early_start:early_end],
+                               rir_key = ('early', rir_rspecifier))
+    early_power = np.dot(early_reverb, early_reverb) / len(early_reverb)
+    return (FftConvolve(signal, rir, rir_key = rir_rspecifier), early_power,
+            peak_index)
+
+
+def _GetOutput(signal, shift_index, num_input_samples, num_output_samples):
+    """ Returns the output of wav-reverberate from the processed signal: if
+    the output is not longer than the input, its samples from shift_index,
+    and otherwise the num_input_samples samples from shift_index repeated to
+    the length of the output (as wav-reverberate does, also when the output
+    is longer because it is not shifted). """
+    if num_output_samples <= num_input_samples:
+        return signal[shift_index:shift_index + num_output_samples]
+    signal = signal[shift_index:shift_index + num_input_samples]
+    num_repeats = (num_output_samples + len(signal) - 1) // len(signal)
+    return np.tile(signal, num_repeats)[:num_output_samples]
+
+
+def _GetNoise(noise_rspecifier, rir_rspecifier, duration, sampling_rate):
+    """ Returns the noise signal as it would be output by
+    'wav-reverberate [--impulse-response=<rir>] [--duration=<duration>]
+    <noise> -', up to its scale, which does not matter as it is scaled to its
+    SNR. """
+    (noise_sampling_rate, noise) = _GetSignal(noise_rspecifier)
+    noise = noise.astype(np.float64)
+    num_samples = len(noise)
+    shift_index = 0
+    if rir_rspecifier is not None:
+        (noise, early_power, shift_index) = _Reverberate(
+            noise, rir_rspecifier, noise_sampling_rate)
+    num_output_samples = (int(noise_sampling_rate * duration)
+                          if duration is not None else num_samples)
+    return _GetOutput(noise, shift_index, num_samples, num_output_samples)
+
+
+def ReverberateSignal(signal, sampling_rate, descriptor, shift_output):
+    """ Returns the signal (a 1-d numpy array) corrupted according to the
+    reverberation descriptor (see the module docstring), as
+    'wav-reverberate --shift-output=<shift_output>' with the options of the
+    descriptor would. """
+    signal = signal.astype(np.float64)
+    num_samples = len(signal)
+    power_before_reverb = np.dot(signal, signal) / num_samples
+    output = signal
+    early_power = power_before_reverb
+    shift_index = 0
+    num_output_samples = num_samples
+    if descriptor['impulse_response'] is not None:
+        (output, early_power, peak_index) = _Reverberate(
+            signal, descriptor['impulse_response'], sampling_rate)
+        if shift_output:
+            shift_index = peak_index
+        else:
+            num_output_samples = len(output)
+
+    for (noise_spec, start_time, snr) in zip(descriptor['noise_specs'],
+                                              descriptor['start_times'],
+                                              descriptor['snrs']):
+        noise = _GetNoise(noise_spec[0], noise_spec[1], noise_spec[2],
+                          sampling_rate)
+        noise_power = np.dot(noise, noise) / len(noise)
+        if noise_power == 0:
+            continue
+        scale = np.sqrt(10 ** (-snr / 10.0) * early_power / noise_power)
+        offset = int(start_time * sampling_rate)
+        if offset < len(output):
+            length = min(len(noise), len(output) - offset)
+            output[offset:offset + length] += scale * noise[:length]
+
+    power_after_reverb = np.dot(output, output) / len(output)
+    if power_after_reverb > 0:
+        output = output * np.sqrt(power_before_reverb / power_after_reverb)
+    return _GetOutput(output, shift_index, num_samples, num_output_samples)
+
+
+def _ReverberateBatch(batch, shift_output):
+    """ Reverberates a batch of (input-rspecifier, descriptor,
+    output-filename), writing the outputs, and returns the number of
+    recordings. """
+    for (input_rspecifier, descriptor, output_filename) in batch:
+        (sampling_rate, signal) = ReadWave(input_rspecifier)
+        WriteWave(output_filename, sampling_rate,
+                  ReverberateSignal(signal, sampling_rate, descriptor,
+                                    shift_output))
+    return len(batch)
+
+
+def ReverberateRecordings(jobs, shift_output, num_jobs = 1, batch_size = 16):
+    """ Reverberates the recordings in the list 'jobs' of (input-rspecifier,
+    descriptor, output-filename), writing each output to a 16-bit wav file.
+    The RIRs and noises are read first, once; the recordings are then
+    processed in batches of 'batch_size' by a pool of num_jobs processes,
+    which share the signals read. """
+    if not g_numpy:
+        raise Exception("NumPy is required to reverberate the recordings "
+                        "in-process")
+    rspecifiers = set()
+    for (input_rspecifier, descriptor, output_filename) in jobs:
+        if descriptor['impulse_response'] is not None:
+            rspecifiers.add(descriptor['impulse_response'])
+        for noise_spec in descriptor['noise_specs']:
+            rspecifiers.add(noise_spec[0])
+            if noise_spec[1] is not None:
+                rspecifiers.add(noise_spec[1])
+    LoadSignals(sorted(rspecifiers))
+
+    batches = [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+    if num_jobs <= 1:
+        for batch in batches:
+            _ReverberateBatch(batch, shift_output)
+        return
+    pool = multiprocessing.Pool(num_jobs)
+    try:
+        results = [pool.apply_async(_ReverberateBatch, (batch, shift_output))
+                   for batch in batches]
+        for result in results:
+            result.get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
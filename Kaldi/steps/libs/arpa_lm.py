@@ -0,0 +1,552 @@
+# Apache 2.0.
+
+""" This module contains a binary format for ARPA-format backoff language
+models, in which the LM can be queried directly from the memory-mapped file,
+without creating python objects for its n-grams.  An ARPA file is converted
+to the binary format once, by convert_arpa_to_binary(); get_binary_lm() does
+the conversion on demand and caches the result, so that later runs just
+memory-map the binary file.
+
+The words are represented by integer word-ids: the words of the unigram
+section get the ids 0, 1, 2... in the order they appear in the ARPA file, and
+any other words that appear in the higher-order sections get the next ids.
+The n-grams are stored by history-state.  For each history-length h (0 for
+the unigram state, 1 for the bigram states and so on) there is a table of
+the history-states, sorted by history, and a table of the entries, i.e. the
+words predicted in each state, sorted by word-id within each state.
+
+The layout of the file is as follows:
+    header: the magic string g_magic, then (as '<II') the maximum n-gram
+        order and the number of words, then (as '<QQ') the offset and size of
+        the vocabulary, then, for each history-length h, (as '<QQQQ') the
+        number of states, the offset of the states, the number of entries
+        and the offset of the entries.
+    states of history-length h: for each state, the history as h big-endian
+        unsigned 32-bit word-ids (so that comparing these bytes compares the
+        histories), the backoff probability as '<d' and the end of its
+        entries as '<Q' (the entries start where those of the previous state
+        end).
+    entries of history-length h: for each entry, the word-id as a big-endian
+        unsigned 32-bit integer and the probability as '<d'.
+    vocabulary: the words, separated by newlines, in the order of their ids.
+The probabilities are stored as probabilities, not as log10 probabilities as
+in the ARPA file.
+
+e.g.
+    lm = arpa_lm.get_binary_lm('data/local/lm/lm.arpa',
+                               cache_dir='data/local/lm/.binary_lm')
+    hist = (lm.word_to_id['the'],)
+    print(lm.get_prob(hist, lm.word_to_id['cat']))
+"""
+
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+try:
+    import numpy as np
+    g_numpy = True
+except ImportError:
+    g_numpy = False
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+g_magic = b'KALDILM1'
+g_header_struct = struct.Struct('<IIQQ')
+g_order_struct = struct.Struct('<QQQQ')
+g_state_struct = struct.Struct('<dQ')     # the part after the history
+g_entry_struct = struct.Struct('<d')      # the part after the word-id
+g_word_struct = struct.Struct('>I')
+g_state_end_struct = struct.Struct('<Q')
+
+# The backoff-prob that is stored in the records of the n-grams that are
+# sorted during the conversion, for n-grams that have no backoff-prob.
+g_no_backoff = -1.0
+
+
+def _encode(text):
+    return text.encode('utf-8') if sys.version_info >= (3, 0) else text
+
+
+def _decode(data):
+    return data.decode('utf-8') if sys.version_info >= (3, 0) else data
+
+
+def _read_arpa_header(arpa_file):
+    """ Reads the ARPA file up to the end of the \\data\\ section, and returns
+    the maximum n-gram order. """
+    while True:
+        line = arpa_file.readline()
+        if line == '':
+            raise ValueError("got EOF looking for \\data\\ marker.")
+        if line[0:6] == '\\data\\':
+            break
+    max_order = 0
+    while True:
+        # read, and ignore, the lines like 'ngram 1=1264'...
+        line = arpa_file.readline()
+        if line == '\n' or line == '\r\n':
+            break
+        a = line[5:].split('=')  # e.g. a = [ '1', '1264' ]
+        if line[0:5] != 'ngram' or len(a) != 2:
+            raise ValueError("read something unexpected in header: "
+                             "{0}".format(line[:-1]))
+        max_order = int(a[0])
+    if max_order == 0:
+        raise ValueError("no 'ngram' lines in header.")
+    return max_order
+
+
+def _read_arpa_section(arpa_file, order, vocab, words):
+    """ Reads the n-grams of the section for 'order' (after its header line)
+    up to the blank line that terminates it, and returns them as a sorted
+    list of records, each the n-gram as 'order' big-endian word-ids (its
+    history then its word) followed by its prob and backoff-prob (or
+    g_no_backoff) as '<dd'.  New words are added to 'vocab' (a dict from word
+    to id) and 'words' (a list of the words, indexed by id). """
+    log10 = math.log(10.0)
+    ngram_struct = struct.Struct('>{0}I'.format(order))
+    records = []
+    while True:
+        line = arpa_file.readline()
+        # the section of n-grams is terminated by a blank line.
+        if line == '\n' or line == '\r\n':
+            break
+        a = line.split()
+        l = len(a)
+        if l != order + 1 and l != order + 2:
+            raise ValueError("in {0}-grams section, got bad line: {1}".format(
+                order, line[:-1]))
+        ids = []
+        for word in a[1:order+1]:
+            word_id = vocab.get(word)
+            if word_id is None:
+                word_id = len(words)
+                vocab[word] = word_id
+                words.append(word)
+            ids.append(word_id)
+        try:
+            prob = math.exp(float(a[0]) * log10)
+            backoff_prob = (math.exp(float(a[order+1]) * log10)
+                            if l == order + 2 else g_no_backoff)
+        except ValueError as e:
+            raise ValueError("in {0}-grams section, got bad line (exception "
+                             "is: {1}): {2}".format(order, str(e), line[:-1]))
+        records.append(ngram_struct.pack(*ids) +
+                       struct.pack('<dd', prob, backoff_prob))
+    records.sort()
+    key_size = 4 * order
+    for i in range(1, len(records)):
+        if records[i][:key_size] == records[i-1][:key_size]:
+            raise ValueError("duplicate {0}-gram: {1}".format(
+                order, ' '.join([words[x] for x in ngram_struct.unpack(
+                    records[i][:key_size])])))
+    return records
+
+
+def _write_history_length(binary_file, hist_len, entries, backoffs):
+    """ Writes the entries and then the states of the history-length
+    'hist_len' to binary_file, and returns (num-states, states-offset,
+    num-entries, entries-offset).  'entries' are the records (see
+    _read_arpa_section()) of the n-grams of order hist_len + 1, and
+    'backoffs' those of order 'hist_len', which give the backoff-probs of
+    the states; a state exists for each history that has entries or a
+    backoff-prob. """
+    hist_size = 4 * hist_len
+    entries_offset = binary_file.tell()
+    states = bytearray()
+    num_states = 0
+    i = 0
+    j = 0
+    while True:
+        while (j < len(backoffs) and struct.unpack_from(
+                '<d', backoffs[j], hist_size + 8)[0] == g_no_backoff):
+            j += 1
+        if i < len(entries):
+            hist = entries[i][:hist_size]
+            if j < len(backoffs) and backoffs[j][:hist_size] < hist:
+                hist = backoffs[j][:hist_size]
+        elif j < len(backoffs):
+            hist = backoffs[j][:hist_size]
+        else:
+            break
+        backoff_prob = 1.0
+        if j < len(backoffs) and backoffs[j][:hist_size] == hist:
+            backoff_prob = struct.unpack_from('<d', backoffs[j],
+                                              hist_size + 8)[0]
+            j += 1
+        chunk = []
+        while i < len(entries) and entries[i][:hist_size] == hist:
+            chunk.append(entries[i][hist_size:hist_size + 12])
+            i += 1
+        binary_file.write(b''.join(chunk))
+        states += hist + g_state_struct.pack(backoff_prob, i)
+        num_states += 1
+    states_offset = binary_file.tell()
+    binary_file.write(bytes(states))
+    return (num_states, states_offset, len(entries), entries_offset)
+
+
+def convert_arpa_to_binary(arpa_file, binary_file):
+    """ Converts the ARPA language model read from the file object
+    'arpa_file' to the binary format, written to the seekable file object
+    'binary_file' (opened in binary mode).  Raises ValueError if the ARPA
+    file is not valid.
+
+    The n-grams of one order at a time are held in memory, as byte strings.
+    """
+    max_order = _read_arpa_header(arpa_file)
+    header_size = (len(g_magic) + g_header_struct.size +
+                   max_order * g_order_struct.size)
+    binary_file.write(b'\0' * header_size)
+
+    vocab = dict()
+    words = []
+    order_info = []
+    prev_records = []
+    cur_order = 0
+    while True:
+        line = arpa_file.readline()
+        if line == '':
+            raise ValueError("found EOF while looking for \\end\\ marker.")
+        elif line[0:5] == '\\end\\':
+            break
+        cur_order += 1
+        expected_line = '\\{0}-grams:'.format(cur_order)
+        if not expected_line in line:  # e.g. allow trailing whitespace
+            raise ValueError("expected line {0}, got {1}".format(
+                expected_line, line[:-1]))
+        if cur_order > max_order:
+            raise ValueError("got more n-gram sections than the {0} in the "
+                             "header.".format(max_order))
+        logger.debug("reading %d-grams", cur_order)
+        records = _read_arpa_section(arpa_file, cur_order, vocab, words)
+        order_info.append(_write_history_length(binary_file, cur_order - 1,
+                                                records, prev_records))
+        prev_records = records
+    if cur_order == 0:
+        raise ValueError("read no n-grams.")
+    for hist_len in range(cur_order, max_order):
+        order_info.append(_write_history_length(binary_file, hist_len, [],
+                                                prev_records))
+        prev_records = []
+
+    vocab_offset = binary_file.tell()
+    vocab_data = _encode('\n'.join(words))
+    binary_file.write(vocab_data)
+    binary_file.seek(0)
+    binary_file.write(g_magic + g_header_struct.pack(
+        max_order, len(words), vocab_offset, len(vocab_data)))
+    for info in order_info:
+        binary_file.write(g_order_struct.pack(*info))
+    binary_file.flush()
+
+
+def is_binary_lm(filename):
+    """ Returns True if 'filename' is a binary LM file. """
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(g_magic)) == g_magic
+    except (IOError, OSError):
+        return False
+
+
+class BinaryArpaLm(object):
+    """ A language model in the binary format, memory-mapped from the file.
+
+    The states of each history-length are referred to by their index in the
+    sorted table of states (see find_state()), and the histories and words
+    are word-ids.
+
+    Attributes:
+        max_order: the maximum n-gram order of the LM
+        words: the list of the words, indexed by word-id
+        word_to_id: a dict from word to word-id
+    """
+
+    def __init__(self, binary_file):
+        """ 'binary_file' is the filename of the binary LM or a file object
+        opened in binary mode; the file object can be closed (or deleted if
+        it's a temporary file) afterwards. """
+        if hasattr(binary_file, 'fileno'):
+            binary_file.flush()
+            self._mmap = mmap.mmap(binary_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        else:
+            with open(binary_file, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[0:len(g_magic)] != g_magic:
+            raise ValueError("not a binary LM file")
+        offset = len(g_magic)
+        (self.max_order, num_words, vocab_offset,
+         vocab_size) = g_header_struct.unpack_from(self._mmap, offset)
+        offset += g_header_struct.size
+        self._num_states = []
+        self._states_offset = []
+        self._num_entries = []
+        self._entries_offset = []
+        for hist_len in range(self.max_order):
+            (num_states, states_offset, num_entries,
+             entries_offset) = g_order_struct.unpack_from(self._mmap, offset)
+            offset += g_order_struct.size
+            self._num_states.append(num_states)
+            self._states_offset.append(states_offset)
+            self._num_entries.append(num_entries)
+            self._entries_offset.append(entries_offset)
+        self.words = (
+            _decode(self._mmap[vocab_offset:vocab_offset + vocab_size]).split(
+                '\n') if num_words > 0 else [])
+        assert len(self.words) == num_words
+        self.word_to_id = dict([(word, word_id) for word_id, word
+                                in enumerate(self.words)])
+        # a dict from word-id to the prob in the unigram state, created when
+        # it's first needed by get_probs().
+        self._unigram_probs = None
+
+    def close(self):
+        self._mmap.close()
+
+    def num_states(self, hist_len):
+        return self._num_states[hist_len]
+
+    def _state_offset(self, hist_len, state):
+        return (self._states_offset[hist_len] +
+                state * (4 * hist_len + g_state_struct.size))
+
+    def find_state(self, hist):
+        """ Returns the index of the state for the history 'hist' (a tuple of
+        word-ids), or -1 if there is no such state. """
+        hist_len = len(hist)
+        if hist_len >= self.max_order:
+            return -1
+        key = struct.pack('>{0}I'.format(hist_len), *hist)
+        record_size = 4 * hist_len + g_state_struct.size
+        offset = self._states_offset[hist_len]
+        mm = self._mmap
+        lo = 0
+        hi = self._num_states[hist_len]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            begin = offset + mid * record_size
+            if mm[begin:begin + 4 * hist_len] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._num_states[hist_len]:
+            begin = offset + lo * record_size
+            if mm[begin:begin + 4 * hist_len] == key:
+                return lo
+        return -1
+
+    def get_tables(self, hist_len):
+        """ Returns (states, entries), numpy arrays that are views of the
+        tables of the history-length 'hist_len' in the memory-mapped file
+        (so they are not copied into memory).  'states' has the fields
+        'hist' (only if hist_len > 0; the history, as 'hist_len' word-ids),
+        'backoff' (the backoff-prob) and 'end' (the end of the state's
+        entries); 'entries' has the fields 'word' and 'prob'.  The arrays
+        must be deleted before close() is called.  Raises RuntimeError if
+        numpy is not available. """
+        if not g_numpy:
+            raise RuntimeError("NumPy is required for get_tables()")
+        fields = [('backoff', '<f8'), ('end', '<u8')]
+        if hist_len > 0:
+            fields.insert(0, ('hist', '>u4', (hist_len,)))
+        return (self._get_table(np.dtype(fields),
+                                self._num_states[hist_len],
+                                self._states_offset[hist_len]),
+                self._get_table(np.dtype([('word', '>u4'), ('prob', '<f8')]),
+                                self._num_entries[hist_len],
+                                self._entries_offset[hist_len]))
+
+    def _get_table(self, dtype, count, offset):
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.frombuffer(self._mmap, dtype=dtype, count=count,
+                             offset=offset)
+
+    def get_state_hist(self, hist_len, state):
+        """ Returns the history (a tuple of word-ids) of a state. """
+        return struct.unpack_from('>{0}I'.format(hist_len), self._mmap,
+                                  self._state_offset(hist_len, state))
+
+    def get_backoff_prob(self, hist_len, state):
+        return g_state_struct.unpack_from(
+            self._mmap, self._state_offset(hist_len, state) + 4 * hist_len)[0]
+
+    def _get_entry_range(self, hist_len, state):
+        offset = self._state_offset(hist_len, state) + 4 * hist_len + 8
+        end = g_state_end_struct.unpack_from(self._mmap, offset)[0]
+        if state == 0:
+            return (0, end)
+        record_size = 4 * hist_len + g_state_struct.size
+        return (g_state_end_struct.unpack_from(
+            self._mmap, offset - record_size)[0], end)
+
+    def num_entries(self, hist_len, state):
+        """ Returns the number of words predicted in a state. """
+        (begin, end) = self._get_entry_range(hist_len, state)
+        return end - begin
+
+    def get_entries(self, hist_len, state):
+        """ Returns the list of (word-id, prob) of the words predicted in a
+        state, sorted by word-id. """
+        (begin, end) = self._get_entry_range(hist_len, state)
+        offset = self._entries_offset[hist_len]
+        mm = self._mmap
+        entries = []
+        for entry in range(begin, end):
+            entry_offset = offset + 12 * entry
+            entries.append(
+                (g_word_struct.unpack_from(mm, entry_offset)[0],
+                 g_entry_struct.unpack_from(mm, entry_offset + 4)[0]))
+        return entries
+
+    def get_word_prob(self, hist_len, state, word):
+        """ Returns the prob of word-id 'word' in a state, or None if it is
+        not predicted in the state (i.e. its prob would involve backoff). """
+        (lo, end) = self._get_entry_range(hist_len, state)
+        hi = end
+        key = g_word_struct.pack(word)
+        offset = self._entries_offset[hist_len]
+        mm = self._mmap
+        while lo < hi:
+            mid = (lo + hi) // 2
+            begin = offset + 12 * mid
+            if mm[begin:begin + 4] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        begin = offset + 12 * lo
+        if lo < end and mm[begin:begin + 4] == key:
+            return g_entry_struct.unpack_from(mm, begin + 4)[0]
+        return None
+
+    def get_prob(self, hist, word):
+        """ Returns the probability of word-id 'word' after the history
+        'hist' (a tuple of word-ids), backing off as needed.  Raises KeyError
+        if the word has no probability in the unigram state. """
+        backoff_prob = 1.0
+        while True:
+            hist_len = len(hist)
+            state = self.find_state(hist)
+            if state != -1:
+                prob = self.get_word_prob(hist_len, state, word)
+                if prob is not None:
+                    return backoff_prob * prob
+                backoff_prob *= self.get_backoff_prob(hist_len, state)
+            if hist_len == 0:
+                raise KeyError(word)
+            hist = hist[1:]
+
+    def get_probs(self, hist, words):
+        """ Returns the list of the probabilities of the word-ids in 'words'
+        after the history 'hist'.  This is equivalent to calling get_prob()
+        for each word, but much faster for many words, as each state on the
+        backoff path is looked up only once.  Raises KeyError if a word has
+        no probability in the unigram state. """
+        probs = [None] * len(words)
+        remaining = list(range(len(words)))
+        backoff_prob = 1.0
+        while True:
+            hist_len = len(hist)
+            state = self.find_state(hist)
+            if state != -1:
+                if hist_len == 0:
+                    if self._unigram_probs is None:
+                        self._unigram_probs = dict(self.get_entries(0, state))
+                    word_to_prob = self._unigram_probs
+                elif len(remaining) * 16 < self.num_entries(hist_len, state):
+                    # it's faster to search for the few words.
+                    word_to_prob = dict()
+                    for i in remaining:
+                        prob = self.get_word_prob(hist_len, state, words[i])
+                        if prob is not None:
+                            word_to_prob[words[i]] = prob
+                else:
+                    word_to_prob = dict(self.get_entries(hist_len, state))
+                backed_off = []
+                for i in remaining:
+                    prob = word_to_prob.get(words[i])
+                    if prob is None:
+                        backed_off.append(i)
+                    else:
+                        probs[i] = backoff_prob * prob
+                remaining = backed_off
+                if len(remaining) == 0:
+                    return probs
+                backoff_prob *= self.get_backoff_prob(hist_len, state)
+            if hist_len == 0:
+                raise KeyError(words[remaining[0]])
+            hist = hist[1:]
+
+
+def get_binary_lm(arpa_in, cache_dir=None):
+    """ Returns the BinaryArpaLm for 'arpa_in', which is the filename of an
+    ARPA file ('-' for the standard input) or of a binary LM file.
+
+    An ARPA file is converted to the binary format.  If cache_dir is given
+    the binary LM is stored in it, under a name derived from the absolute
+    path of the ARPA file and its size and modification time, and the stored
+    binary LM is used as long as the ARPA file does not change.  Otherwise
+    (and for the standard input), the binary LM is written to a temporary
+    file, which is deleted when it is not used any more.
+
+    Raises IOError if the file cannot be opened and ValueError if it is not a
+    valid ARPA file.
+    """
+    if arpa_in == "" or arpa_in == "-":
+        arpa_in = "/dev/stdin"
+    elif is_binary_lm(arpa_in):
+        return BinaryArpaLm(arpa_in)
+
+    cache_file = None
+    if cache_dir is not None and os.path.isfile(arpa_in):
+        stat = os.stat(arpa_in)
+        prefix = hashlib.sha1(
+            _encode(os.path.abspath(arpa_in))).hexdigest()[0:16]
+        cache_file = os.path.join(cache_dir, '{0}.{1}.{2}.lm'.format(
+            prefix, int(stat.st_mtime), stat.st_size))
+        if is_binary_lm(cache_file):
+            return BinaryArpaLm(cache_file)
+
+    with open(arpa_in, 'r') as arpa_file:
+        if cache_file is None:
+            binary_file = tempfile.TemporaryFile()
+            try:
+                convert_arpa_to_binary(arpa_file, binary_file)
+                return BinaryArpaLm(binary_file)
+            finally:
+                binary_file.close()
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as binary_file:
+                convert_arpa_to_binary(arpa_file, binary_file)
+            # rename is atomic, so that a concurrent reader never sees a
+            # partially written binary LM.
+            os.rename(tmp_file, cache_file)
+        except:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+    # remove the binary LMs of older versions of the ARPA file.
+    for name in os.listdir(cache_dir):
+        if (name.startswith(prefix + '.') and name.endswith('.lm') and
+                name != os.path.basename(cache_file)):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+    logger.info("Wrote binary LM for %s to %s", arpa_in, cache_file)
+    return BinaryArpaLm(cache_file)
@@ -0,0 +1,381 @@
+# Apache 2.0.
+
+""" This module scores text with ARPA-format backoff language models, which
+are read through the binary LM format of libs/arpa_lm.py, and computes
+perplexities.
+
+The text is integerized with the vocabulary of the LM, and the sentences are
+scored in batches: all the words of a batch are looked up together, one
+history-length at a time, from the longest history to the unigram state,
+each word backing off until its n-gram is found.  With numpy, the lookups of
+a batch are vectorized binary searches in the memory-mapped tables of the
+LM, done once for each distinct history in the batch; without numpy, the
+backoff path of each history (the states on it and their accumulated
+backoff-probs) is kept in a cache, so that it is looked up only once.
+
+The conventions are those of SRILM's 'ngram -ppl': the probability of the
+end-of-sentence symbol is included, the words that are not in the LM (OOVs)
+are not scored, and the words after an OOV are scored with the history that
+starts after it.  The perplexity is computed over the scored words and the
+end-of-sentence symbols, and 'ppl1' over the scored words only.
+
+e.g.
+    lm = arpa_lm.get_binary_lm('data/local/lm/lm.arpa')
+    scorer = arpa_scoring.ArpaScorer(lm)
+    sentences = [scorer.integerize(line.split()) for line in lines]
+    stats = arpa_scoring.PerplexityStats()
+    for sentence, score in zip(sentences, scorer.score(sentences)):
+        stats.add(*score)
+    print(stats.ppl())
+"""
+
+import logging
+import math
+
+try:
+    import numpy as np
+    g_numpy = True
+except ImportError:
+    g_numpy = False
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class PerplexityStats(object):
+    """ The accumulated log-probability and counts of a set of sentences,
+    from which the perplexity is computed.
+
+    Attributes:
+        logprob: the total log10 probability of the scored words
+        num_sentences: the number of sentences
+        num_words: the number of words, including the OOVs but not the
+            end-of-sentence symbols
+        num_oovs: the number of OOVs
+    """
+
+    def __init__(self):
+        self.logprob = 0.0
+        self.num_sentences = 0
+        self.num_words = 0
+        self.num_oovs = 0
+
+    def add(self, logprob, num_words, num_oovs):
+        """ Adds the score of a sentence, as returned by ArpaScorer.score().
+        """
+        self.logprob += logprob
+        self.num_sentences += 1
+        self.num_words += num_words
+        self.num_oovs += num_oovs
+
+    def ppl(self):
+        """ Returns the perplexity, over the scored words and the
+        end-of-sentence symbols. """
+        return _perplexity(self.logprob,
+                           self.num_words - self.num_oovs + self.num_sentences)
+
+    def ppl1(self):
+        """ Returns the perplexity over the scored words only. """
+        return _perplexity(self.logprob, self.num_words - self.num_oovs)
+
+
+def _perplexity(logprob, num_tokens):
+    if num_tokens <= 0:
+        return float('nan')
+    return math.pow(10.0, -logprob / num_tokens)
+
+
+def sentence_ppl(score):
+    """ Returns the perplexity of a sentence from its score, as returned by
+    ArpaScorer.score(). """
+    (logprob, num_words, num_oovs) = score
+    return _perplexity(logprob, num_words - num_oovs + 1)
+
+
+class ArpaScorer(object):
+    """ Scores integerized sentences with a BinaryArpaLm.
+
+    Attributes:
+        lm: the BinaryArpaLm
+        bos, eos: the word-ids of the beginning- and end-of-sentence symbols
+        unk: the word-id to which the OOVs are mapped by integerize(), or -1
+            if they are not mapped (and are not scored)
+        context: the maximum history-length (the n-gram order minus one)
+        batch_size: the number of words that are scored together
+        use_numpy: True if the batches are scored with numpy
+    """
+
+    def __init__(self, lm, bos='<s>', eos='</s>', unk_word=None,
+                 batch_size=100000, cache_size=100000, use_numpy=True):
+        """ 'unk_word' is the word to which the OOVs are mapped, if it is in
+        the LM; if it is None, or not in the LM, the OOVs are not scored.
+        'cache_size' is the maximum number of histories whose backoff paths
+        are cached, when numpy is not used.  Raises ValueError if the LM has
+        no unigram state or does not contain 'bos' and 'eos'. """
+        self.lm = lm
+        if lm.num_states(0) != 1:
+            raise ValueError("the LM has no unigram state")
+        # the words of the unigram state have the word-ids 0, 1, 2...; the
+        # other words of the LM have no probability, so they are OOVs.
+        self._num_unigrams = lm.num_entries(0, 0)
+        self._vocab = dict([(word, word_id) for word, word_id
+                            in lm.word_to_id.items()
+                            if word_id < self._num_unigrams])
+        self.bos = self._get_id(bos)
+        self.eos = self._get_id(eos)
+        if self.bos == -1 or self.eos == -1:
+            raise ValueError("the LM does not contain the symbols {0} and "
+                             "{1}".format(bos, eos))
+        self.unk = -1 if unk_word is None else self._get_id(unk_word)
+        self.context = lm.max_order - 1
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.use_numpy = use_numpy and g_numpy
+        # the prob of each word-id in the unigram state.
+        self._unigram_probs = [prob for word, prob in lm.get_entries(0, 0)]
+        # a dict from history to its backoff path, see _get_backoff_path().
+        self._backoff_paths = dict()
+        if self.use_numpy:
+            self._unigram_probs = np.array(self._unigram_probs,
+                                           dtype=np.float64)
+            self._tables = [lm.get_tables(hist_len)
+                            for hist_len in range(lm.max_order)]
+
+    def close(self):
+        """ Releases the views of the LM's tables, after which lm.close()
+        can be called. """
+        self._tables = None
+
+    def _get_id(self, word):
+        return self._vocab.get(word, -1)
+
+    def integerize(self, words):
+        """ Returns the list of the word-ids of the words (strings) of a
+        sentence, with -1 for the OOVs (or self.unk if it is not -1).
+        The symbols bos and eos at the start and end of the sentence, if
+        present, are removed. """
+        vocab = self._vocab
+        ids = [vocab.get(word, -1) for word in words]
+        if len(ids) > 0 and ids[-1] == self.eos:
+            ids.pop()
+        if len(ids) > 0 and ids[0] == self.bos:
+            ids.pop(0)
+        if self.unk != -1:
+            ids = [self.unk if word == -1 else word for word in ids]
+        return ids
+
+    def score(self, sentences):
+        """ Returns a list with the score of each of the sentences (lists of
+        word-ids, as returned by integerize()), which is a tuple (logprob,
+        num-words, num-oovs): the log10 probability of the sentence,
+        including that of the end-of-sentence symbol, its number of words
+        and its number of OOVs. """
+        scores = []
+        start = 0
+        while start < len(sentences):
+            end = start
+            batch_words = 0
+            while end < len(sentences) and (
+                    end == start or batch_words < self.batch_size):
+                batch_words += len(sentences[end]) + 1
+                end += 1
+            if self.use_numpy:
+                scores.extend(self._score_batch_numpy(sentences[start:end]))
+            else:
+                scores.extend([self._score_sentence(sentence)
+                               for sentence in sentences[start:end]])
+            start = end
+        return scores
+
+    def _get_backoff_path(self, hist):
+        """ Returns the backoff path of the history 'hist': the list of
+        (hist-len, state, backoff-prob) of the states for the suffixes of
+        the history that exist, from the longest to the unigram state, where
+        backoff-prob is the product of the backoff-probs of the longer
+        states. """
+        path = self._backoff_paths.get(hist)
+        if path is not None:
+            return path
+        path = []
+        backoff_prob = 1.0
+        for hist_len in range(len(hist), -1, -1):
+            suffix = hist[len(hist) - hist_len:]
+            state = self.lm.find_state(suffix)
+            if state != -1:
+                path.append((hist_len, state, backoff_prob))
+                backoff_prob *= self.lm.get_backoff_prob(hist_len, state)
+        if len(self._backoff_paths) >= self.cache_size:
+            self._backoff_paths = dict()
+        self._backoff_paths[hist] = path
+        return path
+
+    def _get_prob(self, hist, word):
+        for hist_len, state, backoff_prob in self._get_backoff_path(hist):
+            if hist_len == 0:
+                return backoff_prob * self._unigram_probs[word]
+            prob = self.lm.get_word_prob(hist_len, state, word)
+            if prob is not None:
+                return backoff_prob * prob
+
+    def _score_sentence(self, sentence):
+        logprob = 0.0
+        num_oovs = 0
+        context = self.context
+        hist = (self.bos,) if context > 0 else ()
+        for word in sentence + [self.eos]:
+            if word == -1:
+                num_oovs += 1
+                hist = ()
+                continue
+            logprob += math.log10(self._get_prob(hist, word))
+            if context > 0:
+                hist = (hist + (word,))[-context:]
+        return (logprob, len(sentence), num_oovs)
+
+    def _score_batch_numpy(self, sentences):
+        """ Scores a batch of sentences with numpy, all the words of the
+        batch together. """
+        lengths = np.array([len(sentence) + 2 for sentence in sentences],
+                           dtype=np.int64)
+        tokens = np.empty(int(lengths.sum()), dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        tokens[starts] = self.bos
+        tokens[starts + lengths - 1] = self.eos
+        is_word = np.ones(len(tokens), dtype=bool)
+        is_word[starts] = False
+        is_word[starts + lengths - 1] = False
+        tokens[is_word] = [word for sentence in sentences
+                           for word in sentence]
+        sentence_index = np.repeat(np.arange(len(sentences)), lengths)
+
+        # the history of a token starts at the bos of its sentence or after
+        # the last OOV before it.
+        positions = np.arange(len(tokens))
+        hist_start = np.zeros(len(tokens), dtype=np.int64)
+        hist_start[starts] = starts
+        is_oov = tokens == -1
+        hist_start[1:][is_oov[:-1]] = positions[1:][is_oov[:-1]]
+        hist_start = np.maximum.accumulate(hist_start)
+        scored = tokens != -1
+        scored[starts] = False
+        hist_len = np.minimum(positions - hist_start, self.context)[scored]
+        words = tokens[scored]
+        positions = positions[scored]
+        # the histories, right-aligned; the entries before the start of a
+        # history are not used.
+        hists = np.empty((len(words), self.context), dtype=np.int64)
+        for i in range(self.context):
+            hists[:, i] = tokens[np.maximum(
+                positions - self.context + i, 0)]
+
+        probs = np.zeros(len(words), dtype=np.float64)
+        backoff_probs = np.ones(len(words), dtype=np.float64)
+        unresolved = np.ones(len(words), dtype=bool)
+        for h in range(self.context, 0, -1):
+            active = np.nonzero(unresolved & (hist_len >= h))[0]
+            if len(active) == 0:
+                continue
+            (states, entries) = self._tables[h]
+            # each distinct history of the batch is looked up only once.
+            (unique_hists, inverse) = self._unique_rows(
+                hists[active, self.context - h:])
+            state = self._find_states(states, unique_hists)[inverse]
+            found_state = state != -1
+            active = active[found_state]
+            state = state[found_state]
+            end = states['end'][state].astype(np.int64)
+            begin = np.where(state > 0, states['end'][np.maximum(
+                state - 1, 0)].astype(np.int64), 0)
+            entry_words = entries['word']
+            active_words = words[active]
+            entry = _lower_bound(
+                begin, end,
+                lambda k, rows: (entry_words[k].astype(np.int64) <
+                                 active_words[rows]))
+            found = entry < end
+            found[found] = (entry_words[entry[found]].astype(np.int64) ==
+                            active_words[found])
+            resolved = active[found]
+            probs[resolved] = (backoff_probs[resolved] *
+                               entries['prob'][entry[found]])
+            unresolved[resolved] = False
+            backed_off = active[~found]
+            backoff_probs[backed_off] *= states['backoff'][state[~found]]
+        probs[unresolved] = (backoff_probs[unresolved] *
+                             self._unigram_probs[words[unresolved]])
+
+        logprobs = np.bincount(sentence_index[scored], weights=np.log10(probs),
+                               minlength=len(sentences))
+        num_oovs = np.bincount(sentence_index[is_oov],
+                               minlength=len(sentences))
+        return [(float(logprobs[i]), len(sentences[i]), int(num_oovs[i]))
+                for i in range(len(sentences))]
+
+    def _unique_rows(self, hists):
+        """ Returns (unique-hists, inverse) like np.unique(hists, axis=0,
+        return_inverse=True), but faster, as the histories are sorted as
+        integers if they fit in one. """
+        num_words = len(self._unigram_probs)
+        if num_words ** hists.shape[1] >= 2 ** 63:
+            (unique_hists, inverse) = np.unique(hists, axis=0,
+                                                return_inverse=True)
+            return (unique_hists, inverse.reshape(-1))
+        keys = np.zeros(len(hists), dtype=np.int64)
+        for j in range(hists.shape[1]):
+            keys = keys * num_words + hists[:, j]
+        (unique_keys, index, inverse) = np.unique(keys, return_index=True,
+                                                  return_inverse=True)
+        return (hists[index], inverse.reshape(-1))
+
+    def _find_states(self, states, hists):
+        """ Returns the indexes of the states with the histories 'hists' (a
+        2-dimensional array, a history per row) in the table 'states', with
+        -1 for the histories that have no state. """
+        state_hists = states['hist']
+        hist_len = hists.shape[1]
+
+        def less(k, rows):
+            # compares the histories lexicographically.
+            less = np.zeros(len(k), dtype=bool)
+            equal = np.ones(len(k), dtype=bool)
+            table_hists = state_hists[k].astype(np.int64)
+            keys = hists[rows]
+            for j in range(hist_len):
+                less |= equal & (table_hists[:, j] < keys[:, j])
+                equal &= table_hists[:, j] == keys[:, j]
+            return less
+
+        num_states = len(states)
+        state = _lower_bound(np.zeros(len(hists), dtype=np.int64),
+                             np.full(len(hists), num_states, dtype=np.int64),
+                             less)
+        found = state < num_states
+        found[found] = np.all(
+            state_hists[state[found]].astype(np.int64) == hists[found],
+            axis=1)
+        return np.where(found, state, -1)
+
+
+def _lower_bound(lo, hi, less):
+    """ A vectorized binary search in a sorted table: returns, for each i,
+    the first index k in [lo[i], hi[i]) for which the i'th key is not greater
+    than the element k of the table, or hi[i] if there is none.  less(k,
+    rows) must return the array of (table[k[j]] < key[rows[j]]). """
+    result = lo.copy()
+    # the rows that are still searched, and their ranges.
+    rows = np.nonzero(lo < hi)[0]
+    lo = lo[rows]
+    hi = hi[rows]
+    while len(rows) > 0:
+        mid = (lo + hi) // 2
+        go_right = less(mid, rows)
+        lo = np.where(go_right, mid + 1, lo)
+        hi = np.where(go_right, hi, mid)
+        done = lo >= hi
+        if done.any():
+            result[rows[done]] = lo[done]
+            searching = ~done
+            rows = rows[searching]
+            lo = lo[searching]
+            hi = hi[searching]
+    return result
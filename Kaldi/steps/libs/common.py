@@ -12,8 +12,21 @@ import argparse
 import logging
 import math
 import os
+import signal
 import subprocess
 import threading
+import time
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+try:
+    import numpy as np
+    g_numpy = True
+except ImportError:
+    g_numpy = False
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
@@ -91,78 +104,130 @@ class BackgroundProcessHandler():
 
     A top-level script is expected to instantiate an object of this class
     and pass it to all calls of run_kaldi_command that are to be run in the
-    background. The background processes are queued and these are polled
-    in a parallel thread at set interval to check for failures.
+    background. Each background process is waited for in a separate thread,
+    which logs an error as soon as the process fails and puts the process
+    into a completion queue. The completed processes are handled in the
+    thread of the top-level script on the next call to add_process(), poll()
+    or ensure_processes_are_done(), which raise a KaldiCommandException for
+    a failed process.
     The top-level script can ensure at the end ensure that all processes are
     completed before exiting.
 
     Attributes:
         __process_queue: Stores a list of process handles and command tuples
-        __polling_time: The time after which the processes are polled
-        __timer: Internal timer object
-        __is_running: Stores whether a timer is running
+            of the processes that have not been handled yet
+        __polling_time: The interval in seconds at which the running
+            processes are logged while waiting for them to finish
+        __done_queue: A queue of (process handle and command tuple, stderr,
+            wall time) for the processes that have finished
+        __slots: A semaphore that limits the number of processes running at
+            the same time, or None if there is no limit
+        __process_done_callback: If not None, a function that is called as
+            process_done_callback(command, returncode, wall_time) for each
+            finished process
+        job_wall_times: A list of (command, wall time in seconds) tuples for
+            the processes that have finished
     """
 
-    def __init__(self, polling_time=600):
+    def __init__(self, polling_time=600, max_running_processes=None,
+                 process_done_callback=None):
         self.__process_queue = []
         self.__polling_time = polling_time
-        self.__timer = None
         self.__lock = threading.Lock()
-        self.__is_running = False
-
-    def __run(self):
-        """ Internal function to run a poll. Calls poll(). """
-        assert(self.__is_running)
-        self.__is_running = False
-        logger.debug("Polling...")
-        if self.poll():
-            # If there are any more background processes running,
-            # start a new timer
-            self.start()
-
-    def start(self):
-        """ Start the background process handler.
-
-        Repeatedly calls itself through the __run() method every
-        __polling_time seconds.
-        """
-        if not self.__is_running:
-            self.__timer = threading.Timer(self.__polling_time, self.__run)
-            logger.debug("Starting new timer...")
-            self.__is_running = True
-            self.__timer.start()
+        self.__done_queue = Queue.Queue()
+        self.__slots = None
+        if max_running_processes is not None and max_running_processes > 0:
+            self.__slots = threading.Semaphore(max_running_processes)
+        self.__process_done_callback = process_done_callback
+        self.job_wall_times = []
+
+    def __wait_for_process(self, t, start_time, holds_slot):
+        """ Internal function that is run in a separate thread for each
+        process. Waits for the process to end and puts it into
+        __done_queue. """
+        p, command = t
+        try:
+            [stdout, stderr] = p.communicate()
+        finally:
+            wall_time = time.time() - start_time
+            if holds_slot:
+                self.__slots.release()
+            if p.returncode != 0:
+                logger.error("Background process '{0}' failed with return "
+                             "code {1} after {2:.1f} seconds".format(
+                                 command, p.returncode, wall_time))
+            self.__done_queue.put((t, stderr, wall_time))
+
+    def __process_done(self, t, stderr, wall_time):
+        """ Internal function to handle a finished process in the thread of
+        the top-level script. """
+        p, command = t
+        with self.__lock:
+            self.__process_queue.remove(t)
+        self.job_wall_times.append((command, wall_time))
+        logger.debug("Process '{0}' finished in {1:.1f} seconds".format(
+                        command, wall_time))
+        if self.__process_done_callback is not None:
+            self.__process_done_callback(command, p.returncode, wall_time)
+        if p.returncode != 0:
+            raise KaldiCommandException(command, stderr)
+
+    def start_process(self, command, **popen_args):
+        """ Blocks until the number of running processes started with this
+        function is below max_running_processes, then runs the command
+        with subprocess.Popen(command, shell=True, **popen_args) and adds it
+        to the queue. The slot is released when the process ends, or at once
+        if it could not be started. Returns the process handle. """
+        if self.__slots is not None:
+            self.__slots.acquire()
+        try:
+            p = subprocess.Popen(command, shell=True, **popen_args)
+        except:
+            if self.__slots is not None:
+                self.__slots.release()
+            raise
+        self.__add_process((p, command), self.__slots is not None)
+        return p
 
     def stop(self):
-        """ Stop the background process handler by cancelling any running timer.
+        """ Kept for compatibility. There is nothing to stop as the processes
+        are waited for in daemon threads.
         """
-        if self.__timer is not None:
-            self.__timer.cancel()
-        self.__is_running = False
+        pass
 
     def poll(self):
-        """ Poll background processes and check their statuses.
+        """ Handle the background processes that have finished.
 
+        Raises KaldiCommandException if any of them failed.
         Returns True if any processes are still in the queue.
         """
+        while True:
+            try:
+                item = self.__done_queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.__process_done(*item)
         with self.__lock:
-            remaining_processes = []
-            for t in self.__process_queue:
-                if self.is_process_done(t):
-                    self.ensure_process_is_done(t)
-                else:
-                    remaining_processes.append(t)
-            self.__process_queue = remaining_processes
             num_processes = len(self.__process_queue)
-            logger.debug("Number of processes remaining is {0}...".format(
-                            num_processes))
+        logger.debug("Number of processes remaining is {0}...".format(
+                        num_processes))
         return (num_processes > 0)
 
     def add_process(self, t):
-        """ Add a (process handle, command) tuple to the queue.
+        """ Add a (process handle, command) tuple to the queue. The process
+        is not counted against max_running_processes; use start_process()
+        for that.
         """
+        self.__add_process(t, False)
+
+    def __add_process(self, t, holds_slot):
         with self.__lock:
             self.__process_queue.append(t)
-        self.start()
+        thread = threading.Thread(target=self.__wait_for_process,
+                                  args=(t, time.time(), holds_slot))
+        thread.daemon = True
+        thread.start()
+        self.poll()
 
     def is_process_done(self, t):
         p, command = t
@@ -170,28 +235,130 @@ class BackgroundProcessHandler():
             return False
         return True
 
-    def ensure_process_is_done(self, t):
-        p, command = t
-        logger.debug("Waiting for process '{0}' to end".format(command))
-        [stdout, stderr] = p.communicate()
-        if p.returncode is not 0:
-            raise KaldiCommandException(command, stderr)
-
     def ensure_processes_are_done(self):
-        self.__process_queue.reverse()
-        while len(self.__process_queue) > 0:
-            t = self.__process_queue.pop()
-            self.ensure_process_is_done(t)
-        self.stop()
-
-    def __del__(self):
-        self.stop()
+        while self.poll():
+            try:
+                # A timeout is used so that the wait can be interrupted.
+                item = self.__done_queue.get(True, self.__polling_time)
+            except Queue.Empty:
+                self.debug()
+                continue
+            self.__process_done(*item)
 
     def debug(self):
-        for p, command in self.__process_queue:
+        with self.__lock:
+            processes = list(self.__process_queue)
+        for p, command in processes:
             logger.info("Process '{0}' is running".format(command))
 
 
+class JobScheduler(object):
+    """ This class runs a set of shell commands (usually the parallel jobs of
+    one iteration of training, e.g. 'run.pl ... nnet3-train ...') with at
+    most 'max_running_jobs' of them running at the same time.
+
+    A failed job is retried up to 'num_retries' times. If it still fails,
+    the other running jobs are cancelled and a KaldiCommandException is
+    raised. Each job is run in its own process group so that it can be
+    cancelled along with the processes it spawns.
+
+    Attributes:
+        commands: The list of commands added with add_job()
+        max_running_jobs: The maximum number of jobs to run at the same time,
+            or None (or 0) to run all of them at the same time
+        num_retries: The number of times a failed job is retried
+        job_timings: A list of (command, wall time in seconds, number of
+            attempts) tuples for the jobs that have finished successfully,
+            in the order in which they finished. The wall time is that of
+            the last attempt.
+    """
+
+    def __init__(self, max_running_jobs=None, num_retries=0):
+        self.commands = []
+        self.max_running_jobs = max_running_jobs
+        self.num_retries = num_retries
+        self.job_timings = []
+
+    def add_job(self, command):
+        self.commands.append(command)
+
+    def __start_job(self, index, done_queue):
+        """ Internal function that starts the job with the given index.
+        The index is put into done_queue when the job ends. """
+        p = subprocess.Popen(self.commands[index], shell=True,
+                             preexec_fn=os.setsid)
+
+        def wait():
+            p.wait()
+            done_queue.put(index)
+
+        thread = threading.Thread(target=wait)
+        thread.daemon = True
+        thread.start()
+        return p
+
+    def run(self):
+        """ Runs all the jobs and waits until they are done.
+        Raises KaldiCommandException if a job fails after all retries.
+        """
+        num_jobs = len(self.commands)
+        max_running_jobs = num_jobs
+        if self.max_running_jobs is not None and self.max_running_jobs > 0:
+            max_running_jobs = self.max_running_jobs
+
+        done_queue = Queue.Queue()
+        pending_jobs = list(range(num_jobs))
+        pending_jobs.reverse()
+        running_jobs = {}   # index -> (process handle, start time)
+        num_attempts = [0] * num_jobs
+        try:
+            while len(pending_jobs) > 0 or len(running_jobs) > 0:
+                while (len(pending_jobs) > 0
+                       and len(running_jobs) < max_running_jobs):
+                    index = pending_jobs.pop()
+                    num_attempts[index] += 1
+                    running_jobs[index] = (
+                        self.__start_job(index, done_queue), time.time())
+                try:
+                    # A timeout is used so that the wait can be interrupted.
+                    index = done_queue.get(True, 60)
+                except Queue.Empty:
+                    continue
+                p, start_time = running_jobs.pop(index)
+                wall_time = time.time() - start_time
+                command = self.commands[index]
+                if p.returncode != 0:
+                    if num_attempts[index] <= self.num_retries:
+                        logger.warning(
+                            "Command '{0}' failed with return code {1}; "
+                            "retrying it (retry {2} of {3})".format(
+                                command, p.returncode, num_attempts[index],
+                                self.num_retries))
+                        pending_jobs.append(index)
+                        continue
+                    logger.error("Command '{0}' failed with return code "
+                                 "{1}; cancelling the other {2} running "
+                                 "jobs".format(command, p.returncode,
+                                               len(running_jobs)))
+                    raise KaldiCommandException(command)
+                self.job_timings.append((command, wall_time,
+                                         num_attempts[index]))
+        finally:
+            self.__cancel_jobs(running_jobs, done_queue)
+
+    def __cancel_jobs(self, running_jobs, done_queue):
+        """ Internal function that kills the running jobs (and the processes
+        they spawned) and waits for them to end. """
+        for p, start_time in running_jobs.values():
+            try:
+                os.killpg(p.pid, signal.SIGTERM)
+            except OSError:
+                # the process has already ended
+                pass
+        for i in range(len(running_jobs)):
+            done_queue.get()
+
+
 def run_job(command, wait=True, background_process_handler=None):
     """ Runs a kaldi job, usually using a script such as queue.pl and
         run.pl, and redirects the stdout and stderr to the parent
@@ -207,15 +374,15 @@ def run_job(command, wait=True, background_process_handler=None):
             background_process_handler is provided, this option will be
             ignored and the process will be run in the background.
     """
-    p = subprocess.Popen(command, shell=True)
-
     if background_process_handler is not None:
         wait = False
-        background_process_handler.add_process((p, command))
+        p = background_process_handler.start_process(command)
+    else:
+        p = subprocess.Popen(command, shell=True)
 
     if wait:
         p.communicate()
-        if p.returncode is not 0:
+        if p.returncode != 0:
             raise KaldiCommandException(command)
         return None
     else:
@@ -236,23 +403,69 @@ def run_kaldi_command(command, wait=True, background_process_handler=None):
             background_process_handler is provided, this option will be
             ignored and the process will be run in the background.
     """
-    p = subprocess.Popen(command, shell=True,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-
     if background_process_handler is not None:
         wait = False
-        background_process_handler.add_process((p, command))
+        p = background_process_handler.start_process(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    else:
+        p = subprocess.Popen(command, shell=True,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
 
     if wait:
         [stdout, stderr] = p.communicate()
-        if p.returncode is not 0:
+        if p.returncode != 0:
             raise KaldiCommandException(command, stderr)
         return stdout, stderr
     else:
         return p
 
 
+def _get_fork_context():
+    """ Returns the multiprocessing context that forks the worker processes,
+    so that the workers inherit the state (e.g. the parsed options) of the
+    calling script. """
+    import multiprocessing
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+def imap_in_order(function, iterable, num_workers=1, max_pending=None):
+    """ Applies 'function' to each element of 'iterable' using a pool of
+    'num_workers' processes and yields the results in the order of the input.
+
+    At most 'max_pending' elements (by default, 4 * num_workers) are
+    submitted to the pool and not yet yielded, so that the input can be
+    streamed without reading all of it into memory. 'function' must be
+    a module-level function and its arguments and return values must be
+    picklable. If num_workers <= 1, no processes are created.
+    """
+    if num_workers <= 1:
+        for x in iterable:
+            yield function(x)
+        return
+
+    import collections
+    if max_pending is None:
+        max_pending = 4 * num_workers
+    max_pending = max(max_pending, 1)
+
+    pool = _get_fork_context().Pool(num_workers)
+    pending = collections.deque()
+    try:
+        for x in iterable:
+            pending.append(pool.apply_async(function, (x,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def get_number_of_leaves_from_tree(alidir):
     [stdout, stderr] = run_kaldi_command(
         "tree-info {0}/tree 2>/dev/null | grep num-pdfs".format(alidir))
@@ -288,11 +501,8 @@ def get_number_of_jobs(alidir):
 def get_ivector_dim(ivector_dir=None):
     if ivector_dir is None:
         return 0
-    [stdout_val, stderr_val] = run_kaldi_command(
-        "feat-to-dim --print-args=false "
-        "scp:{dir}/ivector_online.scp -".format(dir=ivector_dir))
-    ivector_dim = int(stdout_val)
-    return ivector_dim
+    return get_feat_dim_from_scp(
+        "{dir}/ivector_online.scp".format(dir=ivector_dir))
 
 def get_ivector_extractor_id(ivector_dir=None):
     if ivector_dir is None:
@@ -306,14 +516,22 @@ def get_ivector_extractor_id(ivector_dir=None):
     return stdout_val.strip()
 
 def get_feat_dim(feat_dir):
-    [stdout_val, stderr_val] = run_kaldi_command(
-        "feat-to-dim --print-args=false "
-        "scp:{data}/feats.scp -".format(data=feat_dir))
-    feat_dim = int(stdout_val)
-    return feat_dim
+    return get_feat_dim_from_scp("{data}/feats.scp".format(data=feat_dir))
 
 
 def get_feat_dim_from_scp(feat_scp):
+    """ Returns the feature dimension of the first entry in feat_scp.
+    The header of the matrix is read directly from the archive using
+    libs.kaldi_io; we fall back to running feat-to-dim if that is not
+    possible, e.g. if the scp file contains pipes.
+    """
+    try:
+        import libs.kaldi_io as kaldi_io
+        return kaldi_io.get_dim_from_scp(feat_scp)
+    except Exception as e:
+        logger.debug("Could not read the dimension from {0} directly, "
+                     "using feat-to-dim: {1}".format(feat_scp, str(e)))
+
     [stdout_val, stderr_val] = run_kaldi_command(
         "feat-to-dim --print-args=false "
         "scp:{feat_scp} -".format(feat_scp=feat_scp))
@@ -322,52 +540,98 @@ def get_feat_dim_from_scp(feat_scp):
 
 
 def split_data(data, num_jobs, per_utt=False):
-    if per_utt:
-        run_kaldi_command("utils/split_data.sh --per-utt {data} {num_jobs}"
-                          "".format(data=data, num_jobs=num_jobs))
-        return "{data}/split{num_jobs}utt".format(data=data, num_jobs=num_jobs)
-
-    run_kaldi_command("utils/split_data.sh {data} {num_jobs}"
-                      "".format(data=data, num_jobs=num_jobs))
-    return "{data}/split{num_jobs}".format(data=data, num_jobs=num_jobs)
+    """ Splits the data directory into num_jobs parts, like
+    utils/split_data.sh, but with parts of about the same duration; see
+    libs/split_data.py. Returns the split directory, e.g. data/train/split4.
+    """
+    import libs.split_data as split_data_lib
+    return split_data_lib.split_data_dir(data, num_jobs, per_utt=per_utt)
 
 
 def read_kaldi_matrix(matrix_file):
+    """ Reads a matrix in Kaldi's text or binary format from matrix_file.
+    Returns a 2-dimensional numpy array of floats if NumPy is available, and
+    a list of lists of floats otherwise (reading binary matrices requires
+    NumPy). A vector in text format is returned as a matrix with one row.
+    """
     try:
-        lines = map(lambda x: x.split(), open(matrix_file).readlines())
-        first_field = lines[0][0]
-        last_field = lines[-1][-1]
-        lines[0] = lines[0][1:]
-        lines[-1] = lines[-1][:-1]
-        if not (first_field == "[" and last_field == "]"):
+        with open(matrix_file, 'rb') as f:
+            is_binary = (f.read(2) == b'\x00B')
+        if is_binary:
+            import libs.kaldi_io as kaldi_io
+            matrix = kaldi_io.read_mat(matrix_file)
+            if matrix.ndim == 1:
+                matrix = matrix.reshape(1, -1)
+            return matrix
+
+        lines = [x.split() for x in open(matrix_file).readlines()]
+        lines = [x for x in lines if len(x) > 0]
+        if not (len(lines) > 0 and lines[0][0] == "["
+                and lines[-1][-1] == "]"):
             raise Exception(
                 "Kaldi matrix file has incorrect format, "
-                "only text format matrix files can be read by this script")
-        for i in range(len(lines)):
-            lines[i] = map(lambda x: int(float(x)), lines[i])
-        return lines
+                "only text and binary format matrix files can be read "
+                "by this script")
+        lines[0] = lines[0][1:]
+        lines[-1] = lines[-1][:-1]
+        lines = [x for x in lines if len(x) > 0]
+        if g_numpy:
+            num_rows = len(lines)
+            matrix = np.array([x for line in lines for x in line],
+                              dtype=np.float64)
+            return matrix.reshape(num_rows, -1 if num_rows > 0 else 0)
+        return [[float(x) for x in line] for line in lines]
     except IOError:
         raise Exception("Error while reading the kaldi matrix file "
                         "{0}".format(matrix_file))
 
 
-def write_kaldi_matrix(output_file, matrix):
-    # matrix is a list of lists
-    with open(output_file, 'w') as f:
-        f.write("[ ")
-        num_rows = len(matrix)
-        if num_rows == 0:
-            raise Exception("Matrix is empty")
-        num_cols = len(matrix[0])
-
-        for row_index in range(len(matrix)):
-            if num_cols != len(matrix[row_index]):
+def write_kaldi_matrix_to_handle(f, matrix, binary=False):
+    """ Writes the matrix (a numpy array or a list of lists) to the file
+    handle f in Kaldi's text format, or in binary format if binary is True
+    (in which case f must be opened in binary mode).
+    The rows are written in chunks, so that large matrices can be written
+    without formatting the whole matrix in memory.
+    """
+    num_rows = len(matrix)
+    if num_rows == 0:
+        raise Exception("Matrix is empty")
+    if binary:
+        import libs.kaldi_io as kaldi_io
+        kaldi_io.write_binary_matrix(f, matrix)
+        return
+
+    num_cols = len(matrix[0])
+    f.write("[ ")
+    chunk_size = 1000
+    for start in range(0, num_rows, chunk_size):
+        rows = matrix[start:start + chunk_size]
+        if g_numpy:
+            rows = np.asarray(rows, dtype=np.float64)
+            if rows.ndim != 2 or rows.shape[1] != num_cols:
                 raise Exception("All the rows of a matrix are expected to "
                                 "have the same length")
-            f.write(" ".join(map(lambda x: str(x), matrix[row_index])))
-            if row_index != num_rows - 1:
-                f.write("\n")
-        f.write(" ]")
+            # '%.9g' is enough to represent a single-precision float (which
+            # is what Kaldi reads the matrix into) exactly.
+            lines = [" ".join(["%.9g"] * num_cols) % tuple(row)
+                     for row in rows.tolist()]
+        else:
+            lines = []
+            for row in rows:
+                if num_cols != len(row):
+                    raise Exception("All the rows of a matrix are expected "
+                                    "to have the same length")
+                lines.append(" ".join(["%.9g" % x for x in row]))
+        if start > 0:
+            f.write("\n")
+        f.write("\n".join(lines))
+    f.write(" ]")
+
+
+def write_kaldi_matrix(output_file, matrix, binary=False):
+    # matrix is a numpy array or a list of lists
+    with open(output_file, 'wb' if binary else 'w') as f:
+        write_kaldi_matrix_to_handle(f, matrix, binary=binary)
 
 
 def force_symlink(file1, file2):
@@ -381,6 +645,10 @@ def force_symlink(file1, file2):
 
 
 def compute_lifter_coeffs(lifter, dim):
+    if g_numpy:
+        return 1.0 + 0.5 * lifter * np.sin(
+            math.pi * np.arange(dim) / float(lifter))
+
     coeffs = [0] * dim
     for i in range(0, dim):
         coeffs[i] = 1.0 + 0.5 * lifter * math.sin(math.pi * i / float(lifter))
@@ -389,6 +657,19 @@ def compute_lifter_coeffs(lifter, dim):
 
 
 def compute_idct_matrix(K, N, cepstral_lifter=0):
+    """ Returns the N x K IDCT matrix (as a numpy array if NumPy is
+    available), optionally with the cepstral liftering undone. """
+    if g_numpy:
+        n = np.arange(N).reshape(N, 1)
+        k = np.arange(K).reshape(1, K)
+        matrix = math.sqrt(2.0 / float(N)) * np.cos(
+            math.pi / float(N) * (n + 0.5) * k)
+        # normalizer for X_0
+        matrix[:, 0] = math.sqrt(1.0 / float(N))
+        if cepstral_lifter != 0:
+            matrix /= compute_lifter_coeffs(cepstral_lifter, K)
+        return matrix
+
     matrix = [[0] * K for i in range(N)]
     # normalizer for X_0
     normalizer = math.sqrt(1.0 / float(N))
@@ -410,12 +691,66 @@ def compute_idct_matrix(K, N, cepstral_lifter=0):
     return matrix
 
 
+def compute_temporal_dct_matrix(feat_dim, splice, dct_basis):
+    """ Returns the (dct_basis * feat_dim) x ((2 * splice + 1) * feat_dim)
+    matrix that applies a DCT along the time axis to each feature dimension
+    of spliced features (whose layout is frame by frame), as used in the
+    TRAPs feature transform of nnet1. Row k * feat_dim + m is the k'th DCT
+    basis for feature dimension m. The matrix is a numpy array if NumPy is
+    available, and a list of lists otherwise.
+    """
+    context = 2 * splice + 1
+    if g_numpy:
+        k = np.arange(dct_basis).reshape(dct_basis, 1)
+        n = np.arange(context).reshape(1, context)
+        dct = math.sqrt(2.0 / context) * np.cos(
+            math.pi / context * k * (n + 0.5))
+        # matrix[k, m, n, m'] = dct[k, n] * (m == m')
+        matrix = np.einsum('kn,ml->kmnl', dct, np.eye(feat_dim))
+        return matrix.reshape(dct_basis * feat_dim, context * feat_dim)
+
+    matrix = []
+    for k in range(dct_basis):
+        for m in range(feat_dim):
+            row = [0] * (context * feat_dim)
+            for n in range(context):
+                row[n * feat_dim + m] = math.sqrt(2.0 / context) * math.cos(
+                    math.pi / context * k * (n + 0.5))
+            matrix.append(row)
+    return matrix
+
+
+def compute_hamming_matrix(feat_dim, splice):
+    """ Returns the diagonal matrix that applies a Hamming window along the
+    time axis to spliced features, as used in the TRAPs feature transform
+    of nnet1. The matrix is a numpy array if NumPy is available, and a list
+    of lists otherwise.
+    """
+    context = 2 * splice + 1
+    if context < 2:
+        raise Exception("The Hamming window needs splice > 0")
+    if g_numpy:
+        window = 0.54 - 0.46 * np.cos(2 * math.pi * np.arange(context)
+                                      / (context - 1))
+        return np.diag(np.repeat(window, feat_dim))
+
+    dim = context * feat_dim
+    matrix = [[0] * dim for i in range(dim)]
+    for i in range(dim):
+        matrix[i][i] = 0.54 - 0.46 * math.cos(
+            2 * math.pi * (i // feat_dim) / (context - 1))
+    return matrix
+
+
 def write_idct_matrix(feat_dim, cepstral_lifter, file_path):
     # generate the IDCT matrix and write to the file
     idct_matrix = compute_idct_matrix(feat_dim, feat_dim, cepstral_lifter)
     # append a zero column to the matrix, this is the bias of the fixed affine
     # component
-    for k in range(0, feat_dim):
-        idct_matrix[k].append(0)
+    if g_numpy:
+        idct_matrix = np.hstack([idct_matrix, np.zeros((feat_dim, 1))])
+    else:
+        for k in range(0, feat_dim):
+            idct_matrix[k].append(0)
     write_kaldi_matrix(file_path, idct_matrix)
 
@@ -0,0 +1,444 @@
+# Apache 2.0.
+
+""" This module gives access to the files of a Kaldi data directory (utt2spk,
+spk2utt, text, feats.scp, utt2dur, wav.scp, ...), which are tables with one
+line '<key> <value>' per entry, sorted on the key in the C locale.
+
+A TableFile can be used in three ways:
+    - to_dict() reads the whole file into a dict in one pass, like the
+      ParseFileToDict() functions that the scripts used to define;
+    - the entries can be looked up by key ('key in table', table[key]) without
+      reading the file: the file is memory-mapped and an index of the offsets
+      of its lines, sorted on the key, is searched;
+    - items() iterates over the entries in sorted order, and join_tables()
+      iterates over the keys present in several tables at once, as a merge of
+      the sorted tables, without building dicts.
+The index is built the first time it is needed, and saved next to the file
+(as .<name>.index) with the size and the modification time (in nanoseconds
+where the platform gives it) of the file, so that it is only rebuilt when
+the file changes.  As a file can be rewritten with the same size within the
+granularity of the modification time (e.g. by 'sort -o utt2spk utt2spk'),
+a cached index is also checked against the lines at its first and last
+offsets when it is loaded, and against every line it is used to look up,
+and is rebuilt if any of them does not match.
+
+If a key appears on more than one line, to_dict() and the lookups both use
+its first line (like 'sort -u' and utils/fix_data_dir.sh), and items()
+yields all of its lines, the first one first.
+
+write_table() writes the entries of a table sorted on the key, as
+utils/fix_data_dir.sh expects.
+
+e.g.
+    data = data_dir.DataDir("data/train")
+    print(data["text"]["utt1"])
+    for utt, (spk, dur) in data.join("utt2spk", "utt2dur"):
+        print(utt, spk, dur)
+    data.write("utt2spk", [("utt2", "spk1"), ("utt1", "spk1")])
+    data.close()
+"""
+
+import mmap
+import os
+import re
+import struct
+
+# The header of the index files: the magic string, the size and the
+# modification time (in nanoseconds) of the table file, the number of lines
+# and whether the lines of the table file are already sorted.
+_index_magic = b'KTI2'
+_index_header = struct.Struct('<4sQQQQ')
+_offset = struct.Struct('<Q')
+_key_re = re.compile(br'[^ \t\r\n]+')
+
+
+def _to_str(data):
+    return data if isinstance(data, str) else data.decode('utf-8')
+
+
+def _to_bytes(key):
+    return key if isinstance(key, bytes) else key.encode('utf-8')
+
+
+def _mtime_ns(stat):
+    """ Returns the modification time of a file in nanoseconds; st_mtime_ns
+    does not exist in python2, where only st_mtime (a float) is given. """
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 1e9)
+    return mtime_ns
+
+
+class _StaleIndex(Exception):
+    """ Raised when an index does not match the lines of the table file. """
+    pass
+
+
+def _split_line(line):
+    """ Splits a line (bytes) of a table file into (key, value), where value
+    is the rest of the line without the surrounding whitespace. """
+    parts = line.strip().split(None, 1)
+    return (_to_str(parts[0]), _to_str(parts[1]) if len(parts) == 2 else '')
+
+
+class TableFile(object):
+    """ A table file of a data directory; see the module docstring.
+
+    Attributes:
+        filename: The name of the table file.
+        cache_index: If true, the index is saved to and read from the file
+            .<name>.index in the directory of the table file.
+    """
+    def __init__(self, filename, cache_index=True):
+        self.filename = filename
+        self.cache_index = cache_index
+        self._mm = None
+        self._index = None
+        self._num_lines = None
+        self._is_sorted = None
+        self._stat = None
+
+    def index_filename(self):
+        (dirname, basename) = os.path.split(self.filename)
+        return os.path.join(dirname, '.{0}.index'.format(basename))
+
+    def to_dict(self, value_processor=None, num_fields=None):
+        """ Reads the file into a dict from key to value_processor(fields),
+        where fields is the list of the fields of the line after the key
+        (by default the value is the first of them).  If num_fields is not
+        None, a line with a different number of fields (including the key)
+        raises a ValueError.  If a key appears more than once, its first
+        line is used, as by the lookups. """
+        if value_processor is None:
+            value_processor = lambda x: x[0]
+        ans = {}
+        with open(self.filename) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 0:
+                    continue
+                if num_fields is not None and len(parts) != num_fields:
+                    raise ValueError("Bad line in {0} (expected {1} fields): "
+                                     "{2}".format(self.filename, num_fields,
+                                                  line.strip()))
+                if parts[0] not in ans:
+                    ans[parts[0]] = value_processor(parts[1:])
+        return ans
+
+    def _build_index(self, mm):
+        """ Returns (num-lines, is-sorted, index), where the index is the
+        packed offsets of the lines sorted on the key (stable, so the first
+        line of a repeated key comes first). """
+        keys = []
+        offsets = []
+        pos = 0
+        size = len(mm)
+        while pos < size:
+            end = mm.find(b'\n', pos)
+            if end == -1:
+                end = size
+            line = mm[pos:end]
+            parts = line.split(None, 1)
+            if len(parts) > 0:
+                keys.append(parts[0])
+                offsets.append(pos + len(line) - len(line.lstrip()))
+            pos = end + 1
+        is_sorted = all(keys[i] <= keys[i + 1] for i in range(len(keys) - 1))
+        if not is_sorted:
+            order = sorted(range(len(keys)), key=lambda i: keys[i])
+            offsets = [offsets[i] for i in order]
+        index = b''.join([_offset.pack(offset) for offset in offsets])
+        return (len(offsets), is_sorted, index)
+
+    def _read_cached_index(self, stat):
+        try:
+            with open(self.index_filename(), 'rb') as f:
+                header = f.read(_index_header.size)
+                if len(header) != _index_header.size:
+                    return None
+                (magic, size, mtime, num_lines,
+                 is_sorted) = _index_header.unpack(header)
+                if (magic != _index_magic or size != stat.st_size or
+                        mtime != _mtime_ns(stat)):
+                    return None
+                index = f.read()
+                if len(index) != num_lines * _offset.size:
+                    return None
+                return (num_lines, bool(is_sorted), index)
+        except (IOError, OSError):
+            return None
+
+    def _check_index(self, num_lines, index):
+        """ Checks that the first and the last offsets of the index point to
+        the start of a line, and that their keys are in order; raises
+        _StaleIndex if not. """
+        if num_lines == 0:
+            if len(self._mm) != 0 and len(self._mm.split()) != 0:
+                raise _StaleIndex()
+            return
+        first = self._key_at(_offset.unpack_from(index, 0)[0])
+        last = self._key_at(
+            _offset.unpack_from(index, (num_lines - 1) * _offset.size)[0])
+        if first > last:
+            raise _StaleIndex()
+
+    def _write_cached_index(self, stat, num_lines, is_sorted, index):
+        index_filename = self.index_filename()
+        tmp_filename = '{0}.{1}.tmp'.format(index_filename, os.getpid())
+        try:
+            with open(tmp_filename, 'wb') as f:
+                f.write(_index_header.pack(_index_magic, stat.st_size,
+                                           _mtime_ns(stat), num_lines,
+                                           int(is_sorted)))
+                f.write(index)
+            # rename is atomic, so that a concurrent reader never sees a
+            # partially written index.
+            os.rename(tmp_filename, index_filename)
+        except (IOError, OSError):
+            # e.g. the directory is not writable; the index is just not
+            # cached.
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+
+    def _load(self):
+        if self._index is not None:
+            return
+        stat = os.stat(self.filename)
+        if stat.st_size == 0:
+            self._mm = b''
+        else:
+            with open(self.filename, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._stat = stat
+        cached = self._read_cached_index(stat) if self.cache_index else None
+        if cached is not None:
+            try:
+                self._check_index(cached[0], cached[2])
+            except _StaleIndex:
+                cached = None
+        if cached is None:
+            cached = self._build_index(self._mm)
+            if self.cache_index:
+                self._write_cached_index(stat, *cached)
+        (self._num_lines, self._is_sorted, self._index) = cached
+
+    def _rebuild_index(self):
+        """ Rebuilds the index after a line did not match it. """
+        (self._num_lines, self._is_sorted,
+         self._index) = self._build_index(self._mm)
+        if self.cache_index:
+            self._write_cached_index(self._stat, self._num_lines,
+                                     self._is_sorted, self._index)
+
+    def _offset_of(self, i):
+        return _offset.unpack_from(self._index, i * _offset.size)[0]
+
+    def _key_at(self, offset):
+        """ Returns the key of the line at offset, which must be the start of
+        the key (i.e. only preceded by whitespace in its line); raises
+        _StaleIndex if it is not. """
+        if offset >= len(self._mm):
+            raise _StaleIndex()
+        line_start = self._mm.rfind(b'\n', 0, offset) + 1
+        if len(self._mm[line_start:offset].strip()) != 0:
+            raise _StaleIndex()
+        match = _key_re.match(self._mm, offset)
+        if match is None:
+            raise _StaleIndex()
+        return match.group()
+
+    def _line_at(self, offset):
+        end = self._mm.find(b'\n', offset)
+        return self._mm[offset:] if end == -1 else self._mm[offset:end]
+
+    def _find(self, key):
+        """ Returns the offset of the (first) line for key, or None. """
+        self._load()
+        key = _to_bytes(key)
+        try:
+            return self._search(key)
+        except _StaleIndex:
+            self._rebuild_index()
+            return self._search(key)
+
+    def _search(self, key):
+        """ Binary search for key in the index; raises _StaleIndex if the
+        keys it sees are not in order. """
+        lo = 0
+        hi = self._num_lines
+        # the keys at lo - 1 and hi, once they have been seen; each key
+        # seen must be between them.
+        lo_key = None
+        hi_key = None
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self._key_at(self._offset_of(mid))
+            if ((lo_key is not None and mid_key < lo_key) or
+                    (hi_key is not None and mid_key > hi_key)):
+                raise _StaleIndex()
+            if mid_key < key:
+                lo = mid + 1
+                lo_key = mid_key
+            else:
+                hi = mid
+                hi_key = mid_key
+        if lo < self._num_lines:
+            offset = self._offset_of(lo)
+            if self._key_at(offset) == key:
+                return offset
+        return None
+
+    def is_sorted(self):
+        """ Returns true if the lines of the file are sorted on the key. """
+        self._load()
+        return self._is_sorted
+
+    def __len__(self):
+        self._load()
+        return self._num_lines
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __getitem__(self, key):
+        offset = self._find(key)
+        if offset is None:
+            raise KeyError(key)
+        return _split_line(self._line_at(offset))[1]
+
+    def get(self, key, default=None):
+        offset = self._find(key)
+        return (default if offset is None
+                else _split_line(self._line_at(offset))[1])
+
+    def items(self):
+        """ Generator of the (key, value) pairs, sorted on the key; the value
+        is the rest of the line, as a string. """
+        self._load()
+        if self._is_sorted:
+            with open(self.filename, 'rb') as f:
+                for line in f:
+                    if len(line.split(None, 1)) > 0:
+                        yield _split_line(line)
+            return
+        for i in range(self._num_lines):
+            yield _split_line(self._line_at(self._offset_of(i)))
+
+    def keys(self):
+        """ Generator of the keys, sorted. """
+        for key, value in self.items():
+            yield key
+
+    def close(self):
+        if self._mm is not None and not isinstance(self._mm, bytes):
+            self._mm.close()
+        self._mm = None
+        self._index = None
+
+
+def join_tables(tables):
+    """ Generator of (key, [value-in-table-1, value-in-table-2, ...]) for
+    the keys that are present in all the tables (TableFiles, or any iterables
+    of (key, value) sorted on the key), in sorted order.  It is a merge of the
+    sorted tables, so it reads each table once and keeps nothing in memory.
+    """
+    iters = [iter(table.items() if isinstance(table, TableFile) else table)
+             for table in tables]
+    if len(iters) == 0:
+        return
+    current = []
+    for it in iters:
+        try:
+            current.append(next(it))
+        except StopIteration:
+            return
+    while True:
+        max_key = max([_to_bytes(c[0]) for c in current])
+        done = True
+        for i in range(len(iters)):
+            while _to_bytes(current[i][0]) < max_key:
+                try:
+                    current[i] = next(iters[i])
+                except StopIteration:
+                    return
+            if _to_bytes(current[i][0]) != max_key:
+                done = False
+        if done:
+            yield (current[0][0], [c[1] for c in current])
+            for i in range(len(iters)):
+                try:
+                    current[i] = next(iters[i])
+                except StopIteration:
+                    return
+
+
+def write_table(filename, items, is_sorted=False, separator=' '):
+    """ Writes the (key, value) pairs of 'items' to the table file, one line
+    '<key><separator><value>' per pair, sorted on the key; a value that is a
+    list or tuple is written joined with spaces.  If is_sorted is true, the
+    items must already be sorted, and they are written as they are
+    generated, in one pass; otherwise they are sorted in memory first.  The
+    file is written to a temporary file that is renamed at the end. """
+    if not is_sorted:
+        items = sorted(items, key=lambda x: _to_bytes(x[0]))
+    tmp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+    try:
+        with open(tmp_filename, 'w') as f:
+            prev_key = None
+            for (key, value) in items:
+                if is_sorted:
+                    if prev_key is not None and _to_bytes(key) < prev_key:
+                        raise ValueError("The entries written to {0} are not "
+                                         "sorted: {1} follows {2}".format(
+                                             filename, key, _to_str(prev_key)))
+                    prev_key = _to_bytes(key)
+                if isinstance(value, (list, tuple)):
+                    value = ' '.join([str(x) for x in value])
+                f.write('{0}{1}{2}\n'.format(key, separator, value))
+        os.rename(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+class DataDir(object):
+    """ A Kaldi data directory, whose table files are opened as TableFiles
+    when they are first used, e.g. data_dir["utt2spk"]. """
+    def __init__(self, path, cache_index=True):
+        self.path = path
+        self.cache_index = cache_index
+        self.tables = {}
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    def has(self, name):
+        return os.path.exists(self.filename(name))
+
+    def __getitem__(self, name):
+        if name not in self.tables:
+            if not self.has(name):
+                raise IOError("There is no such file {0}".format(
+                    self.filename(name)))
+            self.tables[name] = TableFile(self.filename(name),
+                                          cache_index=self.cache_index)
+        return self.tables[name]
+
+    def join(self, *names):
+        """ Same as join_tables() on the tables 'names'. """
+        return join_tables([self[name] for name in names])
+
+    def write(self, name, items, is_sorted=False, separator=' '):
+        """ Writes the table file 'name' with write_table(). """
+        if name in self.tables:
+            self.tables.pop(name).close()
+        write_table(self.filename(name), items, is_sorted=is_sorted,
+                    separator=separator)
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        self.tables = {}
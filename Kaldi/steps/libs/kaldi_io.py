@@ -0,0 +1,426 @@
+# Apache 2.0.
+
+""" This module contains functions and classes to read Kaldi archives
+(ark files) and script files (scp files) directly in python, without
+running Kaldi binaries.
+
+The ark files are memory-mapped and the matrices and vectors in them are
+returned as NumPy arrays that are views into the memory-mapped file, so
+that reading an object does not copy its data. The exceptions are
+compressed matrices, which need to be uncompressed, and objects in text
+format, which need to be parsed.
+
+Only the 'rxfilenames' of the form "<filename>:<offset>" and
+"<filename>:<offset>[<range>]" (and plain filenames) are supported in scp
+files. Pipes and other special rxfilenames raise a ValueError; callers that
+need to handle them can fall back to using Kaldi binaries.
+
+e.g.
+    reader = kaldi_io.ScpReader("data/train/feats.scp")
+    feats = reader["utt1"]   # a numpy array of shape (num-frames, dim)
+    reader.close()
+"""
+
+import mmap
+import re
+import struct
+
+try:
+    import numpy as np
+    g_numpy = True
+except ImportError:
+    g_numpy = False
+
+
+# Maps the tokens for the binary matrices and vectors to
+# (numpy dtype, is-matrix)
+_binary_types = {
+    'FM': ('<f4', True),
+    'DM': ('<f8', True),
+    'FV': ('<f4', False),
+    'DV': ('<f8', False),
+}
+
+# Maps the tokens for the compressed matrix to the compression format used in
+# Kaldi's compressed-matrix.h.
+_compressed_matrix_types = {
+    'CM': 1,    # kOneByteWithColHeaders
+    'CM2': 2,   # kTwoByte
+    'CM3': 3,   # kOneByte
+}
+
+
+def _check_numpy():
+    if not g_numpy:
+        raise RuntimeError("NumPy is required to read the data of "
+                           "Kaldi objects.")
+
+
+def _read_token(buf, pos):
+    """ Reads a space-terminated token from buf starting at pos.
+    Returns (token, position-after-the-space). """
+    end = buf.find(b' ', pos)
+    if end == -1:
+        raise ValueError("Could not find the end of the token at "
+                         "position {0}".format(pos))
+    return buf[pos:end].decode('latin-1'), end + 1
+
+
+def _read_int32(buf, pos):
+    """ Reads a binary int32 with its size prefix as written by Kaldi's
+    WriteBasicType(). Returns (value, position-after-it). """
+    if buf[pos:pos + 1] != b'\x04':
+        raise ValueError("Expected int32 size marker at position "
+                         "{0}".format(pos))
+    return struct.unpack('<i', buf[pos + 1:pos + 5])[0], pos + 5
+
+
+def _is_binary(buf, pos):
+    return buf[pos:pos + 2] == b'\x00B'
+
+
+def _parse_header(buf, pos):
+    """ Parses the header of a binary Kaldi object starting at pos (just
+    after the binary marker "\\0B").
+
+    Returns a tuple (type, shape, data_pos, end_pos), where type is a token
+    such as 'FM', 'CM2', or 'IV' (for an int32 vector, which has no token),
+    shape is a tuple of ints and data_pos and end_pos are the positions of
+    the start of the data and of the end of the object in buf.
+    """
+    if buf[pos:pos + 1] == b'\x04':
+        # A vector of int32, e.g. an alignment.  Each element is written
+        # along with its size.
+        dim, data_pos = _read_int32(buf, pos)
+        return 'IV', (dim,), data_pos, data_pos + 5 * dim
+
+    token, pos = _read_token(buf, pos)
+    if token in _binary_types:
+        dtype, is_matrix = _binary_types[token]
+        itemsize = 4 if dtype == '<f4' else 8
+        if is_matrix:
+            num_rows, pos = _read_int32(buf, pos)
+            num_cols, pos = _read_int32(buf, pos)
+            shape = (num_rows, num_cols)
+        else:
+            dim, pos = _read_int32(buf, pos)
+            shape = (dim,)
+        size = 1
+        for x in shape:
+            size *= x
+        return token, shape, pos, pos + size * itemsize
+
+    if token in _compressed_matrix_types:
+        (min_value, range_, num_rows,
+         num_cols) = struct.unpack('<ffii', buf[pos:pos + 16])
+        data_pos = pos + 16
+        compression_format = _compressed_matrix_types[token]
+        if compression_format == 1:
+            size = 8 * num_cols + num_rows * num_cols
+        elif compression_format == 2:
+            size = 2 * num_rows * num_cols
+        else:
+            size = num_rows * num_cols
+        return token, (num_rows, num_cols), data_pos, data_pos + size
+
+    raise ValueError("Unsupported Kaldi object with token '{0}'".format(token))
+
+
+def _uncompress_matrix(buf, token, shape, data_pos):
+    """ Uncompresses a compressed matrix whose data (after the global
+    header) starts at data_pos. Returns a float32 numpy array. """
+    min_value, range_ = struct.unpack('<ff', buf[data_pos - 16:data_pos - 8])
+    num_rows, num_cols = shape
+    compression_format = _compressed_matrix_types[token]
+
+    if compression_format == 2:
+        data = np.frombuffer(buf, dtype='<u2', count=num_rows * num_cols,
+                             offset=data_pos).reshape(num_rows, num_cols)
+        return (min_value
+                + data.astype(np.float32) * (range_ / 65535.0)).astype(
+                    np.float32)
+    if compression_format == 3:
+        data = np.frombuffer(buf, dtype=np.uint8, count=num_rows * num_cols,
+                             offset=data_pos).reshape(num_rows, num_cols)
+        return (min_value
+                + data.astype(np.float32) * (range_ / 255.0)).astype(
+                    np.float32)
+
+    # kOneByteWithColHeaders: each column has a header with 4 uint16 values
+    # that are the 0th, 25th, 75th and 100th percentiles of the column, and
+    # the data is stored column by column as bytes that interpolate
+    # piecewise-linearly between the percentiles.
+    headers = np.frombuffer(buf, dtype='<u2', count=4 * num_cols,
+                            offset=data_pos).reshape(num_cols, 4)
+    percentiles = (min_value
+                   + headers.astype(np.float32) * (range_ / 65535.0))
+    p0 = percentiles[:, 0:1]
+    p25 = percentiles[:, 1:2]
+    p75 = percentiles[:, 2:3]
+    p100 = percentiles[:, 3:4]
+    data = np.frombuffer(buf, dtype=np.uint8, count=num_rows * num_cols,
+                         offset=data_pos + 8 * num_cols).reshape(
+                             num_cols, num_rows).astype(np.float32)
+    mat = np.where(
+        data <= 64, p0 + (p25 - p0) * data * (1.0 / 64.0),
+        np.where(data <= 192,
+                 p25 + (p75 - p25) * (data - 64) * (1.0 / 128.0),
+                 p75 + (p100 - p75) * (data - 192) * (1.0 / 63.0)))
+    return mat.T.astype(np.float32)
+
+
+def _read_text_object(buf, pos):
+    """ Reads a matrix or vector in Kaldi's text format starting at pos.
+    Returns (numpy-array, end-position). """
+    start = buf.find(b'[', pos)
+    end = buf.find(b']', pos)
+    if start == -1 or end == -1 or start > end:
+        raise ValueError("Could not parse text-format object at "
+                         "position {0}".format(pos))
+    content = buf[start + 1:end].decode('latin-1')
+    end_pos = end + 1
+    if buf[end_pos:end_pos + 1] == b'\n':
+        end_pos += 1
+    rows = [line.split() for line in content.split('\n')]
+    if content.lstrip(' ').startswith('\n'):
+        # a matrix; each line is a row.
+        rows = [row for row in rows if len(row) > 0]
+        mat = np.array([[float(x) for x in row] for row in rows],
+                       dtype=np.float32)
+        if len(rows) == 0:
+            mat = mat.reshape(0, 0)
+        return mat, end_pos
+    return np.array([float(x) for x in content.split()],
+                    dtype=np.float32), end_pos
+
+
+def _read_object(buf, pos):
+    """ Reads a Kaldi object starting at pos in buf. Returns
+    (numpy-array, end-position). Uncompressed binary matrices and
+    vectors are returned as views into buf. """
+    _check_numpy()
+    if not _is_binary(buf, pos):
+        return _read_text_object(buf, pos)
+
+    token, shape, data_pos, end_pos = _parse_header(buf, pos + 2)
+    if token == 'IV':
+        # The elements are interleaved with their size markers, so we use a
+        # record dtype and return a (strided) view of the values.
+        records = np.frombuffer(buf, dtype=[('size', 'u1'), ('value', '<i4')],
+                                count=shape[0], offset=data_pos)
+        return records['value'], end_pos
+    if token in _compressed_matrix_types:
+        return _uncompress_matrix(buf, token, shape, data_pos), end_pos
+    dtype = _binary_types[token][0]
+    size = 1
+    for x in shape:
+        size *= x
+    array = np.frombuffer(buf, dtype=dtype, count=size, offset=data_pos)
+    return array.reshape(shape), end_pos
+
+
+def _read_shape(buf, pos):
+    """ Returns the shape of the Kaldi object at pos in buf, reading only
+    its header for binary objects. """
+    if not _is_binary(buf, pos):
+        return _read_object(buf, pos)[0].shape
+    return _parse_header(buf, pos + 2)[1]
+
+
+def parse_rxfilename(rxfilename):
+    """ Parses an rxfilename as found in scp files, e.g.
+    "raw_mfcc_train.1.ark:1234" or "foo.ark:1234[10:20,0:12]".
+
+    Returns a tuple (filename, offset, range), where range is None or
+    a tuple of slices (row-slice, column-slice) where the column-slice may be
+    None. Raises ValueError for rxfilenames that are not supported (e.g.
+    pipes).
+    """
+    rxfilename = rxfilename.strip()
+    if (rxfilename.endswith('|') or rxfilename.startswith('ark:')
+            or rxfilename.startswith('scp:') or rxfilename == '-'):
+        raise ValueError("Unsupported rxfilename {0}".format(rxfilename))
+
+    range_ = None
+    m = re.match(r'^(.*)\[([0-9:,]*)\]$', rxfilename)
+    if m is not None:
+        rxfilename = m.group(1)
+        slices = []
+        for part in m.group(2).split(','):
+            if part == '':
+                slices.append(slice(None))
+                continue
+            begin_end = part.split(':')
+            if len(begin_end) != 2:
+                raise ValueError("Bad range in rxfilename {0}".format(
+                    rxfilename))
+            # Kaldi ranges are inclusive of the end.
+            slices.append(slice(int(begin_end[0]), int(begin_end[1]) + 1))
+        if len(slices) > 2:
+            raise ValueError("Bad range in rxfilename {0}".format(rxfilename))
+        range_ = (slices[0], slices[1] if len(slices) == 2 else None)
+
+    m = re.match(r'^(.*):([0-9]+)$', rxfilename)
+    if m is not None:
+        return m.group(1), int(m.group(2)), range_
+    return rxfilename, 0, range_
+
+
+def _apply_range(array, range_):
+    if range_ is None:
+        return array
+    if range_[1] is None:
+        return array[range_[0]]
+    return array[range_[0], range_[1]]
+
+
+def _range_shape(shape, range_):
+    if range_ is None:
+        return shape
+    shape = list(shape)
+    for i, s in enumerate(range_):
+        if s is None or i >= len(shape):
+            continue
+        shape[i] = len(range(*s.indices(shape[i])))
+    return tuple(shape)
+
+
+class MmapFileCache(object):
+    """ Keeps the memory-maps of the files that have been read, so that
+    each file is opened and mapped only once.
+    """
+    def __init__(self):
+        self.mmaps = {}
+
+    def get(self, filename):
+        if filename not in self.mmaps:
+            with open(filename, 'rb') as f:
+                self.mmaps[filename] = mmap.mmap(f.fileno(), 0,
+                                                 access=mmap.ACCESS_READ)
+        return self.mmaps[filename]
+
+    def close(self):
+        """ Closes the memory-maps. The arrays returned from them should not
+        be used after this (they are only valid while the map is open). """
+        for mm in self.mmaps.values():
+            try:
+                mm.close()
+            except BufferError:
+                # There are still numpy views referring to the map; it will
+                # be unmapped when they are garbage-collected.
+                pass
+        self.mmaps = {}
+
+
+class ScpReader(object):
+    """ Random-access reader for a Kaldi scp file whose entries point into
+    ark files (or into files that contain a single object).
+
+    Attributes:
+        keys: The list of keys in the order of the scp file.
+        index: A dict from key to (filename, offset, range); see
+            parse_rxfilename().
+    """
+    def __init__(self, scp_file, file_cache=None):
+        self.keys = []
+        self.index = {}
+        self.file_cache = (MmapFileCache() if file_cache is None
+                           else file_cache)
+
+        with open(scp_file) as f:
+            for line in f:
+                parts = line.strip().split(None, 1)
+                if len(parts) == 0:
+                    continue
+                if len(parts) != 2:
+                    raise ValueError("Bad line '{0}' in scp file {1}".format(
+                        line.strip(), scp_file))
+                key = parts[0]
+                if key not in self.index:
+                    self.keys.append(key)
+                self.index[key] = parse_rxfilename(parts[1])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        for key in self.keys:
+            yield key, self[key]
+
+    def __getitem__(self, key):
+        filename, offset, range_ = self.index[key]
+        array, end = _read_object(self.file_cache.get(filename), offset)
+        return _apply_range(array, range_)
+
+    def shape(self, key):
+        """ Returns the shape of the object for key. For binary objects, this
+        reads only the header, so it does not require NumPy. """
+        filename, offset, range_ = self.index[key]
+        shape = _read_shape(self.file_cache.get(filename), offset)
+        return _range_shape(shape, range_)
+
+    def close(self):
+        self.file_cache.close()
+
+
+def read_ark(ark_file):
+    """ Generator that sequentially reads the ark file and yields tuples
+    (key, numpy-array). The arrays are views into the memory-mapped file
+    where possible. """
+    cache = MmapFileCache()
+    buf = cache.get(ark_file)
+    pos = 0
+    while pos < len(buf):
+        key, pos = _read_token(buf, pos)
+        key = key.strip()
+        array, pos = _read_object(buf, pos)
+        yield key, array
+
+
+def read_mat(rxfilename):
+    """ Reads the matrix (or vector) from an rxfilename such as
+    "foo.ark:1234". """
+    filename, offset, range_ = parse_rxfilename(rxfilename)
+    cache = MmapFileCache()
+    array, end = _read_object(cache.get(filename), offset)
+    return _apply_range(array, range_)
+
+
+def get_dim_from_scp(scp_file):
+    """ Returns the dimension (the number of columns for matrices) of the
+    first object in the scp file; this is what the Kaldi binary
+    'feat-to-dim' prints for "scp:<scp-file>". """
+    with open(scp_file) as f:
+        for line in f:
+            parts = line.strip().split(None, 1)
+            if len(parts) == 2:
+                break
+        else:
+            raise ValueError("Empty scp file {0}".format(scp_file))
+    filename, offset, range_ = parse_rxfilename(parts[1])
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            shape = _range_shape(_read_shape(mm, offset), range_)
+        finally:
+            mm.close()
+    return shape[-1]
+
+
+def write_binary_matrix(file_handle, matrix, double=False):
+    """ Writes the matrix (a numpy array or a list of lists) to the file
+    handle, which must be opened in binary mode, in Kaldi's binary format
+    (without a key). The data is written as float32 ("FM"), or as float64
+    ("DM") if double is True. """
+    _check_numpy()
+    matrix = np.asarray(matrix, dtype='<f8' if double else '<f4')
+    if matrix.ndim != 2:
+        raise ValueError("Expected a 2-dimensional matrix, got shape "
+                         "{0}".format(matrix.shape))
+    file_handle.write(b'\x00B' + (b'DM ' if double else b'FM ')
+                      + b'\x04' + struct.pack('<i', matrix.shape[0])
+                      + b'\x04' + struct.pack('<i', matrix.shape[1]))
+    file_handle.write(np.ascontiguousarray(matrix).tobytes())
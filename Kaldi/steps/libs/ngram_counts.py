@@ -0,0 +1,271 @@
+# Apache 2.0.
+
+""" This module contains a store of n-gram counts, which is shared by the
+scripts that estimate n-gram language models directly in python
+(utils/lang/make_phone_lm.py and steps/cleanup/internal/make_one_biased_lm.py).
+
+The counts are stored per history-state.  NgramCountStore has, for each
+history-length, a dict from the history (a tuple of integer word-ids) to a
+HistoryState, which is a defaultdict from predicted word to count that also
+has the total count.  As HistoryState uses __slots__, a history-state costs
+just a dict, instead of an instance with its own __dict__ besides the dict
+of counts.  The word-ids are interned by the store, i.e. all the occurrences
+of a word-id in the histories and in the counts are the same python object,
+instead of a separate int for each line it was read from.
+
+The raw counts are accumulated from integerized sentences with
+NgramCountStore.add_counts_from_sentences().
+
+e.g.
+    store = ngram_counts.NgramCountStore(3)
+    store.add_counts_from_sentences([[5, 6, 7], [5, 6]], bos=-3, eos=-2)
+    print(store.states[2][(5, 6)][7])   # prints 1
+
+Running this module as a script compares the time and memory of the store
+with those of the per-history CountsForHistory instances that the scripts
+used before, and (if NumPy is available) the time of updating the counts
+one at a time, as the pruning in make_phone_lm.py does, with that of
+history-states backed by NumPy arrays; e.g.
+    python steps/libs/ngram_counts.py --ngram-order 4 < data/lang/phones.int.txt
+"""
+
+from __future__ import print_function
+import argparse
+import bisect
+import functools
+import random
+import sys
+import time
+from collections import defaultdict
+
+
+class HistoryState(defaultdict):
+    """ The counts of the words predicted in a history-state: a defaultdict
+    from the integer word-id to its count, with the attribute:
+        total_count: the sum of the counts.  It is maintained by
+            add_counts() and NgramCountStore.add_counts_from_sentences();
+            code that modifies the counts directly is responsible for
+            keeping it up to date if it uses it.
+    """
+    __slots__ = ['total_count']
+
+    def __init__(self, count_type=int):
+        defaultdict.__init__(self, count_type)
+        self.total_count = 0
+
+    def __str__(self):
+        # e.g. returns ' total=12 3 -> 4 4 -> 6 -1 -> 2'
+        return ' total={0} {1}'.format(
+            str(self.total_count),
+            ' '.join(['{0} -> {1}'.format(word, count)
+                      for word, count in self.items()]))
+
+    def add_counts(self, word_to_count):
+        """ Adds the counts in the dict 'word_to_count' (from word to
+        count). """
+        if len(self) == 0:
+            self.update(word_to_count)
+        else:
+            for word in word_to_count:
+                self[word] += word_to_count[word]
+        self.total_count += sum(word_to_count.values())
+
+
+class NgramCountStore(object):
+    """ A store of n-gram counts, organized by history-state.
+
+    Attributes:
+        ngram_order: the maximum n-gram order
+        count_type: the type of the counts, int or float
+        state_class: the class of the history-states, HistoryState or a
+            subclass of it
+        states: a list, indexed by history-length, of defaultdicts from
+            history (a tuple of integers) to the history-state, so
+            indexing them with a new history creates its history-state.
+        symbols: a dict from each word-id seen by
+            add_counts_from_sentences() to itself, used to intern them.
+    """
+
+    def __init__(self, ngram_order, count_type=int, state_class=HistoryState):
+        self.ngram_order = ngram_order
+        self.count_type = count_type
+        self.state_class = state_class
+        self.states = [defaultdict(functools.partial(state_class, count_type))
+                       for n in range(ngram_order)]
+        self.symbols = dict()
+
+    def add_counts_from_sentences(self, sentences, bos, eos):
+        """ Adds a count of 1 for each n-gram of maximum order in the
+        sentences, which are lists of integer word-ids, after adding the
+        symbols 'bos' and 'eos' at the start and end.  The n-grams at the
+        start of a sentence have shorter histories, as they can't extend
+        before 'bos'.  Returns the number of words counted (including eos).
+        """
+        symbols = self.symbols
+        bos = symbols.setdefault(bos, bos)
+        eos = symbols.setdefault(eos, eos)
+        context = self.ngram_order - 1
+        num_words = 0
+        for sentence in sentences:
+            words = ([bos] + [symbols.setdefault(word, word)
+                              for word in sentence] + [eos])
+            for n in range(1, len(words)):
+                hist = tuple(words[max(0, n - context):n])
+                state = self.states[len(hist)][hist]
+                state[words[n]] += 1
+                state.total_count += 1
+            num_words += len(words) - 1
+        return num_words
+
+
+class _CountsForHistory(object):
+    """ The layout of the counts of a history-state that
+    utils/lang/make_phone_lm.py used before NgramCountStore: an instance
+    with its own __dict__, holding a separate dict of counts.  This is only
+    used by benchmark(). """
+    def __init__(self):
+        self.word_to_count = defaultdict(int)
+        self.total_count = 0
+
+    def AddCount(self, predicted_word, count):
+        self.total_count += count
+        self.word_to_count[predicted_word] += count
+
+
+class _ArrayHistoryState(object):
+    """ A history-state whose counts are NumPy arrays of the sorted word-ids
+    and of their counts.  This is only used by benchmark(). """
+    def __init__(self, state, np):
+        self.words = np.array(sorted(state.keys()), dtype=np.int32)
+        self.counts = np.array([state[w] for w in self.words.tolist()],
+                               dtype=np.float64)
+        self.np = np
+
+    def add_count(self, word, count):
+        self.counts[self.np.searchsorted(self.words, word)] += count
+
+
+def _deep_size(obj, seen):
+    """ Returns the memory used by obj and the objects it refers to that are
+    not in 'seen' (a set of ids), adding them to 'seen'. """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _deep_size(key, seen) + _deep_size(value, seen)
+    elif isinstance(obj, (list, tuple)):
+        for x in obj:
+            size += _deep_size(x, seen)
+    if hasattr(obj, '__dict__'):
+        size += _deep_size(obj.__dict__, seen)
+    for name in getattr(type(obj), '__slots__', []):
+        if hasattr(obj, name):
+            size += _deep_size(getattr(obj, name), seen)
+    return size
+
+
+def _read_sentences(lines):
+    """ Returns the lines of integerized text as a list of lists of strings,
+    which are converted to int by the layouts, as when reading the input. """
+    return [line.split() for line in lines if len(line.split()) > 0]
+
+
+def _random_sentences(num_sentences, vocab_size, seed=0):
+    """ Returns random sentences whose word-ids have a Zipfian distribution,
+    as strings. """
+    rand = random.Random(seed)
+    weights = [1.0 / (i + 1) for i in range(vocab_size)]
+    total = sum(weights)
+    cumulative = []
+    acc = 0.0
+    for w in weights:
+        acc += w / total
+        cumulative.append(acc)
+    sentences = []
+    for i in range(num_sentences):
+        length = rand.randint(5, 30)
+        sentences.append([str(min(bisect.bisect(cumulative, rand.random()),
+                                  vocab_size - 1) + 1)
+                          for j in range(length)])
+    return sentences
+
+
+def benchmark(sentences, ngram_order, bos=-3, eos=-2):
+    """ Counts the n-grams of 'sentences' (lists of strings of integers)
+    in the per-history CountsForHistory layout and in NgramCountStore, and
+    prints the time taken and the memory used by each; then times updating
+    each count once in the NgramCountStore and, if NumPy is available, in
+    array-backed history-states. """
+    num_words = sum([len(x) + 1 for x in sentences])
+    print("{0} sentences, {1} words, n-gram order {2}".format(
+        len(sentences), num_words, ngram_order))
+
+    start = time.time()
+    legacy = [defaultdict(_CountsForHistory) for n in range(ngram_order)]
+    for sentence in sentences:
+        words = [bos] + [int(x) for x in sentence] + [eos]
+        for n in range(1, len(words)):
+            hist = tuple(words[max(0, n + 1 - ngram_order):n])
+            legacy[len(hist)][hist].AddCount(words[n], 1)
+    legacy_time = time.time() - start
+    legacy_size = _deep_size(legacy, set())
+    print("CountsForHistory: {0:.2f} seconds, {1:.1f} MB".format(
+        legacy_time, legacy_size / 1048576.0))
+    del legacy
+
+    start = time.time()
+    store = NgramCountStore(ngram_order)
+    store.add_counts_from_sentences(
+        ([int(x) for x in sentence] for sentence in sentences), bos, eos)
+    store_time = time.time() - start
+    store_size = _deep_size(store.states, set())
+    print("NgramCountStore:  {0:.2f} seconds, {1:.1f} MB".format(
+        store_time, store_size / 1048576.0))
+
+    start = time.time()
+    for states in store.states:
+        for state in states.values():
+            for word in list(state.keys()):
+                state[word] += 1
+    print("Updating each count of NgramCountStore: {0:.2f} seconds".format(
+        time.time() - start))
+
+    try:
+        import numpy as np
+    except ImportError:
+        print("NumPy is not available; not timing the array-backed "
+              "history-states")
+        return
+    array_states = [[(_ArrayHistoryState(state, np), list(state.keys()))
+                     for state in states.values()]
+                    for states in store.states]
+    start = time.time()
+    for states in array_states:
+        for (state, words) in states:
+            for word in words:
+                state.add_count(word, 1)
+    print("Updating each count of array-backed states: {0:.2f} seconds".format(
+        time.time() - start))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compares the time and memory of NgramCountStore with "
+        "those of the layout it replaced (see the module docstring).  "
+        "Reads integerized text from the standard input, or generates "
+        "random sentences with --num-sentences.")
+    parser.add_argument('--ngram-order', type=int, default=4,
+                        help='The n-gram order.')
+    parser.add_argument('--num-sentences', type=int, default=0,
+                        help='If > 0, the number of random sentences to '
+                        'count, instead of reading the standard input.')
+    parser.add_argument('--vocab-size', type=int, default=1000,
+                        help='The vocabulary size of the random sentences.')
+    args = parser.parse_args()
+    if args.num_sentences > 0:
+        sentences = _random_sentences(args.num_sentences, args.vocab_size)
+    else:
+        sentences = _read_sentences(sys.stdin)
+    benchmark(sentences, args.ngram_order)
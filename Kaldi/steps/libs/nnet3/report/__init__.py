@@ -3,6 +3,7 @@
 # Copyright 2016    Vimal Manohar
 # Apache 2.0.
 
+import log_index
 import log_parse
 
-__all__ = ["log_parse"]
+__all__ = ["log_index", "log_parse"]
@@ -0,0 +1,247 @@
+
+
+# Apache 2.0.
+
+""" This module contains the LogIndex class, which extracts the values that
+are used in the training reports (objective functions, accuracies, timing
+and the progress of the parameters) from the log files of an experiment in
+a single pass over each file.
+
+The index is incremental: for each log file it stores the offset up to which
+the file has been read, along with the values extracted so far, in a cache
+in <log-dir>/.log_index/. When a log file is queried again, only the lines
+appended since the last read are parsed. This makes it cheap to query the
+logs of all the iterations after each iteration of training.
+The cache is split into one file per group of log files of an iteration
+(e.g. train.10.*.log), so that querying the logs of one iteration reads and
+writes only the entries of that iteration.
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+import zlib
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+# e.g. "LOG (nnet3-train:PrintTotalStats():nnet-training.cc:211) Overall
+# average objective function for 'output' is -1.47427 over 285384 frames."
+g_objf_regex = re.compile(
+    "LOG .* Overall average objective function for "
+    "'(.*)' is ([0-9e.\-+]+) over ([0-9e.\-+]+) frames")
+
+# e.g. "LOG (nnet3-chain-compute-prob:PrintTotalStats():nnet-chain-
+# diagnostics.cc:144) Overall log-probability for 'output' is -0.307255 per
+# frame, over 20000 frames."
+g_prob_regex = re.compile(
+    "LOG .nnet3.*compute-prob.*:PrintTotalStats..:"
+    "nnet.*diagnostics.cc:[0-9]+. Overall ([a-zA-Z\-]+) for "
+    "'([^']*)'.*is ([0-9.\-e]+) .*per frame")
+
+# e.g. "# Accounting: time=1084 threads=1"
+g_accounting_regex = re.compile("# Accounting: time=([0-9]+) thread")
+
+g_nonlin_regex = re.compile("value-avg.*deriv-avg")
+
+# The types of lines from the progress logs that are stored as they are,
+# as these are parsed by the functions in log_parse.py.
+g_progress_line_patterns = ["Relative parameter differences",
+                            "Parameter differences",
+                            "clipped-proportion"]
+
+
+def _new_record():
+    """ Returns the record of the values extracted from a log file.
+        'time': the time in the '# Accounting' line, or None
+        'objf': a dict from output-name to [objective, num-frames] from the
+            last 'Overall average objective function' line for that output
+        'prob': a dict from '<key>:<output-name>' to the value from the
+            last 'Overall <key> for <output-name>' line of the compute-prob
+            programs
+        'lines': a dict from a pattern (see g_progress_line_patterns; the
+            pattern 'nonlin' is used for the lines with non-linearity stats)
+            to the list of lines that match it
+    """
+    return {'time': None, 'objf': {}, 'prob': {}, 'lines': {}}
+
+
+def _parse_line(line, record):
+    if line.startswith('# Accounting'):
+        mat_obj = g_accounting_regex.search(line)
+        if mat_obj is not None:
+            record['time'] = float(mat_obj.groups()[0])
+        return
+    if 'Overall' in line:
+        mat_obj = g_objf_regex.search(line)
+        if mat_obj is not None:
+            groups = mat_obj.groups()
+            record['objf'][groups[0]] = [float(groups[1]), float(groups[2])]
+            return
+        mat_obj = g_prob_regex.search(line)
+        if mat_obj is not None:
+            groups = mat_obj.groups()
+            record['prob']['{0}:{1}'.format(groups[0], groups[1])] = (
+                float(groups[2]))
+        return
+    for pattern in g_progress_line_patterns:
+        if pattern in line:
+            record['lines'].setdefault(pattern, []).append(line)
+    if 'deriv-avg' in line and g_nonlin_regex.search(line) is not None:
+        record['lines'].setdefault('nonlin', []).append(line)
+
+
+class LogIndex(object):
+    """ An incremental index of the log files in a log directory.
+
+    The log files are grouped by the part of their name up to the iteration
+    number (e.g. 'train.10' for train.10.2.log, 'progress.10' for
+    progress.10.log), or before the first '.' if there is no iteration
+    number (e.g. 'combine' for combine.log), and the cache of each group is
+    stored in a separate file, so that querying the logs of one iteration
+    does not load (or rewrite) the index of the other iterations.
+
+    e.g.
+        index = LogIndex('exp/nnet3/tdnn/log')
+        for log_file, record in index.glob('train.*.log'):
+            print(log_file, record['time'])
+        index.save()
+
+    Attributes:
+        log_dir: The directory containing the log files
+        cache_dir: The directory where the index is cached, or None if the
+            index is not cached on disk
+        groups: A dict from group name to a dict from the basename of a
+            log file to its entry {'offset': offset-up-to-which-the-file-is-
+            indexed, 'crc': checksum-of-the-bytes-before-offset,
+            'record': record (see _new_record())}
+        dirty_groups: The groups that have changed since they were loaded
+    """
+    # The number of bytes before the offset that are checked to detect that a
+    # log file has been rewritten (e.g. when a job is rerun).
+    check_size = 256
+
+    def __init__(self, log_dir, use_cache=True):
+        self.log_dir = log_dir
+        self.cache_dir = (os.path.join(log_dir, '.log_index')
+                          if use_cache else None)
+        self.groups = {}
+        self.dirty_groups = set()
+
+    def _get_group(self, basename):
+        parts = basename.split('.')
+        if len(parts) > 2 and parts[1].isdigit():
+            group = '{0}.{1}'.format(parts[0], parts[1])
+        else:
+            group = parts[0]
+        if group not in self.groups:
+            self.groups[group] = {}
+            if self.cache_dir is not None:
+                cache_file = os.path.join(self.cache_dir, group + '.json')
+                try:
+                    with open(cache_file) as f:
+                        self.groups[group] = json.load(f)
+                except (IOError, OSError, ValueError):
+                    # the cache does not exist or is corrupted; it will be
+                    # rebuilt.
+                    pass
+        return group, self.groups[group]
+
+    def get(self, log_file):
+        """ Returns the record for log_file (a basename in log_dir or a
+        path), after indexing the lines appended to it since the last call.
+        Raises IOError if the file does not exist.
+        """
+        basename = os.path.basename(log_file)
+        group, entries = self._get_group(basename)
+        entry = entries.get(basename)
+
+        with open(os.path.join(self.log_dir, basename), 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if entry is not None:
+                offset = entry['offset']
+                check_start = max(0, offset - self.check_size)
+                if size < offset:
+                    entry = None
+                else:
+                    f.seek(check_start)
+                    if (zlib.crc32(f.read(offset - check_start))
+                            != entry['crc']):
+                        entry = None
+            if entry is None:
+                entry = {'offset': 0, 'crc': zlib.crc32(b''),
+                         'record': _new_record()}
+            if size == entry['offset']:
+                entries[basename] = entry
+                return entry['record']
+
+            f.seek(entry['offset'])
+            data = f.read(size - entry['offset'])
+
+        # Only complete lines are indexed; a partial last line will be read
+        # again when it is complete.
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            entries[basename] = entry
+            return entry['record']
+        record = entry['record']
+        for line in data[:end].decode('latin-1').split('\n')[:-1]:
+            _parse_line(line, record)
+        offset = entry['offset'] + end
+
+        with open(os.path.join(self.log_dir, basename), 'rb') as f:
+            check_start = max(0, offset - self.check_size)
+            f.seek(check_start)
+            entry['crc'] = zlib.crc32(f.read(offset - check_start))
+        entry['offset'] = offset
+        entries[basename] = entry
+        self.dirty_groups.add(group)
+        return record
+
+    def glob(self, pattern):
+        """ Returns a list of (path-of-log-file, record) for the log files in
+        log_dir that match the glob pattern, e.g. 'train.*.log'. """
+        records = []
+        for log_file in sorted(glob.glob(os.path.join(self.log_dir,
+                                                      pattern))):
+            try:
+                records.append((log_file, self.get(log_file)))
+            except IOError:
+                # the file was removed after the glob.
+                continue
+        return records
+
+    def grep(self, pattern, line_pattern):
+        """ Returns the lines of the log files matching the glob pattern that
+        were stored for line_pattern (see g_progress_line_patterns, or
+        'nonlin'), each prefixed by the path of the log file and ':', like
+        the output of grep on multiple files. """
+        lines = []
+        for log_file, record in self.glob(pattern):
+            for line in record['lines'].get(line_pattern, []):
+                lines.append('{0}:{1}'.format(log_file, line))
+        return "\n".join(lines)
+
+    def save(self):
+        """ Writes the cache of the groups that have changed. """
+        if self.cache_dir is None:
+            return
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            for group in self.dirty_groups:
+                cache_file = os.path.join(self.cache_dir, group + '.json')
+                tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+                with open(tmp_file, 'w') as f:
+                    json.dump(self.groups[group], f)
+                # rename is atomic, so that a concurrent reader never sees a
+                # partially written cache.
+                os.rename(tmp_file, cache_file)
+            self.dirty_groups = set()
+        except (IOError, OSError) as e:
+            logger.warning("Could not write the log index cache in "
+                           "{0}: {1}".format(self.cache_dir, str(e)))
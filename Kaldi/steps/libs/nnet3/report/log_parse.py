@@ -11,7 +11,7 @@ import datetime
 import logging
 import re
 
-import libs.common as common_lib
+from libs.nnet3.report import log_index
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
@@ -112,11 +112,11 @@ def parse_progress_logs_for_nonlinearity_stats(exp_dir):
     0.19,0.20,0.20,0.21), mean=0.134, stddev=0.0397]
     """
 
-    progress_log_files = "%s/log/progress.*.log" % (exp_dir)
     stats_per_component_per_iter = {}
 
-    progress_log_lines = common_lib.run_kaldi_command(
-        'grep -e "value-avg.*deriv-avg" {0}'.format(progress_log_files))[0]
+    index = log_index.LogIndex("{0}/log".format(exp_dir))
+    progress_log_lines = index.grep("progress.*.log", "nonlin")
+    index.save()
 
     parse_regex = re.compile(g_normal_nonlin_regex_pattern)
 
@@ -170,11 +170,10 @@ def parse_progress_logs_for_clipped_proportion(exp_dir):
     self-repair-scale=1
     """
 
-    progress_log_files = "%s/log/progress.*.log" % (exp_dir)
     component_names = set([])
-    progress_log_lines = common_lib.run_kaldi_command(
-        'grep -e "{0}" {1}'.format(
-            "clipped-proportion", progress_log_files))[0]
+    index = log_index.LogIndex("{0}/log".format(exp_dir))
+    progress_log_lines = index.grep("progress.*.log", "clipped-proportion")
+    index.save()
     parse_regex = re.compile(".*progress\.([0-9]+)\.log:component "
                              "name=(.*) type=.* "
                              "clipped-proportion=([0-9\.e\-]+)")
@@ -252,11 +251,11 @@ def parse_progress_logs_for_param_diff(exp_dir, pattern):
                            "Parameter differences"]):
         raise Exception("Unknown value for pattern : {0}".format(pattern))
 
-    progress_log_files = "%s/log/progress.*.log" % (exp_dir)
     progress_per_iter = {}
     component_names = set([])
-    progress_log_lines = common_lib.run_kaldi_command(
-        'grep -e "{0}" {1}'.format(pattern, progress_log_files))[0]
+    index = log_index.LogIndex("{0}/log".format(exp_dir))
+    progress_log_lines = index.grep("progress.*.log", pattern)
+    index.save()
     parse_regex = re.compile(".*progress\.([0-9]+)\.log:"
                              "LOG.*{0}.*\[(.*)\]".format(pattern))
     for line in progress_log_lines.split("\n"):
@@ -308,22 +307,20 @@ def parse_progress_logs_for_param_diff(exp_dir, pattern):
 
 
 def parse_train_logs(exp_dir):
-    train_log_files = "%s/log/train.*.log" % (exp_dir)
-    train_log_lines = common_lib.run_kaldi_command(
-        'grep -e Accounting {0}'.format(train_log_files))[0]
-    parse_regex = re.compile(".*train\.([0-9]+)\.([0-9]+)\.log:# "
-                             "Accounting: time=([0-9]+) thread.*")
+    index = log_index.LogIndex("{0}/log".format(exp_dir))
+    parse_regex = re.compile(".*train\.([0-9]+)\.([0-9]+)\.log$")
 
     train_times = {}
-    for line in train_log_lines.split('\n'):
-        mat_obj = parse_regex.search(line)
-        if mat_obj is not None:
+    for log_file, record in index.glob("train.*.log"):
+        mat_obj = parse_regex.search(log_file)
+        if mat_obj is not None and record['time'] is not None:
             groups = mat_obj.groups()
             try:
-                train_times[int(groups[0])][int(groups[1])] = float(groups[2])
+                train_times[int(groups[0])][int(groups[1])] = record['time']
             except KeyError:
                 train_times[int(groups[0])] = {}
-                train_times[int(groups[0])][int(groups[1])] = float(groups[2])
+                train_times[int(groups[0])][int(groups[1])] = record['time']
+    index.save()
     iters = train_times.keys()
     for iter in iters:
         values = train_times[iter].values()
@@ -334,11 +331,8 @@ def parse_train_logs(exp_dir):
 def parse_prob_logs(exp_dir, key='accuracy', output="output"):
     train_prob_files = "%s/log/compute_prob_train.*.log" % (exp_dir)
     valid_prob_files = "%s/log/compute_prob_valid.*.log" % (exp_dir)
-    train_prob_strings = common_lib.run_kaldi_command(
-        'grep -e {0} {1}'.format(key, train_prob_files), wait=True)[0]
-    valid_prob_strings = common_lib.run_kaldi_command(
-        'grep -e {0} {1}'.format(key, valid_prob_files))[0]
 
+    # The values are extracted by log_index from lines like:
     # LOG
     # (nnet3-chain-compute-prob:PrintTotalStats():nnet-chain-diagnostics.cc:149)
     # Overall log-probability for 'output' is -0.399395 + -0.013437 = -0.412832
@@ -349,31 +343,27 @@ def parse_prob_logs(exp_dir, key='accuracy', output="output"):
     # Overall log-probability for 'output' is -0.307255 per frame, over 20000
     # frames.
 
-    parse_regex = re.compile(
-        ".*compute_prob_.*\.([0-9]+).log:LOG "
-        ".nnet3.*compute-prob.*:PrintTotalStats..:"
-        "nnet.*diagnostics.cc:[0-9]+. Overall ([a-zA-Z\-]+) for "
-        "'{output}'.*is ([0-9.\-e]+) .*per frame".format(output=output))
+    parse_regex = re.compile(".*compute_prob_.*\.([0-9]+).log$")
+    prob_key = "{0}:{1}".format(key, output)
+    index = log_index.LogIndex("{0}/log".format(exp_dir))
 
     train_loss = {}
     valid_loss = {}
 
-    for line in train_prob_strings.split('\n'):
-        mat_obj = parse_regex.search(line)
-        if mat_obj is not None:
-            groups = mat_obj.groups()
-            if groups[1] == key:
-                train_loss[int(groups[0])] = groups[2]
+    for log_file, record in index.glob("compute_prob_train.*.log"):
+        mat_obj = parse_regex.search(log_file)
+        if mat_obj is not None and prob_key in record['prob']:
+            train_loss[int(mat_obj.groups()[0])] = record['prob'][prob_key]
     if not train_loss:
+        index.save()
         raise KaldiLogParseException("Could not find any lines with {k} in "
                 " {l}".format(k=key, l=train_prob_files))
 
-    for line in valid_prob_strings.split('\n'):
-        mat_obj = parse_regex.search(line)
-        if mat_obj is not None:
-            groups = mat_obj.groups()
-            if groups[1] == key:
-                valid_loss[int(groups[0])] = groups[2]
+    for log_file, record in index.glob("compute_prob_valid.*.log"):
+        mat_obj = parse_regex.search(log_file)
+        if mat_obj is not None and prob_key in record['prob']:
+            valid_loss[int(mat_obj.groups()[0])] = record['prob'][prob_key]
+    index.save()
 
     if not valid_loss:
         raise KaldiLogParseException("Could not find any lines with {k} in "
@@ -152,7 +152,9 @@ def train_new_models(dir, iter, srand, num_jobs,
         deriv_time_opts.append("--optimization.max-deriv-time-relative={0}".format(
                                     int(max_deriv_time_relative)))
 
-    processes = []
+    scheduler = common_lib.JobScheduler(
+        max_running_jobs=run_opts.max_parallel_train_jobs,
+        num_retries=run_opts.num_train_job_retries)
     for job in range(1, num_jobs+1):
         # k is a zero-based index that we will derive the other indexes from.
         k = num_archives_processed + job - 1
@@ -167,7 +169,7 @@ def train_new_models(dir, iter, srand, num_jobs,
         else:
             cur_cache_io_opts = cache_io_opts
 
-        process_handle = common_lib.run_job(
+        scheduler.add_job(
             """{command} {train_queue_opt} {dir}/log/train.{iter}.{job}.log \
                     nnet3-chain-train {parallel_train_opts} \
                     --apply-deriv-weights={app_deriv_wts} \
@@ -200,23 +202,19 @@ def train_new_models(dir, iter, srand, num_jobs,
                         egs_dir=egs_dir, archive_index=archive_index,
                         buf_size=shuffle_buffer_size,
                         cache_io_opts=cur_cache_io_opts,
-                        num_chunk_per_mb=num_chunk_per_minibatch_str),
-            wait=False)
+                        num_chunk_per_mb=num_chunk_per_minibatch_str))
 
-        processes.append(process_handle)
-
-    all_success = True
-    for process in processes:
-        process.wait()
-        process.communicate()
-        if process.returncode != 0:
-            all_success = False
-
-    if not all_success:
+    try:
+        scheduler.run()
+    except common_lib.KaldiCommandException:
         open('{0}/.error'.format(dir), 'w').close()
         raise Exception("There was error during training "
                         "iteration {0}".format(iter))
 
+    for command, wall_time, num_attempts in scheduler.job_timings:
+        logger.debug("Training job '{0}' took {1:.1f} seconds in {2} "
+                     "attempt(s)".format(command, wall_time, num_attempts))
+
 
 def train_one_iteration(dir, iter, srand, egs_dir,
                         num_jobs, num_archives_processed, num_archives,
@@ -17,6 +17,7 @@ import re
 import shutil
 
 import libs.common as common_lib
+import libs.nnet3.report.log_index as log_index
 import libs.nnet3.train.dropout_schedule as dropout_schedule
 from dropout_schedule import *
 
@@ -39,29 +40,29 @@ class RunOpts(object):
         self.prior_gpu_opt = None
         self.prior_queue_opt = None
         self.parallel_train_opts = None
+        self.max_parallel_train_jobs = None
+        self.num_train_job_retries = 0
 
 
 def get_successful_models(num_models, log_file_pattern,
                           difference_threshold=1.0):
     assert(num_models > 0)
 
-    parse_regex = re.compile(
-        "LOG .* Overall average objective function for "
-        "'output' is ([0-9e.\-+]+) over ([0-9e.\-+]+) frames")
+    # The objective function is read from the last line like
+    # "LOG .* Overall average objective function for 'output' is X over Y
+    # frames" of each log file, which is found using the incremental log
+    # index, so that the log files are not read again in every iteration.
+    index = log_index.LogIndex(os.path.dirname(log_file_pattern))
     objf = []
     for i in range(num_models):
         model_num = i + 1
         logfile = re.sub('%', str(model_num), log_file_pattern)
-        lines = open(logfile, 'r').readlines()
+        record = index.get(logfile)
         this_objf = -100000.0
-        for line_num in range(1, len(lines) + 1):
-            # we search from the end as this would result in
-            # lesser number of regex searches. Python regex is slow !
-            mat_obj = parse_regex.search(lines[-1 * line_num])
-            if mat_obj is not None:
-                this_objf = float(mat_obj.groups()[0])
-                break
+        if 'output' in record['objf']:
+            this_objf = record['objf']['output'][0]
         objf.append(this_objf)
+    index.save()
     max_index = objf.index(max(objf))
     accepted_models = []
     for i in range(num_models):
@@ -754,6 +755,23 @@ class CommonParser:
                                  type=int, dest='num_jobs_final', default=8,
                                  help="Number of neural net jobs to run in "
                                  "parallel at the end of training")
+        self.parser.add_argument("--trainer.optimization.max-parallel-jobs",
+                                 type=int, dest='max_parallel_train_jobs',
+                                 default=0,
+                                 help="""Maximum number of the neural net
+                                 jobs of an iteration that are run at the
+                                 same time; the rest wait for a free slot.
+                                 This is useful with run.pl on a single
+                                 machine, to avoid running more jobs than
+                                 there are CPUs or GPUs. If 0, all the jobs
+                                 of an iteration are run at the same
+                                 time.""")
+        self.parser.add_argument("--trainer.optimization.num-job-retries",
+                                 type=int, dest='num_train_job_retries',
+                                 default=0,
+                                 help="""Number of times a failed neural net
+                                 training job is retried before the
+                                 iteration fails.""")
         self.parser.add_argument("--trainer.optimization.max-models-combine",
                                  "--trainer.max-models-combine",
                                  type=int, dest='max_models_combine',
@@ -858,9 +876,19 @@ class CommonParser:
         self.parser.add_argument("--background-polling-time",
                                  dest="background_polling_time",
                                  type=float, default=60,
-                                 help="""Polling frequency in seconds at which
-                                 the background process handler checks for
-                                 errors in the processes.""")
+                                 help="""Interval in seconds at which the
+                                 background process handler logs the
+                                 processes that are still running while
+                                 waiting for them to finish. Failures of
+                                 the processes are detected as soon as they
+                                 exit.""")
+        self.parser.add_argument("--max-background-jobs",
+                                 dest="max_background_jobs",
+                                 type=int, default=0,
+                                 help="""Maximum number of background
+                                 processes (e.g. the diagnostic jobs) that
+                                 are allowed to run at the same time.
+                                 If 0, there is no limit.""")
 
 
 if __name__ == '__main__':
@@ -62,7 +62,9 @@ def train_new_models(dir, iter, srand, num_jobs,
     context_opts = "--left-context={0} --right-context={1}".format(
         left_context, right_context)
 
-    processes = []
+    scheduler = common_lib.JobScheduler(
+        max_running_jobs=run_opts.max_parallel_train_jobs,
+        num_retries=run_opts.num_train_job_retries)
     for job in range(1, num_jobs+1):
         # k is a zero-based index that we will derive the other indexes from.
         k = num_archives_processed + job - 1
@@ -80,7 +82,7 @@ def train_new_models(dir, iter, srand, num_jobs,
             cache_write_opt = "--write-cache={dir}/cache.{iter}".format(
                 dir=dir, iter=iter+1)
 
-        process_handle = common_lib.run_job(
+        scheduler.add_job(
             """{command} {train_queue_opt} {dir}/log/train.{iter}.{job}.log \
                     nnet3-train {parallel_train_opts} {cache_read_opt} \
                     {cache_write_opt} --print-interval=10 \
@@ -111,22 +113,19 @@ def train_new_models(dir, iter, srand, num_jobs,
                         raw_model=raw_model_string, context_opts=context_opts,
                         egs_dir=egs_dir, archive_index=archive_index,
                         shuffle_buffer_size=shuffle_buffer_size,
-                        minibatch_size_str=minibatch_size_str), wait=False)
+                        minibatch_size_str=minibatch_size_str))
 
-        processes.append(process_handle)
-
-    all_success = True
-    for process in processes:
-        process.wait()
-        process.communicate()
-        if process.returncode != 0:
-            all_success = False
-
-    if not all_success:
+    try:
+        scheduler.run()
+    except common_lib.KaldiCommandException:
         open('{0}/.error'.format(dir), 'w').close()
         raise Exception("There was error during training "
                         "iteration {0}".format(iter))
 
+    for command, wall_time, num_attempts in scheduler.job_timings:
+        logger.debug("Training job '{0}' took {1:.1f} seconds in {2} "
+                     "attempt(s)".format(command, wall_time, num_attempts))
+
 
 def train_one_iteration(dir, iter, srand, egs_dir,
                         num_jobs, num_archives_processed, num_archives,
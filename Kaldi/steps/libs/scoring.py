@@ -0,0 +1,900 @@
+# Apache 2.0.
+
+""" This module computes word error rates and Levenshtein alignments of
+hypotheses against reference texts, like Kaldi's compute-wer and align-text,
+and the detailed statistics of utils/scoring/wer_per_utt_details.pl,
+wer_per_spk_details.pl and wer_ops_details.pl, in one pass and in-process.
+
+The words are integer-encoded with a vocabulary that is shared by the
+reference and the hypotheses, and the utterances are aligned in batches of
+similar lengths: with numpy, the edit-distance matrices of all the
+utterances of a batch are computed together, one reference position at a
+time, where the insertions along a row are resolved with a running minimum
+(a row is min(substitution, deletion) minus the column index, accumulated
+with np.minimum, plus the column index), and then all the utterances of the
+batch are traced back together.  The batches can be spread over a process
+pool.  Without numpy, each utterance is aligned in pure python.
+
+Two tracebacks are done on the same matrix, as the Kaldi tools break the
+ties differently: the counts of insertions, deletions and substitutions are
+those of compute-wer (LevenshteinEditDistance()), and the alignment is that
+of align-text (LevenshteinAlignment()), from which the per-utterance,
+per-speaker and per-word details are computed.  The total number of errors
+is the same in both.
+
+Several sets of hypotheses of the same utterances, e.g. those of each
+LM-weight and word insertion penalty of a decoding directory, can be scored
+together with ReferenceIndex.score_many(), which aligns each distinct pair of
+reference and hypothesis only once.
+
+The alignments can also be turned into ctm-edits lines (see
+steps/cleanup/internal/get_ctm_edits.py) for hypotheses in per-utterance
+CTM format.
+
+e.g.
+    ref_index = scoring.ReferenceIndex(scoring.read_text('data/test/text'))
+    result = ref_index.score(scoring.read_text('exp/tri3/decode/10.txt'),
+                             mode='present', num_jobs=4)
+    print(result.summary())
+    for line in result.per_spk_lines(utt2spk):
+        print(line)
+"""
+
+import io
+import itertools
+import logging
+import multiprocessing
+import struct
+import sys
+
+try:
+    import numpy as np
+    g_numpy = True
+except ImportError:
+    g_numpy = False
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# The maximum number of cells of the edit-distance matrices of a batch, and
+# the maximum number of utterances in a batch.
+g_max_batch_cells = 1 << 22
+g_max_batch_size = 4096
+# The op codes of the alignments: correct, substitution, insertion and
+# deletion, as in the 'op' lines of wer_per_utt_details.pl.
+_ops = b'CSID'
+
+
+def _open_input(filename):
+    if filename == '-':
+        return io.open(sys.stdin.fileno(), encoding='utf-8', closefd=False)
+    return io.open(filename, encoding='utf-8')
+
+
+def read_text(filename):
+    """ Reads a text file (e.g. data/test/text) with lines
+    '<utt> <word1> <word2> ...', or the standard input for '-', and returns
+    the list of (utt, list of words), in the order of the file. """
+    ans = []
+    with _open_input(filename) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) > 0:
+                ans.append((parts[0], parts[1:]))
+    return ans
+
+
+def read_ctm(filename):
+    """ Reads a per-utterance CTM file with lines
+    '<utt> <channel> <start> <duration> <word> [<confidence>]' and returns
+    the list of (utt, ctm_array), in the order of the first line of each
+    utterance, where ctm_array is [[start, duration, word, confidence], ...]
+    (the confidence defaults to 1.0), as get_ctm_edits() expects. """
+    ans = []
+    utt2ctm = {}
+    with _open_input(filename) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 0:
+                continue
+            if len(parts) not in [5, 6]:
+                raise ValueError("Bad line in CTM file {0}: {1}".format(
+                    filename, line.strip()))
+            utt = parts[0]
+            if utt not in utt2ctm:
+                utt2ctm[utt] = []
+                ans.append((utt, utt2ctm[utt]))
+            utt2ctm[utt].append([float(parts[2]), float(parts[3]), parts[4],
+                                 float(parts[5]) if len(parts) == 6 else 1.0])
+    return ans
+
+
+class Vocabulary(object):
+    """ A mapping from words to consecutive integers, that grows as new
+    words are encoded. """
+
+    def __init__(self):
+        self.word2id = {}
+        self.words = []
+
+    def __len__(self):
+        return len(self.words)
+
+    def encode(self, words):
+        """ Returns the tuple of the ids of the words, adding the new words to
+        the vocabulary. """
+        word2id = self.word2id
+        ans = []
+        for word in words:
+            i = word2id.get(word)
+            if i is None:
+                i = len(self.words)
+                word2id[word] = i
+                self.words.append(word)
+            ans.append(i)
+        return tuple(ans)
+
+
+def _align_pair_python(ref, hyp):
+    """ Aligns the sequences of ids ref and hyp in pure python, and returns
+    (num_ins, num_del, num_sub, ops) as _align_batch() does. """
+    M = len(ref)
+    N = len(hyp)
+    D = [list(range(N + 1))]
+    for m in range(1, M + 1):
+        prev = D[m - 1]
+        row = [m] * (N + 1)
+        r = ref[m - 1]
+        for n in range(1, N + 1):
+            row[n] = min(prev[n - 1] + (r != hyp[n - 1]), prev[n] + 1,
+                         row[n - 1] + 1)
+        D.append(row)
+
+    # the counts of compute-wer.
+    num_ins = num_del = num_sub = 0
+    (m, n) = (M, N)
+    while m > 0 or n > 0:
+        if n == 0:
+            num_del += 1
+            m -= 1
+        elif m == 0:
+            num_ins += 1
+            n -= 1
+        else:
+            neq = (ref[m - 1] != hyp[n - 1])
+            sub = D[m - 1][n - 1] + neq
+            dele = D[m - 1][n] + 1
+            ins = D[m][n - 1] + 1
+            if sub < ins and sub < dele:
+                num_sub += neq
+                m -= 1
+                n -= 1
+            elif dele < ins:
+                num_del += 1
+                m -= 1
+            else:
+                num_ins += 1
+                n -= 1
+
+    # the alignment of align-text.
+    ops = []
+    (m, n) = (M, N)
+    while m > 0 or n > 0:
+        if m == 0:
+            ops.append('I')
+            n -= 1
+        elif n == 0:
+            ops.append('D')
+            m -= 1
+        else:
+            neq = (ref[m - 1] != hyp[n - 1])
+            sub = D[m - 1][n - 1] + neq
+            dele = D[m - 1][n] + 1
+            ins = D[m][n - 1] + 1
+            if sub <= min(dele, ins):
+                ops.append('S' if neq else 'C')
+                m -= 1
+                n -= 1
+            elif dele <= ins:
+                ops.append('D')
+                m -= 1
+            else:
+                ops.append('I')
+                n -= 1
+    ops.reverse()
+    return (num_ins, num_del, num_sub, ''.join(ops))
+
+
+def _batch_matrices(pairs):
+    """ Returns the padded arrays of the references and the hypotheses of
+    the batch 'pairs', their lengths, and the edit-distance matrices D, where
+    D[b, m, n] is the distance between the first m words of the reference
+    and the first n words of the hypothesis of utterance b.  The cells beyond
+    the lengths of an utterance do not affect those within them. """
+    B = len(pairs)
+    ref_lens = np.array([len(ref) for (ref, hyp) in pairs], dtype=np.int64)
+    hyp_lens = np.array([len(hyp) for (ref, hyp) in pairs], dtype=np.int64)
+    M = int(ref_lens.max())
+    N = int(hyp_lens.max())
+    # the padding of the references and the hypotheses never matches.
+    R = np.full((B, max(M, 1)), -1, dtype=np.int32)
+    H = np.full((B, max(N, 1)), -2, dtype=np.int32)
+    R[np.arange(R.shape[1]) < ref_lens[:, None]] = list(
+        itertools.chain.from_iterable([ref for (ref, hyp) in pairs]))
+    H[np.arange(H.shape[1]) < hyp_lens[:, None]] = list(
+        itertools.chain.from_iterable([hyp for (ref, hyp) in pairs]))
+
+    columns = np.arange(N + 1, dtype=np.int32)
+    D = np.empty((B, M + 1, N + 1), dtype=np.int32)
+    D[:, 0, :] = columns
+    row = np.empty((B, N + 1), dtype=np.int32)
+    for m in range(1, M + 1):
+        prev = D[:, m - 1, :]
+        # row[n] is the cost of reaching (m, n) by a substitution (or a
+        # match) or a deletion; the insertions are added by the running
+        # minimum of row[k] + (n - k) over k <= n.
+        row[:, 0] = m
+        np.minimum(prev[:, :-1] + (R[:, m - 1:m] != H[:, :N]),
+                   prev[:, 1:] + 1, out=row[:, 1:])
+        row -= columns
+        np.minimum.accumulate(row, axis=1, out=D[:, m, :])
+        D[:, m, :] += columns
+    return (R, H, ref_lens, hyp_lens, D)
+
+
+def _trace_back(R, H, m, n, D, kaldi_counts):
+    """ Traces back all the utterances of a batch together from the cells
+    (m, n) (arrays of positions, which are modified) of the matrices D.  If
+    kaldi_counts is true, the ties are broken like compute-wer does and the
+    arrays (num_ins, num_del, num_sub) are returned; otherwise they are
+    broken like align-text does and the array of the reversed op codes of
+    the alignments, and their lengths, are returned. """
+    B = len(m)
+    if kaldi_counts:
+        counts = np.zeros((3, B), dtype=np.int64)
+    else:
+        ops = np.zeros((B, max(int((m + n).max()), 1)), dtype=np.uint8)
+        ops_lens = np.zeros(B, dtype=np.int64)
+    codes = np.frombuffer(_ops, dtype=np.uint8)
+    idx = np.nonzero((m > 0) | (n > 0))[0]
+    while len(idx) > 0:
+        mi = m[idx]
+        ni = n[idx]
+        mp = np.maximum(mi - 1, 0)
+        np_ = np.maximum(ni - 1, 0)
+        neq = (R[idx, mp] != H[idx, np_])
+        sub = D[idx, mp, np_] + neq
+        dele = D[idx, mp, ni] + 1
+        ins = D[idx, mi, np_] + 1
+        inner = (mi > 0) & (ni > 0)
+        if kaldi_counts:
+            diag = inner & (sub < ins) & (sub < dele)
+            is_del = (ni == 0) | (inner & ~diag & (dele < ins))
+        else:
+            diag = inner & (sub <= np.minimum(dele, ins))
+            is_del = (ni == 0) | (inner & ~diag & (dele <= ins))
+        is_ins = ~(diag | is_del)
+        if kaldi_counts:
+            counts[0, idx] += is_ins
+            counts[1, idx] += is_del
+            counts[2, idx] += diag & neq
+        else:
+            # the op codes: 0 = correct, 1 = substitution, 2 = insertion,
+            # 3 = deletion.
+            op = (diag & neq) + 2 * is_ins + 3 * is_del
+            ops[idx, ops_lens[idx]] = codes[op]
+            ops_lens[idx] += 1
+        m[idx] = mi - (diag | is_del)
+        n[idx] = ni - (diag | is_ins)
+        idx = idx[(m[idx] > 0) | (n[idx] > 0)]
+    if kaldi_counts:
+        return counts
+    return (ops, ops_lens)
+
+
+def _align_batch(job):
+    """ Aligns the batch of pairs of sequences of ids (ref, hyp) and returns
+    the list of (num_ins, num_del, num_sub, ops) for them, where the counts
+    are those of compute-wer and ops is the string of the op codes of the
+    align-text alignment (e.g. 'CCSCD'), or None if the job was called with
+    alignments=False.  It is run in the worker processes. """
+    (pairs, use_numpy, alignments) = job
+    if not use_numpy:
+        ans = [_align_pair_python(ref, hyp) for (ref, hyp) in pairs]
+        if not alignments:
+            ans = [x[:3] + (None,) for x in ans]
+        return ans
+    (R, H, ref_lens, hyp_lens, D) = _batch_matrices(pairs)
+    counts = _trace_back(R, H, ref_lens.copy(), hyp_lens.copy(), D, True)
+    if alignments:
+        (ops, ops_lens) = _trace_back(R, H, ref_lens.copy(), hyp_lens.copy(),
+                                      D, False)
+        ops_strings = [ops[b, ops_lens[b] - 1::-1].tobytes().decode('ascii')
+                       if ops_lens[b] > 0 else '' for b in range(len(pairs))]
+    else:
+        ops_strings = [None] * len(pairs)
+    return [(int(counts[0, b]), int(counts[1, b]), int(counts[2, b]),
+             ops_strings[b]) for b in range(len(pairs))]
+
+
+def _trivial_alignment(ref, hyp, alignments):
+    """ Returns the alignment of (ref, hyp) if it is obvious (if they are
+    equal or one of them is empty), or None. """
+    if ref == hyp:
+        return (0, 0, 0, 'C' * len(ref) if alignments else None)
+    if len(hyp) == 0:
+        return (0, len(ref), 0, 'D' * len(ref) if alignments else None)
+    if len(ref) == 0:
+        return (len(hyp), 0, 0, 'I' * len(hyp) if alignments else None)
+    return None
+
+
+def align(pairs, num_jobs=1, use_numpy=True, alignments=True):
+    """ Aligns the list of pairs of sequences of ids (ref, hyp) and returns
+    the list of (num_ins, num_del, num_sub, ops), where the counts are those
+    of compute-wer and ops is the string of the op codes ('C', 'S', 'I' and
+    'D') of the alignment of align-text, or None if alignments is false.
+    The pairs are aligned in batches of similar lengths, in num_jobs
+    processes. """
+    use_numpy = use_numpy and g_numpy
+    ans = [None] * len(pairs)
+    todo = []
+    for i in range(len(pairs)):
+        (ref, hyp) = pairs[i]
+        ans[i] = _trivial_alignment(ref, hyp, alignments)
+        if ans[i] is None:
+            todo.append(i)
+
+    # batches of utterances with similar lengths, so that little of the
+    # matrices is padding.
+    todo.sort(key=lambda i: (len(pairs[i][0]), len(pairs[i][1])))
+    batches = []
+    batch = []
+    max_ref_len = max_hyp_len = 0
+    for i in todo:
+        (ref, hyp) = pairs[i]
+        ref_len = max(max_ref_len, len(ref))
+        hyp_len = max(max_hyp_len, len(hyp))
+        if len(batch) > 0 and (
+                len(batch) >= g_max_batch_size or
+                (len(batch) + 1) * (ref_len + 1) * (hyp_len + 1) >
+                g_max_batch_cells):
+            batches.append(batch)
+            batch = []
+            ref_len = len(ref)
+            hyp_len = len(hyp)
+        batch.append(i)
+        (max_ref_len, max_hyp_len) = (ref_len, hyp_len)
+    if len(batch) > 0:
+        batches.append(batch)
+
+    jobs = [([pairs[i] for i in batch], use_numpy, alignments)
+            for batch in batches]
+    if num_jobs <= 1 or len(jobs) <= 1:
+        results = [_align_batch(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(min(num_jobs, len(jobs)))
+        try:
+            results = pool.map(_align_batch, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    for (batch, result) in zip(batches, results):
+        for (i, x) in zip(batch, result):
+            ans[i] = x
+    return ans
+
+
+class ReferenceIndex(object):
+    """ The integer-encoded reference texts, against which hypotheses are
+    scored.
+
+    Attributes:
+        vocab: the Vocabulary shared by the references and the hypotheses
+        utts: the list of the utterances, in the order of the reference
+        words: a dict from utterance to its list of reference words
+        refs: a dict from utterance to the tuple of the ids of its words
+    """
+
+    def __init__(self, ref_items, vocab=None):
+        """ ref_items is a list of (utt, list of words), e.g. as returned by
+        read_text(). """
+        self.vocab = Vocabulary() if vocab is None else vocab
+        self.utts = []
+        self.words = {}
+        self.refs = {}
+        for (utt, words) in ref_items:
+            if utt not in self.refs:
+                self.utts.append(utt)
+            self.words[utt] = words
+            self.refs[utt] = self.vocab.encode(words)
+
+    def encode(self, hyp_items):
+        """ Returns a dict from utterance to the tuple of the ids of the words
+        of the hypotheses hyp_items, a list of (utt, list of words). """
+        return dict([(utt, self.vocab.encode(words))
+                     for (utt, words) in hyp_items])
+
+    def score(self, hyp_items, mode='present', num_jobs=1, use_numpy=True,
+              alignments=True):
+        """ Scores the hypotheses hyp_items (a list of (utt, list of words))
+        and returns a ScoringResult.  The mode is that of compute-wer:
+        'present' scores only the utterances in the hypotheses, 'all' scores
+        the missing ones as empty, and 'strict' raises an exception if any is
+        missing.  The hypotheses of utterances that are not in the reference
+        are ignored.  If alignments is false only the counts are computed,
+        and the details are not available. """
+        hyp_words = dict(hyp_items)
+        return self.score_encoded(self.encode(hyp_items), hyp_words,
+                                  mode=mode, num_jobs=num_jobs,
+                                  use_numpy=use_numpy, alignments=alignments)
+
+    def score_encoded(self, hyps, hyp_words=None, mode='present',
+                      num_jobs=1, use_numpy=True, alignments=True):
+        """ Like score(), but hyps is a dict from utterance to the tuple of
+        the ids of its words, as returned by encode().  hyp_words, a dict
+        from utterance to its list of words, is only needed for the
+        details; if it is None, the words are decoded from the ids. """
+        (utts, num_absent) = self._scored_utts(hyps, mode)
+        empty = ()
+        pairs = [(self.refs[utt], hyps.get(utt, empty)) for utt in utts]
+        results = align(pairs, num_jobs=num_jobs, use_numpy=use_numpy,
+                        alignments=alignments)
+        if alignments:
+            if hyp_words is None:
+                vocab_words = self.vocab.words
+                hyp_words = dict([(utt, [vocab_words[i] for i in hyps[utt]])
+                                  for utt in utts if utt in hyps])
+            hyp_words = [hyp_words.get(utt, []) for utt in utts]
+        else:
+            hyp_words = None
+        return ScoringResult(utts, [self.words[utt] for utt in utts],
+                             hyp_words, results, num_absent)
+
+    def score_many(self, hyps_by_key, mode='present', num_jobs=1,
+                   use_numpy=True):
+        """ Scores several sets of hypotheses of the same utterances (e.g.
+        those of each LM-weight and word insertion penalty of a decoding
+        directory) together, and returns a dict from key to ScoringResult
+        (without the alignments), where hyps_by_key is a dict from key to a
+        dict from utterance to the tuple of the ids of its words.  The pairs
+        of reference and hypothesis that are in several of the sets, which
+        are most of them, are aligned only once, and all the distinct pairs
+        are aligned in one call to align(). """
+        empty = ()
+        pair2index = {}
+        pairs = []
+        key2indexes = {}
+        key2utts = {}
+        for key in hyps_by_key:
+            hyps = hyps_by_key[key]
+            (utts, num_absent) = self._scored_utts(hyps, mode)
+            indexes = []
+            for utt in utts:
+                pair = (utt, hyps.get(utt, empty))
+                i = pair2index.get(pair)
+                if i is None:
+                    i = len(pairs)
+                    pair2index[pair] = i
+                    pairs.append((self.refs[utt], pair[1]))
+                indexes.append(i)
+            key2indexes[key] = indexes
+            key2utts[key] = (utts, num_absent)
+        logger.info("Scoring %d sets of hypotheses, with %d distinct "
+                    "utterance hypotheses", len(hyps_by_key), len(pairs))
+        results = align(pairs, num_jobs=num_jobs, use_numpy=use_numpy,
+                        alignments=False)
+        ans = {}
+        for key in hyps_by_key:
+            (utts, num_absent) = key2utts[key]
+            ans[key] = ScoringResult(
+                utts, [self.words[utt] for utt in utts], None,
+                [results[i] for i in key2indexes[key]], num_absent)
+        return ans
+
+    def _scored_utts(self, hyps, mode):
+        """ Returns the list of the utterances that are scored in 'mode' with
+        the hypotheses hyps (a dict from utterance), and the number of the
+        reference utterances that are not in hyps. """
+        if mode not in ['present', 'all', 'strict']:
+            raise ValueError("Invalid mode {0}".format(mode))
+        utts = []
+        num_absent = 0
+        for utt in self.utts:
+            if utt in hyps:
+                utts.append(utt)
+            else:
+                num_absent += 1
+                if mode == 'strict':
+                    raise Exception("No hypothesis for utterance {0}".format(
+                        utt))
+                if mode == 'all':
+                    utts.append(utt)
+        return (utts, num_absent)
+
+
+def _float32(x):
+    return struct.unpack('f', struct.pack('f', x))[0]
+
+
+def _cjustify(s, width):
+    # like cjustify() of wer_per_utt_details.pl: the extra space goes left.
+    right = (width - len(s)) // 2
+    return ' ' * (width - len(s) - right) + s + ' ' * right
+
+
+def _sort_key_chars(s):
+    # 'sort -i' in the C locale ignores the non-printing characters, which
+    # include all the non-ASCII bytes.
+    return bytes(bytearray([c for c in bytearray(s.encode('utf-8'))
+                            if 32 <= c < 127]))
+
+
+class ScoringResult(object):
+    """ The result of scoring hypotheses against a ReferenceIndex.
+
+    Attributes:
+        utts: the list of the scored utterances, in the reference order
+        ref_words, hyp_words: the lists of the words of their reference and
+            hypothesis (hyp_words is None if the alignments were not
+            computed)
+        results: the list of their (num_ins, num_del, num_sub, ops), see
+            align()
+        num_absent: the number of reference utterances without hypothesis
+        num_ins, num_del, num_sub, num_words, num_sent, num_sent_errors: the
+            totals of compute-wer
+    """
+
+    def __init__(self, utts, ref_words, hyp_words, results, num_absent):
+        self.utts = utts
+        self.ref_words = ref_words
+        self.hyp_words = hyp_words
+        self.results = results
+        self.num_absent = num_absent
+        self.num_ins = sum([x[0] for x in results])
+        self.num_del = sum([x[1] for x in results])
+        self.num_sub = sum([x[2] for x in results])
+        self.num_words = sum([len(words) for words in ref_words])
+        self.num_sent = len(utts)
+        self.num_sent_errors = len([x for x in results
+                                    if x[0] + x[1] + x[2] > 0])
+
+    def num_errors(self):
+        return self.num_ins + self.num_del + self.num_sub
+
+    def wer(self):
+        """ Returns the WER in percent, as compute-wer computes it. """
+        return self._percent(self.num_errors(), self.num_words)
+
+    def ser(self):
+        return self._percent(self.num_sent_errors, self.num_sent)
+
+    @staticmethod
+    def _percent(num, den):
+        if den == 0:
+            return float('inf') if num > 0 else float('nan')
+        return _float32(100.0 * num / den)
+
+    def summary(self):
+        """ Returns the output of compute-wer. """
+        return ("%WER {0:.2f} [ {1} / {2}, {3} ins, {4} del, {5} sub ]{6}\n"
+                "%SER {7:.2f} [ {8} / {9} ]\n"
+                "Scored {9} sentences, {10} not present in hyp.\n".format(
+                    self.wer(), self.num_errors(), self.num_words,
+                    self.num_ins, self.num_del, self.num_sub,
+                    ' [PARTIAL]' if self.num_absent != 0 else '',
+                    self.ser(), self.num_sent_errors, self.num_sent,
+                    self.num_absent))
+
+    def _check_alignments(self):
+        if self.hyp_words is None:
+            raise Exception("The alignments were not computed")
+
+    def aligned_pairs(self, i, special_symbol='<eps>'):
+        """ Returns the list of the (ref_word, hyp_word) pairs of the
+        alignment of the i'th utterance, with special_symbol for the missing
+        words. """
+        self._check_alignments()
+        ref_words = self.ref_words[i]
+        hyp_words = self.hyp_words[i]
+        ans = []
+        m = n = 0
+        for op in self.results[i][3]:
+            if op == 'I':
+                ans.append((special_symbol, hyp_words[n]))
+                n += 1
+            elif op == 'D':
+                ans.append((ref_words[m], special_symbol))
+                m += 1
+            else:
+                ans.append((ref_words[m], hyp_words[n]))
+                m += 1
+                n += 1
+        return ans
+
+    def alignment_lines(self, special_symbol='<eps>'):
+        """ Yields the lines of the output of align-text, e.g.
+        'utt1 a a ; b c ; <eps> d ' (with the trailing space). """
+        for i in range(len(self.utts)):
+            yield self.utts[i] + ' ' + ' ; '.join([
+                ref + ' ' + hyp for (ref, hyp)
+                in self.aligned_pairs(i, special_symbol)]) + (
+                    ' ' if len(self.results[i][3]) > 0 else '')
+
+    def _csid(self, i):
+        ops = self.results[i][3]
+        return (ops.count('C'), ops.count('S'), ops.count('I'),
+                ops.count('D'))
+
+    def per_utt_lines(self, special_symbol='<eps>'):
+        """ Yields the lines of the output of wer_per_utt_details.pl: the
+        'ref', 'hyp', 'op' and '#csid' lines of each utterance. """
+        for i in range(len(self.utts)):
+            utt = self.utts[i]
+            ref_str = []
+            hyp_str = []
+            op_str = []
+            for ((ref, hyp), op) in zip(self.aligned_pairs(i, special_symbol),
+                                        self.results[i][3]):
+                width = max(len(ref), len(hyp), 1)
+                ref_str.append(_cjustify(ref, width))
+                hyp_str.append(_cjustify(hyp, width))
+                op_str.append(_cjustify(op, width))
+            yield utt + ' ref  ' + '  '.join(ref_str)
+            yield utt + ' hyp  ' + '  '.join(hyp_str)
+            yield utt + ' op   ' + '  '.join(op_str)
+            yield utt + ' #csid {0} {1} {2} {3}'.format(*self._csid(i))
+
+    def per_spk_lines(self, utt2spk, spk_width=15, width=10):
+        """ Yields the lines of the output of wer_per_spk_details.pl, given
+        the dict utt2spk; the speaker column is as wide as the longest
+        speaker in utt2spk. """
+        self._check_alignments()
+        spk_width = max([spk_width] + [len(spk) for spk in utt2spk.values()])
+        spk2stats = {}
+        for i in range(len(self.utts)):
+            utt = self.utts[i]
+            if utt not in utt2spk:
+                raise Exception("Utterance {0} is not in utt2spk".format(utt))
+            stats = spk2stats.setdefault(utt2spk[utt], [0, 0, 0, 0, 0, 0])
+            (c, s, ins, d) = self._csid(i)
+            stats[0] += c
+            stats[1] += s
+            stats[2] += ins
+            stats[3] += d
+            stats[4] += 1
+            stats[5] += (s + ins + d != 0)
+
+        f = '%{0}s'.format(width)
+        yield ('%-{0}s id  '.format(spk_width) + ' '.join([f] * 8)) % (
+            'SPEAKER', '#SENT', '#WORD', 'Corr', 'Sub', 'Ins', 'Del', 'Err',
+            'S.Err')
+
+        def format_lines(spk, stats):
+            (c, s, ins, d, sent, serr) = stats
+            word = c + s + d
+            err = s + d + ins
+            fd = '%{0}d'.format(width)
+            ff = '%{0}.2f'.format(width)
+            yield ('%-{0}s raw '.format(spk_width) + ' '.join([fd] * 8)) % (
+                spk, sent, word, c, s, ins, d, err, serr)
+            if word != 0:
+                w = float(word)
+                yield ('%-{0}s sys '.format(spk_width) +
+                       ' '.join([fd] * 2 + [ff] * 6)) % (
+                    spk, sent, word, 100 * c / w, 100 * s / w, 100 * ins / w,
+                    100 * d / w, 100 * err / w, 100.0 * serr / sent)
+
+        total = [0] * 6
+        for spk in sorted(spk2stats.keys()):
+            for line in format_lines(spk, spk2stats[spk]):
+                yield line
+            total = [x + y for (x, y) in zip(total, spk2stats[spk])]
+        for line in format_lines('SUM', total):
+            yield line
+
+    def ops_lines(self, special_symbol='<eps>', max_width=16):
+        """ Yields the lines of the output of wer_ops_details.pl, sorted
+        like 'sort -b -i -k 1,1 -k 4,4rn -k 2,2 -k 3,3' in the C locale does
+        in steps/scoring/score_kaldi_wer.sh. """
+        edit_ops = {}
+        for i in range(len(self.utts)):
+            for pair in self.aligned_pairs(i, special_symbol):
+                edit_ops[pair] = edit_ops.get(pair, 0) + 1
+        if len(edit_ops) == 0:
+            return
+        word_width = min(max_width, max([max(len(ref), len(hyp))
+                                         for (ref, hyp) in edit_ops]))
+        ops_width = max([len(str(n)) for n in edit_ops.values()])
+        lines = []
+        for ((ref, hyp), count) in edit_ops.items():
+            if ref == hyp:
+                op = 'correct'
+            elif ref == special_symbol:
+                op = 'insertion'
+            elif hyp == special_symbol:
+                op = 'deletion'
+            else:
+                op = 'substitution'
+            line = u'{0:<14}{1:>{w}}    {2:>{w}}    {3:>{n}}'.format(
+                op, ref, hyp, count, w=word_width, n=ops_width)
+            lines.append(((op, -count, _sort_key_chars(ref),
+                           _sort_key_chars(hyp), line.encode('utf-8')), line))
+        lines.sort()
+        for (key, line) in lines:
+            yield line
+
+    def ctm_edits(self, i, ctm_array, eps_symbol='<eps>', oov_word=None,
+                  symbol_table=None):
+        """ Returns the ctm-edits of the i'th utterance, whose hypothesis was
+        read from the CTM entries ctm_array (see read_ctm()) without the
+        silences (the entries whose word is eps_symbol); see
+        get_ctm_edits(). """
+        self._check_alignments()
+        return get_ctm_edits(
+            _ctm_alignment(self.ref_words[i], ctm_array, self.results[i][3],
+                           eps_symbol),
+            ctm_array, eps_symbol=eps_symbol, oov_word=oov_word,
+            symbol_table=symbol_table)
+
+
+def _ctm_alignment(ref_words, ctm_array, ops, eps_symbol):
+    """ Converts the alignment 'ops' of ref_words with the non-silence words
+    of ctm_array into the alignment_output format of get_ctm_edits(), where
+    the silences of the CTM are aligned with eps_symbol.  Like
+    get_ctm_edits.py does, the deletions at a position come before the
+    silences there. """
+    ans = []
+    m = 0
+    h = 0
+    for op in ops:
+        if op == 'D':
+            ans.append((ref_words[m], eps_symbol, m, h, m + 1, h))
+            m += 1
+            continue
+        while h < len(ctm_array) and ctm_array[h][2] == eps_symbol:
+            ans.append((eps_symbol, eps_symbol, m, h, m, h + 1))
+            h += 1
+        if op == 'I':
+            ans.append((eps_symbol, ctm_array[h][2], m, h, m, h + 1))
+        else:
+            ans.append((ref_words[m], ctm_array[h][2], m, h, m + 1, h + 1))
+            m += 1
+        h += 1
+    while h < len(ctm_array):
+        assert ctm_array[h][2] == eps_symbol
+        ans.append((eps_symbol, eps_symbol, m, h, m, h + 1))
+        h += 1
+    return ans
+
+
+def get_edit_type(hyp_word, ref_word, duration=-1, eps_symbol='<eps>',
+                  oov_word=None, symbol_table=None):
+    if hyp_word == ref_word and hyp_word != eps_symbol:
+        return 'cor'
+    if hyp_word != eps_symbol and ref_word == eps_symbol:
+        return 'ins'
+    if hyp_word == eps_symbol and ref_word != eps_symbol and duration == 0.0:
+        return 'del'
+    if (hyp_word == oov_word and symbol_table is not None
+            and len(symbol_table) > 0 and ref_word not in symbol_table):
+        return 'cor'    # this special case is treated as correct
+    if hyp_word == eps_symbol and ref_word == eps_symbol and duration > 0.0:
+        # silence in hypothesis; we don't match this up with any reference
+        # word.
+        return 'sil'
+    # The following assertion is because, based on how get_ctm_edits()
+    # works, we shouldn't hit this case.
+    assert hyp_word != eps_symbol and ref_word != eps_symbol
+    return 'sub'
+
+
+def get_ctm_edits(alignment_output, ctm_array, eps_symbol="<eps>",
+                  oov_word=None, symbol_table=None):
+    """
+    This function takes two lists
+        alignment_output = The alignment of the reference and the CTM, e.g.
+            the output of smith_waterman_alignment() in
+            steps/cleanup/internal/align_ctm_ref.py, which is a
+            list of tuples (ref_word, hyp_word, ref_word_from_index,
+            hyp_word_from_index, ref_word_to_index, hyp_word_to_index)
+        ctm_array = [ [ start1, duration1, hyp_word1, confidence1 ], ... ]
+    and pads them with new list elements so that the entries 'match up'.
+
+    Returns CTM edits lines, which are CTM lines appended with reference word
+    and edit type.
+
+    What we are aiming for is that for each i, ctm_array[i][2] ==
+    alignment_output[i][1].  The reasons why this is not automatically true
+    are:
+
+     (1) There may be insertions in the hypothesis sequence that are not
+         aligned with any reference words in the beginning of the
+         alignment_output.
+     (2) There may be deletions in the end of the alignment_output that
+         do not correspond to any additional hypothesis CTM lines.
+
+    We introduce suitable entries in to alignment_output and ctm_array as
+    necessary to make them 'match up'.
+    """
+    ctm_edits = []
+    ali_len = len(alignment_output)
+    ctm_len = len(ctm_array)
+    ali_pos = 0
+    ctm_pos = 0
+
+    # current_time is the end of the last ctm segment we processesed.
+    current_time = ctm_array[0][0] if ctm_len > 0 else 0.0
+
+    for (ref_word, hyp_word, ref_prev_i, hyp_prev_i,
+         ref_i, hyp_i) in alignment_output:
+        try:
+            ctm_pos = hyp_prev_i
+
+            if hyp_prev_i == hyp_i:
+                assert hyp_word == eps_symbol
+                # These are deletions as there are no CTM entries
+                # corresponding to these alignments.
+                edit_type = get_edit_type(
+                    hyp_word=eps_symbol, ref_word=ref_word,
+                    duration=0.0, eps_symbol=eps_symbol,
+                    oov_word=oov_word, symbol_table=symbol_table)
+                ctm_line = [current_time, 0.0, eps_symbol, 1.0,
+                            ref_word, edit_type]
+                ctm_edits.append(ctm_line)
+            else:
+                assert ctm_pos < ctm_len
+                assert len(ctm_array[ctm_pos]) == 4
+                assert hyp_i == hyp_prev_i + 1
+                assert hyp_word == ctm_array[ctm_pos][2]
+                # This is the normal case, where there are 2 entries where
+                # they hyp-words match up.
+                ctm_line = list(ctm_array[ctm_pos])
+                if hyp_word == eps_symbol and ref_word != eps_symbol:
+                    # This is a silence in hypothesis aligned with a reference
+                    # word. We split this into two ctm edit lines where the
+                    # first one is a deletion of duration 0 and the second
+                    # one is a silence of duration given by the ctm line.
+                    edit_type = get_edit_type(
+                        hyp_word=eps_symbol, ref_word=ref_word,
+                        duration=0.0, eps_symbol=eps_symbol,
+                        oov_word=oov_word, symbol_table=symbol_table)
+                    assert edit_type == 'del'
+                    ctm_edits.append([current_time, 0.0, eps_symbol, 1.0,
+                                      ref_word, edit_type])
+
+                    edit_type = get_edit_type(
+                        hyp_word=eps_symbol, ref_word=eps_symbol,
+                        duration=ctm_line[1], eps_symbol=eps_symbol,
+                        oov_word=oov_word, symbol_table=symbol_table)
+                    assert edit_type == 'sil'
+                    ctm_line.extend([eps_symbol, edit_type])
+                    ctm_edits.append(ctm_line)
+                else:
+                    edit_type = get_edit_type(
+                        hyp_word=hyp_word, ref_word=ref_word,
+                        duration=ctm_line[1], eps_symbol=eps_symbol,
+                        oov_word=oov_word, symbol_table=symbol_table)
+                    ctm_line.extend([ref_word, edit_type])
+                    ctm_edits.append(ctm_line)
+                current_time = (ctm_array[ctm_pos][0]
+                                + ctm_array[ctm_pos][1])
+        except Exception:
+            logger.error("Could not get ctm edits for "
+                         "edits@{edits_pos} = {0}, ctm@{ctm_pos} = {1}".format(
+                            ("NONE" if ali_pos >= ali_len
+                             else alignment_output[ali_pos]),
+                            ("NONE" if ctm_pos >= ctm_len
+                             else ctm_array[ctm_pos]),
+                            edits_pos=ali_pos, ctm_pos=ctm_pos))
+            logger.error("alignment = {0}".format(alignment_output))
+            raise
+    return ctm_edits
+
+
+def ctm_line_to_string(ctm_line):
+    if len(ctm_line) != 8:
+        raise RuntimeError("len(ctm_line) expected to be {0}. "
+                           "Invalid line {1}".format(8, ctm_line))
+
+    return " ".join([str(x) for x in ctm_line])
@@ -0,0 +1,291 @@
+# Apache 2.0.
+
+""" This module splits a data directory into num_jobs parts, like
+utils/split_data.sh, writing data/split<n>/{1,2,...,n} (or
+data/split<n>utt/... with per_utt=True) with the same files, but it balances
+the total duration of the parts instead of their number of utterances.
+
+The speakers (or, with per_utt=True, the utterances) are kept in their
+sorted order and assigned in contiguous blocks, like utils/split_scp.pl does,
+so that concatenating the outputs of the jobs still gives sorted files; the
+block boundaries are chosen to minimize the duration of the longest part.
+The duration of an utterance is read from utt2dur, or from utt2num_frames,
+or from the headers of the matrices in feats.scp (see libs/kaldi_io); if none
+of them is available every utterance counts as 1.
+
+Each file of the data directory is read once and its lines are written to
+the parts they belong to.  A stamp file in the split directory records the
+sizes and the modification times of the input files, and the directory is not
+split again while they do not change.
+
+e.g.
+    split_dir = split_data.split_data_dir("data/train", 4)
+    # the parts are data/train/split4/1 ... data/train/split4/4
+"""
+
+import logging
+import os
+
+import libs.data_dir as data_dir_lib
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+# The files indexed by utterance, by speaker and by recording that are split;
+# these are the files that utils/split_data.sh splits.
+g_utt_files = ['feats.scp', 'text', 'vad.scp', 'utt2lang']
+g_spk_files = ['spk2gender', 'spk2warp', 'cmvn.scp']
+g_reco_files = ['reco2file_and_channel']
+# The other files whose changes cause the directory to be split again.
+g_other_files = ['utt2spk', 'segments', 'wav.scp', 'utt2dur',
+                 'utt2num_frames']
+# The maximum number of output files that are open at the same time; with
+# more parts than this, an input file is read once per group of parts.
+g_max_open_files = 256
+g_stamp_file = '.split_stamp'
+
+
+def get_utterance_weights(data):
+    """ Returns (a dict from utterance to its duration, or None, and the name
+    of the source of the durations). """
+    data_dir = data_dir_lib.DataDir(data)
+    if data_dir.has('utt2dur'):
+        return (data_dir['utt2dur'].to_dict(
+            value_processor=lambda x: float(x[0])), 'utt2dur')
+    if data_dir.has('utt2num_frames'):
+        return (data_dir['utt2num_frames'].to_dict(
+            value_processor=lambda x: int(x[0])), 'utt2num_frames')
+    if data_dir.has('feats.scp'):
+        import libs.kaldi_io as kaldi_io
+        reader = kaldi_io.ScpReader(data_dir.filename('feats.scp'))
+        try:
+            return (dict([(utt, reader.shape(utt)[0])
+                          for utt in reader.keys]), 'feats.scp')
+        except (ValueError, IOError, OSError) as e:
+            logger.warning("Could not get the lengths of the features in "
+                           "%s (%s); splitting by the number of utterances",
+                           data_dir.filename('feats.scp'), str(e))
+        finally:
+            reader.close()
+    return (None, 'num-utterances')
+
+
+def partition(weights, num_parts):
+    """ Splits the list of weights into num_parts contiguous non-empty
+    blocks that minimize the largest total weight of a block, and returns the
+    list of the start indexes of the blocks.  Requires
+    len(weights) >= num_parts. """
+    assert 0 < num_parts <= len(weights)
+
+    def num_blocks_needed(max_weight):
+        num_blocks = 1
+        total = 0.0
+        for w in weights:
+            if total + w > max_weight and total > 0:
+                num_blocks += 1
+                total = 0.0
+            total += w
+        return num_blocks
+
+    # the optimal maximum weight is between lo and hi; bisect on it.
+    lo = max(max(weights), sum(weights) / float(num_parts))
+    hi = max(weights) + sum(weights) / float(num_parts)
+    if num_blocks_needed(lo) <= num_parts:
+        hi = lo
+    for i in range(100):
+        if hi - lo <= 1.0e-09 * hi:
+            break
+        mid = (lo + hi) / 2
+        if num_blocks_needed(mid) <= num_parts:
+            hi = mid
+        else:
+            lo = mid
+
+    # fill the blocks greedily up to hi, but start a new block whenever the
+    # remaining items are just enough to give one to each remaining block.
+    starts = [0]
+    total = weights[0]
+    for i in range(1, len(weights)):
+        num_remaining_blocks = num_parts - len(starts)
+        if ((total + weights[i] > hi or
+             len(weights) - i <= num_remaining_blocks) and
+                num_remaining_blocks > 0):
+            starts.append(i)
+            total = 0.0
+        total += weights[i]
+    assert len(starts) == num_parts
+    return starts
+
+
+def _get_stamp(data, num_jobs, per_utt):
+    lines = ['num-jobs={0} per-utt={1}'.format(num_jobs, per_utt)]
+    for name in sorted(set(g_utt_files + g_spk_files + g_reco_files +
+                           g_other_files)):
+        filename = os.path.join(data, name)
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            lines.append('{0} {1} {2!r}'.format(name, stat.st_size,
+                                                stat.st_mtime))
+    return '\n'.join(lines) + '\n'
+
+
+def _is_up_to_date(split_dir, stamp, num_jobs):
+    try:
+        with open(os.path.join(split_dir, g_stamp_file)) as f:
+            if f.read() != stamp:
+                return False
+    except (IOError, OSError):
+        return False
+    return all([os.path.isfile(os.path.join(split_dir, str(n), 'utt2spk'))
+                for n in range(1, num_jobs + 1)])
+
+
+def _split_file(filename, key2jobs, split_dir, num_jobs, name):
+    """ Writes the lines of the file whose key (first field) is in key2jobs
+    (a dict from key to a job, or to a list of jobs, numbered from 0) to the
+    file 'name' of the split directories of those jobs.  The file is read
+    once if there are at most g_max_open_files jobs. """
+    for first_job in range(0, num_jobs, g_max_open_files):
+        last_job = min(num_jobs, first_job + g_max_open_files)
+        outputs = [open(os.path.join(split_dir, str(n + 1), name), 'w')
+                   for n in range(first_job, last_job)]
+        try:
+            with open(filename) as f:
+                for line in f:
+                    parts = line.split(None, 1)
+                    if len(parts) == 0 or parts[0] not in key2jobs:
+                        continue
+                    jobs = key2jobs[parts[0]]
+                    if isinstance(jobs, int):
+                        if first_job <= jobs < last_job:
+                            outputs[jobs - first_job].write(line)
+                    else:
+                        for job in jobs:
+                            if first_job <= job < last_job:
+                                outputs[job - first_job].write(line)
+        finally:
+            for output in outputs:
+                output.close()
+
+
+def split_data_dir(data, num_jobs, per_utt=False):
+    """ Splits the data directory 'data' into num_jobs parts of about the
+    same duration (see the module docstring) and returns the split
+    directory, e.g. data/train/split4.  Raises an exception if there are
+    fewer speakers (or utterances, with per_utt) than jobs. """
+    split_dir = os.path.join(data, 'split{0}{1}'.format(
+        num_jobs, 'utt' if per_utt else ''))
+    stamp = _get_stamp(data, num_jobs, per_utt)
+    if _is_up_to_date(split_dir, stamp, num_jobs):
+        return split_dir
+
+    data_dir = data_dir_lib.DataDir(data)
+    # utts and their speakers, in the order of utt2spk (which is sorted).
+    utts = []
+    utt2spk = {}
+    for utt, spk in data_dir['utt2spk'].items():
+        utts.append(utt)
+        utt2spk[utt] = spk
+    (utt2weight, source) = get_utterance_weights(data)
+    if utt2weight is not None:
+        missing = [utt for utt in utts if utt not in utt2weight]
+        if len(missing) > 0:
+            logger.warning("%d utterances are not in %s, e.g. %s; splitting "
+                           "by the number of utterances", len(missing),
+                           source, missing[0])
+            utt2weight = None
+    utt_weight = ((lambda utt: 1) if utt2weight is None
+                  else (lambda utt: utt2weight[utt]))
+
+    # the items that are assigned to the jobs: the speakers in the order of
+    # their first utterance, or the utterances.
+    if per_utt:
+        items = utts
+        weights = [utt_weight(utt) for utt in utts]
+    else:
+        items = []
+        spk2weight = {}
+        for utt in utts:
+            spk = utt2spk[utt]
+            if spk not in spk2weight:
+                items.append(spk)
+                spk2weight[spk] = 0
+            spk2weight[spk] += utt_weight(utt)
+        weights = [spk2weight[spk] for spk in items]
+    if len(items) < num_jobs:
+        raise Exception("Refusing to split {0} into {1} parts, as there are "
+                        "only {2} {3}".format(data, num_jobs, len(items),
+                                              'utterances' if per_utt
+                                              else 'speakers'))
+    # weights of 0 (e.g. empty utterances) would make the blocks arbitrary.
+    weights = [max(w, 1.0e-06) for w in weights]
+    starts = partition(weights, num_jobs) + [len(items)]
+    item2job = {}
+    for job in range(num_jobs):
+        for i in range(starts[job], starts[job + 1]):
+            item2job[items[i]] = job
+    utt2job = dict([(utt, item2job[utt if per_utt else utt2spk[utt]])
+                    for utt in utts])
+
+    for n in range(1, num_jobs + 1):
+        job_dir = os.path.join(split_dir, str(n))
+        if not os.path.isdir(job_dir):
+            os.makedirs(job_dir)
+    stamp_file = os.path.join(split_dir, g_stamp_file)
+    if os.path.exists(stamp_file):
+        os.remove(stamp_file)
+
+    # utt2spk and spk2utt; a speaker may be in several jobs with per_utt.
+    job_utts = [[] for n in range(num_jobs)]
+    for utt in utts:
+        job_utts[utt2job[utt]].append(utt)
+    spk2jobs = {}
+    for job in range(num_jobs):
+        data_dir_lib.write_table(
+            os.path.join(split_dir, str(job + 1), 'utt2spk'),
+            [(utt, utt2spk[utt]) for utt in job_utts[job]], is_sorted=True)
+        spk2utt = {}
+        for utt in job_utts[job]:
+            spk = utt2spk[utt]
+            if spk not in spk2utt:
+                spk2utt[spk] = []
+                spk2jobs.setdefault(spk, []).append(job)
+            spk2utt[spk].append(utt)
+        data_dir_lib.write_table(
+            os.path.join(split_dir, str(job + 1), 'spk2utt'), spk2utt.items())
+
+    has_segments = data_dir.has('segments')
+    for name in g_utt_files + ([] if has_segments else ['wav.scp']):
+        if data_dir.has(name):
+            _split_file(data_dir.filename(name), utt2job, split_dir,
+                        num_jobs, name)
+    for name in g_spk_files:
+        if data_dir.has(name):
+            _split_file(data_dir.filename(name), spk2jobs, split_dir,
+                        num_jobs, name)
+    if has_segments:
+        _split_file(data_dir.filename('segments'), utt2job, split_dir,
+                    num_jobs, 'segments')
+        # the recordings of the segments of each job.
+        reco2jobs = {}
+        with open(data_dir.filename('segments')) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] in utt2job:
+                    jobs = reco2jobs.setdefault(parts[1], [])
+                    if utt2job[parts[0]] not in jobs:
+                        jobs.append(utt2job[parts[0]])
+        for name in g_reco_files + ['wav.scp']:
+            if data_dir.has(name):
+                _split_file(data_dir.filename(name), reco2jobs, split_dir,
+                            num_jobs, name)
+
+    job_weights = [sum(weights[starts[job]:starts[job + 1]])
+                   for job in range(num_jobs)]
+    logger.info("Split %s into %d parts; the %s of the parts are between "
+                "%g and %g", data, num_jobs, source, min(job_weights),
+                max(job_weights))
+    with open(stamp_file, 'w') as f:
+        f.write(stamp)
+    return split_dir
@@ -0,0 +1,723 @@
+# Apache 2.0.
+
+""" This module validates and fixes Kaldi data directories, like
+utils/validate_data_dir.sh and utils/fix_data_dir.sh, but in-process.
+
+validate_data_dir() reads each file of the data directory once, in a pool of
+processes (one file per task): a single streaming pass checks that the file
+is sorted and has no duplicate keys, checks the format of its lines, and
+computes a digest of its list of keys (and, for utt2spk, spk2utt and
+segments, of the utterance-speaker pairs and of the recordings).  The lists of
+keys of the files are then compared through their digests; the files
+themselves are only read again to describe a difference.  The result is a
+report (a dict that can be written as JSON) with the errors and warnings,
+each with the file and the kind of check that failed, and some statistics of
+each file.
+
+fix_data_dir() does what utils/fix_data_dir.sh does: it sorts the files,
+removes duplicate keys and keeps only the utterances, speakers and recordings
+that are present in all the files that list them.  It first validates the
+directory and does nothing when it is already consistent, which is the
+common case; otherwise it reads the files once, filters them in memory and
+writes the files that change, keeping the old ones in <data>/.backup.
+
+e.g.
+    report = validate_data_dir.validate_data_dir("data/train", no_feats=True)
+    if not report['valid']:
+        print(validate_data_dir.format_report(report))
+"""
+
+import contextlib
+import gc
+import hashlib
+import logging
+import math
+import multiprocessing
+import operator
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+# The files that are checked, with what their keys are: utterances, speakers
+# or recordings ('utt-or-reco' for wav.scp and reco2file_and_channel, which
+# are indexed by recording if there is a segments file and by utterance
+# otherwise).
+g_checked_files = [
+    ('utt2spk', 'utt'), ('spk2utt', 'spk'), ('text', 'utt'),
+    ('wav.scp', 'utt-or-reco'), ('segments', 'utt'),
+    ('reco2file_and_channel', 'utt-or-reco'), ('feats.scp', 'utt'),
+    ('cmvn.scp', 'spk'), ('spk2gender', 'spk'), ('spk2warp', 'spk'),
+    ('utt2warp', 'utt'), ('vad.scp', 'utt'), ('utt2lang', 'utt'),
+    ('utt2uniq', 'utt'), ('utt2dur', 'utt'), ('utt2num_frames', 'utt')]
+# The files that utils/validate_data_dir.sh does not check; problems with them
+# are reported as warnings.
+g_unchecked_files = ['segments', 'utt2num_frames']
+# The files that are sorted and filtered by fix_data_dir(), and the ones of
+# them that are filtered on the utterances.
+g_fix_files = ['utt2spk', 'spk2utt', 'feats.scp', 'text', 'segments',
+               'wav.scp', 'cmvn.scp', 'vad.scp', 'reco2file_and_channel',
+               'spk2gender', 'utt2lang', 'utt2uniq', 'utt2dur',
+               'utt2num_frames']
+g_fix_utt_files = ['utt2spk', 'utt2uniq', 'feats.scp', 'vad.scp', 'text',
+                   'segments', 'utt2lang', 'utt2dur', 'utt2num_frames']
+g_illegal_text_symbols = [b'<s>', b'</s>', b'#0']
+# The files whose lines have a fixed format (see _check_line()).
+g_formatted_files = ['utt2spk', 'segments', 'reco2file_and_channel',
+                     'spk2gender', 'spk2warp', 'utt2warp', 'utt2dur']
+# The number of examples of keys given when two lists of keys differ.
+g_num_examples = 3
+# The approximate size in bytes of the blocks of lines that are checked at
+# once.
+g_block_size = 1 << 22
+
+
+def _to_str(data):
+    return data if isinstance(data, str) else data.decode('utf-8', 'replace')
+
+
+def _is_number_in(field, lo, hi):
+    try:
+        return lo < float(field) < hi
+    except ValueError:
+        return False
+
+
+def _check_line(name, fields):
+    """ Returns None if the fields (bytes) of a line of the file 'name' are
+    well formed, 'warning' for a reco2file_and_channel line with channel 1,
+    and the reason why they are not otherwise. """
+    if name == 'utt2spk':
+        if len(fields) != 2:
+            return 'expected 2 fields'
+    elif name == 'segments':
+        if len(fields) != 4:
+            return 'expected 4 fields'
+        try:
+            if not float(fields[3]) > float(fields[2]):
+                return 'the end time is not after the start time'
+        except ValueError:
+            return 'bad times'
+    elif name == 'reco2file_and_channel':
+        if len(fields) != 3:
+            return 'expected 3 fields'
+        if fields[2] == b'1':
+            return 'warning'
+        if fields[2] not in (b'A', b'B'):
+            return 'the channel is not A or B'
+    elif name == 'spk2gender':
+        if len(fields) != 2 or fields[1] not in (b'm', b'f'):
+            return "expected '<speaker> m' or '<speaker> f'"
+    elif name in ('spk2warp', 'utt2warp'):
+        if len(fields) != 2 or not _is_number_in(fields[1], 0.5, 1.5):
+            return 'expected a warping factor between 0.5 and 1.5'
+    elif name == 'utt2dur':
+        if len(fields) != 2 or not _is_number_in(fields[1], 0.0,
+                                                 float('inf')):
+            return 'expected a duration greater than 0'
+    elif name == 'text':
+        for symbol in g_illegal_text_symbols:
+            if symbol in fields[1:]:
+                return 'illegal symbol {0}'.format(_to_str(symbol))
+    return None
+
+
+def _is_strictly_increasing(items):
+    return all(map(operator.lt, items, items[1:]))
+
+
+def _is_increasing(items):
+    return all(map(operator.le, items, items[1:]))
+
+
+def _floats(all_fields, i):
+    return list(map(float, [fields[i] for fields in all_fields]))
+
+
+def _is_well_formed(name, all_fields):
+    """ Returns true if all the lines (lists of fields) of a block of the file
+    'name' are well formed, checking them all at once; if it returns false,
+    they are checked one by one with _check_line(). """
+    num_fields = set(map(len, all_fields))
+    try:
+        if name == 'utt2spk':
+            return num_fields == set([2])
+        elif name == 'segments':
+            return (num_fields == set([4]) and
+                    all(map(operator.lt, _floats(all_fields, 2),
+                            _floats(all_fields, 3))))
+        elif name == 'reco2file_and_channel':
+            return (num_fields == set([3]) and
+                    set([fields[2] for fields in all_fields]) <=
+                    set([b'A', b'B']))
+        elif name == 'spk2gender':
+            return (num_fields == set([2]) and
+                    set([fields[1] for fields in all_fields]) <=
+                    set([b'm', b'f']))
+        elif name in ('spk2warp', 'utt2warp'):
+            return (num_fields == set([2]) and
+                    not [x for x in _floats(all_fields, 1)
+                         if not 0.5 < x < 1.5])
+        elif name == 'utt2dur':
+            if num_fields != set([2]):
+                return False
+            durations = _floats(all_fields, 1)
+            # the sum is NaN if a duration is.
+            total = math.fsum(durations)
+            return (total == total and min(durations) > 0.0 and
+                    max(durations) < float('inf'))
+    except ValueError:
+        return False
+    return True
+
+
+def _speaker_key(line, key):
+    """ Returns the key of the utt2spk line for sort -k2: the line from the
+    end of the first field, and the whole line for lines with the same
+    key. """
+    line = line.strip()
+    return (line[len(key):], line)
+
+
+def _check_speaker_order(lines, keys, all_fields, prev, stats):
+    """ Checks that the block of lines of utt2spk is sorted on the speaker
+    (like sort -k2), after the line whose speaker key is prev[1], and sets
+    stats['speaker_order_error'] to the first pair of lines out of order. """
+    if stats['speaker_order_error'] is not None:
+        return
+    # if the utterances are sorted and the lines are well formed, the lines
+    # are sorted like sort -k2 does if the speakers are.
+    if (stats['sorted'] and stats['num_duplicates'] == 0 and
+            set(map(len, all_fields)) == set([2])):
+        speakers = [fields[1] for fields in all_fields]
+        if prev[1] is not None:
+            speakers.insert(0, prev[1][0].strip())
+        if _is_increasing(speakers):
+            return
+    spk_keys = [_speaker_key(lines[i], keys[i]) for i in range(len(lines))]
+    prev_spk_key = prev[1]
+    for spk_key in spk_keys:
+        if prev_spk_key is not None and spk_key < prev_spk_key:
+            stats['speaker_order_error'] = (_to_str(prev_spk_key[1]),
+                                            _to_str(spk_key[1]))
+            return
+        prev_spk_key = spk_key
+
+
+def _scan_block(name, lines, prev, stats, digests, recordings):
+    """ Checks the block of lines (bytes) of the file 'name', updating stats,
+    the digests and the set of recordings (for segments).  'prev' is the
+    (key, speaker-key) of the last line of the previous block, and the one of
+    the last line of this block is returned.  The checks are done on the
+    whole block at once; the lines are only looked at one by one to describe
+    a problem. """
+    lines = [line for line in lines if not line.isspace()]
+    if len(lines) == 0:
+        return prev
+    all_fields = None
+    if name in g_formatted_files:
+        all_fields = [line.split() for line in lines]
+        keys = [fields[0] for fields in all_fields]
+    else:
+        keys = [line.split(None, 1)[0] for line in lines]
+    stats['num_keys'] += len(keys)
+    digests['keys'].update(b'\n'.join(keys) + b'\n')
+    if not _is_strictly_increasing(keys if prev[0] is None
+                                   else [prev[0]] + keys):
+        prev_key = prev[0]
+        for key in keys:
+            if prev_key is not None and key == prev_key:
+                stats['num_duplicates'] += 1
+                if stats['first_duplicate'] is None:
+                    stats['first_duplicate'] = _to_str(key)
+            elif prev_key is not None and key < prev_key:
+                stats['sorted'] = False
+                if stats['first_unsorted'] is None:
+                    stats['first_unsorted'] = (_to_str(prev_key),
+                                               _to_str(key))
+            prev_key = key
+    next_prev = (keys[-1], None)
+
+    if name == 'text':
+        # text is only checked for the illegal symbols; a quick test on the
+        # whole block first.
+        data = b''.join(lines)
+        if not [symbol for symbol in g_illegal_text_symbols
+                if symbol in data]:
+            return next_prev
+    elif name in g_formatted_files:
+        if name == 'utt2spk':
+            digests['pairs'].update(b''.join(
+                [b' '.join(fields[0:2]) + b'\n' for fields in all_fields]))
+            _check_speaker_order(lines, keys, all_fields, prev, stats)
+            next_prev = (keys[-1], _speaker_key(lines[-1], keys[-1]))
+        elif name == 'segments':
+            recordings.update([fields[1] for fields in all_fields
+                               if len(fields) > 1])
+        if _is_well_formed(name, all_fields):
+            return next_prev
+    else:
+        if name == 'spk2utt':
+            digests['pairs'].update(b''.join(
+                [b''.join([utt + b' ' + fields[0] + b'\n'
+                           for utt in fields[1:]])
+                 for fields in [line.split() for line in lines]]))
+        return next_prev
+
+    for i in range(len(lines)):
+        problem = _check_line(name, lines[i].split() if all_fields is None
+                              else all_fields[i])
+        if problem == 'warning':
+            stats['num_channel_1'] += 1
+        elif problem is not None:
+            stats['num_bad_lines'] += 1
+            if stats['first_bad_line'] is None:
+                stats['first_bad_line'] = '{0} ({1})'.format(
+                    _to_str(lines[i].strip()), problem)
+    return next_prev
+
+
+@contextlib.contextmanager
+def _gc_disabled():
+    """ Disables the garbage collector in the block: the files are read into
+    millions of small objects and no reference cycles, for which it would
+    only waste time. """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+def _scan_file(job):
+    """ Reads the file 'filename' (the file 'name' of a data directory) in one
+    pass, and returns a dict with its statistics, the problems found in it and
+    the digests of its lists of keys.  It is run in the worker processes, so
+    it only takes and returns picklable things. """
+    (filename, name) = job
+    stats = {'num_lines': 0, 'num_keys': 0, 'sorted': True,
+             'num_duplicates': 0, 'num_bad_lines': 0,
+             'first_unsorted': None, 'first_duplicate': None,
+             'first_bad_line': None, 'num_channel_1': 0,
+             'speaker_order_error': None}
+    # the digests of the keys and, for utt2spk and spk2utt, of the
+    # 'utt spk' pairs (those implied by spk2utt for spk2utt).
+    digests = {'keys': hashlib.md5(), 'pairs': hashlib.md5()}
+    recordings = set()
+    prev = (None, None)
+    with _gc_disabled():
+        with open(filename, 'rb') as f:
+            while True:
+                lines = f.readlines(g_block_size)
+                if len(lines) == 0:
+                    break
+                stats['num_lines'] += len(lines)
+                prev = _scan_block(name, lines, prev, stats, digests,
+                                   recordings)
+    stats['keys_digest'] = digests['keys'].hexdigest()
+    stats['pairs_digest'] = digests['pairs'].hexdigest()
+    if name == 'segments':
+        recordings_md5 = hashlib.md5()
+        recordings_md5.update(b''.join([recording + b'\n'
+                                        for recording in sorted(recordings)]))
+        stats['num_recordings'] = len(recordings)
+        stats['recordings_digest'] = recordings_md5.hexdigest()
+    return stats
+
+
+def _scan_files(jobs, num_jobs):
+    """ Runs _scan_file() on the list of (filename, name) 'jobs', in num_jobs
+    processes, and returns the list of the results. """
+    if num_jobs <= 1 or len(jobs) <= 1:
+        return [_scan_file(job) for job in jobs]
+    # the biggest files first, so that they do not finish last.
+    order = sorted(range(len(jobs)),
+                   key=lambda i: -os.path.getsize(jobs[i][0]))
+    pool = multiprocessing.Pool(min(num_jobs, len(jobs)))
+    try:
+        results = pool.map(_scan_file, [jobs[i] for i in order], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    ans = [None] * len(jobs)
+    for i in range(len(order)):
+        ans[order[i]] = results[i]
+    return ans
+
+
+def _read_keys(filename, field=0):
+    """ Returns the set of the values of the field 'field' of the lines of
+    the file. """
+    ans = set()
+    with _gc_disabled(), open(filename, 'rb') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > field:
+                ans.add(fields[field])
+    return ans
+
+
+def _describe_difference(data, name1, name2, field1=0, field2=0):
+    """ Returns a dict with the number of keys that are only in one of the
+    two files, with some examples, by reading their keys (only used when they
+    differ, to report it). """
+    keys1 = _read_keys(os.path.join(data, name1), field1)
+    keys2 = _read_keys(os.path.join(data, name2), field2)
+    only1 = sorted(keys1 - keys2)
+    only2 = sorted(keys2 - keys1)
+    return {'num_only_in_' + name1: len(only1),
+            'num_only_in_' + name2: len(only2),
+            'only_in_' + name1: [_to_str(x) for x in only1[:g_num_examples]],
+            'only_in_' + name2: [_to_str(x) for x in only2[:g_num_examples]]}
+
+
+def _add_issue(report, severity, name, check, message, details=None):
+    issue = {'file': name, 'check': check, 'message': message}
+    if details is not None:
+        issue['details'] = details
+    report['errors' if severity == 'error' else 'warnings'].append(issue)
+    if severity == 'error':
+        report['valid'] = False
+
+
+def validate_data_dir(data, no_feats=False, no_text=False, no_wav=False,
+                      num_jobs=4, describe_differences=True):
+    """ Validates the data directory 'data' like utils/validate_data_dir.sh
+    (with its options --no-feats, --no-text and --no-wav), reading the files
+    in num_jobs processes, and returns the report, a dict with the keys:
+        data: the directory;
+        valid: true if there are no errors;
+        errors, warnings: lists of dicts with the keys 'file', 'check' (one of
+            'missing', 'empty', 'sorted', 'format', 'speaker-order', 'keys',
+            'num-speakers' and 'channel'), 'message' and, for differences
+            between the keys of two files, 'details';
+        files: a dict from the name of each file that was read to its
+            statistics (num_lines, num_keys, sorted, num_duplicates,
+            num_bad_lines).
+    If describe_differences is false, the files whose keys differ are not read
+    again to give the 'details'.
+    Unlike utils/validate_data_dir.sh, it does not stop at the first error.
+    Problems with segments and utt2num_frames that the shell script does not
+    detect are reported as warnings. """
+    report = {'data': data, 'valid': True, 'errors': [], 'warnings': [],
+              'files': {}}
+    if not os.path.isdir(data):
+        _add_issue(report, 'error', None, 'missing',
+                   'no such directory {0}'.format(data))
+        return report
+    for name in ['spk2utt', 'utt2spk']:
+        filename = os.path.join(data, name)
+        if not os.path.isfile(filename):
+            _add_issue(report, 'error', name, 'missing',
+                       'no such file {0}'.format(filename))
+        elif os.path.getsize(filename) == 0:
+            _add_issue(report, 'error', name, 'empty',
+                       'empty file {0}'.format(filename))
+    if not report['valid']:
+        return report
+
+    def has(name):
+        return os.path.isfile(os.path.join(data, name))
+
+    for (name, option, required) in [('text', '--no-text', not no_text),
+                                     ('wav.scp', '--no-wav', not no_wav),
+                                     ('feats.scp', '--no-feats',
+                                      not no_feats)]:
+        if required and not has(name):
+            _add_issue(report, 'error', name, 'missing',
+                       'no such file {0} (if this is by design, specify '
+                       '{1})'.format(os.path.join(data, name), option))
+    if has('segments') and not has('wav.scp'):
+        _add_issue(report, 'error', 'segments', 'missing',
+                   'in directory {0}, segments file exists but no '
+                   'wav.scp'.format(data))
+
+    names = [name for (name, index) in g_checked_files if has(name)]
+    results = _scan_files([(os.path.join(data, name), name)
+                           for name in names], num_jobs)
+    stats = dict(zip(names, results))
+    # the files that are not sorted or have duplicates; their lists of keys
+    # are not compared with those of the other files.
+    unsorted = set()
+    for name in names:
+        s = stats[name]
+        report['files'][name] = dict([(k, s[k]) for k in [
+            'num_lines', 'num_keys', 'sorted', 'num_duplicates',
+            'num_bad_lines']])
+        if not s['sorted'] or s['num_duplicates'] > 0:
+            unsorted.add(name)
+            example = ('{0} follows {1}'.format(s['first_unsorted'][1],
+                                                s['first_unsorted'][0])
+                       if s['first_unsorted'] is not None else
+                       '{0} is repeated'.format(s['first_duplicate']))
+            _add_issue(report, 'warning' if name == 'utt2num_frames'
+                       else 'error', name, 'sorted',
+                       'file {0} is not in sorted order or has duplicates '
+                       '({1} duplicates; e.g. {2})'.format(
+                           os.path.join(data, name), s['num_duplicates'],
+                           example))
+        if s['num_bad_lines'] > 0:
+            _add_issue(report, 'error', name, 'format',
+                       'badly formatted {0} file: {1} bad lines, e.g. '
+                       '{2}'.format(name, s['num_bad_lines'],
+                                    s['first_bad_line']))
+        if s['num_channel_1'] > 0:
+            _add_issue(report, 'warning', name, 'channel',
+                       'The channel should be marked as A or B, not 1! You '
+                       'should change it ASAP!')
+
+    def compare_keys(name, reference, what, severity='error',
+                     digest='keys_digest', reference_digest='keys_digest',
+                     field=0):
+        if (name not in stats or reference not in stats or
+                name in unsorted or reference in unsorted):
+            return
+        if stats[name][digest] != stats[reference][reference_digest]:
+            _add_issue(report, severity, name, 'keys',
+                       'in {0}, {1} lists extracted from {2} and {3} '
+                       'differ'.format(data, what, reference, name),
+                       _describe_difference(data, reference, name,
+                                            field2=field)
+                       if describe_differences else None)
+
+    utt2spk = stats['utt2spk']
+    if utt2spk['speaker_order_error'] is not None:
+        _add_issue(report, 'error', 'utt2spk', 'speaker-order',
+                   'utt2spk is not in sorted order when sorted first on '
+                   'speaker-id (fix this by making speaker-ids prefixes of '
+                   'utt-ids); e.g. "{1}" follows "{0}"'.format(
+                       *utt2spk['speaker_order_error']))
+    if stats['spk2utt']['pairs_digest'] != utt2spk['pairs_digest']:
+        _add_issue(report, 'error', 'spk2utt', 'keys',
+                   'spk2utt and utt2spk do not seem to match')
+    if stats['spk2utt']['num_lines'] == 1:
+        _add_issue(report, 'warning', 'spk2utt', 'num-speakers',
+                   'you have only one speaker.  This probably a bad idea.')
+
+    for (name, index) in g_checked_files:
+        if name in ('utt2spk', 'spk2utt', 'segments'):
+            continue
+        if index == 'spk':
+            compare_keys(name, 'spk2utt', 'speaker')
+        elif index == 'utt' or not has('segments'):
+            compare_keys(name, 'utt2spk', 'utterance',
+                         'warning' if name in g_unchecked_files else 'error')
+    if has('segments') and has('wav.scp'):
+        compare_keys('segments', 'utt2spk', 'utterance', 'warning')
+        compare_keys('segments', 'wav.scp', 'recording',
+                     digest='recordings_digest', field=1)
+        compare_keys('segments', 'reco2file_and_channel', 'recording',
+                     digest='recordings_digest', field=1)
+    return report
+
+
+def format_report(report, program='validate_data_dir'):
+    """ Returns the errors and warnings of the report as lines of text, like
+    the messages of utils/validate_data_dir.sh. """
+    lines = []
+    for (severity, issues) in [('WARNING: ', report['warnings']),
+                               ('Error: ', report['errors'])]:
+        for issue in issues:
+            lines.append('{0}: {1}{2}'.format(program, severity,
+                                              issue['message']))
+            details = issue.get('details')
+            if details is not None:
+                for key in sorted(details.keys()):
+                    if key.startswith('only_in_') and details[key]:
+                        lines.append('{0}:    {1} keys only in {2}, e.g. '
+                                     '{3}'.format(
+                                         program, details['num_' + key],
+                                         key[len('only_in_'):],
+                                         ' '.join(details[key])))
+    return '\n'.join(lines)
+
+
+def _read_table(filename):
+    """ Returns a dict from each key of the file to its line (bytes, ending
+    with a newline), keeping the first line of each key, like sort -k1,1 -u.
+    """
+    with open(filename, 'rb') as f:
+        lines = [line for line in f if not line.isspace()]
+    if len(lines) > 0 and not lines[-1].endswith(b'\n'):
+        lines[-1] += b'\n'
+    keys = [line.split(None, 1)[0] for line in lines]
+    # the first line of a key is the last one assigned.
+    return dict(zip(reversed(keys), reversed(lines)))
+
+
+def _second_fields(table):
+    """ Returns a dict from each key of the table (as returned by
+    _read_table()) to the second field of its line (or None). """
+    ans = {}
+    for (key, line) in table.items():
+        fields = line.split(None, 2)
+        ans[key] = fields[1] if len(fields) > 1 else None
+    return ans
+
+
+def fix_data_dir(data, num_jobs=4):
+    """ Fixes the data directory 'data' like utils/fix_data_dir.sh (see the
+    module docstring), and returns the report of validate_data_dir() (with
+    --no-feats, --no-text and --no-wav) before the fix, with the list of the
+    changes made under the key 'changes'.  Raises an exception, without
+    changing the directory, for the problems that utils/fix_data_dir.sh does
+    not fix, e.g. if utt2spk is not sorted on the speaker or no utterances
+    would remain. """
+    if not os.path.isfile(os.path.join(data, 'utt2spk')):
+        raise Exception("no such file {0}".format(
+            os.path.join(data, 'utt2spk')))
+    report = validate_data_dir(data, no_feats=True, no_text=True, no_wav=True,
+                               num_jobs=num_jobs, describe_differences=False)
+    report['changes'] = []
+    # problems that need the files to be sorted or filtered.
+    if not [issue for issue in report['errors'] + report['warnings']
+            if issue['check'] in ('missing', 'empty', 'sorted', 'keys',
+                                  'speaker-order')]:
+        num_utts = report['files']['utt2spk']['num_keys']
+        logger.info("%s is consistent; kept all %d utterances.", data,
+                    num_utts)
+        return report
+    # the files that are already sorted, and that only need to be written if
+    # they are filtered.
+    sorted_files = set([name for (name, stats) in report['files'].items()
+                        if stats['sorted'] and stats['num_duplicates'] == 0])
+    if [issue for issue in report['errors']
+            if issue['check'] == 'speaker-order']:
+        sorted_files.discard('utt2spk')
+    with _gc_disabled():
+        _fix_data_dir(data, sorted_files, report['changes'])
+    return report
+
+
+def _fix_data_dir(data, sorted_files, changes):
+    """ Does the work of fix_data_dir(), appending the descriptions of the
+    changes to the list 'changes'; the files in the set 'sorted_files' are
+    known to be sorted and unique (and utt2spk to be sorted on the speaker,
+    if it is in it). """
+    tables = {}
+    for name in g_fix_files:
+        filename = os.path.join(data, name)
+        if os.path.isfile(filename):
+            tables[name] = _read_table(filename)
+    utt2spk = _second_fields(tables['utt2spk'])
+    utt2reco = (_second_fields(tables['segments']) if 'segments' in tables
+                else None)
+
+    # the tables that have to be written.
+    modified = set([name for name in tables if name not in sorted_files])
+
+    def filter_table(name, keys):
+        """ Keeps the lines of the table whose key is in the set 'keys'. """
+        if name not in tables or keys.issuperset(tables[name]):
+            return
+        table = tables[name]
+        new_table = dict([(key, table[key]) for key in table if key in keys])
+        if len(new_table) != len(table):
+            changes.append("filtered {0} from {1} to {2} lines".format(
+                name, len(table), len(new_table)))
+            tables[name] = new_table
+            modified.add(name)
+
+    def filter_recordings():
+        if 'segments' not in tables:
+            return
+        if 'wav.scp' not in tables:
+            raise Exception("{0}/segments exists but not {0}/wav.scp".format(
+                data))
+        recordings = set([utt2reco[utt] for utt in tables['segments']])
+        recordings.intersection_update(tables['wav.scp'].keys())
+        if len(recordings) == 0:
+            raise Exception("Empty list of recordings (bad file "
+                            "{0}/segments)?".format(data))
+        filter_table('segments', set([utt for utt in tables['segments']
+                                      if utt2reco[utt] in recordings]))
+        for name in ['wav.scp', 'reco2file_and_channel']:
+            filter_table(name, recordings)
+
+    def filter_speakers():
+        speakers = set([utt2spk[utt] for utt in tables['utt2spk']])
+        for name in ['cmvn.scp', 'spk2gender']:
+            if name in tables:
+                speakers.intersection_update(tables[name].keys())
+        filter_table('utt2spk', set([utt for utt in tables['utt2spk']
+                                     if utt2spk[utt] in speakers]))
+        for name in ['cmvn.scp', 'spk2gender']:
+            filter_table(name, speakers)
+
+    def filter_utts():
+        if 'utt2spk' not in sorted_files:
+            utts = sorted(tables['utt2spk'].keys())
+            stats = {'sorted': True, 'num_duplicates': 0,
+                     'speaker_order_error': None}
+            _check_speaker_order([tables['utt2spk'][utt] for utt in utts],
+                                 utts, [[utt, utt2spk[utt]] for utt in utts],
+                                 (None, None), stats)
+            if stats['speaker_order_error'] is not None:
+                raise Exception("utt2spk is not in sorted order when sorted "
+                                "first on speaker-id (fix this by making "
+                                "speaker-ids prefixes of utt-ids)")
+        utts = set(tables['utt2spk'].keys())
+        for name in (['feats.scp', 'text', 'segments', 'utt2lang'] +
+                     ([] if 'segments' in tables else ['wav.scp'])):
+            if name in tables:
+                utts.intersection_update(tables[name].keys())
+        if len(utts) == 0:
+            raise Exception("no utterances remained: not proceeding further.")
+        if len(utts) != len(tables['utt2spk']):
+            changes.append("kept {0} utterances out of {1}".format(
+                len(utts), len(tables['utt2spk'])))
+        for name in (g_fix_utt_files +
+                     ([] if 'segments' in tables else ['wav.scp'])):
+            filter_table(name, utts)
+
+    filter_recordings()
+    filter_speakers()
+    filter_utts()
+    filter_speakers()
+    filter_recordings()
+
+    # spk2utt is always derived from utt2spk, like utt2spk_to_spk2utt.pl does.
+    spk2utt = {}
+    speakers = []
+    for utt in sorted(tables['utt2spk'].keys()):
+        spk = utt2spk[utt]
+        if spk not in spk2utt:
+            spk2utt[spk] = []
+            speakers.append(spk)
+        spk2utt[spk].append(utt)
+    tables['spk2utt'] = dict([(spk, spk + b' ' + b' '.join(spk2utt[spk]) +
+                               b'\n') for spk in speakers])
+    modified.add('spk2utt')
+
+    backup_dir = os.path.join(data, '.backup')
+    for name in g_fix_files:
+        if name not in modified:
+            continue
+        filename = os.path.join(data, name)
+        content = b''.join([tables[name][key]
+                            for key in sorted(tables[name].keys())])
+        old_content = b''
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as f:
+                old_content = f.read()
+        if content == old_content:
+            continue
+        if not os.path.isdir(backup_dir):
+            os.makedirs(backup_dir)
+        if os.path.isfile(filename):
+            shutil.copyfile(filename, os.path.join(backup_dir, name))
+        tmp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            f.write(content)
+        os.rename(tmp_filename, filename)
+        changes.append("rewrote {0}".format(name))
+    if len(changes) == 0:
+        logger.info("%s needed no changes; kept all %d utterances.", data,
+                    len(tables['utt2spk']))
+    else:
+        logger.info("Fixed %s: %s; the old files are kept in %s", data,
+                    '; '.join(changes), backup_dir)
@@ -0,0 +1,386 @@
+# Apache 2.0.
+
+""" This module gets the durations of the recordings in a wav.scp, like the
+program wav-to-duration, but without reading the audio in most cases: the
+duration is computed from the RIFF/WAVE header of the file (or the header of
+the NIST SPHERE file for 'sph2pipe -f wav <file> |').
+
+The entries of the wav.scp can be wav files or commands ending in '|'.  A
+simple pipeline of 'cat <file>', 'sph2pipe -f wav <file>' and sox commands
+that only convert the format (i.e. that have no effects, like 'speed') is
+followed to the file at its start, whose header gives the duration; other
+commands are run, and the duration is taken from the header of their output,
+or, if read_entire_file is true (needed for commands that change the
+duration, e.g. sox with 'speed', whose header is wrong), by reading their
+entire output.  For a wav file, as for wav-to-duration --read-entire-file,
+the header still gives the duration unless its data size is missing (0 or
+0xFFFFFFFF, as written for a stream), in which case the duration is given
+by the size of the file; read_entire_file only means that the duration of a
+truncated file is that of the data present in it.
+
+The headers are read by a pool of threads, and can be cached in a file,
+which stores for each file its size and modification time, so that the
+headers of the files that have not changed since are not read again.
+
+e.g.
+    durations = wav_duration.get_durations(
+        [('utt1', 'data/wav/utt1.wav'), ('utt2', 'cat data/utt2.wav |')],
+        cache_file='data/train/.wav_duration_cache')
+    print(durations)   # e.g. [('utt1', 2.41), ('utt2', 3.2)]
+"""
+
+import logging
+import os
+import shlex
+import struct
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+# The options of sox that take a value.
+g_sox_options_with_value = set([
+    '-t', '--type', '-r', '--rate', '-b', '--bits', '-c', '--channels',
+    '-e', '--encoding', '-v', '--volume', '-C', '--compression',
+    '--buffer', '--input-buffer'])
+
+
+class _AudioInfo(object):
+    """ The information about an audio file that the duration is computed
+    from.
+
+    Attributes:
+        sampling_rate: the sampling rate
+        header_samples: the number of samples according to the header, or
+            None if the header does not give it (e.g. if it was written to
+            a pipe)
+        file_samples: the number of samples of the data present in the file,
+            or None if it is not known (i.e. for the output of a command)
+    """
+    __slots__ = ['sampling_rate', 'header_samples', 'file_samples']
+
+    def __init__(self, sampling_rate, header_samples, file_samples):
+        self.sampling_rate = sampling_rate
+        self.header_samples = header_samples
+        self.file_samples = file_samples
+
+    def num_samples(self, read_entire_file):
+        if self.header_samples is None:
+            return self.file_samples
+        if read_entire_file and self.file_samples is not None:
+            # any chunks after the data (e.g. LIST) are not audio, so the
+            # file only gives the duration if it is shorter than the header
+            # says.
+            return min(self.header_samples, self.file_samples)
+        return self.header_samples
+
+
+def _read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("unexpected end of file in the wav header")
+    return data
+
+
+def _read_wav_header(f):
+    """ Reads the RIFF/WAVE header from the file object f, up to the start
+    of the data, and returns (sampling-rate, block-align, data-size), where
+    data-size is None if the header does not give it.  Raises ValueError if
+    it is not a valid wav header. """
+    (riff, riff_size, wave) = struct.unpack('<4sI4s', _read_exactly(f, 12))
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise ValueError("not a RIFF/WAVE file")
+    sampling_rate = None
+    while True:
+        (chunk_id, chunk_size) = struct.unpack('<4sI', _read_exactly(f, 8))
+        if chunk_id == b'data':
+            if sampling_rate is None:
+                raise ValueError("no 'fmt ' chunk before the data")
+            # sizes of 0 and 0xFFFFFFFF are written when the size is not
+            # known, e.g. when writing to a pipe.
+            if chunk_size == 0 or chunk_size == 0xFFFFFFFF:
+                chunk_size = None
+            return (sampling_rate, block_align, chunk_size)
+        data = _read_exactly(f, chunk_size + (chunk_size & 1))
+        if chunk_id == b'fmt ':
+            if chunk_size < 16:
+                raise ValueError("'fmt ' chunk is too small")
+            (audio_format, num_channels, sampling_rate, byte_rate,
+             block_align, bits_per_sample) = struct.unpack('<HHIIHH',
+                                                           data[:16])
+            if block_align == 0:
+                raise ValueError("block-align is zero in the wav header")
+
+
+def _get_wav_file_info(path):
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        (sampling_rate, block_align, data_size) = _read_wav_header(f)
+        data_offset = f.tell()
+    file_samples = (file_size - data_offset) // block_align
+    header_samples = (None if data_size is None
+                      else data_size // block_align)
+    return _AudioInfo(sampling_rate, header_samples, file_samples)
+
+
+def _get_sphere_file_info(path):
+    """ Reads the header of a NIST SPHERE file. """
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b'NIST_1A':
+            raise ValueError("not a NIST SPHERE file")
+        header_size = int(f.readline().strip())
+        header = f.read(header_size)
+    sampling_rate = None
+    num_samples = None
+    for line in header.split(b'\n'):
+        a = line.split()
+        if len(a) == 3 and a[0] == b'sample_rate':
+            sampling_rate = int(a[2])
+        elif len(a) == 3 and a[0] == b'sample_count':
+            num_samples = int(a[2])
+        elif len(a) > 0 and a[0] == b'end_head':
+            break
+    if sampling_rate is None or num_samples is None:
+        raise ValueError("could not parse the SPHERE header")
+    return _AudioInfo(sampling_rate, num_samples, num_samples)
+
+
+def _parse_sox_command(args):
+    """ Parses the arguments of a sox command (after 'sox'), and returns
+    (input, output-sampling-rate or None), or None if the command has
+    effects or does not write to the standard output. """
+    positional = []
+    out_rate = None
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in g_sox_options_with_value:
+            if i + 1 >= len(args):
+                return None
+            if arg in ['-r', '--rate'] and len(positional) == 1:
+                # a rate given after the input is that of the output.
+                try:
+                    rate = args[i + 1].lower()
+                    out_rate = int(float(rate[:-1]) * 1000
+                                   if rate.endswith('k') else float(rate))
+                except ValueError:
+                    return None
+            i += 2
+        elif arg.startswith('-') and arg != '-':
+            i += 1
+        else:
+            positional.append(arg)
+            i += 1
+    # anything after the output is an effect.
+    if len(positional) != 2 or positional[1] != '-':
+        return None
+    return (positional[0], out_rate)
+
+
+def _follow_pipeline(rspecifier):
+    """ Returns (path, file-type, output-sampling-rate or None) for an
+    rspecifier that is a wav file or a pipeline whose output has the
+    duration of a file at its start; file-type is 'wav' or 'sph'.  Returns
+    None for other pipelines. """
+    rspecifier = rspecifier.strip()
+    if not rspecifier.endswith('|'):
+        return (rspecifier, 'wav', None)
+    try:
+        commands = [shlex.split(command)
+                    for command in rspecifier[:-1].split('|')]
+    except ValueError:
+        return None
+    path = None
+    file_type = None
+    out_rate = None
+    for command in commands:
+        if len(command) == 0:
+            return None
+        program = os.path.basename(command[0])
+        source = None
+        if program == 'cat' and len(command) <= 2:
+            source = command[1] if len(command) == 2 else '-'
+        elif (program == 'sph2pipe' and len(command) >= 4 and
+              command[1:3] == ['-f', 'wav'] and
+              all([arg in ['-p', '-c', '1', '2'] for arg in command[3:-1]])):
+            source = command[-1]
+            file_type = 'sph'
+        elif program == 'sox':
+            parsed = _parse_sox_command(command[1:])
+            if parsed is None:
+                return None
+            (source, rate) = parsed
+            if rate is not None:
+                out_rate = rate
+        else:
+            return None
+        if path is None:
+            if source == '-':
+                return None
+            path = source
+            if file_type is None:
+                file_type = 'wav'
+        elif source != '-':
+            return None
+    return (path, file_type, out_rate)
+
+
+def _get_command_info(command, read_entire_file):
+    """ Runs the command (an rspecifier ending in '|') and returns the
+    _AudioInfo of its output. """
+    p = subprocess.Popen(command.strip()[:-1], shell=True,
+                         stdout=subprocess.PIPE)
+    try:
+        (sampling_rate, block_align, data_size) = _read_wav_header(p.stdout)
+        if data_size is not None and not read_entire_file:
+            return _AudioInfo(sampling_rate, data_size // block_align, None)
+        num_bytes = 0
+        while True:
+            data = p.stdout.read(1 << 16)
+            if len(data) == 0:
+                break
+            num_bytes += len(data)
+        if p.wait() != 0:
+            raise ValueError("command exited with status {0}".format(
+                p.returncode))
+        return _AudioInfo(sampling_rate, None, num_bytes // block_align)
+    finally:
+        p.stdout.close()
+        if p.poll() is None:
+            # we don't need the rest of the output.
+            p.kill()
+        p.wait()
+
+
+class DurationCache(object):
+    """ An on-disk cache of the information about audio files read from
+    their headers, keyed by the absolute path of the file, which is valid
+    as long as the size and the modification time of the file do not
+    change.  The cache file has one line per file:
+        <size> <mtime> <sampling-rate> <header-samples> <file-samples> <path>
+    with '-' for a number of samples that is not known.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.entries = dict()
+        self.dirty = False
+        try:
+            with open(cache_file) as f:
+                for line in f:
+                    a = line.rstrip('\n').split(' ', 5)
+                    if len(a) != 6:
+                        continue
+                    self.entries[a[5]] = (
+                        int(a[0]), a[1], _AudioInfo(
+                            int(a[2]), None if a[3] == '-' else int(a[3]),
+                            None if a[4] == '-' else int(a[4])))
+        except (IOError, OSError, ValueError):
+            # the cache does not exist or is corrupted; it will be rebuilt.
+            self.entries = dict()
+
+    def get(self, path, get_info):
+        """ Returns the _AudioInfo of the file 'path', from the cache if
+        the file has not changed, and otherwise from get_info(path). """
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        mtime = repr(stat.st_mtime)
+        entry = self.entries.get(key)
+        if (entry is not None and entry[0] == stat.st_size and
+                entry[1] == mtime):
+            return entry[2]
+        info = get_info(path)
+        self.entries[key] = (stat.st_size, mtime, info)
+        self.dirty = True
+        return info
+
+    def save(self):
+        """ Writes the cache file if it has changed. """
+        if not self.dirty:
+            return
+        tmp_file = '{0}.{1}.tmp'.format(self.cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                for key in sorted(self.entries.keys()):
+                    (size, mtime, info) = self.entries[key]
+                    f.write('{0} {1} {2} {3} {4} {5}\n'.format(
+                        size, mtime, info.sampling_rate,
+                        '-' if info.header_samples is None
+                        else info.header_samples,
+                        '-' if info.file_samples is None
+                        else info.file_samples, key))
+            # rename is atomic, so that a concurrent reader never sees a
+            # partially written cache.
+            os.rename(tmp_file, self.cache_file)
+            self.dirty = False
+        except (IOError, OSError) as e:
+            logger.warning("Could not write the duration cache %s: %s",
+                           self.cache_file, str(e))
+
+
+def get_duration(rspecifier, read_entire_file=False, cache=None):
+    """ Returns the duration in seconds of the recording 'rspecifier' (a
+    wav file or a command ending in '|', as in a wav.scp), using the
+    DurationCache 'cache' if it is not None.  Raises an exception (e.g.
+    IOError or ValueError) if it fails. """
+    followed = _follow_pipeline(rspecifier)
+    if followed is None:
+        info = _get_command_info(rspecifier, read_entire_file)
+        return float(info.num_samples(read_entire_file)) / info.sampling_rate
+    (path, file_type, out_rate) = followed
+    get_info = (_get_sphere_file_info if file_type == 'sph'
+                else _get_wav_file_info)
+    try:
+        info = get_info(path) if cache is None else cache.get(path, get_info)
+    except ValueError:
+        if not rspecifier.strip().endswith('|'):
+            raise
+        # e.g. 'sox in.flac -t wav - |': the file is not in the format
+        # expected, so the command is run.
+        info = _get_command_info(rspecifier, read_entire_file)
+        return float(info.num_samples(read_entire_file)) / info.sampling_rate
+    num_samples = info.num_samples(read_entire_file)
+    if out_rate is not None and out_rate != info.sampling_rate:
+        # sox resamples to out_rate.
+        return (float(int(num_samples * float(out_rate) /
+                          info.sampling_rate + 0.5)) / out_rate)
+    return float(num_samples) / info.sampling_rate
+
+
+def get_durations(wav_scp, read_entire_file=False, num_threads=8,
+                  cache_file=None):
+    """ Returns the list of (recording-id, duration) for the list of
+    (recording-id, rspecifier) 'wav_scp', in the same order.  The recordings
+    whose duration cannot be obtained are left out, with a warning.  If
+    cache_file is not None, it is used as the DurationCache. """
+    cache = None if cache_file is None else DurationCache(cache_file)
+
+    def get(entry):
+        try:
+            return get_duration(entry[1], read_entire_file, cache)
+        except Exception as e:
+            logger.warning("Could not get the duration of %s (%s): %s",
+                           entry[0], entry[1], str(e))
+            return None
+
+    if num_threads > 1 and len(wav_scp) > 1:
+        pool = ThreadPool(num_threads)
+        try:
+            durations = pool.map(get, wav_scp, chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        durations = [get(entry) for entry in wav_scp]
+    if cache is not None:
+        cache.save()
+    return [(wav_scp[i][0], durations[i]) for i in range(len(wav_scp))
+            if durations[i] is not None]
+
+
+def format_duration(duration):
+    """ Returns the duration as it is printed by wav-to-duration (i.e. with 6
+    significant digits). """
+    return '{0:g}'.format(duration)
@@ -6,6 +6,8 @@
 
 import argparse
 import errno
+import hashlib
+import json
 import logging
 import os
 import re
@@ -69,6 +71,24 @@ def get_args():
                         help="""List of space separated
                         <output-node>:<objective-type> entities,
                         one for each output node""")
+    parser.add_argument("--incremental", type=str, default=False,
+                        action=common_lib.StrToBoolAction,
+                        choices=["true", "false"],
+                        help="""If true, a figure is plotted only if its
+                        data has changed since the last run with the same
+                        output directory (or if the figure does not exist),
+                        and the latex report is compiled only if some figure
+                        has changed. This makes it cheap to regenerate the
+                        report periodically while training.""")
+    parser.add_argument("--data-feed", type=str, default=True,
+                        action=common_lib.StrToBoolAction,
+                        choices=["true", "false"],
+                        help="""If true, the per-iteration stats of the
+                        experiment directory (objectives, accuracies,
+                        training time, non-linearity stats, clipped
+                        proportions and parameter differences) are written to
+                        <output-dir>/training_stats.json and
+                        <output-dir>/training_stats.csv""")
     parser.add_argument("exp_dir", nargs='+',
                         help="the first dir is the experiment directory, "
                         "e.g. exp/nnet3/tdnn, the rest dirs (if exist) "
@@ -121,16 +141,28 @@ class LatexReport:
 """
         self.document.append(fig_latex)
 
-    def close(self):
+    def close(self, force_compile=True):
+        """Writes the latex file and compiles it. If force_compile is False,
+        the report is compiled only if the latex file has changed or the pdf
+        does not exist."""
         self.document.append("\end{document}")
-        return self.compile()
+        return self.compile(force_compile)
 
-    def compile(self):
+    def compile(self, force_compile=True):
         root, ext = os.path.splitext(self.pdf_file)
         dir_name = os.path.dirname(self.pdf_file)
         latex_file = root + ".tex"
+        document = "\n".join(self.document)
+        if not force_compile and os.path.exists(self.pdf_file):
+            try:
+                if open(latex_file).read() == document:
+                    logger.info("The latex report has not changed, not "
+                                "compiling it.")
+                    return True
+            except IOError:
+                pass
         lat_file = open(latex_file, "w")
-        lat_file.write("\n".join(self.document))
+        lat_file.write(document)
         lat_file.close()
         logger.info("Compiling the latex report.")
         try:
@@ -144,6 +176,93 @@ class LatexReport:
         return True
 
 
+class PlotCache:
+    """Class that keeps a signature of the data that each figure was plotted
+    from, so that in the incremental mode only the figures whose data has
+    changed are plotted again. The signatures are stored in
+    <output-dir>/plot_cache.json.
+
+    Attributes:
+        cache_file: The file that the signatures are stored in
+        incremental: If False, every figure is considered to be out of date
+        signatures: A dict from figure file name to the signature of its data
+        num_plotted: The number of figures that were out of date
+    """
+
+    def __init__(self, output_dir, incremental=False):
+        self.cache_file = "{0}/plot_cache.json".format(output_dir)
+        self.incremental = incremental
+        self.signatures = {}
+        self.num_plotted = 0
+        if incremental:
+            try:
+                with open(self.cache_file) as f:
+                    self.signatures = json.load(f)
+            except (IOError, ValueError):
+                pass
+
+    @staticmethod
+    def get_signature(data):
+        """Returns a signature of data, which is any json-serializable
+        object, e.g. lists of the rows of the tables that are plotted."""
+        return hashlib.md5(json.dumps(data, sort_keys=True).encode(
+            'utf-8')).hexdigest()
+
+    def needs_plot(self, figfile_name, data):
+        """Returns True if the figure figfile_name needs to be plotted from
+        data; in that case the figure is assumed to be plotted and the new
+        signature is recorded."""
+        signature = self.get_signature(data)
+        if (self.incremental and os.path.exists(figfile_name)
+                and self.signatures.get(figfile_name) == signature):
+            return False
+        self.signatures[figfile_name] = signature
+        self.num_plotted += 1
+        return True
+
+    def save(self):
+        with open(self.cache_file, "w") as f:
+            json.dump(self.signatures, f)
+
+
+def _write_data_feed(data_feed, output_dir):
+    """Writes the per-iteration stats collected in data_feed by the
+    generate_*_plots functions to <output-dir>/training_stats.json, and in
+    a long format with one value per line
+    <iteration>,<category>,<name>,<value> to
+    <output-dir>/training_stats.csv."""
+    with open("{0}/training_stats.json".format(output_dir), "w") as f:
+        json.dump(data_feed, f, sort_keys=True)
+
+    rows = []
+    for iter, time in data_feed.get('train_time', {}).items():
+        rows.append((iter, 'train_time', '', time))
+    for name, table in data_feed.get('objectives', {}).items():
+        for iter, train_value, valid_value in table:
+            rows.append((iter, 'objective', name + ':train', train_value))
+            rows.append((iter, 'objective', name + ':valid', valid_value))
+    for component, stats in data_feed.get('nonlin_stats', {}).items():
+        for row in stats['rows']:
+            for column, value in zip(stats['columns'][1:], row[1:]):
+                rows.append((row[0], 'nonlin_stats',
+                             "{0}:{1}".format(component, column), value))
+    for component, table in data_feed.get('clipped_proportion', {}).items():
+        for iter, value in table:
+            rows.append((iter, 'clipped_proportion', component, value))
+    for diff_type, diffs in data_feed.get('parameter_differences',
+                                          {}).items():
+        category = re.sub(" ", "_", diff_type.lower())
+        for component, values in diffs.items():
+            for iter, value in values.items():
+                rows.append((iter, category, component, value))
+    rows.sort(key=lambda x: (int(x[0]), x[1], x[2]))
+
+    with open("{0}/training_stats.csv".format(output_dir), "w") as f:
+        f.write("iteration,category,name,value\n")
+        for row in rows:
+            f.write("{0},{1},{2},{3}\n".format(*row))
+
+
 def latex_compliant_name(name_string):
     """this function is required as latex does not allow all the component names
     allowed by nnet3.
@@ -157,55 +276,63 @@ def latex_compliant_name(name_string):
 
 def generate_acc_logprob_plots(exp_dir, output_dir, plot, key='accuracy',
         file_basename='accuracy', comparison_dir=None,
-        start_iter=1, latex_report=None, output_name='output'):
+        start_iter=1, latex_report=None, output_name='output',
+        plot_cache=None, data_feed=None):
 
     assert start_iter >= 1
 
-    if plot:
-        fig = plt.figure()
-        plots = []
-
     comparison_dir = [] if comparison_dir is None else comparison_dir
     dirs = [exp_dir] + comparison_dir
-    index = 0
-    for dir in dirs:
+    data_per_dir = []
+    for index, dir in enumerate(dirs):
         [report, times, data] = log_parse.generate_acc_logprob_report(dir, key,
                 output_name)
+        data = [list(x) for x in data]
         if index == 0:
             # this is the main experiment directory
             with open("{0}/{1}.log".format(output_dir,
                                            file_basename), "w") as f:
                 f.write(report)
+            if data_feed is not None:
+                data_feed.setdefault('objectives', {})[
+                    "{0}:{1}".format(output_name, key)] = data
+                data_feed['train_time'] = times
+
+        if plot and len(data) == 0:
+            logger.warning("Couldn't find any rows for the"
+                           "accuracy/log-probability plot, not generating it")
+            return
+        data_per_dir.append(data)
 
-        if plot:
-            color_val = g_plot_colors[index]
-            data = np.array(data)
-            if data.shape[0] == 0:
-                logger.warning("Couldn't find any rows for the"
-                               "accuracy/log-probability plot, not generating it")
-                return
-            data = data[data[:, 0] >= start_iter, :]
-            plot_handle, = plt.plot(data[:, 0], data[:, 1], color=color_val,
-                                    linestyle="--",
-                                    label="train {0}".format(dir))
-            plots.append(plot_handle)
-            plot_handle, = plt.plot(data[:, 0], data[:, 2], color=color_val,
-                                    label="valid {0}".format(dir))
-            plots.append(plot_handle)
-        index += 1
     if plot:
-        plt.xlabel('Iteration')
-        plt.ylabel(key)
-        lgd = plt.legend(handles=plots, loc='lower center',
-                         bbox_to_anchor=(0.5, -0.2 + len(dirs) * -0.1),
-                         ncol=1, borderaxespad=0.)
-        plt.grid(True)
-        fig.suptitle("{0} plot for {1}".format(key, output_name))
         figfile_name = '{0}/{1}_{2}.pdf'.format(
             output_dir, file_basename,
             latex_compliant_name(output_name))
-        plt.savefig(figfile_name, bbox_extra_artists=(lgd,),
-                    bbox_inches='tight')
+        if plot_cache is None or plot_cache.needs_plot(
+                figfile_name, [dirs, start_iter, data_per_dir]):
+            fig = plt.figure()
+            plots = []
+            for index, dir in enumerate(dirs):
+                color_val = g_plot_colors[index]
+                data = np.array(data_per_dir[index])
+                data = data[data[:, 0] >= start_iter, :]
+                plot_handle, = plt.plot(data[:, 0], data[:, 1],
+                                        color=color_val, linestyle="--",
+                                        label="train {0}".format(dir))
+                plots.append(plot_handle)
+                plot_handle, = plt.plot(data[:, 0], data[:, 2],
+                                        color=color_val,
+                                        label="valid {0}".format(dir))
+                plots.append(plot_handle)
+            plt.xlabel('Iteration')
+            plt.ylabel(key)
+            lgd = plt.legend(handles=plots, loc='lower center',
+                             bbox_to_anchor=(0.5, -0.2 + len(dirs) * -0.1),
+                             ncol=1, borderaxespad=0.)
+            plt.grid(True)
+            fig.suptitle("{0} plot for {1}".format(key, output_name))
+            plt.savefig(figfile_name, bbox_extra_artists=(lgd,),
+                        bbox_inches='tight')
         if latex_report is not None:
             latex_report.add_figure(
                 figfile_name,
@@ -295,7 +422,8 @@ def plot_a_nonlin_component(fig, dirs, stat_tables_per_component_per_dir,
 # 4) Plot the "Per-dimension average-(value, derivative) percentiles" figure 
 #    for each nonlinearity component.
 def generate_nonlin_stats_plots(exp_dir, output_dir, plot, comparison_dir=None,
-                                start_iter=1, latex_report=None):
+                                start_iter=1, latex_report=None,
+                                plot_cache=None, data_feed=None):
     assert start_iter >= 1
 
     comparison_dir = [] if comparison_dir is None else comparison_dir
@@ -330,6 +458,24 @@ def generate_nonlin_stats_plots(exp_dir, output_dir, plot, comparison_dir=None,
         stat_tables_per_component_per_dir[dir] = stat_tables_per_component
 
     main_stat_tables = stat_tables_per_component_per_dir[exp_dir]
+    if data_feed is not None:
+        data_feed['nonlin_stats'] = {}
+        stat_names = ["ValueMean", "ValueStddev", "DerivMean", "DerivStddev",
+                      "Value_5th", "Value_50th", "Value_95th",
+                      "Deriv_5th", "Deriv_50th", "Deriv_95th"]
+        for component_name in main_stat_tables.keys():
+            component_type = stats_per_dir[exp_dir][component_name]['type']
+            if component_type == 'LstmNonlinearity':
+                # the stats of the five gates are concatenated in each row
+                columns = ["{0}_{1}".format(gate, stat_name)
+                           for gate in g_lstm_gate
+                           for stat_name in stat_names]
+            else:
+                columns = stat_names
+            data_feed['nonlin_stats'][component_name] = {
+                'type': component_type,
+                'columns': ["Iteration"] + columns,
+                'rows': main_stat_tables[component_name]}
     for component_name in main_stat_tables.keys():
         # this is the main experiment directory
         with open("{dir}/nonlinstats_{comp_name}.log".format(
@@ -367,19 +513,25 @@ def generate_nonlin_stats_plots(exp_dir, output_dir, plot, comparison_dir=None,
         common_prefix = common_prefix[0:prefix_length]
         
         for component_name in main_component_names:
+            # the data that the plots of this component are generated from
+            plot_data = [dirs, start_iter,
+                         [stat_tables_per_component_per_dir[dir].get(
+                             component_name) for dir in dirs]]
             if stats_per_dir[exp_dir][component_name]['type'] == 'LstmNonlinearity':
                 for i in range(0,5):
                     component_type = 'Lstm-' + g_lstm_gate[i]
-                    lgd = plot_a_nonlin_component(fig, dirs,
-                            stat_tables_per_component_per_dir, component_name,
-                            common_prefix, prefix_length, component_type, start_iter, i)
-                    fig.suptitle("Per-dimension average-(value, derivative) percentiles for "
-                         "{component_name}-{gate}".format(component_name=component_name, gate=g_lstm_gate[i]))
                     comp_name = latex_compliant_name(component_name)
                     figfile_name = '{dir}/nonlinstats_{comp_name}_{gate}.pdf'.format(
                         dir=output_dir, comp_name=comp_name, gate=g_lstm_gate[i])
-                    fig.savefig(figfile_name, bbox_extra_artists=(lgd,),
-                        bbox_inches='tight')
+                    if plot_cache is None or plot_cache.needs_plot(
+                            figfile_name, plot_data):
+                        lgd = plot_a_nonlin_component(fig, dirs,
+                                stat_tables_per_component_per_dir, component_name,
+                                common_prefix, prefix_length, component_type, start_iter, i)
+                        fig.suptitle("Per-dimension average-(value, derivative) percentiles for "
+                             "{component_name}-{gate}".format(component_name=component_name, gate=g_lstm_gate[i]))
+                        fig.savefig(figfile_name, bbox_extra_artists=(lgd,),
+                            bbox_inches='tight')
                     if latex_report is not None:
                         latex_report.add_figure(
                         figfile_name,
@@ -387,16 +539,18 @@ def generate_nonlin_stats_plots(exp_dir, output_dir, plot, comparison_dir=None,
                         "{0}-{1}".format(component_name, g_lstm_gate[i]))
             else:
                 component_type = stats_per_dir[exp_dir][component_name]['type']
-                lgd = plot_a_nonlin_component(fig, dirs,
-                        stat_tables_per_component_per_dir,component_name,
-                        common_prefix, prefix_length, component_type, start_iter, 0)
-                fig.suptitle("Per-dimension average-(value, derivative) percentiles for "
-                         "{component_name}".format(component_name=component_name))
                 comp_name = latex_compliant_name(component_name)
                 figfile_name = '{dir}/nonlinstats_{comp_name}.pdf'.format(
                     dir=output_dir, comp_name=comp_name)
-                fig.savefig(figfile_name, bbox_extra_artists=(lgd,),
-                        bbox_inches='tight')
+                if plot_cache is None or plot_cache.needs_plot(
+                        figfile_name, plot_data):
+                    lgd = plot_a_nonlin_component(fig, dirs,
+                            stat_tables_per_component_per_dir,component_name,
+                            common_prefix, prefix_length, component_type, start_iter, 0)
+                    fig.suptitle("Per-dimension average-(value, derivative) percentiles for "
+                             "{component_name}".format(component_name=component_name))
+                    fig.savefig(figfile_name, bbox_extra_artists=(lgd,),
+                            bbox_inches='tight')
                 if latex_report is not None:
                     latex_report.add_figure(
                     figfile_name,
@@ -407,7 +561,8 @@ def generate_nonlin_stats_plots(exp_dir, output_dir, plot, comparison_dir=None,
 
 def generate_clipped_proportion_plots(exp_dir, output_dir, plot,
                                       comparison_dir=None, start_iter=1,
-                                      latex_report=None):
+                                      latex_report=None, plot_cache=None,
+                                      data_feed=None):
     assert(start_iter >= 1)
 
     comparison_dir = [] if comparison_dir is None else comparison_dir
@@ -444,6 +599,10 @@ def generate_clipped_proportion_plots(exp_dir, output_dir, plot,
     file.write(iter_stat_report)
     file.close()
 
+    if data_feed is not None:
+        data_feed['clipped_proportion'] = (
+            stats_per_dir[exp_dir]['cp_per_iter_per_component'])
+
     if plot:
         main_component_names = (
             stats_per_dir[exp_dir]['cp_per_iter_per_component'].keys())
@@ -468,6 +627,20 @@ def generate_clipped_proportion_plots(exp_dir, output_dir, plot,
 
         fig = plt.figure()
         for component_name in main_component_names:
+            comp_name = latex_compliant_name(component_name)
+            figfile_name = '{dir}/clipped_proportion_{comp_name}.pdf'.format(
+                dir=output_dir, comp_name=comp_name)
+            plot_data = [dirs, start_iter,
+                         [stats_per_dir[dir]['cp_per_iter_per_component'].get(
+                             component_name) if dir in stats_per_dir else None
+                          for dir in dirs]]
+            if plot_cache is not None and not plot_cache.needs_plot(
+                    figfile_name, plot_data):
+                if latex_report is not None:
+                    latex_report.add_figure(
+                        figfile_name,
+                        "Clipped proportion at {0}".format(component_name))
+                continue
             fig.clf()
             index = 0
             plots = []
@@ -497,9 +670,6 @@ def generate_clipped_proportion_plots(exp_dir, output_dir, plot,
             plt.grid(True)
             fig.suptitle("Clipped-proportion value at {comp_name}".format(
                             comp_name=component_name))
-            comp_name = latex_compliant_name(component_name)
-            figfile_name = '{dir}/clipped_proportion_{comp_name}.pdf'.format(
-                dir=output_dir, comp_name=comp_name)
             fig.savefig(figfile_name, bbox_extra_artists=(lgd,),
                         bbox_inches='tight')
             if latex_report is not None:
@@ -510,7 +680,8 @@ def generate_clipped_proportion_plots(exp_dir, output_dir, plot,
 
 def generate_parameter_diff_plots(exp_dir, output_dir, plot,
                                   comparison_dir=None, start_iter=1,
-                                  latex_report=None):
+                                  latex_report=None, plot_cache=None,
+                                  data_feed=None):
     # Parameter changes
     assert start_iter >= 1
 
@@ -527,6 +698,12 @@ def generate_parameter_diff_plots(exp_dir, output_dir, plot,
             stats_per_dir[dir][key] = (
                 log_parse.parse_progress_logs_for_param_diff(dir, key))
 
+    if data_feed is not None:
+        data_feed['parameter_differences'] = {}
+        for diff_type in key_file:
+            data_feed['parameter_differences'][diff_type] = (
+                stats_per_dir[exp_dir][diff_type]['progress_per_component'])
+
     # write down the stats for the main experiment directory
     for diff_type in key_file:
         with open("{0}/{1}".format(output_dir, key_file[diff_type]), "w") as f:
@@ -592,6 +769,23 @@ def generate_parameter_diff_plots(exp_dir, output_dir, plot,
                         ', '.join(main_component_names)))
 
         for component_name in main_component_names:
+            comp_name = latex_compliant_name(component_name)
+            figfile_name = '{dir}/param_diff_{comp_name}.pdf'.format(
+                dir=output_dir, comp_name=comp_name)
+            plot_data = [dirs, start_iter,
+                         [[sorted(stats_per_dir[dir][diff_type][
+                             'progress_per_component'].get(
+                                 component_name, {}).items())
+                           for diff_type in ['Parameter differences',
+                                             'Relative parameter differences']]
+                          for dir in dirs]]
+            if plot_cache is not None and not plot_cache.needs_plot(
+                    figfile_name, plot_data):
+                if latex_report is not None:
+                    latex_report.add_figure(
+                        figfile_name,
+                        "Parameter differences at {0}".format(component_name))
+                continue
             fig.clf()
             index = 0
             plots = []
@@ -640,9 +834,6 @@ def generate_parameter_diff_plots(exp_dir, output_dir, plot,
             plt.grid(True)
             fig.suptitle("Parameter differences at {comp_name}".format(
                 comp_name=component_name))
-            comp_name = latex_compliant_name(component_name)
-            figfile_name = '{dir}/param_diff_{comp_name}.pdf'.format(
-                dir=output_dir, comp_name=comp_name)
             fig.savefig(figfile_name, bbox_extra_artists=(lgd,),
                         bbox_inches='tight')
             if latex_report is not None:
@@ -652,7 +843,7 @@ def generate_parameter_diff_plots(exp_dir, output_dir, plot,
 
 
 def generate_plots(exp_dir, output_dir, output_names, comparison_dir=None,
-                   start_iter=1):
+                   start_iter=1, incremental=False, write_data_feed=True):
     try:
         os.makedirs(output_dir)
     except OSError as e:
@@ -662,8 +853,11 @@ def generate_plots(exp_dir, output_dir, output_names, comparison_dir=None,
             raise e
     if g_plot:
         latex_report = LatexReport("{0}/report.pdf".format(output_dir))
+        plot_cache = PlotCache(output_dir, incremental)
     else:
         latex_report = None
+        plot_cache = None
+    data_feed = {} if write_data_feed else None
 
     for (output_name, objective_type) in output_names:
         if objective_type == "linear":
@@ -672,46 +866,59 @@ def generate_plots(exp_dir, output_dir, output_names, comparison_dir=None,
                 exp_dir, output_dir, g_plot, key='accuracy',
                 file_basename='accuracy', comparison_dir=comparison_dir,
                 start_iter=start_iter,
-                latex_report=latex_report, output_name=output_name)
+                latex_report=latex_report, output_name=output_name,
+                plot_cache=plot_cache, data_feed=data_feed)
 
             logger.info("Generating log-likelihood plots")
             generate_acc_logprob_plots(
                 exp_dir, output_dir, g_plot, key='log-likelihood',
                 file_basename='loglikelihood', comparison_dir=comparison_dir,
                 start_iter=start_iter,
-                latex_report=latex_report, output_name=output_name)
+                latex_report=latex_report, output_name=output_name,
+                plot_cache=plot_cache, data_feed=data_feed)
         elif objective_type == "chain":
             logger.info("Generating log-probability plots")
             generate_acc_logprob_plots(
                 exp_dir, output_dir, g_plot,
                 key='log-probability', file_basename='log_probability',
                 comparison_dir=comparison_dir, start_iter=start_iter,
-                latex_report=latex_report, output_name=output_name)
+                latex_report=latex_report, output_name=output_name,
+                plot_cache=plot_cache, data_feed=data_feed)
         else:
             logger.info("Generating " + objective_type + " objective plots")
             generate_acc_logprob_plots(
                 exp_dir, output_dir, g_plot, key='objective',
                 file_basename='objective', comparison_dir=comparison_dir,
                 start_iter=start_iter,
-                latex_report=latex_report, output_name=output_name)
+                latex_report=latex_report, output_name=output_name,
+                plot_cache=plot_cache, data_feed=data_feed)
 
     logger.info("Generating non-linearity stats plots")
     generate_nonlin_stats_plots(
         exp_dir, output_dir, g_plot, comparison_dir=comparison_dir,
-        start_iter=start_iter, latex_report=latex_report)
+        start_iter=start_iter, latex_report=latex_report,
+        plot_cache=plot_cache, data_feed=data_feed)
 
     logger.info("Generating clipped-proportion plots")
     generate_clipped_proportion_plots(
         exp_dir, output_dir, g_plot, comparison_dir=comparison_dir,
-        start_iter=start_iter, latex_report=latex_report)
+        start_iter=start_iter, latex_report=latex_report,
+        plot_cache=plot_cache, data_feed=data_feed)
 
     logger.info("Generating parameter difference plots")
     generate_parameter_diff_plots(
         exp_dir, output_dir, g_plot, comparison_dir=comparison_dir,
-        start_iter=start_iter, latex_report=latex_report)
+        start_iter=start_iter, latex_report=latex_report,
+        plot_cache=plot_cache, data_feed=data_feed)
+
+    if data_feed is not None:
+        logger.info("Writing the training stats")
+        _write_data_feed(data_feed, output_dir)
 
     if g_plot and latex_report is not None:
-        has_compiled = latex_report.close()
+        plot_cache.save()
+        has_compiled = latex_report.close(
+            force_compile=(not incremental or plot_cache.num_plotted > 0))
         if has_compiled:
             logger.info("Report has been generated. "
                         "You can find it at the location "
@@ -737,15 +944,21 @@ def main():
     if args.comparison_dir is not None:
       generate_plots(args.exp_dir[0], args.output_dir, output_nodes,
                      comparison_dir=args.comparison_dir,
-                     start_iter=args.start_iter)
+                     start_iter=args.start_iter,
+                     incremental=args.incremental,
+                     write_data_feed=args.data_feed)
     else:
       if len(args.exp_dir) == 1:
         generate_plots(args.exp_dir[0], args.output_dir, output_nodes,
-                       start_iter=args.start_iter)
+                       start_iter=args.start_iter,
+                       incremental=args.incremental,
+                       write_data_feed=args.data_feed)
       if len(args.exp_dir) > 1:
         generate_plots(args.exp_dir[0], args.output_dir, output_nodes,
                        comparison_dir=args.exp_dir[1:],
-                       start_iter=args.start_iter)
+                       start_iter=args.start_iter,
+                       incremental=args.incremental,
+                       write_data_feed=args.data_feed)
 
 
 if __name__ == "__main__":
@@ -140,6 +140,8 @@ def process_args(args):
         run_opts.prior_queue_opt = ""
 
     run_opts.command = args.command
+    run_opts.max_parallel_train_jobs = args.max_parallel_train_jobs
+    run_opts.num_train_job_retries = args.num_train_job_retries
     run_opts.egs_command = (args.egs_command
                             if args.egs_command is not None else
                             args.command)
@@ -408,7 +410,8 @@ def main():
     [args, run_opts] = get_args()
     try:
         background_process_handler = common_lib.BackgroundProcessHandler(
-            polling_time=args.background_polling_time)
+            polling_time=args.background_polling_time,
+            max_running_processes=args.max_background_jobs)
         train(args, run_opts, background_process_handler)
         background_process_handler.ensure_processes_are_done()
     except Exception as e:
@@ -62,36 +62,15 @@ fi
 mkdir -p $dir/scoring_kaldi
 cat $data/text | $ref_filtering_cmd > $dir/scoring_kaldi/test_filt.txt || exit 1;
 if [ $stage -le 0 ]; then
-
-  for wip in $(echo $word_ins_penalty | sed 's/,/ /g'); do
-    mkdir -p $dir/scoring_kaldi/penalty_$wip/log
-
-    if $decode_mbr ; then
-      $cmd LMWT=$min_lmwt:$max_lmwt $dir/scoring_kaldi/penalty_$wip/log/best_path.LMWT.log \
-        acwt=\`perl -e \"print 1.0/LMWT\"\`\; \
-        lattice-scale --inv-acoustic-scale=LMWT "ark:gunzip -c $dir/lat.*.gz|" ark:- \| \
-        lattice-add-penalty --word-ins-penalty=$wip ark:- ark:- \| \
-        lattice-prune --beam=$beam ark:- ark:- \| \
-        lattice-mbr-decode  --word-symbol-table=$symtab \
-        ark:- ark,t:- \| \
-        utils/int2sym.pl -f 2- $symtab \| \
-        $hyp_filtering_cmd '>' $dir/scoring_kaldi/penalty_$wip/LMWT.txt || exit 1;
-
-    else
-      $cmd LMWT=$min_lmwt:$max_lmwt $dir/scoring_kaldi/penalty_$wip/log/best_path.LMWT.log \
-        lattice-scale --inv-acoustic-scale=LMWT "ark:gunzip -c $dir/lat.*.gz|" ark:- \| \
-        lattice-add-penalty --word-ins-penalty=$wip ark:- ark:- \| \
-        lattice-best-path --word-symbol-table=$symtab ark:- ark,t:- \| \
-        utils/int2sym.pl -f 2- $symtab \| \
-        $hyp_filtering_cmd '>' $dir/scoring_kaldi/penalty_$wip/LMWT.txt || exit 1;
-    fi
-
-    $cmd LMWT=$min_lmwt:$max_lmwt $dir/scoring_kaldi/penalty_$wip/log/score.LMWT.log \
-      cat $dir/scoring_kaldi/penalty_$wip/LMWT.txt \| \
-      compute-wer --text --mode=present \
-      ark:$dir/scoring_kaldi/test_filt.txt  ark,p:- ">&" $dir/wer_LMWT_$wip || exit 1;
-
-  done
+  # this gets the hypotheses of each LM-weight and penalty into
+  # $dir/scoring_kaldi/penalty_$wip/LMWT.txt and their WER into
+  # $dir/wer_LMWT_$wip, and skips those whose inputs did not change since
+  # the last time.
+  steps/scoring/score_sweep.py --cmd "$cmd" --decode-mbr $decode_mbr \
+    --beam $beam --word-ins-penalty $word_ins_penalty \
+    --min-lmwt $min_lmwt --max-lmwt $max_lmwt \
+    --hyp-filter "$hyp_filtering_cmd" --mode present \
+    $dir/scoring_kaldi/test_filt.txt $lang_or_graph $dir || exit 1;
 fi
 
 
@@ -119,16 +98,13 @@ if [ $stage -le 1 ]; then
     echo $best_lmwt > $dir/scoring_kaldi/wer_details/lmwt # record best language model weight
     echo $best_wip > $dir/scoring_kaldi/wer_details/wip # record best word insertion penalty
 
+    # this writes the per_utt, per_spk and ops files of wer_details, as
+    # align-text | utils/scoring/wer_per_utt_details.pl and
+    # utils/scoring/wer_{per_spk,ops}_details.pl would.
     $cmd $dir/scoring_kaldi/log/stats1.log \
-      cat $dir/scoring_kaldi/penalty_$best_wip/$best_lmwt.txt \| \
-      align-text --special-symbol="'***'" ark:$dir/scoring_kaldi/test_filt.txt ark:- ark,t:- \|  \
-      utils/scoring/wer_per_utt_details.pl --special-symbol "'***'" \| tee $dir/scoring_kaldi/wer_details/per_utt \|\
-       utils/scoring/wer_per_spk_details.pl $data/utt2spk \> $dir/scoring_kaldi/wer_details/per_spk || exit 1;
-
-    $cmd $dir/scoring_kaldi/log/stats2.log \
-      cat $dir/scoring_kaldi/wer_details/per_utt \| \
-      utils/scoring/wer_ops_details.pl --special-symbol "'***'" \| \
-      sort -b -i -k 1,1 -k 4,4rn -k 2,2 -k 3,3 \> $dir/scoring_kaldi/wer_details/ops || exit 1;
+      utils/scoring/compute_wer.py --mode=present --special-symbol="'***'" \
+        --utt2spk=$data/utt2spk --details-dir=$dir/scoring_kaldi/wer_details \
+        $dir/scoring_kaldi/test_filt.txt $dir/scoring_kaldi/penalty_$best_wip/$best_lmwt.txt || exit 1;
 
     $cmd $dir/scoring_kaldi/log/wer_bootci.log \
       compute-wer-bootci --mode=present \
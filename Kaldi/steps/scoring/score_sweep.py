@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+# Apache 2.0.
+
+from __future__ import print_function
+import sys
+import argparse
+import glob
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+
+sys.path.insert(0, 'steps')
+import libs.common as common_lib
+import libs.scoring as scoring_lib
+
+logger = logging.getLogger('libs')
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter("{0}: %(message)s".format(sys.argv[0])))
+logger.addHandler(handler)
+
+parser = argparse.ArgumentParser(description="""
+This script does stage 0 of steps/scoring/score_kaldi_wer.sh: for each
+LM-weight and word insertion penalty, it gets the best-path (or, with
+--decode-mbr=true, the MBR) hypotheses of the lattices of a decoding
+directory into <decode-dir>/scoring_kaldi/penalty_<wip>/<lmwt>.txt and their
+WER into <decode-dir>/wer_<lmwt>_<wip>.  Unlike the shell script, it
+remembers (in <decode-dir>/scoring_kaldi/.sweep_cache) the inputs from
+which each of them was computed, and only computes again those whose inputs
+changed (the lattices, the symbol table and the options for the hypotheses;
+the reference and the hypotheses for the WER).  The hypotheses of all the
+penalties are extracted by concurrent jobs, and all the WERs are computed
+in one process, that integer-encodes the reference once and aligns each
+distinct pair of reference and hypothesis only once (see
+steps/libs/scoring.py).
+It has to be run from the top-level (e.g. egs/.../s5) directory, as the
+scripts are.
+e.g.: steps/scoring/score_sweep.py --cmd run.pl --word-ins-penalty 0.0,0.5,1.0 \\
+        --min-lmwt 7 --max-lmwt 17 exp/tri3/decode/scoring_kaldi/test_filt.txt \\
+        exp/tri3/graph exp/tri3/decode
+""")
+
+parser.add_argument('--cmd', type = str, default = 'run.pl',
+                    help = 'Command that runs the jobs that extract the '
+                    'hypotheses, e.g. run.pl or queue.pl.')
+parser.add_argument('--decode-mbr', type = str, default = 'false',
+                    choices = ['true', 'false'],
+                    help = 'If true, use minimum Bayes risk decoding '
+                    '(confusion networks) instead of the best path.')
+parser.add_argument('--beam', type = float, default = 6.0,
+                    help = 'Pruning beam of the lattices, with '
+                    '--decode-mbr=true.')
+parser.add_argument('--word-ins-penalty', type = str, default = '0.0,0.5,1.0',
+                    help = 'Comma-separated list of word insertion '
+                    'penalties.')
+parser.add_argument('--min-lmwt', type = int, default = 7,
+                    help = 'Minimum LM-weight.')
+parser.add_argument('--max-lmwt', type = int, default = 17,
+                    help = 'Maximum LM-weight.')
+parser.add_argument('--hyp-filter', type = str, default = 'cat',
+                    help = 'Command that filters the hypotheses, e.g. '
+                    'local/wer_hyp_filter.')
+parser.add_argument('--max-running-jobs', type = int, default = 0,
+                    help = 'Maximum number of extraction jobs (one per '
+                    'penalty and range of LM-weights) that run at the same '
+                    'time; 0 for no limit.')
+parser.add_argument('--num-jobs', type = int, default = 1,
+                    help = 'Number of processes that align the utterances.')
+parser.add_argument('--mode', type = str, default = 'present',
+                    choices = ['present', 'all', 'strict'],
+                    help = 'Scoring mode, as for compute-wer.')
+parser.add_argument('ref', type = str,
+                    help = 'The (filtered) reference text, e.g. '
+                    '<decode-dir>/scoring_kaldi/test_filt.txt.')
+parser.add_argument('lang_or_graph', type = str,
+                    help = 'The lang or graph directory, for words.txt.')
+parser.add_argument('dir', type = str, help = 'The decoding directory.')
+
+args = parser.parse_args()
+
+scoring_dir = os.path.join(args.dir, 'scoring_kaldi')
+cache_file = os.path.join(scoring_dir, '.sweep_cache')
+symtab = os.path.join(args.lang_or_graph, 'words.txt')
+
+
+def file_stamp(filename):
+    stat = os.stat(filename)
+    return '{0} {1} {2!r}'.format(filename, stat.st_size, stat.st_mtime)
+
+
+def file_digest(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(1 << 20)
+            if len(block) == 0:
+                break
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def read_cache():
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if isinstance(cache, dict):
+            return cache
+    except (IOError, OSError, ValueError):
+        pass
+    return {}
+
+
+def write_cache(cache):
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump(cache, f, indent = 1, sort_keys = True,
+                  separators = (',', ': '))
+    os.rename(cache_file + '.tmp', cache_file)
+
+
+def is_empty_gzip(filename):
+    with gzip.open(filename, 'rb') as f:
+        return len(f.read(1)) == 0
+
+
+def hyp_file(lmwt, wip):
+    return os.path.join(scoring_dir, 'penalty_' + wip,
+                        '{0}.txt'.format(lmwt))
+
+
+def wer_file(lmwt, wip):
+    return os.path.join(args.dir, 'wer_{0}_{1}'.format(lmwt, wip))
+
+
+def extraction_command(wip, min_lmwt, max_lmwt):
+    """ Returns the command that writes the hypotheses of the penalty wip for
+    the LM-weights min_lmwt to max_lmwt, as score_kaldi_wer.sh does. """
+    penalty_dir = os.path.join(scoring_dir, 'penalty_' + wip)
+    if args.decode_mbr == 'true':
+        decode = ("lattice-prune --beam={0} ark:- ark:- \\| "
+                  "lattice-mbr-decode --word-symbol-table={1} "
+                  "ark:- ark,t:- \\| ".format(args.beam, symtab))
+    else:
+        decode = ("lattice-best-path --word-symbol-table={0} "
+                  "ark:- ark,t:- \\| ".format(symtab))
+    return ("{cmd} LMWT={min_lmwt}:{max_lmwt} "
+            "{penalty_dir}/log/best_path.LMWT.log "
+            "lattice-scale --inv-acoustic-scale=LMWT "
+            "\"ark:gunzip -c {dir}/lat.*.gz|\" ark:- \\| "
+            "lattice-add-penalty --word-ins-penalty={wip} ark:- ark:- \\| "
+            "{decode}utils/int2sym.pl -f 2- {symtab} \\| "
+            "{hyp_filter} '>' {penalty_dir}/LMWT.txt".format(
+                cmd=args.cmd, min_lmwt=min_lmwt, max_lmwt=max_lmwt,
+                penalty_dir=penalty_dir, dir=args.dir, wip=wip,
+                decode=decode, symtab=symtab, hyp_filter=args.hyp_filter))
+
+
+def extract_hypotheses(keys, cache):
+    """ Extracts the hypotheses of the (lmwt, wip) pairs in keys whose
+    inputs changed since they were last extracted, and records the new
+    inputs in the cache. """
+    lattices = sorted(glob.glob(os.path.join(args.dir, 'lat.*.gz')))
+    if len(lattices) == 0:
+        raise Exception("No lattices {0}/lat.*.gz".format(args.dir))
+    inputs = hashlib.md5('\n'.join(
+        [file_stamp(symtab)] + [file_stamp(x) for x in lattices] +
+        ['decode-mbr={0} beam={1} hyp-filter={2}'.format(
+            args.decode_mbr, args.beam, args.hyp_filter)]).encode(
+                'utf-8')).hexdigest()
+    extracted = cache.setdefault('extracted', {})
+
+    def is_up_to_date(lmwt, wip):
+        entry = extracted.get('{0}_{1}'.format(lmwt, wip))
+        filename = hyp_file(lmwt, wip)
+        return (entry is not None and entry['inputs'] == inputs and
+                os.path.exists(filename) and
+                entry['output'] == file_stamp(filename))
+
+    # a job for each penalty and range of consecutive LM-weights to do.
+    jobs = []
+    for wip in sorted(set([wip for (lmwt, wip) in keys])):
+        lmwts = sorted([lmwt for (lmwt, w) in keys
+                        if w == wip and not is_up_to_date(lmwt, w)])
+        for lmwt in lmwts:
+            if len(jobs) > 0 and jobs[-1][0] == wip and \
+                    jobs[-1][2] == lmwt - 1:
+                jobs[-1][2] = lmwt
+            else:
+                jobs.append([wip, lmwt, lmwt])
+    num_todo = sum([max_lmwt - min_lmwt + 1
+                    for (wip, min_lmwt, max_lmwt) in jobs])
+    logger.info("Extracting the hypotheses of %d of the %d LM-weights and "
+                "penalties (%d jobs)", num_todo, len(keys), len(jobs))
+    if len(jobs) == 0:
+        return
+
+    scheduler = common_lib.JobScheduler(
+        max_running_jobs=args.max_running_jobs)
+    commands = []
+    for (wip, min_lmwt, max_lmwt) in jobs:
+        log_dir = os.path.join(scoring_dir, 'penalty_' + wip, 'log')
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        commands.append(extraction_command(wip, min_lmwt, max_lmwt))
+        scheduler.add_job(commands[-1])
+    try:
+        scheduler.run()
+    finally:
+        # record the jobs that finished, even if another one failed.
+        done = set([command for (command, wall_time, num_attempts)
+                    in scheduler.job_timings])
+        # The pipeline of a job is run without pipefail, so a job whose
+        # decoding failed still succeeds, with empty hypotheses; these are
+        # not recorded, so that they are extracted again on the next run.
+        lattices_empty = None
+        for ((wip, min_lmwt, max_lmwt), command) in zip(jobs, commands):
+            if command not in done:
+                continue
+            for lmwt in range(min_lmwt, max_lmwt + 1):
+                filename = hyp_file(lmwt, wip)
+                if not os.path.exists(filename):
+                    continue
+                if os.path.getsize(filename) == 0:
+                    if lattices_empty is None:
+                        lattices_empty = all([is_empty_gzip(x)
+                                              for x in lattices])
+                    if not lattices_empty:
+                        logger.warning(
+                            "The hypotheses %s are empty although the "
+                            "lattices are not; see the log in %s",
+                            filename, os.path.join(os.path.dirname(filename),
+                                                   'log'))
+                        extracted.pop('{0}_{1}'.format(lmwt, wip), None)
+                        continue
+                extracted['{0}_{1}'.format(lmwt, wip)] = {
+                    'inputs': inputs,
+                    'output': file_stamp(filename)}
+        write_cache(cache)
+
+
+def score_hypotheses(keys, cache):
+    """ Computes the WER of the (lmwt, wip) pairs in keys whose reference or
+    hypotheses changed since it was last computed, and writes the files
+    wer_<lmwt>_<wip>. """
+    ref_digest = file_digest(args.ref)
+    scored = cache.setdefault('scored', {})
+    todo = {}
+    for (lmwt, wip) in keys:
+        key = '{0}_{1}'.format(lmwt, wip)
+        inputs = '{0} {1} mode={2}'.format(
+            ref_digest, file_stamp(hyp_file(lmwt, wip)), args.mode)
+        entry = scored.get(key)
+        if (entry is None or entry['inputs'] != inputs or
+                not os.path.exists(wer_file(lmwt, wip))):
+            todo[(lmwt, wip)] = inputs
+    logger.info("Scoring the hypotheses of %d of the %d LM-weights and "
+                "penalties", len(todo), len(keys))
+    if len(todo) == 0:
+        return
+
+    ref_index = scoring_lib.ReferenceIndex(scoring_lib.read_text(args.ref))
+    # the integer hypotheses of each (lmwt, wip).
+    hyps_by_key = dict([((lmwt, wip), ref_index.encode(
+        scoring_lib.read_text(hyp_file(lmwt, wip))))
+                        for (lmwt, wip) in todo])
+    results = ref_index.score_many(hyps_by_key, mode = args.mode,
+                                   num_jobs = args.num_jobs)
+    for (lmwt, wip) in sorted(todo.keys()):
+        with io.open(wer_file(lmwt, wip), 'w', encoding='utf-8') as f:
+            f.write(u'{0}'.format(results[(lmwt, wip)].summary()))
+        scored['{0}_{1}'.format(lmwt, wip)] = {
+            'inputs': todo[(lmwt, wip)],
+            'summary': results[(lmwt, wip)].summary()}
+    write_cache(cache)
+
+
+def main():
+    wips = [wip for wip in args.word_ins_penalty.split(',') if wip != '']
+    keys = [(lmwt, wip) for wip in wips
+            for lmwt in range(args.min_lmwt, args.max_lmwt + 1)]
+    if len(keys) == 0:
+        sys.exit("{0}: no LM-weights or penalties to score".format(
+            sys.argv[0]))
+    if not os.path.isdir(scoring_dir):
+        os.makedirs(scoring_dir)
+    cache = read_cache()
+    try:
+        extract_hypotheses(keys, cache)
+        score_hypotheses(keys, cache)
+    except Exception as e:
+        logger.error("Scoring failed: %s", str(e))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -66,11 +66,7 @@ elif [ -f $data/wav.scp ]; then
      } ' > $data/utt2dur; then
     echo "$0: successfully obtained utterance lengths from sphere-file headers"
   else
-    echo "$0: could not get utterance lengths from sphere-file headers, using wav-to-duration"
-    if ! command -v wav-to-duration >/dev/null; then
-      echo  "$0: wav-to-duration is not on your path"
-      exit 1;
-    fi
+    echo "$0: could not get utterance lengths from sphere-file headers, using utils/data/wav_to_duration.py"
 
     read_entire_file=false
     if cat $data/wav.scp | grep -q 'sox.*speed'; then
@@ -80,10 +76,23 @@ elif [ -f $data/wav.scp ]; then
       echo "... perturb_data_dir_speed_3way.sh."
     fi
 
-    if ! wav-to-duration --read-entire-file=$read_entire_file scp:$data/wav.scp ark,t:$data/utt2dur 2>&1 | grep -v 'nonzero return status'; then
-      echo "$0: there was a problem getting the durations; moving $data/utt2dur to $data/.backup/"
-      mkdir -p $data/.backup/
-      mv $data/utt2dur $data/.backup/
+    # utils/data/wav_to_duration.py reads the wav headers in-process, following
+    # the pipes of cat, sph2pipe and sox, instead of running every command of
+    # the wav.scp; wav-to-duration is used if it fails.
+    if utils/data/wav_to_duration.py --read-entire-file=$read_entire_file \
+         --cache=$data/.wav_duration_cache $data/wav.scp $data/utt2dur; then
+      echo "$0: successfully obtained utterance lengths from the wav files"
+    else
+      echo "$0: utils/data/wav_to_duration.py failed, using wav-to-duration"
+      if ! command -v wav-to-duration >/dev/null; then
+        echo  "$0: wav-to-duration is not on your path"
+        exit 1;
+      fi
+      if ! wav-to-duration --read-entire-file=$read_entire_file scp:$data/wav.scp ark,t:$data/utt2dur 2>&1 | grep -v 'nonzero return status'; then
+        echo "$0: there was a problem getting the durations; moving $data/utt2dur to $data/.backup/"
+        mkdir -p $data/.backup/
+        mv $data/utt2dur $data/.backup/
+      fi
     fi
   fi
 elif [ -f $data/feats.scp ]; then
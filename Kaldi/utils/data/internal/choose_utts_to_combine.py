@@ -11,6 +11,9 @@ import sys
 import os
 from collections import defaultdict
 
+sys.path.insert(0, 'steps')
+import libs.data_dir as data_dir_lib
+
 
 parser = argparse.ArgumentParser(description="""
 This script, called from data/utils/combine_short_segments.sh, chooses consecutive
@@ -86,10 +89,14 @@ def CombineList(min_duration, durations):
 
     num_utts = len(durations)
 
-    # for each utterance-index i, group_start[i] gives us the
-    # start-index of the group of utterances of which it's currently
-    # a member.
-    group_start = range(num_utts)
+    # Each group of utterances is a range of utterance-indexes; the groups
+    # form a doubly linked list through the group_end and group_start arrays
+    # below, which are only updated at the boundaries of the groups, so that
+    # merging two groups takes constant time.
+    #
+    # is_group_start[i] is True if utterance-index i is currently the start of
+    # a group of utterances.
+    is_group_start = [ True ] * num_utts
     # if utterance-index i currently corresponds to the start of a group
     # of utterances, then group_durations[i] is the total duration of
     # that utterance-group, otherwise undefined.
@@ -98,12 +105,16 @@ def CombineList(min_duration, durations):
     # of utterances, then group_end[i] is the end-index (i.e. last index plus one
     # of that utterance-group, otherwise undefined.
     group_end = [ x + 1 for x in range(num_utts) ]
+    # if utterance-index i currently corresponds to the last utterance of a
+    # group of utterances, then group_start[i] is the start-index of that
+    # utterance-group, otherwise undefined.
+    group_start = list(range(num_utts))
 
     queue = [ i for i in range(num_utts) if LessThan(group_durations[i], min_duration) ]
 
     while len(queue) > 0:
         i = queue.pop()
-        if group_start[i] != i or not LessThan(group_durations[i], min_duration):
+        if not is_group_start[i] or not LessThan(group_durations[i], min_duration):
             # this group no longer exists or already has at least the minimum duration.
             continue
         this_dur = group_durations[i]
@@ -117,7 +128,7 @@ def CombineList(min_duration, durations):
 
         if left_dur == 0.0 and right_dur == 0.0:
             # there is only one group.  Nothing more to merge; break
-            assert group_start[i] == 0 and group_end[i] == num_utts
+            assert i == 0 and group_end[i] == num_utts
             break
         # work out whether to combine left or right,
         # by means of the combine_left variable [ True or False ]
@@ -150,10 +161,11 @@ def CombineList(min_duration, durations):
         if combine_left:
             assert left_dur != 0.0
             new_group_start = group_start[i-1]
-            group_end[new_group_start] = group_end[i]
-            for j in range(group_start[i], group_end[i]):
-                group_start[j] = new_group_start
-                group_durations[new_group_start] += durations[j]
+            new_group_end = group_end[i]
+            group_end[new_group_start] = new_group_end
+            group_start[new_group_end - 1] = new_group_start
+            group_durations[new_group_start] += this_dur
+            is_group_start[i] = False
             # note: there is no need to add group_durations[new_group_start] to
             # the queue even if it is still below the minimum length, because it
             # would have previously had to have been below the minimum length,
@@ -164,9 +176,9 @@ def CombineList(min_duration, durations):
             old_group_end = group_end[i]
             new_group_end = group_end[old_group_end]
             group_end[i] = new_group_end
-            for j in range(old_group_end, new_group_end):
-                group_durations[i] += durations[j]
-                group_start[j] = i
+            group_start[new_group_end - 1] = i
+            group_durations[i] += right_dur
+            is_group_start[old_group_end] = False
             if LessThan(group_durations[i], min_duration):
                 # the group starting at i is still below the minimum length, so
                 # we need to put it back on the queue.
@@ -285,43 +297,30 @@ spk2utt = []
 # utt2spk is a dict from speaker-id to utternace-id.
 utt2spk = dict()
 try:
-    f = open(args.spk2utt_in)
-except:
-    sys.exit("choose_utts_to_combine.py: error opening --spk2utt={0}".format(args.spk2utt_in))
-while True:
-    line = f.readline()
-    if line == '':
-        break
-    a = line.split()
-    if len(a) < 2:
-        sys.exit("choose_utts_to_combine.py: bad line in spk2utt file: " + line)
-    spk = a[0]
-    utts = a[1:]
-    spk2utt.append((spk, utts))
-    for utt in utts:
-        if utt in utt2spk:
-            sys.exit("choose_utts_to_combine.py: utterance {0} is listed more than once"
-                     "in the spk2utt file {1}".format(utt, args.spk2utt_in))
-        utt2spk[utt] = spk
-f.close()
+    for spk, utts in data_dir_lib.TableFile(args.spk2utt_in).items():
+        utts = utts.split()
+        if len(utts) == 0:
+            sys.exit("choose_utts_to_combine.py: bad line in spk2utt file: " + spk)
+        spk2utt.append((spk, utts))
+        for utt in utts:
+            if utt in utt2spk:
+                sys.exit("choose_utts_to_combine.py: utterance {0} is listed more than once"
+                         "in the spk2utt file {1}".format(utt, args.spk2utt_in))
+            utt2spk[utt] = spk
+except (IOError, OSError) as e:
+    sys.exit("choose_utts_to_combine.py: error reading --spk2utt={0}: {1}".format(
+            args.spk2utt_in, str(e)))
 
 # utt2dur is a dict from utterance-id (as a string) to duration in seconds (as a float)
-utt2dur = dict()
 try:
-    f = open(args.utt2dur_in)
-except:
-    sys.exit("choose_utts_to_combine.py: error opening utt2dur file {0}".format(args.utt2dur_in))
-while True:
-    line = f.readline()
-    if line == '':
-        break
-    try:
-        [ utt, dur ] = line.split()
-        dur = float(dur)
-        utt2dur[utt] = dur
-    except:
-        sys.exit("choose_utts_to_combine.py: bad line in utt2dur file {0}: {1}".format(
-                args.utt2dur_in, line))
+    utt2dur = data_dir_lib.TableFile(args.utt2dur_in).to_dict(
+        value_processor = lambda x: float(x[0]), num_fields = 2)
+except (IOError, OSError) as e:
+    sys.exit("choose_utts_to_combine.py: error opening utt2dur file {0}: {1}".format(
+            args.utt2dur_in, str(e)))
+except ValueError as e:
+    sys.exit("choose_utts_to_combine.py: bad utt2dur file {0}: {1}".format(
+            args.utt2dur_in, str(e)))
 
 
 utt_groups = GetUtteranceGroups(args.min_duration, spk2utt, utt2dur)
@@ -331,54 +330,45 @@ utt_group_names = [ group[0] if len(group)==1 else group[0] + "-comb" + str(len(
                     for group in utt_groups ]
 
 
-# write the utt2utts file.
-try:
-    with open(args.utt2utts_out, 'w') as f:
-        for i in range(len(utt_groups)):
-            print(utt_group_names[i], ' '.join(utt_groups[i]), file = f)
-except Exception as e:
-    sys.exit("choose_utts_to_combine.py: exception writing to "
-             "<utt2utts-out>={0}: {1}".format(args.utt2utts_out, str(e)))
-
-# write the utt2spk file.
-try:
-    with open(args.utt2spk_out, 'w') as f:
-        for i in range(len(utt_groups)):
-            utt_group = utt_groups[i]
-            spk_list = [ utt2spk[utt] for utt in utt_group ]
-            if spk_list == [ spk_list[0] ] * len(utt_group):
-                spk = spk_list[0]
-            else:
-                spk2dur = defaultdict(float)
-                # spk2dur is a map from the speaker-id to the duration within this
-                # utt, that it comprises.
-                for utt in utt_group:
-                    spk2dur[utt2spk[utt]] += utt2dur[utt]
-                # the following code, which picks the speaker that contributed
-                # the most to the duration of this utterance, is a little
-                # complex because we want to break ties in a deterministic way
-                # picking the earlier spaker in case of a tied duration.
-                longest_spk_dur = -1.0
-                spk = None
-                for this_spk in sorted(spk2dur.keys()):
-                    if LessThan(longest_spk_dur, spk2dur[this_spk]):
-                        longest_spk_dur = spk2dur[this_spk]
-                        spk = this_spk
-                assert spk != None
-            new_utt = utt_group_names[i]
-            print(new_utt, spk, file = f)
-except Exception as e:
-    sys.exit("choose_utts_to_combine.py: exception writing to "
-             "<utt2spk-out>={0}: {1}".format(args.utt2spk_out, str(e)))
-
-# write the utt2dur file.
-try:
-    with open(args.utt2dur_out, 'w') as f:
-        for i in range(len(utt_groups)):
-            utt_name = utt_group_names[i]
-            duration = sum([ utt2dur[utt] for utt in utt_groups[i]])
-            print(utt_name, duration, file = f)
-except Exception as e:
-    sys.exit("choose_utts_to_combine.py: exception writing to "
-             "<utt2dur-out>={0}: {1}".format(args.utt2dur_out, str(e)))
-
+# This function returns the speaker of a group of utterances: the speaker of
+# its utterances if they all have the same one, otherwise the speaker that
+# contributed the most to its duration.
+def GetGroupSpeaker(utt_group):
+    spk_list = [ utt2spk[utt] for utt in utt_group ]
+    if spk_list == [ spk_list[0] ] * len(utt_group):
+        return spk_list[0]
+    spk2dur = defaultdict(float)
+    # spk2dur is a map from the speaker-id to the duration within this
+    # utt, that it comprises.
+    for utt in utt_group:
+        spk2dur[utt2spk[utt]] += utt2dur[utt]
+    # the following code, which picks the speaker that contributed
+    # the most to the duration of this utterance, is a little
+    # complex because we want to break ties in a deterministic way
+    # picking the earlier spaker in case of a tied duration.
+    longest_spk_dur = -1.0
+    spk = None
+    for this_spk in sorted(spk2dur.keys()):
+        if LessThan(longest_spk_dur, spk2dur[this_spk]):
+            longest_spk_dur = spk2dur[this_spk]
+            spk = this_spk
+    assert spk != None
+    return spk
+
+
+# write the utt2utts, utt2spk and utt2dur files; they are written sorted on
+# the new utterance-ids.
+outputs = [ ("<utt2utts-out>", args.utt2utts_out,
+             lambda i: utt_groups[i]),
+            ("<utt2spk-out>", args.utt2spk_out,
+             lambda i: GetGroupSpeaker(utt_groups[i])),
+            ("<utt2dur-out>", args.utt2dur_out,
+             lambda i: sum([ utt2dur[utt] for utt in utt_groups[i]])) ]
+for (name, filename, get_value) in outputs:
+    try:
+        data_dir_lib.write_table(filename,
+                                 [ (utt_group_names[i], get_value(i))
+                                   for i in range(len(utt_groups)) ])
+    except Exception as e:
+        sys.exit("choose_utts_to_combine.py: exception writing to "
+                 "{0}={1}: {2}".format(name, filename, str(e)))
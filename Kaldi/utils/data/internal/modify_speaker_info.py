@@ -3,6 +3,10 @@
 from __future__ import print_function
 import argparse, sys,os
 from collections import defaultdict
+
+sys.path.insert(0, 'steps')
+import libs.data_dir as data_dir_lib
+
 parser = argparse.ArgumentParser(description="""
 Combine consecutive utterances into fake speaker ids for a kind of
 poor man's segmentation.  Reads old utt2spk from standard input,
@@ -39,19 +43,9 @@ while True:
     spk2utt[spk].append(utt)
 
 if args.seconds_per_spk_max > 0:
-    utt2dur = dict()
     try:
-        f = open(args.utt2dur)
-        while True:
-            line = f.readline()
-            if line == '':
-                break
-            a = line.split()
-            if len(a) != 2:
-                sys.exit("modify_speaker_info.py: bad utt2dur line from standard input (expected two fields): " +
-                         line)
-            [ utt, dur ] = a
-            utt2dur[utt] = float(dur)
+        utt2dur = data_dir_lib.TableFile(args.utt2dur).to_dict(
+            value_processor = lambda x: float(x[0]), num_fields = 2)
         for utt in utt2spk:
             if not utt in utt2dur:
                 sys.exit("modify_speaker_info.py: utterance {0} not in utt2dur file {1}".format(
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Apache 2.0.
+
+from __future__ import print_function
+import sys
+import argparse
+import json
+import logging
+
+sys.path.insert(0, 'steps')
+import libs.validate_data_dir as validate_lib
+
+parser = argparse.ArgumentParser(description="""
+This script validates a data directory, like utils/validate_data_dir.sh, or
+with --fix=true fixes it, like utils/fix_data_dir.sh, but it reads each file
+only once, and the files in parallel, so it is much faster on large
+directories.  The --no-xxx options mean that xxx is not required to be
+present, but it is checked if it is present.  Unlike the shell script, it
+reports all the problems it finds, and it can write them as JSON with
+--report.  See steps/libs/validate_data_dir.py.
+It has to be run from the top-level (e.g. egs/.../s5) directory, as the
+scripts are.
+e.g.: utils/data/validate_data_dir.py --no-feats=true data/train
+      utils/data/validate_data_dir.py --fix=true data/train
+""")
+
+parser.add_argument('--no-feats', type = str, default = 'false',
+                    choices = ['true', 'false'],
+                    help = 'If true, feats.scp is not required.')
+parser.add_argument('--no-text', type = str, default = 'false',
+                    choices = ['true', 'false'],
+                    help = 'If true, text is not required.')
+parser.add_argument('--no-wav', type = str, default = 'false',
+                    choices = ['true', 'false'],
+                    help = 'If true, wav.scp is not required.')
+parser.add_argument('--fix', type = str, default = 'false',
+                    choices = ['true', 'false'],
+                    help = 'If true, sort and filter the files of the data '
+                    'directory like utils/fix_data_dir.sh, instead of '
+                    'validating it (the --no-xxx options are ignored).')
+parser.add_argument('--num-jobs', type = int, default = 4,
+                    help = 'Number of processes that read the files.')
+parser.add_argument('--report', type = str, default = None,
+                    help = "If set, the file to which the report is written "
+                    "as JSON; '-' for the standard output.")
+parser.add_argument('data', type = str, help = 'The data directory.')
+
+args = parser.parse_args()
+
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    "{0}: %(message)s".format(sys.argv[0])))
+validate_lib.logger.addHandler(handler)
+validate_lib.logger.setLevel(logging.INFO)
+
+if args.fix == 'true':
+    try:
+        report = validate_lib.fix_data_dir(args.data,
+                                           num_jobs = args.num_jobs)
+    except Exception as e:
+        sys.exit("{0}: {1}".format(sys.argv[0], str(e)))
+else:
+    report = validate_lib.validate_data_dir(
+        args.data, no_feats = (args.no_feats == 'true'),
+        no_text = (args.no_text == 'true'), no_wav = (args.no_wav == 'true'),
+        num_jobs = args.num_jobs)
+    text = validate_lib.format_report(report, sys.argv[0])
+    if text != '':
+        print(text, file=sys.stderr)
+
+if args.report is not None:
+    try:
+        f = (sys.stdout if args.report == '-' else open(args.report, 'w'))
+        json.dump(report, f, indent = 2, sort_keys = True,
+                  separators = (',', ': '))
+        f.write('\n')
+        if f is not sys.stdout:
+            f.close()
+    except (IOError, OSError) as e:
+        sys.exit("{0}: error writing {1}: {2}".format(sys.argv[0],
+                                                      args.report, str(e)))
+
+if args.fix != 'true':
+    if not report['valid']:
+        sys.exit(1)
+    print("{0}: Successfully validated data-directory {1}".format(
+        sys.argv[0], args.data), file=sys.stderr)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# Apache 2.0.
+
+from __future__ import print_function
+import sys
+import argparse
+import logging
+
+sys.path.insert(0, 'steps')
+import libs.wav_duration as wav_duration_lib
+
+parser = argparse.ArgumentParser(description="""
+This script writes the duration in seconds of each recording of a wav.scp,
+like the program wav-to-duration (e.g. to create utt2dur or reco2dur), but it
+gets the durations from the headers of the files, following simple
+pipelines of cat, sph2pipe and sox to the file they read, so it is much
+faster.  Other commands are run, to read the header of their output (or all
+of it, with --read-entire-file=true).  See steps/libs/wav_duration.py.
+It has to be run from the top-level (e.g. egs/.../s5) directory, as the
+scripts are.
+e.g.: utils/data/wav_to_duration.py data/train/wav.scp data/train/utt2dur
+""")
+
+parser.add_argument('--read-entire-file', type = str, default = 'false',
+                    choices = ['true', 'false'],
+                    help = "If true, the duration of the commands that are "
+                    "run is obtained by reading all their output instead of "
+                    "from the headers; this is needed when the headers are "
+                    "wrong, e.g. for sox commands with speed perturbation.  "
+                    "For files, the header is still used unless it has no "
+                    "data size or the file is truncated.")
+parser.add_argument('--num-threads', type = int, default = 8,
+                    help = 'Number of threads that read the headers.')
+parser.add_argument('--cache', type = str, default = None,
+                    help = 'If set, a file in which the information read from '
+                    'the headers is cached, with the size and modification '
+                    'time of the files, so that it is not read again for the '
+                    'files that have not changed.')
+parser.add_argument('wav_scp', type = str,
+                    help = "The wav.scp; '-' for the standard input.")
+parser.add_argument('durations_out', type = str,
+                    help = "The output file of '<recording-id> <duration>' "
+                    "lines; '-' for the standard output.")
+
+args = parser.parse_args()
+
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    "{0}: WARNING: %(message)s".format(sys.argv[0])))
+wav_duration_lib.logger.addHandler(handler)
+
+try:
+    f = (sys.stdin if args.wav_scp == '-' else open(args.wav_scp, 'r'))
+    wav_scp = []
+    for line in f:
+        a = line.split(None, 1)
+        if len(a) != 2:
+            if len(a) != 0:
+                print("{0}: bad line in {1}: {2}".format(
+                    sys.argv[0], args.wav_scp, line.strip()), file=sys.stderr)
+            continue
+        wav_scp.append((a[0], a[1].strip()))
+except (IOError, OSError) as e:
+    sys.exit("{0}: error reading {1}: {2}".format(sys.argv[0], args.wav_scp,
+                                                  str(e)))
+
+durations = wav_duration_lib.get_durations(
+    wav_scp, read_entire_file = (args.read_entire_file == 'true'),
+    num_threads = args.num_threads, cache_file = args.cache)
+
+try:
+    f = (sys.stdout if args.durations_out == '-'
+         else open(args.durations_out, 'w'))
+    for (recording_id, duration) in durations:
+        print(recording_id, wav_duration_lib.format_duration(duration),
+              file=f)
+    f.close()
+except (IOError, OSError) as e:
+    sys.exit("{0}: error writing {1}: {2}".format(
+        sys.argv[0], args.durations_out, str(e)))
+
+print("{0}: got the durations of {1} out of {2} recordings".format(
+    sys.argv[0], len(durations), len(wav_scp)), file=sys.stderr)
+if len(durations) == 0 and len(wav_scp) > 0:
+    sys.exit(1)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+# Apache 2.0.
+
+from __future__ import print_function
+import sys
+import argparse
+
+sys.path.insert(0, 'steps')
+import libs.arpa_lm as arpa_lm_lib
+
+parser = argparse.ArgumentParser(description="""
+This script converts an ARPA-format language model to the binary format of
+steps/libs/arpa_lm.py, which is memory-mapped by the programs that read it
+(e.g. utils/lang/internal/arpa2fst_constrained.py) instead of being parsed.
+It has to be run from the top-level (e.g. egs/.../s5) directory, as the
+scripts are.
+e.g.: utils/lang/arpa_to_binary_lm.py data/local/lm/lm.arpa data/local/lm/lm.bin
+""")
+
+parser.add_argument('arpa_in', type = str,
+                    help = "The input ARPA file (must not be gzipped); '-' "
+                    "for the standard input.")
+parser.add_argument('binary_lm_out', type = str,
+                    help = 'The output binary LM file.')
+
+args = parser.parse_args()
+
+try:
+    arpa_file = (sys.stdin if args.arpa_in == '-' else open(args.arpa_in, 'r'))
+    binary_file = open(args.binary_lm_out, 'wb')
+except (IOError, OSError) as e:
+    sys.exit("{0}: error opening files: {1}".format(sys.argv[0], str(e)))
+
+try:
+    arpa_lm_lib.convert_arpa_to_binary(arpa_file, binary_file)
+except ValueError as e:
+    sys.exit("{0}: reading {1}, {2}".format(sys.argv[0], args.arpa_in, str(e)))
+binary_file.close()
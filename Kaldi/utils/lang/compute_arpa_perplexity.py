@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Apache 2.0.
+
+from __future__ import print_function
+import sys
+import argparse
+
+sys.path.insert(0, 'steps')
+import libs.arpa_lm as arpa_lm_lib
+import libs.arpa_scoring as arpa_scoring_lib
+
+parser = argparse.ArgumentParser(description="""
+This script computes the perplexity of one or more ARPA-format language
+models on a text, e.g. to compare LMs built with different options on
+held-out data.  The conventions are those of SRILM's 'ngram -ppl': the
+end-of-sentence symbol is scored, the words not in the LM (OOVs) are not
+scored, and for each LM it prints the numbers of sentences, words and OOVs,
+the total log10 probability, the perplexity ('ppl', over the scored words and
+the end-of-sentence symbols) and 'ppl1' (over the scored words only).
+It has to be run from the top-level (e.g. egs/.../s5) directory, as the
+scripts are.
+e.g.: utils/lang/compute_arpa_perplexity.py --has-keys=true data/test/text \\
+          data/local/lm/lm_bg.arpa data/local/lm/lm_tg.arpa
+""")
+
+parser.add_argument('--has-keys', type = str, default = 'false',
+                    choices = ['true', 'false'],
+                    help = "If true, the first field of each line of the text "
+                    "is a key (e.g. the utterance-id in data/*/text), which "
+                    "is not scored.")
+parser.add_argument('--unk-word', type = str, default = None,
+                    help = "If set, and the LM contains this word, the OOVs "
+                    "are mapped to it and scored, e.g. '<unk>'.")
+parser.add_argument('--per-sentence-scores', type = str, default = None,
+                    help = "If set, a file to which the score of each "
+                    "sentence is written, as a line '<key> <num-words>' "
+                    "followed by '<num-oovs> <logprob> <ppl>' for each LM; "
+                    "the key is the line number (from 1) if --has-keys=false.")
+parser.add_argument('--batch-size', type = int, default = 100000,
+                    help = 'The number of words that are scored together.')
+parser.add_argument('--use-numpy', type = str, default = 'true',
+                    choices = ['true', 'false'],
+                    help = 'If true, score the batches with numpy, if it is '
+                    'available.')
+parser.add_argument('--binary-lm-cache-dir', type = str, default = None,
+                    help = 'If set, a directory in which the binary versions '
+                    'of the ARPA LMs (see utils/lang/arpa_to_binary_lm.py) '
+                    'are cached, so that the ARPA files are read only the '
+                    'first time.')
+parser.add_argument('text', type = str,
+                    help = "The text to score, one sentence per line; '-' "
+                    "for the standard input.")
+parser.add_argument('lms', type = str, nargs = '+',
+                    help = 'The ARPA LMs (must not be gzipped), or binary LMs.')
+
+args = parser.parse_args()
+
+try:
+    f = (sys.stdin if args.text == '-' else open(args.text, 'r'))
+    keys = []
+    sentences = []
+    for line in f:
+        a = line.split()
+        if args.has_keys == 'true':
+            if len(a) == 0:
+                continue
+            keys.append(a[0])
+            a = a[1:]
+        else:
+            keys.append(str(len(keys) + 1))
+        sentences.append(a)
+except (IOError, OSError) as e:
+    sys.exit("{0}: error reading {1}: {2}".format(sys.argv[0], args.text,
+                                                  str(e)))
+
+all_scores = []
+for lm_in in args.lms:
+    try:
+        lm = arpa_lm_lib.get_binary_lm(lm_in,
+                                       cache_dir=args.binary_lm_cache_dir)
+        scorer = arpa_scoring_lib.ArpaScorer(
+            lm, unk_word=args.unk_word, batch_size=args.batch_size,
+            use_numpy=(args.use_numpy == 'true'))
+    except (IOError, OSError, ValueError) as e:
+        sys.exit("{0}: reading {1}, {2}".format(sys.argv[0], lm_in, str(e)))
+    scores = scorer.score([scorer.integerize(sentence)
+                           for sentence in sentences])
+    scorer.close()
+    lm.close()
+
+    stats = arpa_scoring_lib.PerplexityStats()
+    for score in scores:
+        stats.add(*score)
+    print("{0}: {1} sentences, {2} words, {3} OOVs".format(
+        lm_in, stats.num_sentences, stats.num_words, stats.num_oovs))
+    print("logprob= {0:.6g} ppl= {1:.6g} ppl1= {2:.6g}".format(
+        stats.logprob, stats.ppl(), stats.ppl1()))
+    all_scores.append(scores)
+
+if args.per_sentence_scores is not None:
+    try:
+        with open(args.per_sentence_scores, 'w') as f:
+            for i in range(len(keys)):
+                fields = [keys[i], str(all_scores[0][i][1])]
+                for scores in all_scores:
+                    fields.extend([str(scores[i][2]),
+                                   '{0:.6g}'.format(scores[i][0]),
+                                   '{0:.6g}'.format(
+                                       arpa_scoring_lib.sentence_ppl(
+                                           scores[i]))])
+                print(' '.join(fields), file=f)
+    except (IOError, OSError) as e:
+        sys.exit("{0}: error writing {1}: {2}".format(
+            sys.argv[0], args.per_sentence_scores, str(e)))
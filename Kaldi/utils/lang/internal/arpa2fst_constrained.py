@@ -9,6 +9,9 @@ import argparse
 import math
 from collections import defaultdict
 
+sys.path.insert(0, 'steps')
+import libs.arpa_lm as arpa_lm_lib
+
 # note, this was originally based
 
 parser = argparse.ArgumentParser(description="""
@@ -29,8 +32,15 @@ parser.add_argument('--disambig-symbol', type = str, default = "#0",
                     help = 'Disambiguation symbol (e.g. #0), '
                     'that is printed on the input side only of backoff '
                     'arcs (output side would be epsilon)')
+parser.add_argument('--binary-lm-cache-dir', type = str, default = '',
+                    help = 'If set, the ARPA file is converted to a binary LM '
+                    'that is stored in this directory, and later runs on the same '
+                    'ARPA file (as long as it is unchanged) just memory-map the '
+                    'binary LM instead of reading the ARPA file.  See '
+                    'steps/libs/arpa_lm.py.')
 parser.add_argument('arpa_in', type = str,
-                    help = 'The input ARPA file (must not be gzipped)')
+                    help = 'The input ARPA file (must not be gzipped), or a binary LM '
+                    'file written by utils/lang/arpa_to_binary_lm.py')
 parser.add_argument('allowed_bigrams_in', type = str,
                     help = "A file containing the list of allowed bigram pairs.  "
                     "Must include pairs like '<s> foo' and 'foo </s>', as well as "
@@ -44,194 +54,165 @@ if args.verbose >= 1:
     print(' '.join(sys.argv), file = sys.stderr)
 
 
-class HistoryState:
-    def __init__(self):
-        # note: neither backoff_prob nor the floats
-        # in word_to_prob are in log space.
-        self.backoff_prob = 1.0
-        # will be a dict from string to float.  the prob is
-        # the actual probability of the word, including any probability
-        # mass from backoff (they get added together while writing out
-        # the arpa, and these probs are read in from the arpa).
-        self.word_to_prob = dict()
+# This class maps between the states of the output FST and their histories
+# (tuples of word-ids), computing them from the binary LM rather than storing
+# them.  The FST-states are:
+#   - the bigram state for <s> (which comes first as it's the start state),
+#   - a bigram state for each of the other words of the unigram section except
+#     </s> [even if the LM didn't naturally have such bigram states, we create
+#     them so that we can enforce the bigram constraints supplied by the user],
+#     in the order of their word-ids,
+#   - the states of the LM with history-length >= 2, by history-length and then
+#     in the order of the LM.
+# note: we do not allocate an FST state for the unigram state, because
+# we don't have a unigram state in the output FST, only bigram states.
+class FstStateMap:
+    def __init__(self, lm):
+        self.lm = lm
+        self.bos = lm.word_to_id['<s>']
+        # the words of the unigram section have the word-ids 0, 1, ... (see
+        # steps/libs/arpa_lm.py).
+        self.num_unigram_words = lm.num_entries(0, 0) if lm.num_states(0) > 0 else 0
+        self.skipped_words = sorted([ x for x in [ self.bos, lm.word_to_id['</s>'] ]
+                                      if x < self.num_unigram_words ])
+        # self.first_state[n] is the first FST-state for history-length n >= 1;
+        # the last element is the number of FST-states.
+        self.first_state = [ None, 1, 1 + self.num_unigram_words - len(self.skipped_words) ]
+        for n in range(2, lm.max_order):
+            self.first_state.append(self.first_state[n] + lm.num_states(n))
+
+    def NumStates(self):
+        return self.first_state[-1]
+
+    # Returns the FST-state for history 'hist', or -1 if there is none.
+    def GetState(self, hist):
+        if len(hist) == 1:
+            word = hist[0]
+            if word == self.bos:
+                return 0
+            if word >= self.num_unigram_words or word in self.skipped_words:
+                return -1
+            return 1 + word - len([ x for x in self.skipped_words if x < word ])
+        if len(hist) < 2 or len(hist) >= self.lm.max_order:
+            return -1
+        lm_state = self.lm.find_state(hist)
+        return self.first_state[len(hist)] + lm_state if lm_state != -1 else -1
+
+    # Returns the history of FST-state 'state'.
+    def GetHist(self, state):
+        if state == 0:
+            return (self.bos,)
+        if state < self.first_state[2]:
+            word = state - 1
+            for x in self.skipped_words:
+                if word >= x:
+                    word += 1
+            return (word,)
+        hist_len = 2
+        while state >= self.first_state[hist_len + 1]:
+            hist_len += 1
+        return self.lm.get_state_hist(hist_len, state - self.first_state[hist_len])
 
 
 class ArpaModel:
     def __init__(self):
-        # self.orders is indexed by history-length [i.e. 0 for unigram,
-        # 1 for bigram and so on], and is then a dict indexed
-        # by tuples of history-words.  E.g. for trigrams, we'd index
-        # it as self.orders[2][('a', 'b')].
-        # The value-type of the dict is HistoryState.  E.g. to set the
-        # probability of the trigram a b -> c to 0.2, we'd do
-        # self.orders[2][('a', 'b')].word_to_prob['c'] = 0.2
-        self.orders = []
-
-    def Read(self, arpa_in):
-        assert len(self.orders) == 0
-        log10 = math.log(10.0)
-        if arpa_in == "" or arpa_in == "-":
-            arpa_in = "/dev/stdin"
+        # self.lm is the language model in the binary format of
+        # steps/libs/arpa_lm.py, which is memory-mapped from the file, so
+        # that we don't need to create python objects for all the n-grams.
+        # In it, words are integer word-ids; self.lm.words maps them to the
+        # strings and self.lm.word_to_id back.  The histories of the
+        # history-states are tuples of word-ids, and the states of each
+        # history-length are numbered in the sorted order of their histories.
+        # The probabilities are not in log space; the prob of a word in a
+        # history-state is the actual probability of the word, including any
+        # probability mass from backoff (they get added together while
+        # writing out the arpa, and these probs are read in from the arpa).
+        self.lm = None
+
+    def Read(self, arpa_in, cache_dir = None):
+        assert self.lm is None
         try:
-            f = open(arpa_in, "r")
-        except:
-            sys.exit("{0}: error opening ARPA file {1}".format(
-                     sys.argv[0], arpa_in))
-        # first read till the \data\ marker.
-        while True:
-            line = f.readline()
-            if line == '':
-                sys.exit("{0}: reading {1}, got EOF looking for \\data\\ marker.".format(
-                    sys.argv[0], arpa_in))
-            if line[0:6] == '\\data\\':
-                break
-        while True:
-            # read, and ignore, the lines like 'ngram 1=1264'...
-            line = f.readline()
-            if line == '\n' or line == '\r\n':
-                break
-            if line[0:5] != 'ngram':
-                sys.exit("{0}: reading {1}, read something unexpected in header: {2}".format(
-                    sys.argv[0], arpa_in, line[:-1]))
-            rest=line[5:]
-            a = rest.split('=')  # e.g. a = [ '1', '1264] ]
-            if len(a) != 2:
-                sys.exit("{0}: reading {1}, read something unexpected in header: {2}".format(
-                    sys.argv[0], arpa_in, line[:-1]))
-            max_order = int(a[0])
-
-
-        for n in range(max_order):
-            # self.orders[n], indexed by history-length (length of the
-            # history-vector, == order-1), is a map from history as a tuple
-            # of strings, to class HistoryState.
-            self.orders.append(defaultdict(lambda: HistoryState()))
-
-        cur_order = 0
-        while True:
-            line = f.readline()
-            if line == '':
-                sys.exit("{0}: reading {1}, found EOF while looking for \\end\\ marker.".format(
-                    sys.argv[0], arpa_in))
-            elif line[0:5] == '\\end\\':
-                if len(self.orders) == 0:
-                    sys.exit("{0}: reading {1}, read no n-grams.".format(sys.argv[0], arpa_in))
-                break
-            else:
-                cur_order += 1
-                expected_line = '\\{0}-grams:'.format(cur_order)
-                if not expected_line in line:  # e.g. allow trailing whitespace and newline
-                    sys.exit("{0}: reading {1}, expected line {1}, got {2}".format(arpa_in, expected_line, line[:-1]))
-                if args.verbose >= 2:
-                    print("{0}: reading {1}-grams".format(
-                        sys.argv[0], cur_order), file = sys.stderr)
-
-                # now read all the n-grams from this order.
-                while True:
-                    line = f.readline()
-                    # the section of n-grams is terminated by a blank line.
-                    if line == '\n' or line == '\r\n':
-                        break
-                    a = line.split()
-                    l = len(a)
-                    if l != cur_order + 1 and l != cur_order + 2:
-                        sys.exit("{0}: reading {1}: in {2}-grams section, got bad line: {3}".format(
-                            sys.argv[0], arpa_in, cur_order, line[:-1]))
-                    try:
-                        prob = math.exp(float(a[0]) * log10)
-                        hist = tuple(a[1:cur_order])  # tuple of strings
-                        word = a[cur_order]  # a string
-                        backoff_prob = math.exp(float(a[cur_order+1]) * log10) if l == cur_order + 2 else None
-                    except Exception as e:
-                        sys.exit("{0}: reading {1}: in {2}-grams section, got bad "
-                                 "line (exception is: {3}): {4}".format(
-                                     sys.argv[0], arpa_in, cur_order,
-                                     str(type(e)) + ',' + str(e), line[:-1]))
-                    self.orders[cur_order-1][hist].word_to_prob[word] = prob
-                    if backoff_prob != None:
-                        self.orders[cur_order][hist + (word,)].backoff_prob = backoff_prob
+            self.lm = arpa_lm_lib.get_binary_lm(arpa_in, cache_dir)
+        except (IOError, OSError) as e:
+            sys.exit("{0}: error opening ARPA file {1}: {2}".format(
+                     sys.argv[0], arpa_in, str(e)))
+        except ValueError as e:
+            sys.exit("{0}: reading {1}, {2}".format(sys.argv[0], arpa_in, str(e)))
 
         if args.verbose >= 2:
             print("{0}: read {1}-gram model from {2}".format(
-                sys.argv[0], cur_order, arpa_in), file = sys.stderr)
-        if cur_order < 2:
+                sys.argv[0], self.lm.max_order, arpa_in), file = sys.stderr)
+        if self.lm.max_order < 2:
             # we'd have to have some if-statements in the code to make this work,
             # and I don't want to have to test it.
             sys.exit("{0}: this script does not work when the ARPA language model "
                      "is unigram.".format(sys.argv[0]))
+        for word in [ '<s>', '</s>' ]:
+            if not word in self.lm.word_to_id:
+                sys.exit("{0}: the ARPA language model has no {1} symbol.".format(
+                    sys.argv[0], word))
 
-    # Returns the probability of word 'word' in history-state 'hist'.
+    # Returns the word-id of the word 'word' (a string).
+    # Dies with error if this word is not predicted at all by the LM (not in vocab).
+    def GetWordId(self, word):
+        if not word in self.lm.word_to_id:
+            sys.exit("{0}: no probability in unigram for word {1}".format(
+                sys.argv[0], word))
+        return self.lm.word_to_id[word]
+
+    # Returns the probability of word-id 'word' in history-state 'hist' (a
+    # tuple of word-ids).
     # Dies with error if this word is not predicted at all by the LM (not in vocab).
-    # history-state does not exist.
     def GetProb(self, hist, word):
-        assert len(hist) < len(self.orders)
-        if len(hist) == 0:
-            word_to_prob = self.orders[0][()].word_to_prob
-            if not word in word_to_prob:
-                sys.exit("{0}: no probability in unigram for word {1}".format(
-                    sys.argv[0], word))
-            return word_to_prob[word]
-        else:
-            if hist in self.orders[len(hist)]:
-                hist_state = self.orders[len(hist)][hist]
-                if word in hist_state.word_to_prob:
-                    return hist_state.word_to_prob[word]
-                else:
-                    return hist_state.backoff_prob * self.GetProb(hist[1:], word)
-            else:
-                return self.GetProb(hist[1:], word)
-
-    # This gets the state corresponding to 'hist' in 'hist_to_state', but backs
+        assert len(hist) < self.lm.max_order
+        try:
+            return self.lm.get_prob(hist, word)
+        except KeyError:
+            sys.exit("{0}: no probability in unigram for word {1}".format(
+                sys.argv[0], self.lm.words[word]))
+
+    # Returns the list of the probabilities of the word-ids 'words' in
+    # history-state 'hist'; this is much faster than calling GetProb() for
+    # each word.
+    def GetProbs(self, hist, words):
+        assert len(hist) < self.lm.max_order
+        try:
+            return self.lm.get_probs(hist, words)
+        except KeyError as e:
+            sys.exit("{0}: no probability in unigram for word {1}".format(
+                sys.argv[0], self.lm.words[e.args[0]]))
+
+    # This gets the state corresponding to 'hist' in 'state_map', but backs
     # off for us if there is no such state.
-    def GetStateForHist(self, hist_to_state, hist):
-        if hist in hist_to_state:
-            return hist_to_state[hist]
+    def GetStateForHist(self, state_map, hist):
+        state = state_map.GetState(hist)
+        if state != -1:
+            return state
         else:
             if len(hist) <= 1:
                 # this would likely be a code error, but possibly an error
                 # in the ARPA file
                 sys.exit("{0}: error processing histories: history-state {1} "
-                         "does not exist.".format(sys.argv[0], hist))
-            return self.GetStateForHist(hist_to_state, hist[1:])
+                         "does not exist.".format(
+                             sys.argv[0], tuple([ self.lm.words[x] for x in hist ])))
+            return self.GetStateForHist(state_map, hist[1:])
 
 
     def GetHistToStateMap(self):
-        # This function, called from PrintAsFst, returns (hist_to_state,
-        # state_to_hist), which map from history (as a tuple of strings) to
-        # integer FST-state and vice versa.
-
-        hist_to_state = dict()
-        state_to_hist = []
-
-        # Make sure the initial bigram state comes first (and that
-        # we have such a state even if it was completely pruned
-        # away in the bigram LM.. which is unlikely of course)
-        hist = ('<s>',)
-        hist_to_state[hist] = len(state_to_hist)
-        state_to_hist.append(hist)
-
-        # create a bigram state for each of the 'real' words...  even if the LM
-        # didn't naturally have such bigram states, we'll create them so that we
-        # can enforce the bigram constraints supplied in 'bigrams_file' by the
-        # user.
-        for word in self.orders[0][()].word_to_prob:
-            if word != '<s>' and word != '</s>':
-                hist = (word,)
-                hist_to_state[hist] = len(state_to_hist)
-                state_to_hist.append(hist)
-
-        # note: we do not allocate an FST state for the unigram state, because
-        # we don't have a unigram state in the output FST, only bigram states; and
-        # we don't iterate over bigram histories because we covered them all above;
-        # that's why we start 'n' from 2 below instead of from 0.
-        for n in range(2, len(self.orders)):
-            for hist in self.orders[n].keys():
-                # note: hist is a tuple of strings.
-                assert not hist in hist_to_state
-                hist_to_state[hist] = len(state_to_hist)
-                state_to_hist.append(hist)
-
-        return (hist_to_state, state_to_hist)
+        # This function, called from PrintAsFst, returns an FstStateMap, which
+        # maps from history (as a tuple of word-ids) to integer FST-state and
+        # vice versa.
+        return FstStateMap(self.lm)
+
+    # This function converts 'bigram_map' (see ReadBigramMap()) to word-ids,
+    # for the left-hand words that are in the LM.
+    def GetBigramMapAsIds(self, bigram_map):
+        ans = dict()
+        for word1, words2 in bigram_map.items():
+            if word1 in self.lm.word_to_id:
+                ans[self.lm.word_to_id[word1]] = set(
+                    [ self.GetWordId(word2) for word2 in words2 ])
+        return ans
 
     # This function prints the estimated language model as an FST.
     # disambig_symbol will be something like '#0' (a symbol introduced
@@ -239,17 +220,20 @@ class ArpaModel:
     # bigram_map represent the allowed bigrams (left-word, right-word): it's a map
     # from left-word to a set of right-words (both are strings).
     def PrintAsFst(self, disambig_symbol, bigram_map):
-        # History will map from history (as a tuple) to integer FST-state.
-        (hist_to_state, state_to_hist) = self.GetHistToStateMap()
-
+        # state_map maps from history (as a tuple of word-ids) to integer
+        # FST-state and vice versa.
+        state_map = self.GetHistToStateMap()
+        bigram_map = self.GetBigramMapAsIds(bigram_map)
+        words = self.lm.words
+        eos = self.lm.word_to_id['</s>']
 
         # The following 3 things are just for diagnostics.
-        normalization_stats = [ [0, 0.0] for x in range(len(self.orders)) ]
+        normalization_stats = [ [0, 0.0] for x in range(self.lm.max_order) ]
         num_ngrams_allowed = 0
         num_ngrams_disallowed = 0
 
-        for state in range(len(state_to_hist)):
-            hist = state_to_hist[state]
+        for state in range(state_map.NumStates()):
+            hist = state_map.GetHist(state)
             hist_len = len(hist)
             assert hist_len > 0
             if hist_len == 1:  # it's a bigram state...
@@ -257,73 +241,82 @@ class ArpaModel:
                 if not context_word in bigram_map:
                     print("{0}: warning: word {1} appears in ARPA but is not listed "
                           "as a left context in the bigram map".format(
-                              sys.argv[0], context_word), file = sys.stderr)
+                              sys.argv[0], words[context_word]), file = sys.stderr)
                     continue
                 # word list is a list of words that can follow this word.  It must be nonempty.
-                word_list = list(bigram_map[context_word])
+                word_list = sorted(bigram_map[context_word])
 
                 normalization_stats[hist_len][0] += 1
 
-                for word in word_list:
-                    prob = self.GetProb((context_word,), word)
+                for word, prob in zip(word_list,
+                                      self.GetProbs((context_word,), word_list)):
                     assert prob != 0
                     normalization_stats[hist_len][1] += prob
                     cost = -math.log(prob)
                     if abs(cost) < 0.01 and args.verbose >= 3:
                         print("{0}: warning: very small cost {1} for {2}->{3}".format(
-                            sys.argv[0], cost, context_word, word), file=sys.stderr)
-                    if word == '</s>':
+                            sys.argv[0], cost, words[context_word], words[word]),
+                              file=sys.stderr)
+                    if word == eos:
                         # print the final-prob of this state.
                         print("%d %.3f" % (state, cost))
                     else:
-                        next_state = self.GetStateForHist(hist_to_state,
+                        next_state = self.GetStateForHist(state_map,
                                                           (context_word, word))
                         print("%d %d %s %s %.3f" %
-                              (state, next_state, word, word, cost))
+                              (state, next_state, words[word], words[word], cost))
             else:  # it's a higher-order than bigram state.
-                assert hist in self.orders[hist_len]
-                hist_state = self.orders[hist_len][hist]
+                lm_state = self.lm.find_state(hist)
+                assert lm_state != -1
                 most_recent_word = hist[-1]
+                if not most_recent_word in bigram_map:
+                    sys.exit("{0}: word {1} appears as the last word of the history {2} "
+                             "in the ARPA but is not listed as a left context in the "
+                             "bigram map".format(
+                                 sys.argv[0], words[most_recent_word],
+                                 ' '.join([ words[x] for x in hist ])))
+                allowed_words = bigram_map[most_recent_word]
 
                 normalization_stats[hist_len][0] += 1
                 normalization_stats[hist_len][1] += \
-                  sum([ self.GetProb(hist, word) for word in bigram_map[most_recent_word]])
+                  sum(self.GetProbs(hist, list(allowed_words)))
 
-                for word, prob in hist_state.word_to_prob.items():
+                entries = self.lm.get_entries(hist_len, lm_state)
+                for word, prob in entries:
                     cost = -math.log(prob)
-                    if word in bigram_map[most_recent_word]:
+                    if word in allowed_words:
                         num_ngrams_allowed += 1
                     else:
                         num_ngrams_disallowed += 1
                         continue
-                    if word == '</s>':
+                    if word == eos:
                         # print the final-prob of this state.
                         print("%d %.3f" % (state, cost))
                     else:
-                        next_state = self.GetStateForHist(hist_to_state,
+                        next_state = self.GetStateForHist(state_map,
                                                           (hist) + (word,))
                         print("%d %d %s %s %.3f" %
-                              (state, next_state, word, word, cost))
+                              (state, next_state, words[word], words[word], cost))
                 # Now deal with the backoff probability of this state (back off
                 # to the lower-order state).
-                assert hist in self.orders[hist_len]
-                backoff_prob = self.orders[hist_len][hist].backoff_prob
+                backoff_prob = self.lm.get_backoff_prob(hist_len, lm_state)
                 assert backoff_prob != 0.0
                 cost = -math.log(backoff_prob)
                 backoff_hist = hist[1:]
-                backoff_state = self.GetStateForHist(hist_to_state, backoff_hist)
+                backoff_state = self.GetStateForHist(state_map, backoff_hist)
                 # note: we only print the disambig symbol on the input side.
                 if args.verbose >= 3 and abs(cost) < 0.001:
                     print("{0}: very low backoff cost {1} for history {2}, state = {3}".format(
-                        sys.argv[0], cost, str(hist), state), file = sys.stderr)
+                        sys.argv[0], cost, str(tuple([ words[x] for x in hist ])), state),
+                          file = sys.stderr)
 
                 # For hist-states that completely back off (they have no words coming out of them),
                 # there is no need to disambiguate, we can print an epsilon that will later be removed.
-                this_disambig_symbol = disambig_symbol if len(hist_state.word_to_prob) != 0 else '<eps>'
+                this_disambig_symbol = disambig_symbol if len(entries) != 0 else '<eps>'
                 print("%d %d %s <eps> %.3f" %
                       (state, backoff_state, this_disambig_symbol, cost))
         if args.verbose >= 1:
-            for hist_len in range(1, len(self.orders)):
+            for hist_len in range(1, self.lm.max_order):
                 num_states = normalization_stats[hist_len][0]
                 avg_prob_sum = normalization_stats[hist_len][1] / num_states if num_states > 0 else 0.0
                 print("{0}: for {1}-gram states, over {2} states the average sum of "
@@ -386,7 +379,9 @@ def ReadBigramMap(bigrams_file):
     return ans
 
 arpa_model = ArpaModel()
-arpa_model.Read(args.arpa_in)
+arpa_model.Read(args.arpa_in,
+                cache_dir = (args.binary_lm_cache_dir
+                             if args.binary_lm_cache_dir != '' else None))
 bigrams_map = ReadBigramMap(args.allowed_bigrams_in)
 if len(args.disambig_symbol.split()) != 1:
     sys.exit("{0}: invalid option --disambig-symbol={1}".format(
@@ -7,7 +7,9 @@ from __future__ import print_function
 import sys
 import argparse
 import math
-from collections import defaultdict
+
+sys.path.insert(0, 'steps')
+import libs.ngram_counts as ngram_counts_lib
 
 # note, this was originally based
 
@@ -65,31 +67,20 @@ if args.verbose >= 1:
 
 
 
-class CountsForHistory:
+class CountsForHistory(ngram_counts_lib.HistoryState):
     ## This class (which is more like a struct) stores the counts seen in a
     ## particular history-state.  It is used inside class NgramCounts.
-    ## It really does the job of a dict from int to float, but it also
-    ## keeps track of the total count.
-    def __init__(self):
-        # The 'lambda: defaultdict(float)' is an anonymous function taking no
-        # arguments that returns a new defaultdict(float).
-        self.word_to_count = defaultdict(int)
-        self.total_count = 0
+    ## It is a dict from int to int (see HistoryState in
+    ## steps/libs/ngram_counts.py), but it also keeps track of the total count.
+    ## The empty __slots__ keeps its instances as small as a dict.
+    __slots__ = []
 
     def Words(self):
-        return self.word_to_count.keys()
-
-    def __str__(self):
-        # e.g. returns ' total=12 3->4 4->6 -1->2'
-        return ' total={0} {1}'.format(
-            str(self.total_count),
-            ' '.join(['{0} -> {1}'.format(word, count)
-                      for word, count in self.word_to_count.items()]))
+        return self.keys()
 
 
     ## Adds a certain count (expected to be integer, but might be negative).  If
-    ## the resulting count for this word is zero, removes the dict entry from
-    ## word_to_count.
+    ## the resulting count for this word is zero, removes the dict entry.
     ## [note, though, that in some circumstances we 'add back' zero counts
     ## where the presence of n-grams would be structurally required by the arpa,
     ## specifically if a higher-order history state has a nonzero count,
@@ -98,26 +89,28 @@ class CountsForHistory:
     def AddCount(self, predicted_word, count):
         self.total_count += count
         assert self.total_count >= 0
-        old_count = self.word_to_count[predicted_word]
+        old_count = self[predicted_word]
         new_count = old_count + count
         if new_count < 0:
             print("predicted-word={0}, old-count={1}, count={2}".format(
                     predicted_word, old_count, count))
         assert new_count >= 0
         if new_count == 0:
-            del self.word_to_count[predicted_word]
+            del self[predicted_word]
         else:
-            self.word_to_count[predicted_word] = new_count
+            self[predicted_word] = new_count
 
 class NgramCounts:
     ## A note on data-structure.  Firstly, all words are represented as
     ## integers.  We store n-gram counts as an array, indexed by (history-length
     ## == n-gram order minus one) (note: python calls arrays "lists") of dicts
     ## from histories to counts, where histories are arrays of integers and
-    ## "counts" are dicts from integer to float.  For instance, when
+    ## "counts" are CountsForHistory objects.  For instance, when
     ## accumulating the 4-gram count for the '8' in the sequence '5 6 7 8', we'd
-    ## do as follows: self.counts[3][[5,6,7]][8] += 1.0 where the [3] indexes an
-    ## array, the [[5,6,7]] indexes a dict, and the [8] indexes a dict.
+    ## do as follows: self.counts[3][(5,6,7)].AddCount(8, 1) where the [3]
+    ## indexes an array and the [(5,6,7)] indexes a dict.  The array is the
+    ## 'states' of an NgramCountStore (see steps/libs/ngram_counts.py), which
+    ## also does the counting of the raw n-grams.
     def __init__(self, ngram_order):
         assert ngram_order >= 2
         # Integerized counts will never contain negative numbers, so
@@ -133,45 +126,35 @@ class NgramCounts:
         # the backoff counts in each state.
         self.backoff_symbol = -1
         self.total_num_words = 0  # count includes EOS but not BOS.
-        self.counts = []
-        for n in range(ngram_order):
-            self.counts.append(defaultdict(lambda: CountsForHistory()))
-
-    # adds a raw count (called while processing input data).
-    # Suppose we see the sequence '6 7 8 9' and ngram_order=4, 'history'
-    # would be (6,7,8) and 'predicted_word' would be 9; 'count' would be
-    # 1.
-    def AddCount(self, history, predicted_word, count):
-        self.counts[len(history)][history].AddCount(predicted_word, count)
-
+        self.count_store = ngram_counts_lib.NgramCountStore(
+            ngram_order, state_class = CountsForHistory)
+        self.counts = self.count_store.states
 
     # 'line' is a string containing a sequence of integer word-ids.
-    # This function adds the un-smoothed counts from this line of text.
-    def AddRawCountsFromLine(self, line):
+    # This function returns them as a list of integers.
+    def ParseLine(self, line):
         try:
-            words = [self.bos_symbol] + [ int(x) for x in line.split() ] + [self.eos_symbol]
+            return [ int(x) for x in line.split() ]
         except:
             sys.exit("make_phone_lm.py: bad input line {0} (expected a sequence "
                      "of integers)".format(line))
 
-        for n in range(1, len(words)):
-            predicted_word = words[n]
-            history_start = max(0, n + 1 - args.ngram_order)
-            history = tuple(words[history_start:n])
-            self.AddCount(history, predicted_word, 1)
-            self.total_num_words += 1
-
+    # This function adds the un-smoothed counts from the lines of the standard
+    # input, using the NgramCountStore.
     def AddRawCountsFromStandardInput(self):
-        lines_processed = 0
-        while True:
-            line = sys.stdin.readline()
-            if line == '':
-                break
-            self.AddRawCountsFromLine(line)
-            lines_processed += 1
-        if lines_processed == 0 or args.verbose > 0:
+        lines_processed = [ 0 ]
+        def ReadSentences():
+            while True:
+                line = sys.stdin.readline()
+                if line == '':
+                    break
+                lines_processed[0] += 1
+                yield self.ParseLine(line)
+        self.total_num_words += self.count_store.add_counts_from_sentences(
+            ReadSentences(), self.bos_symbol, self.eos_symbol)
+        if lines_processed[0] == 0 or args.verbose > 0:
             print("make_phone_lm.py: processed {0} lines of input".format(
-                    lines_processed), file = sys.stderr)
+                    lines_processed[0]), file = sys.stderr)
 
 
     # This backs off the counts by subtracting 1 and assigning the subtracted
@@ -224,8 +207,8 @@ class NgramCounts:
                 print(str(hist) + str(counts_for_hist), file = sys.stderr)
                 total += counts_for_hist.total_count
                 total_excluding_backoff += counts_for_hist.total_count
-                if self.backoff_symbol in counts_for_hist.word_to_count:
-                    total_excluding_backoff -= counts_for_hist.word_to_count[self.backoff_symbol]
+                if self.backoff_symbol in counts_for_hist:
+                    total_excluding_backoff -= counts_for_hist[self.backoff_symbol]
         print('total count = {0}, excluding backoff = {1}'.format(
                 total, total_excluding_backoff), file = sys.stderr)
 
@@ -250,16 +233,16 @@ class NgramCounts:
             return None
         counts_for_hist = self.counts[len(hist)][hist]
         total_count = float(counts_for_hist.total_count)
-        if not word in counts_for_hist.word_to_count:
+        if not word in counts_for_hist:
             print("make_phone_lm.py: no prob for {0} -> {1} "
                   "[no such count]".format(hist, word),
                   file = sys.stderr)
             return None
-        prob = float(counts_for_hist.word_to_count[word]) / total_count
+        prob = float(counts_for_hist[word]) / total_count
         if len(hist) > 0 and word != self.backoff_symbol and \
-          self.backoff_symbol in counts_for_hist.word_to_count:
+          self.backoff_symbol in counts_for_hist:
             prob_in_backoff = self.GetProb(hist[1:], word)
-            backoff_prob = float(counts_for_hist.word_to_count[self.backoff_symbol]) / total_count
+            backoff_prob = float(counts_for_hist[self.backoff_symbol]) / total_count
             try:
                 prob += backoff_prob * prob_in_backoff
             except:
@@ -280,8 +263,8 @@ class NgramCounts:
                                 args.ngram_order)):
             num_states_removed = 0
             for hist, counts_for_hist in self.counts[n].items():
-                l = len(counts_for_hist.word_to_count)
-                assert l > 0 and self.backoff_symbol in counts_for_hist.word_to_count
+                l = len(counts_for_hist)
+                assert l > 0 and self.backoff_symbol in counts_for_hist
                 if l == 1 and not hist in protected_histories:  # only the backoff symbol has a count.
                     del self.counts[n][hist]
                     num_states_removed += 1
@@ -315,8 +298,8 @@ class NgramCounts:
                     reduced_hist = reduced_hist[1:]  # shift an element off
                                                      # the history.
                     counts_for_backoff_hist = self.counts[m][reduced_hist]
-                    for word in counts_for_hist.word_to_count.keys():
-                        counts_for_backoff_hist.word_to_count[word] += 0
+                    for word in counts_for_hist.keys():
+                        counts_for_backoff_hist[word] += 0
                 # This loop ensures that if we have an n-gram like (6, 7, 8) -> 9,
                 # then, say, (6, 7) -> 8 and (6) -> 7 exist.  This will be needed
                 # for FST representations of the ARPA LM.
@@ -326,7 +309,7 @@ class NgramCounts:
                     reduced_hist = reduced_hist[:-1]  # pop an element off the
                                                       # history
                     counts_for_backoff_hist = self.counts[m][reduced_hist]
-                    counts_for_backoff_hist.word_to_count[this_word] += 0
+                    counts_for_backoff_hist[this_word] += 0
         if args.verbose >= 1:
             print("make_phone_lm.py: in EnsureStructurallyNeededNgramsExist(), "
                   "added {0} n-grams".format(self.GetNumNgrams() - num_ngrams_initial),
@@ -351,7 +334,7 @@ class NgramCounts:
             # For order 1, make sure the keys are sorted.
             keys = this_order_counts.keys() if n != 1 else sorted(this_order_counts.keys())
             for hist in keys:
-                word_to_count = this_order_counts[hist].word_to_count
+                word_to_count = this_order_counts[hist]
                 this_fst_state = hist_to_state[hist]
 
                 for word in word_to_count.keys():
@@ -392,7 +375,7 @@ class NgramCounts:
                     reduced_hist = reduced_hist[1:]  # shift an element off
                                                      # the history.
 
-                    for word in counts_for_hist.word_to_count.keys():
+                    for word in counts_for_hist.keys():
                         if word != self.backoff_symbol:
                             ans.add(reduced_hist + (word,))
                 # The following statement ensures that if we are in a
@@ -407,10 +390,10 @@ class NgramCounts:
 
     def PruneNgram(self, hist, word):
         counts_for_hist = self.counts[len(hist)][hist]
-        assert word != self.backoff_symbol and word in counts_for_hist.word_to_count
-        count = counts_for_hist.word_to_count[word]
-        del counts_for_hist.word_to_count[word]
-        counts_for_hist.word_to_count[self.backoff_symbol] += count
+        assert word != self.backoff_symbol and word in counts_for_hist
+        count = counts_for_hist[word]
+        del counts_for_hist[word]
+        counts_for_hist[self.backoff_symbol] += count
         # the next call adds the count to the symbol 'word' in the backoff
         # history-state, and also updates its 'total_count'.
         self.counts[len(hist) - 1][hist[1:]].AddCount(word, count)
@@ -544,24 +527,47 @@ class NgramCounts:
 
 
     def GetLikeChangeFromPruningNgram(self, hist, word):
-        counts_for_hist = self.counts[len(hist)][hist]
-        counts_for_backoff_hist = self.counts[len(hist) - 1][hist[1:]]
-        assert word != self.backoff_symbol and word in counts_for_hist.word_to_count
-        count = counts_for_hist.word_to_count[word]
-        discount = counts_for_hist.word_to_count[self.backoff_symbol]
-        backoff_total = counts_for_backoff_hist.total_count
-        # backoff_count is a pseudo-count: it's like the count of 'word' in the
-        # backoff history-state, but adding something to account for further
-        # levels of backoff.
-        try:
-            backoff_count = self.GetProb(hist[1:], word) * backoff_total
-        except:
-            print("problem getting backoff count: hist = {0}, word = {1}".format(hist, word),
-                  file = sys.stderr)
-            sys.exit(1)
-
-        return self.PruningLogprobChange(float(count), float(discount),
-                                         backoff_count, float(backoff_total))
+        return self.GetLikeChangesFromPruningNgrams(hist, [word])[0]
+
+    # This function returns a list containing, for each word in 'words', the
+    # same value as GetLikeChangeFromPruningNgram(hist, word), but the
+    # quantities that only depend on the history-state 'hist' are looked up
+    # only once.  'backoff_prob_cache', if provided, is a dict from
+    # backoff-history to a dict from word to the result of
+    # GetProb(backoff-history, word); it avoids recomputing those (recursive)
+    # probabilities for all the history-states that back off to the same
+    # history-state.  It must not be reused after the counts change.
+    def GetLikeChangesFromPruningNgrams(self, hist, words,
+                                        backoff_prob_cache = None):
+        word_to_count = self.counts[len(hist)][hist]
+        backoff_hist = hist[1:]
+        discount = float(word_to_count[self.backoff_symbol])
+        backoff_total = self.counts[len(hist) - 1][backoff_hist].total_count
+        if backoff_prob_cache is None:
+            backoff_probs = dict()
+        else:
+            backoff_probs = backoff_prob_cache.setdefault(backoff_hist, dict())
+
+        like_changes = []
+        for word in words:
+            assert word != self.backoff_symbol and word in word_to_count
+            # backoff_count is a pseudo-count: it's like the count of 'word' in
+            # the backoff history-state, but adding something to account for
+            # further levels of backoff.
+            try:
+                backoff_prob = backoff_probs.get(word)
+                if backoff_prob is None:
+                    backoff_prob = self.GetProb(backoff_hist, word)
+                    backoff_probs[word] = backoff_prob
+                backoff_count = backoff_prob * backoff_total
+            except:
+                print("problem getting backoff count: hist = {0}, word = {1}".format(hist, word),
+                      file = sys.stderr)
+                sys.exit(1)
+            like_changes.append(self.PruningLogprobChange(
+                float(word_to_count[word]), discount,
+                backoff_count, float(backoff_total)))
+        return like_changes
 
     # note: returns loglike change per word.
     def PruneToIntermediateTarget(self, num_extra_ngrams):
@@ -583,14 +589,21 @@ class NgramCounts:
         # so we can prune the n-grams that made the least-negative
         # likelihood change.
         like_change_and_ngrams = []
+        # The counts don't change while we compute the likelihood changes, so
+        # the probabilities in the backoff history-states can be cached.
+        backoff_prob_cache = dict()
         for n in range(args.no_backoff_ngram_order, args.ngram_order):
             for hist, counts_for_hist in self.counts[n].items():
-                for word, count in counts_for_hist.word_to_count.items():
-                    if word != self.backoff_symbol:
-                        if not hist + (word,) in protected_ngrams:
-                            like_change = self.GetLikeChangeFromPruningNgram(hist, word)
-                            like_change_and_ngrams.append((like_change,) + hist + (word,))
-                            num_candidates_per_order[len(hist)] += 1
+                words = [ word for word in counts_for_hist
+                          if word != self.backoff_symbol and
+                          not hist + (word,) in protected_ngrams ]
+                if len(words) == 0:
+                    continue
+                like_changes = self.GetLikeChangesFromPruningNgrams(
+                    hist, words, backoff_prob_cache)
+                for word, like_change in zip(words, like_changes):
+                    like_change_and_ngrams.append((like_change,) + hist + (word,))
+                num_candidates_per_order[n] += len(words)
 
         like_change_and_ngrams.sort(reverse = True)
 
@@ -707,8 +720,8 @@ class NgramCounts:
             return ans
         else:
             for counts_for_hist in self.counts[hist_len].values():
-                ans += len(counts_for_hist.word_to_count)
-                if self.backoff_symbol in counts_for_hist.word_to_count:
+                ans += len(counts_for_hist)
+                if self.backoff_symbol in counts_for_hist:
                     ans -= 1  # don't count the backoff symbol, it doesn't produce
                               # its own n-gram line.
             return ans
@@ -754,7 +767,7 @@ class NgramCounts:
                     print('-99\t<s>\t{0}'.format('%.5f' % math.log10(backoff_prob)))
 
             for hist in self.counts[hist_len].keys():
-                for word in self.counts[hist_len][hist].word_to_count.keys():
+                for word in self.counts[hist_len][hist].keys():
                     if word != self.backoff_symbol:
                         prob = self.GetProb(hist, word)
                         assert prob != None and prob > 0
@@ -20,9 +20,12 @@
 # and takes into account that data-layout is along frequency axis, 
 # while DCT is done along temporal axis.
 
-from math import *
+from __future__ import print_function
 import sys
 
+sys.path.insert(0, 'steps')
+import libs.common as common_lib
+
 
 from optparse import OptionParser
 
@@ -40,28 +43,7 @@ dim=int(options.dim)
 splice=int(options.splice)
 dct_basis=int(options.dct_basis)
 
-timeContext=2*splice+1
-
-
-#generate the DCT matrix
-M_PI = 3.1415926535897932384626433832795
-M_SQRT2 = 1.4142135623730950488016887
-
-
 #generate sparse DCT matrix
-print '['
-for k in range(dct_basis):
-    for m in range(dim):
-        for n in range(timeContext):
-          if(n==0): 
-              print m*'0 ',
-          else: 
-              print (dim-1)*'0 ',
-          print str(sqrt(2.0/timeContext)*cos(M_PI/timeContext*k*(n+0.5))),
-          if(n==timeContext-1):
-              print (dim-m-1)*'0 ',
-        print
-    print 
-
-print ']'
-
+matrix = common_lib.compute_temporal_dct_matrix(dim, splice, dct_basis)
+common_lib.write_kaldi_matrix_to_handle(sys.stdout, matrix)
+print()
@@ -18,9 +18,12 @@
 # ./gen_hamm_mat.py
 # script generates diagonal matrix with hamming window values
 
-from math import *
+from __future__ import print_function
 import sys
 
+sys.path.insert(0, 'steps')
+import libs.common as common_lib
+
 
 from optparse import OptionParser
 
@@ -38,20 +41,6 @@ splice=int(options.splice)
 
 
 #generate the diagonal matrix with hammings
-M_2PI = 6.283185307179586476925286766559005
-
-dim_mat=(2*splice+1)*dim
-timeContext=2*splice+1
-print '['
-for row in range(dim_mat):
-    for col in range(dim_mat):
-        if col!=row:
-            print '0',
-        else:
-            i=int(row/dim)
-            print str(0.54 - 0.46*cos((M_2PI * i) / (timeContext-1))),
-    print
-
-print ']'
-
-
+matrix = common_lib.compute_hamming_matrix(dim, splice)
+common_lib.write_kaldi_matrix_to_handle(sys.stdout, matrix)
+print()
@@ -18,7 +18,7 @@
 # ./gen_splice.py
 # generates <splice> Component
 
-from math import *
+from __future__ import print_function
 import sys
 
 
@@ -40,12 +40,7 @@ splice_step=int(options.splice_step)
 
 dim_out=(2*splice+1)*dim_in
 
-print '<splice>', dim_out, dim_in
-print '[',
-
 splice_vec = range(-splice*splice_step, splice*splice_step+1, splice_step)
-for idx in range(len(splice_vec)):
-    print splice_vec[idx],
-
-print ']'
 
+print('<splice>', dim_out, dim_in)
+print('[', ' '.join(str(x) for x in splice_vec), ']')
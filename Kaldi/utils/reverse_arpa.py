@@ -4,11 +4,26 @@
 
 import sys
 import codecs # for UTF-8/unicode
+import argparse
+import heapq
+import tempfile
 
-if len(sys.argv) != 2:
-    print 'usage: reverse_arpa arpa.in'
-    sys.exit()
-arpaname = sys.argv[1]
+parser = argparse.ArgumentParser(usage='reverse_arpa [options] arpa.in',
+                                 description="""
+Reverses the ARPA language model arpa.in (the reversed model is written to the
+standard output).  By default all the n-grams are held in memory; for large
+language models, use --max-memory, which reverses the model with external
+sorting on disk, one n-gram order at a time.""")
+parser.add_argument('--max-memory', type = int, default = 0,
+                    help = 'If > 0, the approximate maximum memory (in MB) to use for '
+                    'n-grams; the n-grams are sorted in runs of this size in '
+                    'temporary files.  The output is the same as without this option.')
+parser.add_argument('--tmp-dir', type = str, default = None,
+                    help = 'Directory for the temporary files of --max-memory '
+                    '(default: the system default)')
+parser.add_argument('arpaname', metavar = 'arpa.in', type = str)
+args = parser.parse_args()
+arpaname = args.arpaname
 
 #\data\
 #ngram 1=4
@@ -30,95 +45,65 @@ arpaname = sys.argv[1]
 #-0.23940	a b </s>
 #\end\
 
-# read language model in ARPA format
-try:
-  file = codecs.open(arpaname, "r", "utf-8")
-except IOError:
-  print 'file not found: ' + arpaname
-  sys.exit()
-
-text=file.readline()
-while (text and text[:6] != "\\data\\"): text=file.readline()
-if not text:
-  print "invalid ARPA file"
-  sys.exit()
-#print text,
-while (text and text[:5] != "ngram"): text=file.readline()
-
-# get ngram counts
-cngrams=[]
-n=0
-while (text and text[:5] == "ngram"):
-  ind = text.split("=")
-  counts = int(ind[1].strip())
-  r = ind[0].split()
-  read_n = int(r[1].strip())
-  if read_n != n+1:
-    print "invalid ARPA file:", text
+# reads the header of the ARPA file; returns the list of the ngram counts,
+# and a generator of the n-grams as (n, words, prob, back)
+def ReadArpa(file):
+  text=file.readline()
+  while (text and text[:6] != "\\data\\"): text=file.readline()
+  if not text:
+    print "invalid ARPA file"
     sys.exit()
-  n = read_n
-  cngrams.append(counts)
   #print text,
-  text=file.readline()
+  while (text and text[:5] != "ngram"): text=file.readline()
+
+  # get ngram counts
+  cngrams=[]
+  n=0
+  while (text and text[:5] == "ngram"):
+    ind = text.split("=")
+    counts = int(ind[1].strip())
+    r = ind[0].split()
+    read_n = int(r[1].strip())
+    if read_n != n+1:
+      print "invalid ARPA file:", text
+      sys.exit()
+    n = read_n
+    cngrams.append(counts)
+    #print text,
+    text=file.readline()
+  return (cngrams, ReadNgrams(file, cngrams, text))
 
 # read all n-grams order by order
-sentprob = 0.0 # sentence begin unigram
-ngrams=[]
-inf=float("inf")
-for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
-  while (text and "-grams:" not in text): text=file.readline()
-  if n != int(text[1]):
-    print "invalid ARPA file:", text
-    sys.exit()
-  #print text,cngrams[n-1]
-  this_ngrams={} # stores all read ngrams
-  for ng in range(cngrams[n-1]):
-    while (text and len(text.split())<2):
+def ReadNgrams(file, cngrams, text):
+  for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
+    while (text and "-grams:" not in text): text=file.readline()
+    if n != int(text[1]):
+      print "invalid ARPA file:", text
+      sys.exit()
+    #print text,cngrams[n-1]
+    for ng in range(cngrams[n-1]):
+      while (text and len(text.split())<2):
+        text=file.readline()
+        if (not text) or ((len(text.split())==1) and (("-grams:" in text) or (text[:5] == "\\end\\"))): break
+      if (not text) or ((len(text.split())==1) and (("-grams:" in text) or (text[:5] == "\\end\\"))):
+        break # to deal with incorrect ARPA files
+      entry = text.split()
+      prob = float(entry[0])
+      if len(entry)>n+1:
+        back = float(entry[-1])
+        words = entry[1:n+1]
+      else:
+        back = 0.0
+        words = entry[1:]
+      yield (n, words, prob, back)
       text=file.readline()
       if (not text) or ((len(text.split())==1) and (("-grams:" in text) or (text[:5] == "\\end\\"))): break
-    if (not text) or ((len(text.split())==1) and (("-grams:" in text) or (text[:5] == "\\end\\"))):
-      break # to deal with incorrect ARPA files
-    entry = text.split()
-    prob = float(entry[0])
-    if len(entry)>n+1:
-      back = float(entry[-1])
-      words = entry[1:n+1]
-    else:
-      back = 0.0
-      words = entry[1:]
-    ngram = " ".join(words)
-    if (n==1) and words[0]=="<s>":
-      sentprob = prob
-      prob = 0.0
-    this_ngrams[ngram] = (prob,back)
-    #print prob,ngram.encode("utf-8"),back
-
-    for x in range(n-1,0,-1):
-      # add all missing backoff ngrams for reversed lm
-      l_ngram = " ".join(words[:x]) # shortened ngram
-      r_ngram = " ".join(words[1:1+x]) # shortened ngram with offset one
-      if l_ngram not in ngrams[x-1]: # create missing ngram
-        ngrams[x-1][l_ngram] = (0.0,inf)
-        #print ngram, "create 0.0", l_ngram, "inf"
-      if r_ngram not in ngrams[x-1]: # create missing ngram
-        ngrams[x-1][r_ngram] = (0.0,inf)
-        #print ngram, "create 0.0", r_ngram, "inf",x,n,h_ngram
-
-      # add all missing backoff ngrams for forward lm
-      h_ngram = " ".join(words[n-x:]) # shortened history
-      if h_ngram not in ngrams[x-1]: # create missing ngram
-        ngrams[x-1][h_ngram] = (0.0,inf)
-        #print "create inf", h_ngram, "0.0"
-    text=file.readline()
-    if (not text) or ((len(text.split())==1) and (("-grams:" in text) or (text[:5] == "\\end\\"))): break
-  ngrams.append(this_ngrams)
 
-while (text and text[:5] != "\\end\\"): text=file.readline()
-if not text:
-  print "invalid ARPA file"
-  sys.exit()
-file.close()
-#print text,
+  while (text and text[:5] != "\\end\\"): text=file.readline()
+  if not text:
+    print "invalid ARPA file"
+    sys.exit()
+  #print text,
 
 #fourgram "maxent" model (b(ABCD)=0):
 #p(A)+b(A) A 0
@@ -132,6 +117,313 @@ file.close()
 #p(ABC)+b(ABC)-p(BC)+p(AB)-p(B)+p(A) CBA 0
 #p(ABCD)+b(ABCD)-p(BCD)+p(ABC)-p(BC)+p(AB)-p(B)+p(A) DCBA 0
 
+# prints one n-gram of the reversed model; 'words' are the words of the
+# forward n-gram, 'prob' is (prob, backoff) of the forward n-gram (backoff is
+# inf for newly created n-grams), and l_probs and r_probs are the lists of the
+# probs of the forward n-grams words[:x] and words[1:1+x], for x = 1 .. n-1.
+# 'offset' is the reversed weight of <s>; returns its new value.
+def PrintReversedNgram(n, words, prob, l_probs, r_probs, offset):
+  # reverse word order
+  rstr = " ".join(reversed(words))
+  # swap <s> and </s>
+  rev_ngram = rstr.replace("<s>","<temp>").replace("</s>","<s>").replace("<temp>","</s>")
+
+  revprob = prob[0]
+  if (prob[1] != inf): # only backoff weights from not newly created ngrams
+    revprob = revprob + prob[1]
+  #print prob[0],prob[1]
+  # sum all missing terms in decreasing ngram order
+  for x in range(n-1,0,-1):
+    p_l = l_probs[x-1]
+    #print p_l,l_ngram
+    revprob = revprob + p_l
+
+    p_r = r_probs[x-1]
+    #print -p_r,r_ngram
+    revprob = revprob - p_r
+
+  if n != len(cngrams): #not highest order
+    back = 0.0
+    if rev_ngram[:3] == "<s>": # special handling since arpa2fst ignores <s> weight
+      if n == 1:
+        offset = revprob # remember <s> weight
+        revprob = sentprob # apply <s> weight from forward model
+        back = offset
+      elif n == 2:
+        revprob = revprob + offset # add <s> weight to bigrams starting with <s>
+    if (prob[1] != inf): # only backoff weights from not newly created ngrams
+      print revprob,Encode(rev_ngram),back
+    else:
+      print revprob,Encode(rev_ngram),"-100000.0"
+  else: # highest order - no backoff weights
+    if (n==2) and (rev_ngram[:3] == "<s>"): revprob = revprob + offset
+    print revprob,Encode(rev_ngram)
+  return offset
+
+
+# This class sorts lines (byte strings ending in newline) with bounded memory:
+# the lines are collected until their approximate size in memory reaches
+# max_bytes, and then sorted and written to a temporary file (a 'run'); the
+# sorted lines are read by merging the runs.
+class ExternalSorter:
+  # the approximate memory used by a line besides its characters.
+  line_overhead = 48
+  # the maximum number of runs that are merged at once.
+  max_runs = 64
+
+  def __init__(self, max_bytes, tmp_dir):
+    self.max_bytes = max_bytes
+    self.tmp_dir = tmp_dir
+    self.lines = []
+    self.size = 0
+    self.runs = [] # temporary files
+
+  def Add(self, line):
+    self.lines.append(line)
+    self.size += len(line) + self.line_overhead
+    if self.size >= self.max_bytes:
+      self.lines.sort()
+      self.WriteRun(self.lines)
+
+  def WriteRun(self, sorted_lines):
+    run = tempfile.TemporaryFile(dir=self.tmp_dir)
+    run.writelines(sorted_lines)
+    run.seek(0)
+    self.runs.append(run)
+    self.lines = []
+    self.size = 0
+
+  # returns an iterator over the sorted lines.
+  def SortedLines(self):
+    self.lines.sort()
+    if len(self.runs) == 0:
+      lines = self.lines
+      self.lines = []
+      return iter(lines)
+    if len(self.lines) > 0:
+      self.WriteRun(self.lines)
+    while len(self.runs) > self.max_runs:
+      runs = self.runs[:self.max_runs]
+      self.runs = self.runs[self.max_runs:]
+      self.WriteRun(heapq.merge(*runs))
+      for run in runs: run.close()
+    return heapq.merge(*self.runs)
+
+def Encode(ngram):
+  return ngram.encode("utf-8") if isinstance(ngram, unicode) else ngram
+
+# splits a line 'key\tfield1\tfield2...\n' into [ key, field1, field2, ... ]
+def SplitLine(line):
+  return line[:-1].split("\t")
+
+# This class looks up keys in 'lines', an iterator over sorted lines
+# 'key\tvalue\n', in one pass: the keys must be looked up in sorted order.
+class SortedLookup:
+  def __init__(self, lines):
+    self.lines = lines
+    self.cur = None # [ key, value ]
+    self.Next()
+
+  def Next(self):
+    line = next(self.lines, None)
+    self.cur = line[:-1].split("\t", 1) if line is not None else None
+
+  # returns the value for 'key', or None if there is no such line.
+  def Find(self, key):
+    while self.cur is not None and self.cur[0] < key:
+      self.Next()
+    if self.cur is not None and self.cur[0] == key:
+      return self.cur[1]
+    return None
+
+
+# This reverses the ARPA model in 'file' with bounded memory.  The n-grams are
+# kept on disk in temporary files sorted by n-gram (which is the order in
+# which they are printed).
+#  (1) While reading the ARPA file, the n-grams of each order, and the shorter
+#      n-grams they require [those that the in-memory version creates when
+#      missing], are added to an ExternalSorter per order.  Each n-gram
+#      requires its prefix and suffix of length n-1; they are flagged with
+#      whether their own prefix (1) and/or suffix (2) are required, which
+#      gives all the n-grams that the in-memory version would create.
+#  (2) From the highest order down, the sorted lines of each order are merged
+#      into a table of n-grams, 'key\tprob\tback', and the required n-grams
+#      of the next lower order are added to its sorter.
+#  (3) From the lowest order up, each order is printed; this needs the probs
+#      of the prefixes of words[:n-1] and of words[1:], which are looked up in
+#      the table of the 'prefix probs' of the order n-1, 'key\tp(w1) p(w1 w2)...',
+#      in merge passes, the latter after sorting by words[1:].  The prefix
+#      probs of order n are written while printing it.
+def ReverseArpaWithExternalSort(file, max_bytes, tmp_dir):
+  global cngrams, sentprob
+  (cngrams, ngram_reader) = ReadArpa(file)
+  num_orders = len(cngrams)
+
+  # (1)
+  sorters = [ ExternalSorter(max_bytes / max(num_orders, 1), tmp_dir)
+              for n in range(num_orders) ]
+  seq = 0
+  for (n, words, prob, back) in ngram_reader:
+    if (n==1) and words[0]=="<s>":
+      sentprob = prob
+      prob = 0.0
+    key = " ".join(words).encode("utf-8")
+    # the sequence number makes the last of any duplicate n-grams win, as in
+    # the in-memory version.
+    sorters[n-1].Add("%s\t1\t%012d\t%r\t%r\n" % (key, seq, prob, back))
+    seq += 1
+    if n > 1:
+      sorters[n-2].Add("%s\t0\t1\n" % " ".join(words[:-1]).encode("utf-8"))
+      sorters[n-2].Add("%s\t0\t3\n" % " ".join(words[1:]).encode("utf-8"))
+  file.close()
+
+  # (2)
+  tables = [ None ] * num_orders
+  for n in range(num_orders,0,-1):
+    table = tempfile.TemporaryFile(dir=tmp_dir)
+    num_ngrams = 0
+    cur_key = None
+    for line in sorters[n-1].SortedLines():
+      fields = SplitLine(line)
+      if fields[0] != cur_key:
+        if cur_key is not None:
+          WriteTableLine(table, sorters, n, cur_key, cur_value, flags)
+          num_ngrams += 1
+        cur_key = fields[0]
+        cur_value = "0.0\tinf"
+        flags = 0
+      if fields[1] == "0":
+        flags |= int(fields[2])
+      else:
+        cur_value = fields[3] + "\t" + fields[4]
+    if cur_key is not None:
+      WriteTableLine(table, sorters, n, cur_key, cur_value, flags)
+      num_ngrams += 1
+    sorters[n-1] = None
+    table.seek(0)
+    tables[n-1] = (table, num_ngrams)
+
+  # (3)
+  print "\\data\\"
+  for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
+    print "ngram "+str(n)+"="+str(tables[n-1][1])
+  offset = 0.0
+  prefix_probs = None
+  for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
+    print "\\"+str(n)+"-grams:"
+    table = tables[n-1][0]
+    if n > 1:
+      r_lookup = SortedLookup(GetSuffixPrefixProbs(table, prefix_probs,
+                                                   max_bytes, tmp_dir))
+      table.seek(0)
+      prefix_probs.seek(0)
+      l_lookup = SortedLookup(prefix_probs)
+    new_prefix_probs = tempfile.TemporaryFile(dir=tmp_dir)
+    for line in table:
+      [ key, prob, back ] = SplitLine(line)
+      prob = (float(prob), float(back))
+      words = key.split(" ")
+      l_probs = []
+      r_probs = []
+      prefix_probs_str = ""
+      if n > 1:
+        l_ngram = " ".join(words[:-1])
+        prefix_probs_str = l_lookup.Find(l_ngram)
+        if prefix_probs_str is None:
+          sys.stderr.write(key+": not found "+l_ngram+"\n")
+          sys.exit(1)
+        l_probs = map(float, prefix_probs_str.split(" "))
+        r_probs = map(float, r_lookup.Find(key).split(" "))
+        prefix_probs_str += " "
+      new_prefix_probs.write("%s\t%s%r\n" % (key, prefix_probs_str, prob[0]))
+      offset = PrintReversedNgram(n, words, prob, l_probs, r_probs, offset)
+    table.close()
+    if prefix_probs is not None:
+      prefix_probs.close()
+    new_prefix_probs.seek(0)
+    prefix_probs = new_prefix_probs
+  print "\\end\\"
+
+# writes a line of the table of n-grams for (2), and adds the n-grams
+# required by it to the sorter of the next lower order.
+def WriteTableLine(table, sorters, n, key, value, flags):
+  table.write("%s\t%s\n" % (key, value))
+  if n > 1:
+    words = key.split(" ")
+    if flags & 1: # its prefix is required
+      sorters[n-2].Add("%s\t0\t1\n" % " ".join(words[:-1]))
+    if flags & 2: # its suffix is required
+      sorters[n-2].Add("%s\t0\t2\n" % " ".join(words[1:]))
+
+# returns an iterator over lines 'key\tprefix-probs' for the n-grams in
+# 'table', where the prefix-probs are those of words[1:] of the n-gram, looked
+# up in 'prefix_probs' (the table of prefix-probs of the next lower order).
+def GetSuffixPrefixProbs(table, prefix_probs, max_bytes, tmp_dir):
+  by_suffix = ExternalSorter(max_bytes / 2, tmp_dir)
+  for line in table:
+    key = line[:line.index("\t")]
+    by_suffix.Add("%s\t%s\n" % (key[key.index(" ")+1:], key))
+  prefix_probs.seek(0)
+  lookup = SortedLookup(prefix_probs)
+  by_key = ExternalSorter(max_bytes / 2, tmp_dir)
+  for line in by_suffix.SortedLines():
+    [ r_ngram, key ] = SplitLine(line)
+    r_probs = lookup.Find(r_ngram)
+    if r_probs is None:
+      sys.stderr.write(key+": not found "+r_ngram+"\n")
+      sys.exit(1)
+    by_key.Add("%s\t%s\n" % (key, r_probs))
+  return by_key.SortedLines()
+
+
+inf=float("inf")
+sentprob = 0.0 # sentence begin unigram
+
+# read language model in ARPA format
+try:
+  file = codecs.open(arpaname, "r", "utf-8")
+except IOError:
+  print 'file not found: ' + arpaname
+  sys.exit()
+
+if args.max_memory > 0:
+  ReverseArpaWithExternalSort(file, args.max_memory * 1024 * 1024, args.tmp_dir)
+  sys.exit()
+
+# read all n-grams order by order
+(cngrams, ngram_reader) = ReadArpa(file)
+ngrams=[]
+for (n, words, prob, back) in ngram_reader:
+  while len(ngrams) < n:
+    ngrams.append({}) # stores all read ngrams
+  this_ngrams = ngrams[n-1]
+  ngram = " ".join(words)
+  if (n==1) and words[0]=="<s>":
+    sentprob = prob
+    prob = 0.0
+  this_ngrams[ngram] = (prob,back)
+  #print prob,ngram.encode("utf-8"),back
+
+  for x in range(n-1,0,-1):
+    # add all missing backoff ngrams for reversed lm
+    l_ngram = " ".join(words[:x]) # shortened ngram
+    r_ngram = " ".join(words[1:1+x]) # shortened ngram with offset one
+    if l_ngram not in ngrams[x-1]: # create missing ngram
+      ngrams[x-1][l_ngram] = (0.0,inf)
+      #print ngram, "create 0.0", l_ngram, "inf"
+    if r_ngram not in ngrams[x-1]: # create missing ngram
+      ngrams[x-1][r_ngram] = (0.0,inf)
+      #print ngram, "create 0.0", r_ngram, "inf",x,n,h_ngram
+
+    # add all missing backoff ngrams for forward lm
+    h_ngram = " ".join(words[n-x:]) # shortened history
+    if h_ngram not in ngrams[x-1]: # create missing ngram
+      ngrams[x-1][h_ngram] = (0.0,inf)
+      #print "create inf", h_ngram, "0.0"
+while len(ngrams) < len(cngrams):
+  ngrams.append({})
+file.close()
+
 # compute new reversed ARPA model
 print "\\data\\"
 for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
@@ -143,46 +435,18 @@ for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
   keys.sort()
   for ngram in keys:
     prob = ngrams[n-1][ngram]
-    # reverse word order
     words = ngram.split()
-    rstr = " ".join(reversed(words))
-    # swap <s> and </s>
-    rev_ngram = rstr.replace("<s>","<temp>").replace("</s>","<s>").replace("<temp>","</s>")
-
-    revprob = prob[0]
-    if (prob[1] != inf): # only backoff weights from not newly created ngrams
-      revprob = revprob + prob[1]
-    #print prob[0],prob[1]
-    # sum all missing terms in decreasing ngram order
-    for x in range(n-1,0,-1): 
+    l_probs = []
+    r_probs = []
+    for x in range(1,n):
       l_ngram = " ".join(words[:x]) # shortened ngram
       if l_ngram not in ngrams[x-1]:
-        sys.stderr.write(rev_ngram+": not found "+l_ngram+"\n")
-      p_l = ngrams[x-1][l_ngram][0]
-      #print p_l,l_ngram
-      revprob = revprob + p_l
+        sys.stderr.write(ngram.encode("utf-8")+": not found "+l_ngram.encode("utf-8")+"\n")
+      l_probs.append(ngrams[x-1][l_ngram][0])
 
       r_ngram = " ".join(words[1:1+x]) # shortened ngram with offset one
       if r_ngram not in ngrams[x-1]:
-        sys.stderr.write(rev_ngram+": not found "+r_ngram+"\n")
-      p_r = ngrams[x-1][r_ngram][0]
-      #print -p_r,r_ngram
-      revprob = revprob - p_r
-
-    if n != len(cngrams): #not highest order
-      back = 0.0
-      if rev_ngram[:3] == "<s>": # special handling since arpa2fst ignores <s> weight
-        if n == 1:
-          offset = revprob # remember <s> weight
-          revprob = sentprob # apply <s> weight from forward model
-          back = offset
-        elif n == 2:
-          revprob = revprob + offset # add <s> weight to bigrams starting with <s>
-      if (prob[1] != inf): # only backoff weights from not newly created ngrams
-        print revprob,rev_ngram.encode("utf-8"),back
-      else:
-        print revprob,rev_ngram.encode("utf-8"),"-100000.0"
-    else: # highest order - no backoff weights
-      if (n==2) and (rev_ngram[:3] == "<s>"): revprob = revprob + offset
-      print revprob,rev_ngram.encode("utf-8")
+        sys.stderr.write(ngram.encode("utf-8")+": not found "+r_ngram.encode("utf-8")+"\n")
+      r_probs.append(ngrams[x-1][r_ngram][0])
+    offset = PrintReversedNgram(n, words, prob, l_probs, r_probs, offset)
 print "\\end\\"
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# Apache 2.0.
+
+from __future__ import print_function
+import sys
+import argparse
+import io
+import logging
+import os
+
+sys.path.insert(0, 'steps')
+import libs.scoring as scoring_lib
+import libs.data_dir as data_dir_lib
+
+parser = argparse.ArgumentParser(description="""
+This script computes the WER of hypotheses against a reference text and
+prints it like compute-wer --text does.  It can also write the alignments
+like align-text, the detailed statistics that utils/scoring/wer_per_utt_details.pl,
+wer_per_spk_details.pl and wer_ops_details.pl compute from them (the files
+per_utt, per_spk and ops of --details-dir, as in steps/scoring/score_kaldi_wer.sh),
+and, for hypotheses in per-utterance CTM format, the ctm-edits of
+steps/cleanup/internal/get_ctm_edits.py.  The utterances are aligned in
+vectorized batches, in --num-jobs processes; see steps/libs/scoring.py.
+It has to be run from the top-level (e.g. egs/.../s5) directory, as the
+scripts are.
+e.g.: utils/scoring/compute_wer.py --mode=present data/test/text exp/tri3/decode/scoring_kaldi/penalty_0.0/10.txt
+      utils/scoring/compute_wer.py --special-symbol='***' --utt2spk=data/test/utt2spk \\
+        --details-dir=exp/tri3/decode/scoring_kaldi/wer_details data/test/text 10.txt
+""")
+
+parser.add_argument('--mode', type = str, default = 'strict',
+                    choices = ['present', 'all', 'strict'],
+                    help = "As for compute-wer: 'present' scores only the "
+                    "utterances that have a hypothesis, 'all' scores the "
+                    "others as empty, and 'strict' fails if any is missing.")
+parser.add_argument('--num-jobs', type = int, default = 1,
+                    help = 'Number of processes that align the utterances.')
+parser.add_argument('--hyp-format', type = str, default = 'text',
+                    choices = ['text', 'ctm'],
+                    help = 'Format of the hypotheses; with ctm, the words '
+                    'whose word is --eps-symbol (the silences) are not '
+                    'scored.')
+parser.add_argument('--special-symbol', type = str, default = '<eps>',
+                    help = 'Symbol for the missing words in the alignments '
+                    'and the details, as for align-text.')
+parser.add_argument('--utt2spk', type = str, default = None,
+                    help = 'The utt2spk file, needed for the per_spk file of '
+                    '--details-dir.')
+parser.add_argument('--details-dir', type = str, default = None,
+                    help = 'If set, the directory to which the files per_utt, '
+                    'ops and (with --utt2spk) per_spk are written.')
+parser.add_argument('--alignment', type = str, default = None,
+                    help = 'If set, the file to which the alignments are '
+                    'written, in the format of align-text.')
+parser.add_argument('--ctm-edits', type = str, default = None,
+                    help = 'If set, the file to which the ctm-edits are '
+                    'written; requires --hyp-format=ctm.')
+parser.add_argument('--eps-symbol', type = str, default = '<eps>',
+                    help = 'The silence word of the CTM and the ctm-edits.')
+parser.add_argument('--oov', type = str, default = None,
+                    help = 'The OOV word; in the ctm-edits, its substitutions '
+                    'for words that are not in --symbol-table count as '
+                    'correct.')
+parser.add_argument('--symbol-table', type = str, default = None,
+                    help = 'The words.txt of the system, used with --oov.')
+parser.add_argument('ref', type = str, help = 'The reference text.')
+parser.add_argument('hyp', type = str,
+                    help = "The hypotheses, or '-' for the standard input.")
+
+args = parser.parse_args()
+
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    "{0}: %(message)s".format(sys.argv[0])))
+scoring_lib.logger.addHandler(handler)
+scoring_lib.logger.setLevel(logging.INFO)
+
+if args.ctm_edits is not None and args.hyp_format != 'ctm':
+    sys.exit("{0}: --ctm-edits requires --hyp-format=ctm".format(sys.argv[0]))
+
+
+def write_lines(filename, lines):
+    with io.open(filename, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(line + u'\n')
+
+
+try:
+    ref_index = scoring_lib.ReferenceIndex(scoring_lib.read_text(args.ref))
+    if args.hyp_format == 'ctm':
+        utt2ctm = dict(scoring_lib.read_ctm(args.hyp))
+        hyp_items = [(utt, [x[2] for x in ctm_array
+                            if x[2] != args.eps_symbol])
+                     for (utt, ctm_array) in utt2ctm.items()]
+    else:
+        hyp_items = scoring_lib.read_text(args.hyp)
+    result = ref_index.score(hyp_items, mode = args.mode,
+                             num_jobs = args.num_jobs)
+except Exception as e:
+    sys.exit("{0}: {1}".format(sys.argv[0], str(e)))
+
+sys.stdout.write(result.summary())
+sys.stdout.flush()
+
+try:
+    if args.alignment is not None:
+        write_lines(args.alignment,
+                    result.alignment_lines(args.special_symbol))
+    if args.details_dir is not None:
+        if not os.path.isdir(args.details_dir):
+            os.makedirs(args.details_dir)
+        write_lines(os.path.join(args.details_dir, 'per_utt'),
+                    result.per_utt_lines(args.special_symbol))
+        if args.utt2spk is not None:
+            utt2spk = data_dir_lib.TableFile(args.utt2spk).to_dict(
+                num_fields = 2)
+            write_lines(os.path.join(args.details_dir, 'per_spk'),
+                        result.per_spk_lines(utt2spk))
+        write_lines(os.path.join(args.details_dir, 'ops'),
+                    result.ops_lines(args.special_symbol))
+    if args.ctm_edits is not None:
+        symbol_table = {}
+        if args.symbol_table is not None:
+            symbol_table = data_dir_lib.TableFile(args.symbol_table).to_dict()
+        with io.open(args.ctm_edits, 'w', encoding='utf-8') as f:
+            for i in range(len(result.utts)):
+                utt = result.utts[i]
+                ctm_edits = result.ctm_edits(
+                    i, utt2ctm.get(utt, []), eps_symbol = args.eps_symbol,
+                    oov_word = args.oov, symbol_table = symbol_table)
+                for line in ctm_edits:
+                    f.write(u' '.join([u'{0}'.format(x)
+                                       for x in [utt, '1'] + line]) + u'\n')
+except Exception as e:
+    sys.exit("{0}: error writing the details: {1}".format(sys.argv[0],
+                                                          str(e)))